@@ -340,6 +340,11 @@ def build_parser():
                         help='N-best for MBR training')
     parser.add_argument('--mbr_softmax_smoothing', type=float, default=0.8,
                         help='softmax smoothing (beta) for MBR training')
+    parser.add_argument('--mbr_nbest_type', type=str, default='beam',
+                        choices=['beam', 'sampling'],
+                        help='how to generate N-best lists for MBR training')
+    parser.add_argument('--mbr_eval_interval', type=float, default=0.1,
+                        help='interval (in epochs) of evaluation during MBR training (0 disables it)')
     # TransformerXL
     parser.add_argument('--bptt', type=int, default=0,
                         help='number of tokens to truncate in TransformerXL decoder during training')
@@ -360,6 +365,12 @@ def build_parser():
                         help='print to standard output during evaluation')
     parser.add_argument('--recog_n_gpus', type=int, default=0,
                         help='number of GPUs (0 indicates CPU)')
+    parser.add_argument('--recog_n_jobs', type=int, default=1,
+                        help='number of processes for sharded decoding on CPU')
+    parser.add_argument('--recog_encoder_cache', type=strtobool, default=False,
+                        help='cache encoder outputs and CTC posteriors per utterance to reuse them across decoding runs')
+    parser.add_argument('--recog_encoder_cache_fp16', type=strtobool, default=False,
+                        help='save the encoder cache in half precision')
     parser.add_argument('--recog_sets', type=str, default=[], nargs='+',
                         help='tsv file paths for the evaluation sets')
     parser.add_argument('--recog_first_n_utt', type=int, default=-1,
@@ -382,6 +393,8 @@ def build_parser():
                         help='size of mini-batch in evaluation')
     parser.add_argument('--recog_beam_width', type=int, default=1,
                         help='size of beam')
+    parser.add_argument('--recog_nbest_export', type=strtobool, default=False,
+                        help='save N-best hypotheses with separate score components to nbest.npz for rescoring')
     parser.add_argument('--recog_max_len_ratio', type=float, default=1.0,
                         help='')
     parser.add_argument('--recog_min_len_ratio', type=float, default=0.0,
@@ -407,10 +420,18 @@ def build_parser():
                                   First-pass backward LM in case of synchronous bidirectional decoding.')
     parser.add_argument('--recog_ctc_weight', type=float, default=0.0,
                         help='weight of CTC score')
+    parser.add_argument('--recog_ctc_vocab_threshold', type=float, default=0.0,
+                        help='exclude tokens whose CTC posteriors never exceed this in the utterance '
+                             'from the output layer in joint CTC/attention beam search (0 disables)')
+    parser.add_argument('--recog_ctc_blank_skip_threshold', type=float, default=0.0,
+                        help='skip encoder frames whose CTC blank probability is larger than this '
+                             'before attention decoding (0 disables)')
+    parser.add_argument('--recog_ctc_blank_skip_margin', type=int, default=1,
+                        help='number of context frames kept around non-blank frames for blank skipping')
     parser.add_argument('--recog_lm', type=str, default=False, nargs='?',
-                        help='path to first path LM for shallow fusion')
+                        help='path to first path LM for shallow fusion (n-gram LM if *.arpa or *.arpa.gz)')
     parser.add_argument('--recog_lm_second', type=str, default=False, nargs='?',
-                        help='path to second path LM for rescoring')
+                        help='path to second path LM for rescoring (n-gram LM if *.arpa or *.arpa.gz)')
     parser.add_argument('--recog_lm_bwd', type=str, default=False, nargs='?',
                         help='path to second path LM in the reverse direction for rescoring')
     parser.add_argument('--recog_resolving_unk', type=strtobool, default=False,
@@ -425,14 +446,30 @@ def build_parser():
                         help='carry over ASR decoder state')
     parser.add_argument('--recog_lm_state_carry_over', type=strtobool, default=False,
                         help='carry over LM state')
+    parser.add_argument('--recog_lm_cache_size', type=int, default=0,
+                        help='number of token prefixes to cache LM states for shallow fusion (0 disables caching)')
+    parser.add_argument('--recog_lm_shortlist', type=int, default=0,
+                        help='number of top candidates of the ASR model scored by the LM in shallow fusion '
+                             'without the full output layer (0 disables). '
+                             'RNN and CTC decoders always use the beam width.')
+    parser.add_argument('--recog_lm_shortlist_partition_size', type=int, default=1024,
+                        help='number of the most frequent tokens (and of sampled other tokens) used to '
+                             'estimate the partition function of the LM in shortlist scoring')
     parser.add_argument('--recog_softmax_smoothing', type=float, default=1.0,
                         help='softmax smoothing (beta) for diverse hypothesis generation')
     parser.add_argument('--recog_wordlm', type=strtobool, default=False,
-                        help='')
+                        help='fuse a word-level LM with character/wordpiece ASR by look-ahead scores '
+                             'on a lexicon prefix tree')
     parser.add_argument('--recog_n_average', type=int, default=1,
                         help='number of models for the model averaging of Transformer')
     parser.add_argument('--recog_streaming', type=strtobool, default=False,
                         help='streaming decoding')
+    parser.add_argument('--recog_long_form', type=strtobool, default=False,
+                        help='decode long recordings by CTC-based segmentation and batched segment decoding')
+    parser.add_argument('--recog_long_form_block_size', type=int, default=4000,
+                        help='number of input frames per block to compute CTC posteriors for long-form decoding')
+    parser.add_argument('--recog_long_form_max_segment_frames', type=int, default=3000,
+                        help='maximum number of input frames per segment for long-form decoding (0 means unlimited)')
     parser.add_argument('--recog_chunk_sync', type=strtobool, default=False,
                         help='chunk-synchronous beam search decoding for MoChA')
     parser.add_argument('--recog_ctc_spike_forced_decoding', type=strtobool, default=False,
@@ -449,4 +486,18 @@ def build_parser():
                         help='delay threshold for MMA decoder')
     parser.add_argument('--recog_mem_len', type=int, default=0,
                         help='number of tokens for memory in TransformerXL decoder during evaluation')
+    parser.add_argument('--recog_lm_kv_cache_len', type=int, default=0,
+                        help='number of past tokens attended by TransformerLM during incremental decoding '
+                             '(sliding window, 0 means unbounded)')
+    # recognition server
+    parser.add_argument('--recog_server_host', type=str, default='127.0.0.1',
+                        help='host name of the recognition server')
+    parser.add_argument('--recog_server_port', type=int, default=8080,
+                        help='port number of the recognition server')
+    parser.add_argument('--recog_server_max_batch_size', type=int, default=8,
+                        help='maximum number of requests decoded in a mini-batch')
+    parser.add_argument('--recog_server_max_latency', type=float, default=50,
+                        help='maximum time to wait for other requests to form a mini-batch [ms]')
+    parser.add_argument('--recog_server_cmvn', type=str, default=False, nargs='?',
+                        help='path to global CMVN statistics for waveform requests')
     return parser
@@ -6,7 +6,6 @@
 
 """Evaluate the ASR model."""
 
-import argparse
 import copy
 import logging
 import os
@@ -15,6 +14,8 @@ import time
 
 from neural_sp.bin.args_asr import parse_args_eval
 from neural_sp.bin.eval_utils import average_checkpoints
+from neural_sp.bin.eval_utils import eval_sharded
+from neural_sp.bin.eval_utils import load_lms
 from neural_sp.bin.train_utils import load_checkpoint
 from neural_sp.bin.train_utils import load_config
 from neural_sp.bin.train_utils import set_logger
@@ -26,7 +27,7 @@ from neural_sp.evaluators.ppl import eval_ppl
 from neural_sp.evaluators.word import eval_word
 from neural_sp.evaluators.wordpiece import eval_wordpiece
 from neural_sp.evaluators.wordpiece_bleu import eval_wordpiece_bleu
-from neural_sp.models.lm.build import build_lm
+from neural_sp.models.seq2seq.encoder_cache import EncoderCache
 from neural_sp.models.seq2seq.speech2text import Speech2Text
 
 logger = logging.getLogger(__name__)
@@ -36,6 +37,9 @@ def main():
 
     # Load configuration
     args, recog_params, dir_name = parse_args_eval(sys.argv[1:])
+    if args.recog_long_form and args.recog_nbest_export:
+        raise ValueError('N-best export is not supported in long-form decoding '
+                         'because segments of a recording are decoded separately.')
 
     # Setting for logging
     if os.path.isfile(os.path.join(args.recog_dir, 'decode.log')):
@@ -83,43 +87,7 @@ def main():
 
             # Load the LM for shallow fusion
             if not args.lm_fusion:
-                # first path
-                if args.recog_lm is not None and args.recog_lm_weight > 0:
-                    conf_lm = load_config(os.path.join(os.path.dirname(args.recog_lm), 'conf.yml'))
-                    args_lm = argparse.Namespace()
-                    for k, v in conf_lm.items():
-                        setattr(args_lm, k, v)
-                    args_lm.recog_mem_len = args.recog_mem_len
-                    lm = build_lm(args_lm, wordlm=args.recog_wordlm,
-                                  lm_dict_path=os.path.join(os.path.dirname(args.recog_lm), 'dict.txt'),
-                                  asr_dict_path=os.path.join(dir_name, 'dict.txt'))
-                    load_checkpoint(args.recog_lm, lm)
-                    if args_lm.backward:
-                        model.lm_bwd = lm
-                    else:
-                        model.lm_fwd = lm
-
-                # second path (forward)
-                if args.recog_lm_second is not None and args.recog_lm_second_weight > 0:
-                    conf_lm_second = load_config(os.path.join(os.path.dirname(args.recog_lm_second), 'conf.yml'))
-                    args_lm_second = argparse.Namespace()
-                    for k, v in conf_lm_second.items():
-                        setattr(args_lm_second, k, v)
-                    args_lm_second.recog_mem_len = args.recog_mem_len
-                    lm_second = build_lm(args_lm_second)
-                    load_checkpoint(args.recog_lm_second, lm_second)
-                    model.lm_second = lm_second
-
-                # second path (bakward)
-                if args.recog_lm_bwd is not None and args.recog_lm_bwd_weight > 0:
-                    conf_lm = load_config(os.path.join(os.path.dirname(args.recog_lm_bwd), 'conf.yml'))
-                    args_lm_bwd = argparse.Namespace()
-                    for k, v in conf_lm.items():
-                        setattr(args_lm_bwd, k, v)
-                    args_lm_bwd.recog_mem_len = args.recog_mem_len
-                    lm_bwd = build_lm(args_lm_bwd)
-                    load_checkpoint(args.recog_lm_bwd, lm_bwd)
-                    model.lm_bwd = lm_bwd
+                load_lms(model, args, dir_name)
 
             if not args.recog_unit:
                 args.recog_unit = args.unit
@@ -137,6 +105,9 @@ def main():
             logger.info('coverage penalty: %.3f' % args.recog_coverage_penalty)
             logger.info('coverage threshold: %.3f' % args.recog_coverage_threshold)
             logger.info('CTC weight: %.3f' % args.recog_ctc_weight)
+            logger.info('CTC vocabulary pruning threshold: %.3f' % args.recog_ctc_vocab_threshold)
+            logger.info('CTC blank skipping threshold: %.3f (margin: %d)' %
+                        (args.recog_ctc_blank_skip_threshold, args.recog_ctc_blank_skip_margin))
             logger.info('fist LM path: %s' % args.recog_lm)
             logger.info('second LM path: %s' % args.recog_lm_second)
             logger.info('backward LM path: %s' % args.recog_lm_bwd)
@@ -149,49 +120,62 @@ def main():
             logger.info('ensemble: %d' % (len(ensemble_models)))
             logger.info('ASR decoder state carry over: %s' % (args.recog_asr_state_carry_over))
             logger.info('LM state carry over: %s' % (args.recog_lm_state_carry_over))
+            logger.info('LM state cache size: %d' % (args.recog_lm_cache_size))
             logger.info('model average (Transformer): %d' % (args.recog_n_average))
+            logger.info('#processes: %d' % (args.recog_n_jobs))
+            logger.info('encoder cache: %s' % (args.recog_encoder_cache))
 
             # GPU setting
             if args.recog_n_gpus >= 1:
                 model.cudnn_setting(deterministic=True, benchmark=False)
                 model.cuda()
 
+        if args.recog_encoder_cache:
+            # NOTE: cache is separated per checkpoint and evaluation set
+            checkpoint_name = os.path.basename(args.recog_model[0])
+            if args.recog_n_average > 1:
+                checkpoint_name += '_avg' + str(args.recog_n_average)
+            model.encoder_cache = EncoderCache(
+                os.path.join(dir_name, 'encoder_cache', checkpoint_name, dataloader.set),
+                fp16=args.recog_encoder_cache_fp16)
+
         start_time = time.time()
 
+        elapsed_times_shard = None
         if args.recog_metric == 'edit_distance':
+            kwargs = {'epoch': epoch - 1}
             if args.recog_unit in ['word', 'word_char']:
-                wer, cer, _ = eval_word(ensemble_models, dataloader, recog_params,
-                                        epoch=epoch - 1,
-                                        recog_dir=args.recog_dir,
-                                        progressbar=True)
-                wer_avg += wer
-                cer_avg += cer
+                eval_fn = eval_word
             elif args.recog_unit == 'wp':
-                wer, cer = eval_wordpiece(ensemble_models, dataloader, recog_params,
-                                          epoch=epoch - 1,
-                                          recog_dir=args.recog_dir,
-                                          streaming=args.recog_streaming,
-                                          progressbar=True,
-                                          fine_grained=True)
-                wer_avg += wer
-                cer_avg += cer
+                eval_fn = eval_wordpiece
+                kwargs.update({'streaming': args.recog_streaming, 'fine_grained': True})
             elif 'char' in args.recog_unit:
-                wer, cer = eval_char(ensemble_models, dataloader, recog_params,
-                                     epoch=epoch - 1,
-                                     recog_dir=args.recog_dir,
-                                     progressbar=True,
-                                     task_idx=0)
+                eval_fn = eval_char
+                kwargs.update({'task_idx': 0})
                 #  task_idx=1 if args.recog_unit and 'char' in args.recog_unit else 0)
-                wer_avg += wer
-                cer_avg += cer
             elif 'phone' in args.recog_unit:
-                per = eval_phone(ensemble_models, dataloader, recog_params,
-                                 epoch=epoch - 1,
-                                 recog_dir=args.recog_dir,
-                                 progressbar=True)
-                per_avg += per
+                eval_fn = eval_phone
             else:
                 raise ValueError(args.recog_unit)
+
+            # NOTE: sharded decoding is supported on CPU only
+            if args.recog_n_jobs > 1 and args.recog_n_gpus == 0 and not args.recog_streaming:
+                result, elapsed_times_shard = eval_sharded(
+                    eval_fn, ensemble_models, dataloader, recog_params,
+                    recog_dir=args.recog_dir,
+                    n_jobs=args.recog_n_jobs,
+                    **kwargs)
+            else:
+                result = eval_fn(ensemble_models, dataloader, recog_params,
+                                 recog_dir=args.recog_dir,
+                                 progressbar=True,
+                                 **kwargs)
+
+            if 'phone' in args.recog_unit:
+                per_avg += result
+            else:
+                wer_avg += result[0]
+                cer_avg += result[1]
         elif args.recog_metric in ['ppl', 'loss']:
             ppl, loss = eval_ppl(ensemble_models, dataloader, progressbar=True)
             ppl_avg += ppl
@@ -209,8 +193,19 @@ def main():
         else:
             raise NotImplementedError(args.recog_metric)
         elasped_time = time.time() - start_time
+        for m in model.modules():
+            if getattr(m, 'lm_cache', None) is not None:
+                m.lm_cache.report()
+        if model.encoder_cache is not None and elapsed_times_shard is None:
+            # NOTE: reported by each process in sharded decoding
+            model.encoder_cache.report()
         logger.info('Elasped time: %.3f [sec]' % elasped_time)
         logger.info('RTF: %.3f' % (elasped_time / (dataloader.n_frames * 0.01)))
+        if elapsed_times_shard is not None:
+            # NOTE: RTF above is based on the wall time including process startup and merging
+            logger.info('Elasped time (slowest process): %.3f [sec]' % max(elapsed_times_shard))
+            logger.info('Elasped time (sum over processes): %.3f [sec]' % sum(elapsed_times_shard))
+            logger.info('Speedup: %.2fx' % (sum(elapsed_times_shard) / elasped_time))
 
     if args.recog_metric == 'edit_distance':
         if 'phone' in args.recog_unit:
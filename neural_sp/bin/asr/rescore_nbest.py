@@ -0,0 +1,74 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Grid search of score fusion weights over exported N-best lists."""
+
+import argparse
+import logging
+import sys
+
+from neural_sp.evaluators.nbest import load_nbest
+from neural_sp.evaluators.nbest import rescore_nbest
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args(input_args):
+    parser = argparse.ArgumentParser(
+        description='Scores are not normalized by the hypothesis length (recog_length_norm is ignored). '
+                    'Only components computed in beam search can be given non-zero weights.')
+    parser.add_argument('--nbest', type=str, nargs='+', required=True,
+                        help='paths to nbest.npz saved with --recog_nbest_export')
+    parser.add_argument('--ctc_weight', type=float, nargs='+', default=[0.0],
+                        help='candidates of the CTC weight')
+    parser.add_argument('--lm_weight', type=float, nargs='+', default=[0.0],
+                        help='candidates of the first-pass LM weight')
+    parser.add_argument('--lm_second_weight', type=float, nargs='+', default=[0.0],
+                        help='candidates of the second-pass LM weight')
+    parser.add_argument('--lm_bwd_weight', type=float, nargs='+', default=[0.0],
+                        help='candidates of the second-pass backward LM weight')
+    parser.add_argument('--length_penalty', type=float, nargs='+', default=[0.0],
+                        help='candidates of the length penalty')
+    parser.add_argument('--coverage_penalty', type=float, nargs='+', default=[0.0],
+                        help='candidates of the coverage penalty')
+    parser.add_argument('--metric', type=str, default='wer', choices=['wer', 'cer'],
+                        help='metric for evaluation')
+    parser.add_argument('--remove_space', action='store_true',
+                        help='remove spaces before computing CER (e.g., CSJ)')
+    parser.add_argument('--topk', type=int, default=10,
+                        help='number of the best settings to show')
+    return parser.parse_args(input_args)
+
+
+def main():
+
+    args = parse_args(sys.argv[1:])
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+
+    nbest = load_nbest(args.nbest)
+    logger.info('Loaded %d hypotheses for %d utterances' % (len(nbest['hyps']), len(nbest['utt_ids'])))
+
+    weight_grid = {'ctc_weight': args.ctc_weight,
+                   'lm_weight': args.lm_weight,
+                   'lm_second_weight': args.lm_second_weight,
+                   'lm_bwd_weight': args.lm_bwd_weight,
+                   'length_penalty': args.length_penalty,
+                   'coverage_penalty': args.coverage_penalty}
+    results = rescore_nbest(nbest, weight_grid,
+                            char_level=args.metric == 'cer',
+                            remove_space=args.remove_space)
+
+    for setting, err in results:
+        print('%s: %.2f %%' % (' '.join(['%s=%.3f' % (k, v) for k, v in setting.items()]), err))
+
+    print('-' * 50)
+    print('Best %d settings (%s):' % (min(args.topk, len(results)), args.metric.upper()))
+    for setting, err in sorted(results, key=lambda x: x[1])[:args.topk]:
+        print('%s: %.2f %%' % (' '.join(['%s=%.3f' % (k, v) for k, v in setting.items()]), err))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Serve the ASR model on localhost with dynamic request batching."""
+
+import logging
+import os
+import sys
+
+from neural_sp.bin.args_asr import parse_args_eval
+from neural_sp.bin.eval_utils import average_checkpoints
+from neural_sp.bin.eval_utils import load_lms
+from neural_sp.bin.server_utils import RecognitionServer
+from neural_sp.bin.train_utils import load_checkpoint
+from neural_sp.bin.train_utils import set_logger
+from neural_sp.datasets.token_converter.character import Idx2char
+from neural_sp.datasets.token_converter.phone import Idx2phone
+from neural_sp.datasets.token_converter.word import Idx2word
+from neural_sp.datasets.token_converter.wordpiece import Idx2wp
+from neural_sp.models.seq2seq.frontends.fbank import load_cmvn
+from neural_sp.models.seq2seq.speech2text import Speech2Text
+
+logger = logging.getLogger(__name__)
+
+
+def build_idx2token(args):
+    if args.unit in ['word', 'word_char']:
+        return Idx2word(args.dict)
+    elif args.unit == 'wp':
+        return Idx2wp(args.dict, args.wp_model)
+    elif args.unit in ['char']:
+        return Idx2char(args.dict)
+    elif 'phone' in args.unit:
+        return Idx2phone(args.dict)
+    else:
+        raise ValueError(args.unit)
+
+
+def main():
+
+    # Load configuration
+    args, recog_params, dir_name = parse_args_eval(sys.argv[1:])
+
+    # Setting for logging
+    set_logger(os.path.join(args.recog_dir, 'server.log') if args.recog_dir else None,
+               stdout=args.recog_stdout or not args.recog_dir)
+
+    # Load the ASR model
+    model = Speech2Text(args, dir_name)
+    if args.recog_n_average > 1:
+        # Model averaging for Transformer
+        model = average_checkpoints(model, args.recog_model[0],
+                                    n_average=args.recog_n_average)
+    else:
+        load_checkpoint(args.recog_model[0], model)
+
+    # Load the LM for shallow fusion
+    if not args.lm_fusion:
+        load_lms(model, args, dir_name)
+
+    # GPU setting
+    if args.recog_n_gpus >= 1:
+        model.cudnn_setting(deterministic=True, benchmark=False)
+        model.cuda()
+
+    logger.info('beam width: %d' % args.recog_beam_width)
+    logger.info('CTC weight: %.3f' % args.recog_ctc_weight)
+    logger.info('fist LM path: %s' % args.recog_lm)
+    logger.info('LM weight (first-pass): %.3f' % args.recog_lm_weight)
+    logger.info('streaming: %s' % args.recog_streaming)
+    logger.info('max batch size: %d' % args.recog_server_max_batch_size)
+    logger.info('max latency: %.1f [ms]' % args.recog_server_max_latency)
+
+    server = RecognitionServer(model, recog_params, build_idx2token(args),
+                               host=args.recog_server_host,
+                               port=args.recog_server_port,
+                               max_batch_size=args.recog_server_max_batch_size,
+                               max_latency=args.recog_server_max_latency / 1000,
+                               cmvn=load_cmvn(args.recog_server_cmvn) if args.recog_server_cmvn else None)
+    logger.info('Serving on http://%s:%d' % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info('Metrics: %s' % server.batcher.metrics.report())
+
+
+if __name__ == '__main__':
+    main()
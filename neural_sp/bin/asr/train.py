@@ -367,12 +367,13 @@ def main():
                 model.module.plot_attention()
                 model.module.plot_ctc()
 
-            # Ealuate model every 0.1 epoch during MBR training
-            if args.mbr_training:
-                if int(train_set.epoch_detail * 10) != int(epoch_detail_prev * 10):
+            # Ealuate model every args.mbr_eval_interval epoch during MBR training
+            if args.mbr_training and args.mbr_eval_interval > 0:
+                interval = args.mbr_eval_interval
+                if int(train_set.epoch_detail / interval) != int(epoch_detail_prev / interval):
                     # dev
                     evaluate([model.module], dev_set, recog_params, args,
-                             int(train_set.epoch_detail * 10) / 10, logger)
+                             int(train_set.epoch_detail / interval) * interval, logger)
                     # Save the model
                     scheduler.save_checkpoint(
                         model, save_path, remove_old=False, amp=amp,
@@ -6,9 +6,23 @@
 
 """Utility functions for evaluation."""
 
+import argparse
+import codecs
 import logging
+import multiprocessing
+import numpy as np
 import os
+import time
 import torch
+import traceback
+
+from neural_sp.bin.train_utils import load_checkpoint
+from neural_sp.bin.train_utils import load_config
+from neural_sp.evaluators.nbest import load_nbest
+from neural_sp.evaluators.nbest import save_nbest
+from neural_sp.models.lm.build import build_lm
+from neural_sp.models.lm.ngram import is_arpa
+from neural_sp.models.lm.ngram import NgramLM
 
 logger = logging.getLogger(__name__)
 
@@ -51,3 +65,257 @@ def average_checkpoints(model, best_model_path, n_average, topk_list=[]):
     torch.save(checkpoint_avg, checkpoint_avg_path)
 
     return model
+
+
+def load_lms(model, args, dir_name):
+    """Load LMs for shallow fusion and rescoring and attach them to the ASR model.
+
+    Args:
+        model (Speech2Text): ASR model
+        args (Namespace): evaluation arguments
+        dir_name (str): directory of the ASR model
+
+    """
+    # first path
+    if args.recog_lm is not None and args.recog_lm_weight > 0 and is_arpa(args.recog_lm):
+        model.lm_fwd = NgramLM(args.recog_lm, os.path.join(dir_name, 'dict.txt'))
+    elif args.recog_lm is not None and args.recog_lm_weight > 0:
+        conf_lm = load_config(os.path.join(os.path.dirname(args.recog_lm), 'conf.yml'))
+        args_lm = argparse.Namespace()
+        for k, v in conf_lm.items():
+            setattr(args_lm, k, v)
+        args_lm.recog_mem_len = args.recog_mem_len
+        args_lm.recog_lm_kv_cache_len = args.recog_lm_kv_cache_len
+        args_lm.recog_lm_shortlist_partition_size = args.recog_lm_shortlist_partition_size
+        lm = build_lm(args_lm, wordlm=args.recog_wordlm,
+                      lm_dict_path=os.path.join(os.path.dirname(args.recog_lm), 'dict.txt'),
+                      asr_dict_path=os.path.join(dir_name, 'dict.txt'))
+        load_checkpoint(args.recog_lm, lm)
+        if args_lm.backward:
+            model.lm_bwd = lm
+        else:
+            model.lm_fwd = lm
+
+    # second path (forward)
+    if args.recog_lm_second is not None and args.recog_lm_second_weight > 0 and \
+            is_arpa(args.recog_lm_second):
+        model.lm_second = NgramLM(args.recog_lm_second, os.path.join(dir_name, 'dict.txt'))
+    elif args.recog_lm_second is not None and args.recog_lm_second_weight > 0:
+        conf_lm_second = load_config(os.path.join(os.path.dirname(args.recog_lm_second), 'conf.yml'))
+        args_lm_second = argparse.Namespace()
+        for k, v in conf_lm_second.items():
+            setattr(args_lm_second, k, v)
+        args_lm_second.recog_mem_len = args.recog_mem_len
+        lm_second = build_lm(args_lm_second)
+        load_checkpoint(args.recog_lm_second, lm_second)
+        model.lm_second = lm_second
+
+    # second path (bakward)
+    if args.recog_lm_bwd is not None and args.recog_lm_bwd_weight > 0:
+        conf_lm = load_config(os.path.join(os.path.dirname(args.recog_lm_bwd), 'conf.yml'))
+        args_lm_bwd = argparse.Namespace()
+        for k, v in conf_lm.items():
+            setattr(args_lm_bwd, k, v)
+        args_lm_bwd.recog_mem_len = args.recog_mem_len
+        lm_bwd = build_lm(args_lm_bwd)
+        load_checkpoint(args.recog_lm_bwd, lm_bwd)
+        model.lm_bwd = lm_bwd
+
+
+def split_shards(df, n_shards, by_session=False):
+    """Split utterances into shards with balanced total input length.
+
+    Utterances (or sessions if `by_session`) are assigned greedily from the
+    longest one to the shard with the smallest total number of frames so far.
+    Ties are broken by the first appearance in `df`, so the assignment is
+    deterministic. Utterances in each shard keep the original order of `df`,
+    so that all utterances of a session are decoded in the same order as in
+    a single process when `by_session` is True.
+
+    Args:
+        df (pandas.DataFrame): dataframe of the evaluation set
+        n_shards (int): number of shards
+        by_session (bool): keep all utterances of each session in the same shard
+    Returns:
+        shards (list): list of index labels per shard, in the original order
+
+    """
+    groups = {}
+    for i in range(len(df)):
+        key = str(df['session'].values[i]) if by_session else i
+        groups.setdefault(key, []).append(i)
+    groups = list(groups.values())  # in the order of the first appearance
+
+    n_shards = max(1, min(n_shards, len(groups)))
+    loads = [0] * n_shards
+    shards = [[] for _ in range(n_shards)]
+    xlens = df['xlen'].values
+    order = sorted(range(len(groups)), key=lambda g: (-sum(int(xlens[i]) for i in groups[g]), g))
+    for g in order:
+        k = loads.index(min(loads))
+        loads[k] += sum(int(xlens[i]) for i in groups[g])
+        shards[k] += groups[g]
+    return [[df.index[i] for i in sorted(s)] for s in shards if len(s) > 0]
+
+
+def _restrict_dataloader(dataloader, labels):
+    """Restrict the evaluation dataloader to a subset of utterances in place."""
+    dataset = dataloader.dataset
+    sampler = dataloader.batch_sampler
+    # NOTE: discourse-aware batching looks up the following utterances in
+    # the same session by index labels, so labels are kept in that case.
+    # Otherwise, the sampler slices the dataframe by position with index labels.
+    keep_labels = getattr(sampler, 'discourse_aware', False)
+    for obj in [dataset, sampler]:
+        for name in ['df', 'df_sub1', 'df_sub2']:
+            df = getattr(obj, name, None)
+            if df is not None:
+                df = df.loc[labels]
+                setattr(obj, name, df if keep_labels else df.reset_index(drop=True))
+    dataloader.reset()
+
+
+def _shard_worker(eval_fn, models, dataloader, labels, recog_dir, n_threads,
+                  queue, shard_id, kwargs):
+    try:
+        torch.set_num_threads(n_threads)
+        _restrict_dataloader(dataloader, labels)
+        start_time = time.time()
+        result, n_tokens = eval_fn(models, dataloader, recog_dir=recog_dir, progressbar=False,
+                                   return_n_tokens=True, **kwargs)
+        if getattr(models[0], 'encoder_cache', None) is not None:
+            models[0].encoder_cache.report()
+        queue.put((shard_id, (result, n_tokens), time.time() - start_time, None))
+    except Exception:
+        queue.put((shard_id, None, 0., traceback.format_exc()))
+
+
+def _trn_utt_id(line):
+    """Extract the utterance ID from a line of trn formatted as `text (speaker-utt_id)`."""
+    return line.rstrip('\n').rsplit('(', 1)[1][:-1].split('-', 1)[1]
+
+
+def _merge_trn(shard_dirs, recog_dir, utt_ids, fname):
+    """Merge trn files of shards into `recog_dir` in the order of `utt_ids`."""
+    lines = {}
+    for shard_dir in shard_dirs:
+        with codecs.open(os.path.join(shard_dir, fname), 'r', encoding='utf-8') as f:
+            for line in f:
+                lines[_trn_utt_id(line)] = line
+    assert len(lines) == len(utt_ids), fname
+    with codecs.open(os.path.join(recog_dir, fname), 'w', encoding='utf-8') as f:
+        for utt_id in utt_ids:
+            f.write(lines[utt_id])
+
+
+def _merge_nbest(shard_dirs, recog_dir, utt_ids):
+    """Merge N-best lists of shards into `recog_dir` in the order of `utt_ids`."""
+    paths = [os.path.join(d, 'nbest.npz') for d in shard_dirs]
+    if not all(os.path.isfile(path) for path in paths):
+        return
+    nbest = load_nbest(paths)
+    utt2idx = {str(utt_id): i for i, utt_id in enumerate(nbest['utt_ids'])}
+    order = [utt2idx[str(utt_id)] for utt_id in utt_ids if str(utt_id) in utt2idx]
+    rank = np.zeros(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    hyp_order = np.argsort(rank[nbest['hyp2utt']], kind='stable')
+    save_nbest(os.path.join(recog_dir, 'nbest.npz'),
+               {'utt_ids': nbest['utt_ids'][order],
+                'refs': nbest['refs'][order],
+                'hyps': nbest['hyps'][hyp_order],
+                'hyp2utt': rank[nbest['hyp2utt']][hyp_order],
+                'scores': nbest['scores'][hyp_order]})
+
+
+def _average_results(results, n_tokens):
+    """Average results of shards.
+
+    Args:
+        results (list): results of `eval_fn` per shard. Each of them is an error rate
+            or a tuple of error rates followed by counts (e.g., n_oov for eval_word).
+        n_tokens (list): tuples of the number of reference tokens per shard,
+            which are the denominators of the error rates in the same position
+    Returns:
+        result: same as `eval_fn`
+
+    """
+    if not isinstance(results[0], tuple):
+        results = [(r,) for r in results]
+    result = []
+    for i in range(len(results[0])):
+        values = [r[i] for r in results]
+        if i < len(n_tokens[0]):
+            weights = [n[i] for n in n_tokens]
+            if sum(weights) > 0:
+                result.append(sum(v * w for v, w in zip(values, weights)) / sum(weights))
+            else:
+                result.append(0.)
+        else:
+            result.append(sum(values))  # count (e.g., n_oov)
+    return result[0] if len(result) == 1 else tuple(result)
+
+
+def eval_sharded(eval_fn, models, dataloader, recog_params, recog_dir, n_jobs, **kwargs):
+    """Decode the evaluation set with multiple processes.
+
+    The evaluation set is split into `n_jobs` shards and each shard is
+    decoded in a forked process, so that model parameters are shared with
+    the parent process copy-on-write. When states are carried over between
+    utterances or the dataloader is discourse-aware, each session is decoded
+    within a single shard. Per-shard hypotheses (and N-best lists) are merged
+    in `recog_dir` in the original utterance order, and error rates are averaged
+    over shards weighted by the number of reference tokens counted by `eval_fn`.
+
+    Args:
+        eval_fn (callable): one of eval_word/eval_wordpiece/eval_char/eval_phone
+        models (list): models to evaluate
+        dataloader (torch.utils.data.DataLoader): evaluation dataloader
+        recog_params (dict):
+        recog_dir (str): directory to save decoding results
+        n_jobs (int): number of processes
+        kwargs: other keyword arguments passed to `eval_fn`
+    Returns:
+        result: same as `eval_fn` (error rates, followed by n_oov for eval_word)
+        elapsed_times (list): decoding time per shard [sec]
+
+    """
+    df = dataloader.batch_sampler.df
+    by_session = recog_params.get('recog_asr_state_carry_over', False) or \
+        recog_params.get('recog_lm_state_carry_over', False) or \
+        getattr(dataloader.batch_sampler, 'discourse_aware', False)
+    shard_labels = split_shards(df, n_jobs, by_session=by_session)
+    n_jobs = len(shard_labels)
+    n_threads = max(1, torch.get_num_threads() // n_jobs)
+    shard_dirs = [os.path.join(recog_dir, 'shard' + str(k)) for k in range(n_jobs)]
+    logger.info('Decode %d utterances with %d processes (%d threads each)%s' %
+                (len(df), n_jobs, n_threads, ' by session' if by_session else ''))
+
+    ctx = multiprocessing.get_context('fork')
+    queue = ctx.Queue()
+    kwargs.update({'recog_params': recog_params})
+    workers = []
+    for k in range(n_jobs):
+        p = ctx.Process(target=_shard_worker,
+                        args=(eval_fn, models, dataloader, shard_labels[k], shard_dirs[k],
+                              n_threads, queue, k, kwargs))
+        p.start()
+        workers.append(p)
+
+    results, n_tokens, elapsed_times = [None] * n_jobs, [None] * n_jobs, [0.] * n_jobs
+    for _ in range(n_jobs):
+        k, result, elapsed_time, error = queue.get()
+        if error is not None:
+            for p in workers:
+                p.terminate()
+            raise RuntimeError('Decoding failed in shard %d:\n%s' % (k, error))
+        (results[k], n_tokens[k]), elapsed_times[k] = result, elapsed_time
+    for p in workers:
+        p.join()
+
+    # Merge hypotheses in the original order
+    utt_ids = [str(utt_id) for utt_id in df['utt_id']]
+    for fname in ['ref.trn', 'hyp.trn']:
+        _merge_trn(shard_dirs, recog_dir, utt_ids, fname)
+    _merge_nbest(shard_dirs, recog_dir, utt_ids)
+
+    return _average_results(results, n_tokens), elapsed_times
@@ -177,6 +177,8 @@ def set_asr_model_name(args):
     if args.mbr_training:
         dir_name += '_MBR' + str(args.recog_beam_width) + 'best'
         dir_name += '_ce' + str(args.mbr_ce_weight) + '_smooth' + str(args.recog_softmax_smoothing)
+        if args.mbr_nbest_type == 'sampling':
+            dir_name += '_sample'
 
     if args.n_gpus > 1:
         dir_name += '_' + str(args.n_gpus) + 'GPU'
@@ -0,0 +1,333 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Utility functions for the recognition server."""
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+import io
+import json
+import logging
+import numpy as np
+import queue
+import threading
+import time
+
+from neural_sp.models.seq2seq.frontends.fbank import Fbank
+
+logger = logging.getLogger(__name__)
+
+
+def decode_batch(model, xs, recog_params, idx2token):
+    """Decode a mini-batch of utterances in the same way as evaluators.
+
+    Args:
+        model (Speech2Text): ASR model
+        xs (list): A list of length `[B]`, which contains arrays of size `[T, input_dim]`
+        recog_params (dict): hyper-parameters for decoding
+        idx2token (): converter from index to token
+    Returns:
+        best_hyps_id (list): A list of length `[B]`, which contains arrays of size `[L]`
+
+    """
+    if recog_params['recog_streaming'] or recog_params['recog_chunk_sync']:
+        best_hyps_id, _ = model.decode_streaming(xs, recog_params, idx2token, exclude_eos=True)
+    elif recog_params['recog_long_form']:
+        best_hyps_id, _ = model.decode_long_form(xs, recog_params, idx2token=None, exclude_eos=True)
+    else:
+        best_hyps_id, _ = model.decode(xs, recog_params, idx2token=None, exclude_eos=True)
+    return best_hyps_id
+
+
+class ServerMetrics(object):
+    """Throughput, queueing delay and real-time factor of the server.
+
+    Args:
+        frame_shift (float): frame shift of input features [sec]
+
+    """
+
+    def __init__(self, frame_shift=0.01):
+        self.frame_shift = frame_shift
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time.time()
+            self.n_requests = 0
+            self.n_batches = 0
+            self.n_frames = 0
+            self.queue_delay_sum = 0.
+            self.queue_delay_max = 0.
+            self.decode_time = 0.
+
+    def add_batch(self, n_frames, queue_delays, decode_time):
+        """Record a decoded mini-batch.
+
+        Args:
+            n_frames (int): total number of input frames in the mini-batch
+            queue_delays (list): time from arrival to the start of decoding for each request [sec]
+            decode_time (float): elapsed time to decode the mini-batch [sec]
+
+        """
+        with self.lock:
+            self.n_requests += len(queue_delays)
+            self.n_batches += 1
+            self.n_frames += n_frames
+            self.queue_delay_sum += sum(queue_delays)
+            self.queue_delay_max = max([self.queue_delay_max] + queue_delays)
+            self.decode_time += decode_time
+
+    def report(self):
+        """Return a summary of metrics.
+
+        Returns:
+            metrics (dict):
+                n_requests (int): number of decoded requests
+                n_batches (int): number of decoded mini-batches
+                avg_batch_size (float): average number of requests per mini-batch
+                throughput (float): number of requests per second
+                audio_throughput (float): seconds of audio decoded per second
+                avg_queue_delay (float): average time from arrival to the start of decoding [sec]
+                max_queue_delay (float): maximum time from arrival to the start of decoding [sec]
+                rtf (float): real-time factor of decoding
+
+        """
+        with self.lock:
+            elapsed_time = max(time.time() - self.start_time, 1e-6)
+            audio_duration = self.n_frames * self.frame_shift
+            return {'n_requests': self.n_requests,
+                    'n_batches': self.n_batches,
+                    'avg_batch_size': self.n_requests / max(self.n_batches, 1),
+                    'throughput': self.n_requests / elapsed_time,
+                    'audio_throughput': audio_duration / elapsed_time,
+                    'avg_queue_delay': self.queue_delay_sum / max(self.n_requests, 1),
+                    'max_queue_delay': self.queue_delay_max,
+                    'rtf': self.decode_time / audio_duration if audio_duration > 0 else 0.}
+
+
+class Request(object):
+    """Recognition request waiting in the queue."""
+
+    def __init__(self, xs):
+        self.xs = xs
+        self.arrival_time = time.time()
+        self.done = threading.Event()
+        self.hyp = None
+        self.error = None
+        self.queue_delay = None
+        self.decode_time = None
+        self.batch_size = None
+
+
+class DynamicBatcher(object):
+    """Form mini-batches of concurrent requests and decode them in a worker thread.
+
+    Decoding starts when `max_batch_size` requests are queued or `max_latency`
+    seconds have passed since the arrival of the oldest request in the queue.
+
+    Args:
+        decode_fn (callable): function mapping a list of `[T, input_dim]` arrays to a list of hypotheses
+        max_batch_size (int): maximum number of requests in a mini-batch
+        max_latency (float): maximum time to wait for other requests [sec]
+        metrics (ServerMetrics):
+
+    """
+
+    def __init__(self, decode_fn, max_batch_size=8, max_latency=0.05, metrics=None):
+        assert max_batch_size >= 1
+        self.decode_fn = decode_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.metrics = metrics if metrics is not None else ServerMetrics()
+
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, xs):
+        """Queue a request and wait for the result.
+
+        Args:
+            xs (np.ndarray): `[T, input_dim]`
+        Returns:
+            request (Request): finished request
+
+        """
+        request = Request(xs)
+        self.queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request
+
+    def _next_batch(self):
+        request = self.queue.get()
+        if request is None:
+            return None
+        batch = [request]
+        deadline = request.arrival_time + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                request = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                self.queue.put(None)  # stop after decoding this mini-batch
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            start_time = time.time()
+            try:
+                hyps = self.decode_fn([r.xs for r in batch])
+            except Exception as e:
+                logger.exception('Failed to decode a mini-batch')
+                hyps = [None] * len(batch)
+                for r in batch:
+                    r.error = e
+            decode_time = time.time() - start_time
+
+            queue_delays = [start_time - r.arrival_time for r in batch]
+            self.metrics.add_batch(sum(len(r.xs) for r in batch), queue_delays, decode_time)
+            logger.debug('batch size: %d, decoding time: %.3f [sec]' % (len(batch), decode_time))
+            for r, hyp, queue_delay in zip(batch, hyps, queue_delays):
+                r.hyp = hyp
+                r.queue_delay = queue_delay
+                r.decode_time = decode_time
+                r.batch_size = len(batch)
+                r.done.set()
+
+
+class RecognitionHandler(BaseHTTPRequestHandler):
+    """HTTP request handler of RecognitionServer.
+
+    POST /recognize: recognize an utterance in the request body saved by `np.save`.
+        A 2-dimensional array `[T, input_dim]` is regarded as input features, and
+        a 1-dimensional array `[n_samples]` as a 16-bit waveform, which is
+        converted to log-mel filterbank features.
+    GET /metrics: report metrics of the server.
+
+    """
+
+    def do_POST(self):
+        if self.path != '/recognize':
+            self._send_json(404, {'error': 'Not found: %s' % self.path})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            xs = self.server.load_input(body)
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+
+        try:
+            request = self.server.batcher.submit(xs)
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+            return
+        hyp = np.asarray(request.hyp, dtype=np.int64)
+        self._send_json(200, {'hyp': hyp.tolist(),
+                              'text': self.server.idx2token(hyp) if self.server.idx2token is not None else None,
+                              'n_frames': len(xs),
+                              'queue_delay': request.queue_delay,
+                              'decode_time': request.decode_time,
+                              'batch_size': request.batch_size})
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self._send_json(404, {'error': 'Not found: %s' % self.path})
+            return
+        self._send_json(200, self.server.batcher.metrics.report())
+
+    def _send_json(self, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s' % (self.address_string(), format % args))
+
+
+class RecognitionServer(ThreadingHTTPServer):
+    """Long-running recognition server on localhost.
+
+    The ASR model, LMs and token converters are loaded once, and requests from
+    concurrent clients are decoded in mini-batches by DynamicBatcher.
+
+    Args:
+        model (Speech2Text): ASR model (LMs are attached)
+        recog_params (dict): hyper-parameters for decoding
+        idx2token (): converter from index to token
+        host (str): host name
+        port (int): port number (0 means an arbitrary free port)
+        max_batch_size (int): maximum number of requests in a mini-batch
+        max_latency (float): maximum time to wait for other requests [sec]
+        fbank_conf (dict): configuration of Fbank for waveform requests
+            (the number of mel bins is input_dim by default)
+        cmvn (tuple): mean and standard deviation returned by `load_cmvn`
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, model, recog_params, idx2token=None, host='127.0.0.1', port=8080,
+                 max_batch_size=8, max_latency=0.05, fbank_conf=None, cmvn=None):
+        super(RecognitionServer, self).__init__((host, port), RecognitionHandler)
+        self.input_dim = model.input_dim
+        self.idx2token = idx2token
+        self.fbank_conf = {'n_mels': self.input_dim}
+        if fbank_conf is not None:
+            self.fbank_conf.update(fbank_conf)
+        self.cmvn = cmvn
+
+        self.batcher = DynamicBatcher(lambda xs: decode_batch(model, xs, recog_params, idx2token),
+                                      max_batch_size, max_latency)
+        self.batcher.start()
+
+    def load_input(self, body):
+        """Convert a request body to input features.
+
+        Args:
+            body (bytes): array saved by `np.save`
+        Returns:
+            xs (np.ndarray): `[T, input_dim]`
+
+        """
+        try:
+            xs = np.load(io.BytesIO(body), allow_pickle=False)
+        except Exception:
+            raise ValueError('The request body must be an array saved by numpy.save.')
+        if xs.ndim == 1:
+            xs = Fbank(cmvn=self.cmvn, **self.fbank_conf)(xs)
+        if xs.ndim != 2 or xs.shape[1] != self.input_dim:
+            raise ValueError('Invalid input shape: %s (input_dim: %d)' % (str(xs.shape), self.input_dim))
+        if len(xs) == 0:
+            raise ValueError('Empty input.')
+        return xs.astype(np.float32)
+
+    def server_close(self):
+        super(RecognitionServer, self).server_close()
+        self.batcher.stop()
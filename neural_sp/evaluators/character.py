@@ -8,16 +8,19 @@
 
 import codecs
 import logging
+import os
 from tqdm import tqdm
 
-from neural_sp.evaluators.edit_distance import compute_wer
+from neural_sp.evaluators.edit_distance import compute_wer_batch
+from neural_sp.evaluators.nbest import NbestWriter
 from neural_sp.utils import mkdir_join
 
 logger = logging.getLogger(__name__)
 
 
 def eval_char(models, dataloader, recog_params, epoch,
-              recog_dir=None, streaming=False, progressbar=False, task_idx=0):
+              recog_dir=None, streaming=False, progressbar=False, task_idx=0,
+              return_n_tokens=False):
     """Evaluate the character-level model by WER & CER.
 
     Args:
@@ -32,9 +35,11 @@ def eval_char(models, dataloader, recog_params, epoch,
             0: main task
             1: sub task
             2: sub sub task
+        return_n_tokens (bool): also return the number of reference tokens used to normalize error rates
     Returns:
         wer (float): Word error rate
         cer (float): Character error rate
+        n_tokens (tuple): number of reference words and characters (if return_n_tokens)
 
     """
     if recog_dir is None:
@@ -54,9 +59,15 @@ def eval_char(models, dataloader, recog_params, epoch,
     n_sub_w, n_ins_w, n_del_w = 0, 0, 0
     n_sub_c, n_ins_c, n_del_c = 0, 0, 0
     n_word, n_char = 0, 0
+    refs_w, hyps_w = [], []
+    refs_c, hyps_c = [], []
     n_streamable, quantity_rate, n_utt = 0, 0, 0
     last_success_frame_ratio = 0
 
+    nbest_writer = None
+    if recog_params.get('recog_nbest_export', False):
+        nbest_writer = NbestWriter()
+
     # Reset data counter
     dataloader.reset(recog_params['recog_batch_size'])
 
@@ -80,6 +91,13 @@ def eval_char(models, dataloader, recog_params, epoch,
                 best_hyps_id, _ = models[0].decode_streaming(
                     batch['xs'], recog_params, dataloader.idx2token[0],
                     exclude_eos=True)
+            elif recog_params['recog_long_form']:
+                best_hyps_id, _ = models[0].decode_long_form(
+                    batch['xs'], recog_params,
+                    idx2token=dataloader.idx2token[task_idx] if progressbar else None,
+                    exclude_eos=True,
+                    speakers=batch['sessions' if dataloader.corpus == 'swbd' else 'speakers'],
+                    task=task)
             else:
                 best_hyps_id, _ = models[0].decode(
                     batch['xs'], recog_params,
@@ -114,16 +132,16 @@ def eval_char(models, dataloader, recog_params, epoch,
                 logger.debug('Hyp: %s' % hyp)
                 logger.debug('-' * 150)
 
+                if nbest_writer is not None and models[0].nbest_components is not None:
+                    nbest = models[0].nbest_components[b]
+                    nbest_writer.add(batch['utt_ids'][b], ref,
+                                     [dataloader.idx2token[task_idx](h['hyp']) for h in nbest], nbest)
+
                 if not streaming:
                     if ('char' in dataloader.unit and 'nowb' not in dataloader.unit) or (task_idx > 0 and dataloader.unit_sub1 == 'char'):
                         # Compute WER
-                        wer_b, sub_b, ins_b, del_b = compute_wer(ref=ref.split(' '),
-                                                                 hyp=hyp.split(' '),
-                                                                 normalize=False)
-                        wer += wer_b
-                        n_sub_w += sub_b
-                        n_ins_w += ins_b
-                        n_del_w += del_b
+                        refs_w.append(ref.split(' '))
+                        hyps_w.append(hyp.split(' '))
                         n_word += len(ref.split(' '))
                         # NOTE: sentence error rate for Chinese
 
@@ -131,13 +149,8 @@ def eval_char(models, dataloader, recog_params, epoch,
                     if dataloader.corpus == 'csj':
                         ref = ref.replace(' ', '')
                         hyp = hyp.replace(' ', '')
-                    cer_b, sub_b, ins_b, del_b = compute_wer(ref=list(ref),
-                                                             hyp=list(hyp),
-                                                             normalize=False)
-                    cer += cer_b
-                    n_sub_c += sub_b
-                    n_ins_c += ins_b
-                    n_del_c += del_b
+                    refs_c.append(list(ref))
+                    hyps_c.append(list(hyp))
                     n_char += len(ref)
                     if models[0].streamable():
                         n_streamable += 1
@@ -158,8 +171,12 @@ def eval_char(models, dataloader, recog_params, epoch,
     # Reset data counters
     dataloader.reset()
 
+    if nbest_writer is not None:
+        nbest_writer.save(os.path.join(os.path.dirname(hyp_trn_path), 'nbest.npz'))
+
     if not streaming:
         if ('char' in dataloader.unit and 'nowb' not in dataloader.unit) or (task_idx > 0 and dataloader.unit_sub1 == 'char'):
+            wer, n_sub_w, n_ins_w, n_del_w = [float(c.sum()) for c in compute_wer_batch(refs_w, hyps_w)]
             wer /= n_word
             n_sub_w /= n_word
             n_ins_w /= n_word
@@ -167,6 +184,7 @@ def eval_char(models, dataloader, recog_params, epoch,
         else:
             wer = n_sub_w = n_ins_w = n_del_w = 0
 
+        cer, n_sub_c, n_ins_c, n_del_c = [float(c.sum()) for c in compute_wer_batch(refs_c, hyps_c)]
         cer /= n_char
         n_sub_c /= n_char
         n_ins_c /= n_char
@@ -186,4 +204,6 @@ def eval_char(models, dataloader, recog_params, epoch,
     logger.info('Quantity rate (%s): %.2f %%' % (dataloader.set, quantity_rate * 100))
     logger.info('Last success frame ratio (%s): %.2f %%' % (dataloader.set, last_success_frame_ratio))
 
+    if return_n_tokens:
+        return (wer, cer), (n_word, n_char)
     return wer, cer
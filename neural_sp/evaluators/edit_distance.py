@@ -7,6 +7,7 @@
 """Functions for computing edit distance."""
 
 import numpy as np
+import torch
 
 
 def compute_per(ref, hyp, normalize=False):
@@ -56,6 +57,105 @@ def compute_cer(ref, hyp, normalize=False):
     return cer * 100
 
 
+def _encode(ref, hyp):
+    """Map tokens in ref and hyp to shared integer indices.
+
+    Args:
+        ref (list): tokens in the reference transcript
+        hyp (list): tokens in the predicted transcript
+    Returns:
+        ref_ids (np.ndarray): `[R]`
+        hyp_ids (np.ndarray): `[H]`
+
+    """
+    token2idx = {}
+    ref_ids = np.fromiter((token2idx.setdefault(t, len(token2idx)) for t in ref),
+                          dtype=np.int64, count=len(ref))
+    hyp_ids = np.fromiter((token2idx.setdefault(t, len(token2idx)) for t in hyp),
+                          dtype=np.int64, count=len(hyp))
+    return ref_ids, hyp_ids
+
+
+def _edit_distance_table(ref_ids, hyp_ids):
+    """Fill the dynamic programming table of edit distance along anti-diagonals.
+
+    Cells are stored diagonal-major (the k-th row holds D[i][k - i]) so that
+    each anti-diagonal is updated with contiguous slices of the previous two.
+    The shorter sequence is used as the row axis, and the table is transposed
+    back at the end since the edit distance is symmetric.
+
+    Args:
+        ref_ids (np.ndarray): `[R]`
+        hyp_ids (np.ndarray): `[H]`
+    Returns:
+        d (np.ndarray): `[R + 1, H + 1]`
+
+    """
+    transpose = len(ref_ids) > len(hyp_ids)
+    a, b = (hyp_ids, ref_ids) if transpose else (ref_ids, hyp_ids)
+    alen, blen = len(a), len(b)
+    b_rev = b[::-1]
+
+    diags = np.zeros((alen + blen + 1, alen + 1), dtype=np.int32)
+    for k in range(alen + blen + 1):
+        if k <= blen:
+            diags[k, 0] = k  # D[0][k]
+        if k <= alen:
+            diags[k, k] = k  # D[k][0]
+        lo, hi = max(1, k - blen), min(alen, k - 1)
+        if lo > hi:
+            continue
+        cost = (a[lo - 1:hi] != b_rev[blen - k + lo:blen - k + hi + 1]).astype(np.int32)
+        diags[k, lo:hi + 1] = np.minimum(diags[k - 2, lo - 1:hi] + cost,
+                                         np.minimum(diags[k - 1, lo:hi + 1], diags[k - 1, lo - 1:hi]) + 1)
+
+    i = np.arange(alen + 1)[:, None]
+    d = diags[i + np.arange(blen + 1)[None, :], i]  # `[A + 1, B + 1]`
+    return d.T if transpose else d
+
+
+def _backtrace(d, ref_ids, hyp_ids):
+    """Find out the manipulation steps from the dynamic programming table.
+
+    Args:
+        d (np.ndarray): `[R + 1, H + 1]`
+        ref_ids (np.ndarray): `[R]`
+        hyp_ids (np.ndarray): `[H]`
+    Returns:
+        error_list (list): sequence of C/S/I/D from the beginning
+
+    """
+    d = d.tolist()
+    ref_ids = ref_ids.tolist()
+    hyp_ids = hyp_ids.tolist()
+    x = len(ref_ids)
+    y = len(hyp_ids)
+    error_list = []
+    while x > 0 or y > 0:
+        if x > 0 and y > 0:
+            if d[x][y] == d[x - 1][y - 1] and ref_ids[x - 1] == hyp_ids[y - 1]:
+                error_list.append("C")
+                x = x - 1
+                y = y - 1
+            elif d[x][y] == d[x][y - 1] + 1:
+                error_list.append("I")
+                y = y - 1
+            elif d[x][y] == d[x - 1][y - 1] + 1:
+                error_list.append("S")
+                x = x - 1
+                y = y - 1
+            else:
+                error_list.append("D")
+                x = x - 1
+        elif x == 0:
+            error_list.append("I")
+            y = y - 1
+        else:
+            error_list.append("D")
+            x = x - 1
+    return error_list[::-1]
+
+
 def compute_wer(ref, hyp, normalize=False):
     """Compute Word Error Rate.
 
@@ -72,64 +172,10 @@ def compute_wer(ref, hyp, normalize=False):
         n_del (int): the number of deletion
 
     """
-    # Initialisation
-    d = np.zeros((len(ref) + 1) * (len(hyp) + 1), dtype=np.uint16)
-    d = d.reshape((len(ref) + 1, len(hyp) + 1))
-    for i in range(len(ref) + 1):
-        for j in range(len(hyp) + 1):
-            if i == 0:
-                d[0][j] = j
-            elif j == 0:
-                d[i][0] = i
-
-    # Computation
-    for i in range(1, len(ref) + 1):
-        for j in range(1, len(hyp) + 1):
-            if ref[i - 1] == hyp[j - 1]:
-                d[i][j] = d[i - 1][j - 1]
-            else:
-                sub_tmp = d[i - 1][j - 1] + 1
-                ins_tmp = d[i][j - 1] + 1
-                del_tmp = d[i - 1][j] + 1
-                d[i][j] = min(sub_tmp, ins_tmp, del_tmp)
-
-    wer = d[len(ref)][len(hyp)]
-
-    # Find out the manipulation steps
-    x = len(ref)
-    y = len(hyp)
-    error_list = []
-    while True:
-        if x == 0 and y == 0:
-            break
-        else:
-            if x > 0 and y > 0:
-                if d[x][y] == d[x - 1][y - 1] and ref[x - 1] == hyp[y - 1]:
-                    error_list.append("C")
-                    x = x - 1
-                    y = y - 1
-                elif d[x][y] == d[x][y - 1] + 1:
-                    error_list.append("I")
-                    y = y - 1
-                elif d[x][y] == d[x - 1][y - 1] + 1:
-                    error_list.append("S")
-                    x = x - 1
-                    y = y - 1
-                else:
-                    error_list.append("D")
-                    x = x - 1
-            elif x == 0 and y > 0:
-                if d[x][y] == d[x][y - 1] + 1:
-                    error_list.append("I")
-                    y = y - 1
-                else:
-                    error_list.append("D")
-                    x = x - 1
-            elif y == 0 and x > 0:
-                error_list.append("D")
-                x = x - 1
-            else:
-                raise ValueError
+    ref_ids, hyp_ids = _encode(ref, hyp)
+    d = _edit_distance_table(ref_ids, hyp_ids)
+    wer = int(d[-1, -1])
+    error_list = _backtrace(d, ref_ids, hyp_ids)
 
     n_sub = error_list.count("S")
     n_ins = error_list.count("I")
@@ -145,6 +191,138 @@ def compute_wer(ref, hyp, normalize=False):
     return wer * 100, n_sub * 100, n_ins * 100, n_del * 100
 
 
+def compute_wer_batch(refs, hyps, normalize=False, return_alignment=False, batch_size=256):
+    """Compute Word Error Rate for many reference/hypothesis pairs at once.
+
+    Pairs are sorted by length and scored in mini-batches with
+    `compute_edit_distance_batch`.
+
+    Args:
+        refs (list): length `N`, each of which contains tokens in the reference transcript
+        hyps (list): length `N`, each of which contains tokens in the predicted transcript
+        normalize (bool, optional): if True, divide by the length of each ref
+        return_alignment (bool, optional): return a sequence of C/S/I/D per pair
+        batch_size (int): number of pairs scored in parallel
+    Returns:
+        wers (np.ndarray): `[N]`
+        n_subs (np.ndarray): `[N]`
+        n_inss (np.ndarray): `[N]`
+        n_dels (np.ndarray): `[N]`
+        alignments (list): length `N`, each of which contains a list of C/S/I/D (optional)
+
+    """
+    assert len(refs) == len(hyps)
+    n_pairs = len(refs)
+    counts = np.zeros((4, n_pairs), dtype=np.int64)  # err/sub/ins/del
+
+    token2idx = {}
+    refs_ids = [[token2idx.setdefault(t, len(token2idx)) for t in ref] for ref in refs]
+    hyps_ids = [[token2idx.setdefault(t, len(token2idx)) for t in hyp] for hyp in hyps]
+
+    order = sorted(range(n_pairs), key=lambda n: len(refs_ids[n]) + len(hyps_ids[n]))
+    for offset in range(0, n_pairs, batch_size):
+        ids = order[offset:offset + batch_size]
+        rlens = torch.LongTensor([len(refs_ids[n]) for n in ids])
+        hlens = torch.LongTensor([len(hyps_ids[n]) for n in ids])
+        refs_pad = torch.full((len(ids), max(1, int(rlens.max()))), -1, dtype=torch.int64)
+        hyps_pad = torch.full((len(ids), max(1, int(hlens.max()))), -1, dtype=torch.int64)
+        for b, n in enumerate(ids):
+            refs_pad[b, :rlens[b]] = torch.LongTensor(refs_ids[n])
+            hyps_pad[b, :hlens[b]] = torch.LongTensor(hyps_ids[n])
+        out = compute_edit_distance_batch(hyps_pad, hlens, refs_pad, rlens, return_counts=True)
+        counts[:, ids] = torch.stack(out, dim=0).numpy()
+
+    wers, n_subs, n_inss, n_dels = [c.astype(np.float64) * 100 for c in counts]
+    if normalize:
+        rlens = np.array([len(ref) for ref in refs], dtype=np.float64)
+        wers /= rlens
+
+    if return_alignment:
+        alignments = []
+        for ref_ids, hyp_ids in zip(refs_ids, hyps_ids):
+            ref_ids, hyp_ids = np.array(ref_ids, dtype=np.int64), np.array(hyp_ids, dtype=np.int64)
+            alignments.append(_backtrace(_edit_distance_table(ref_ids, hyp_ids), ref_ids, hyp_ids))
+        return wers, n_subs, n_inss, n_dels, alignments
+    return wers, n_subs, n_inss, n_dels
+
+
+def compute_edit_distance_batch(hyps, hyp_lens, refs, ref_lens, return_counts=False):
+    """Compute edit distances between integer-encoded token sequences in parallel.
+
+    The dynamic programming table is filled along anti-diagonals, so that
+    all cells on a diagonal are computed at once for all pairs in a mini-batch.
+    Substitution/insertion/deletion counts follow the same path as the
+    backtrace in `compute_wer`.
+
+    Args:
+        hyps (LongTensor): `[B, H]`
+        hyp_lens (LongTensor): `[B]`
+        refs (LongTensor): `[B, R]`
+        ref_lens (LongTensor): `[B]`
+        return_counts (bool): return the number of substitution/insertion/deletion
+    Returns:
+        dists (LongTensor): `[B]`
+        n_sub (LongTensor): `[B]` (optional)
+        n_ins (LongTensor): `[B]` (optional)
+        n_del (LongTensor): `[B]` (optional)
+
+    """
+    bs, hmax = hyps.size()
+    rmax = refs.size(1)
+    device = hyps.device
+    hyp_lens = hyp_lens.to(device).long()
+    ref_lens = ref_lens.to(device).long()
+    refs = refs.to(device)
+    inf = rmax + hmax + 1
+
+    def shift(x):
+        # D[i-1] -> i
+        pad = x.new_zeros(x.size()[:-1] + (1,))
+        pad[0] = inf
+        return torch.cat([pad, x[..., :-1]], dim=-1)
+
+    # NOTE: each cell holds (distance, #sub, #ins, #del)
+    i_range = torch.arange(rmax + 1, device=device)  # reference index
+    prev2 = None
+    prev = hyps.new_zeros((4, bs, rmax + 1), dtype=torch.int64)
+    prev[0] = inf
+    prev[0, :, 0] = 0  # D[0][0]
+    outs = hyps.new_zeros((4, bs), dtype=torch.int64)
+    for k in range(1, rmax + hmax + 1):
+        j_range = k - i_range  # hypothesis index on the k-th diagonal
+        invalid = (j_range < 0) | (j_range > hmax)
+        left = prev  # insertion: D[i][j-1]
+        up = shift(prev)  # deletion: D[i-1][j]
+        cur = left.clone()
+        cur[0] = torch.min(left[0], up[0]) + 1
+        is_ins = cur[0] == left[0] + 1
+        is_del = ~is_ins
+        if prev2 is not None and hmax > 0 and rmax > 0:
+            diag = shift(prev2)  # substitution/correct: D[i-1][j-1]
+            hyp_tokens = hyps[:, (j_range[1:] - 1).clamp(0, hmax - 1)]  # `[B, R]`
+            cost = torch.cat([hyp_tokens.new_ones(bs, 1), (hyp_tokens != refs).long()], dim=1)
+            cur[0] = torch.min(cur[0], diag[0] + cost)
+            is_cor = (cost == 0) & (cur[0] == diag[0])
+            is_ins = ~is_cor & (cur[0] == left[0] + 1)
+            is_sub = ~is_cor & ~is_ins & (cur[0] == diag[0] + 1)
+            is_del = ~is_cor & ~is_ins & ~is_sub
+            for n in range(1, 4):
+                cur[n] = torch.where(is_cor | is_sub, diag[n], cur[n])
+            cur[1] += is_sub.long()
+        cur[1:] = torch.where(is_del.unsqueeze(0), up[1:], cur[1:])
+        cur[2] += is_ins.long()
+        cur[3] += is_del.long()
+        cur[0] = cur[0].masked_fill(invalid.unsqueeze(0), inf)
+        is_end = (ref_lens + hyp_lens) == k
+        outs = torch.where(is_end.unsqueeze(0),
+                           cur.gather(2, ref_lens.view(1, bs, 1).expand(4, bs, 1)).squeeze(2), outs)
+        prev2, prev = prev, cur
+
+    if return_counts:
+        return outs[0], outs[1], outs[2], outs[3]
+    return outs[0]
+
+
 def wer_align(ref, hyp, normalize=False, double_byte=False):
     """Compute Word Error Rate.
 
@@ -167,62 +345,10 @@ def wer_align(ref, hyp, normalize=False, double_byte=False):
     i_char = "Ｉ" if double_byte else "I"
     d_char = "Ｄ" if double_byte else "D"
 
-    # Build the matrix
-    d = np.zeros((len(ref) + 1) * (len(hyp) + 1),
-                 dtype=np.uint8).reshape((len(ref) + 1, len(hyp) + 1))
-    for i in range(len(ref) + 1):
-        for j in range(len(hyp) + 1):
-            if i == 0:
-                d[0][j] = j
-            elif j == 0:
-                d[i][0] = i
-    for i in range(1, len(ref) + 1):
-        for j in range(1, len(hyp) + 1):
-            if ref[i - 1] == hyp[j - 1]:
-                d[i][j] = d[i - 1][j - 1]
-            else:
-                n_sub = d[i - 1][j - 1] + 1
-                n_ins = d[i][j - 1] + 1
-                n_del = d[i - 1][j] + 1
-                d[i][j] = min(n_sub, n_ins, n_del)
-    wer = float(d[len(ref)][len(hyp)])
-
-    # Find out the manipulation steps
-    x = len(ref)
-    y = len(hyp)
-    error_list = []
-    while True:
-        if x == 0 and y == 0:
-            break
-        else:
-            if x > 0 and y > 0:
-                if d[x][y] == d[x - 1][y - 1] and ref[x - 1] == hyp[y - 1]:
-                    error_list.append("C")
-                    x = x - 1
-                    y = y - 1
-                elif d[x][y] == d[x][y - 1] + 1:
-                    error_list.append("I")
-                    y = y - 1
-                elif d[x][y] == d[x - 1][y - 1] + 1:
-                    error_list.append("S")
-                    x = x - 1
-                    y = y - 1
-                else:
-                    error_list.append("D")
-                    x = x - 1
-            elif x == 0 and y > 0:
-                if d[x][y] == d[x][y - 1] + 1:
-                    error_list.append("I")
-                    y = y - 1
-                else:
-                    error_list.append("D")
-                    x = x - 1
-            elif y == 0 and x > 0:
-                error_list.append("D")
-                x = x - 1
-            else:
-                raise ValueError
-    error_list = error_list[::-1]
+    ref_ids, hyp_ids = _encode(ref, hyp)
+    d = _edit_distance_table(ref_ids, hyp_ids)
+    wer = float(d[-1, -1])
+    error_list = _backtrace(d, ref_ids, hyp_ids)
 
     # Print the result in aligned way
     print("REF: ", end='')
@@ -0,0 +1,157 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Export and rescore N-best lists with separate score components."""
+
+import itertools
+import logging
+import numpy as np
+
+from neural_sp.evaluators.edit_distance import compute_wer_batch
+
+logger = logging.getLogger(__name__)
+
+# NOTE: all components are unweighted
+COMPONENTS = ['att', 'ctc', 'lm', 'lm_second', 'lm_second_bwd', 'length', 'cp']
+
+
+class NbestWriter(object):
+    """Accumulate N-best hypotheses and their score components per utterance."""
+
+    def __init__(self):
+        self.utt_ids = []
+        self.refs = []
+        self.hyps = []
+        self.hyp2utt = []
+        self.scores = []
+
+    def add(self, utt_id, ref, hyps, components):
+        """Add N-best hypotheses of an utterance.
+
+        Args:
+            utt_id (str): name of the utterance
+            ref (str): reference transcription
+            hyps (list): A list of length `[N]`, which contains transcriptions
+            components (list): A list of length `[N]`, which contains dicts of score components
+
+        """
+        for hyp, comp in zip(hyps, components):
+            self.hyps.append(hyp)
+            self.hyp2utt.append(len(self.utt_ids))
+            self.scores.append([comp.get(k, 0.) for k in COMPONENTS])
+        self.utt_ids.append(str(utt_id))
+        self.refs.append(ref)
+
+    def save(self, path):
+        save_nbest(path, {'utt_ids': self.utt_ids,
+                          'refs': self.refs,
+                          'hyps': self.hyps,
+                          'hyp2utt': self.hyp2utt,
+                          'scores': self.scores})
+
+
+def save_nbest(path, nbest):
+    """Save N-best lists in the format of NbestWriter.
+
+    Args:
+        path (str): path to the .npz file
+        nbest (dict): N-best lists (utt_ids/refs/hyps/hyp2utt/scores)
+
+    """
+    np.savez_compressed(path,
+                        utt_ids=np.array(nbest['utt_ids']),
+                        refs=np.array(nbest['refs']),
+                        hyps=np.array(nbest['hyps']),
+                        hyp2utt=np.array(nbest['hyp2utt'], dtype=np.int32),
+                        scores=np.array(nbest['scores'], dtype=np.float32).reshape(-1, len(COMPONENTS)),
+                        components=np.array(COMPONENTS))
+    logger.info('Saved %d hypotheses for %d utterances: %s' % (len(nbest['hyps']), len(nbest['utt_ids']), path))
+
+
+def load_nbest(paths):
+    """Load N-best lists saved by NbestWriter.
+
+    Args:
+        paths (list): paths to .npz files
+    Returns:
+        nbest (dict): concatenated N-best lists
+
+    """
+    nbest = {'utt_ids': [], 'refs': [], 'hyps': [], 'hyp2utt': [], 'scores': []}
+    n_utt = 0
+    for path in paths:
+        data = np.load(path)
+        assert list(data['components']) == COMPONENTS, path
+        for k in ['utt_ids', 'refs', 'hyps', 'scores']:
+            nbest[k].append(data[k])
+        nbest['hyp2utt'].append(data['hyp2utt'] + n_utt)
+        n_utt += len(data['utt_ids'])
+    return {k: np.concatenate(v) for k, v in nbest.items()}
+
+
+def rescore_nbest(nbest, weight_grid, char_level=False, remove_space=False):
+    """Pick the best hypothesis per utterance for each setting of weights.
+
+    The total score is computed in the same way as in beam search:
+        (1 - ctc_weight) * att + ctc_weight * ctc + lm_weight * lm
+        + lm_second_weight * lm_second + lm_bwd_weight * lm_second_bwd
+        + length_penalty * length + coverage_penalty * cp
+    The GNMT-style length and coverage penalties are not supported, and
+    scores are not normalized by the hypothesis length even if the N-best
+    lists were generated with `recog_length_norm`.
+
+    Components not computed in beam search (e.g., CTC scores decoded with
+    ctc_weight=0 or LM scores decoded without the LM) are saved as NaN, and
+    only zero weights can be used for them.
+
+    Args:
+        nbest (dict): N-best lists loaded by `load_nbest`
+        weight_grid (dict): candidates of each weight
+            (ctc_weight/lm_weight/lm_second_weight/lm_bwd_weight/length_penalty/coverage_penalty)
+        char_level (bool): compute CER instead of WER
+        remove_space (bool): remove spaces before computing CER
+    Returns:
+        results (list): A list of (setting (dict), error rate (float))
+
+    """
+    keys = ['ctc_weight', 'lm_weight', 'lm_second_weight', 'lm_bwd_weight',
+            'length_penalty', 'coverage_penalty']
+    settings = [dict(zip(keys, values)) for values in itertools.product(*[weight_grid[k] for k in keys])]
+    # `[G, n_components]`
+    weights = np.array([[1 - s['ctc_weight'], s['ctc_weight'], s['lm_weight'], s['lm_second_weight'],
+                         s['lm_bwd_weight'], s['length_penalty'], s['coverage_penalty']]
+                        for s in settings], dtype=np.float64)
+
+    # Count errors of every hypothesis only once
+    def tokenize(text):
+        text = str(text)
+        if char_level:
+            return list(text.replace(' ', '') if remove_space else text)
+        return text.split(' ')
+    refs = [tokenize(nbest['refs'][u]) for u in nbest['hyp2utt']]
+    hyps = [tokenize(h) for h in nbest['hyps']]
+    n_errs = compute_wer_batch(refs, hyps)[0] / 100  # `[N_hyp]`
+    n_ref_tokens = sum(len(tokenize(r)) for r in nbest['refs'])
+
+    scores = nbest['scores'].astype(np.float64)  # `[N_hyp, n_components]`
+    missing = np.isnan(scores).any(0)
+    for c in np.where(missing)[0]:
+        if (weights[:, c] != 0).any():
+            raise ValueError('%s scores were not computed in beam search (decode with a non-zero weight).'
+                             % COMPONENTS[c])
+    scores = np.where(missing, 0., scores) @ weights.T  # `[N_hyp, G]`
+    hyp2utt = nbest['hyp2utt']
+    n_utt = len(nbest['utt_ids'])
+    results = []
+    for g, setting in enumerate(settings):
+        # best hypothesis per utterance (the first one in the case of ties)
+        order = np.lexsort((-scores[:, g], hyp2utt))
+        is_first = np.ones(len(order), dtype=bool)
+        is_first[1:] = hyp2utt[order][1:] != hyp2utt[order][:-1]
+        best = order[is_first]
+        assert len(best) == n_utt
+        results.append((setting, float(n_errs[best].sum()) * 100 / n_ref_tokens))
+    return results
@@ -10,14 +10,14 @@ import codecs
 import logging
 from tqdm import tqdm
 
-from neural_sp.evaluators.edit_distance import compute_wer
+from neural_sp.evaluators.edit_distance import compute_wer_batch
 from neural_sp.utils import mkdir_join
 
 logger = logging.getLogger(__name__)
 
 
 def eval_phone(models, dataloader, recog_params, epoch,
-               recog_dir=None, streaming=False, progressbar=False):
+               recog_dir=None, streaming=False, progressbar=False, return_n_tokens=False):
     """Evaluate a phone-level model by PER.
 
     Args:
@@ -28,8 +28,10 @@ def eval_phone(models, dataloader, recog_params, epoch,
         recog_dir (str):
         streaming (bool): streaming decoding for the session-level evaluation
         progressbar (bool): visualize the progressbar
+        return_n_tokens (bool): also return the number of reference tokens used to normalize error rates
     Returns:
         per (float): Phone error rate
+        n_tokens (tuple): number of reference phones (if return_n_tokens)
 
     """
     if recog_dir is None:
@@ -47,6 +49,7 @@ def eval_phone(models, dataloader, recog_params, epoch,
     per = 0
     n_sub, n_ins, n_del = 0, 0, 0
     n_phone = 0
+    refs, hyps = [], []
 
     # Reset data counter
     dataloader.reset()
@@ -62,6 +65,12 @@ def eval_phone(models, dataloader, recog_params, epoch,
                 best_hyps_id, _ = models[0].decode_streaming(
                     batch['xs'], recog_params, dataloader.idx2token[0],
                     exclude_eos=True)
+            elif recog_params['recog_long_form']:
+                best_hyps_id, _ = models[0].decode_long_form(
+                    batch['xs'], recog_params,
+                    idx2token=dataloader.idx2token[0] if progressbar else None,
+                    exclude_eos=True,
+                    speakers=batch['sessions' if dataloader.corpus == 'swbd' else 'speakers'])
             else:
                 best_hyps_id, _ = models[0].decode(
                     batch['xs'], recog_params,
@@ -91,13 +100,8 @@ def eval_phone(models, dataloader, recog_params, epoch,
 
                 if not streaming:
                     # Compute PER
-                    per_b, sub_b, ins_b, del_b = compute_wer(ref=ref.split(' '),
-                                                             hyp=hyp.split(' '),
-                                                             normalize=False)
-                    per += per_b
-                    n_sub += sub_b
-                    n_ins += ins_b
-                    n_del += del_b
+                    refs.append(ref.split(' '))
+                    hyps.append(hyp.split(' '))
                     n_phone += len(ref.split(' '))
 
                 if progressbar:
@@ -113,6 +117,7 @@ def eval_phone(models, dataloader, recog_params, epoch,
     dataloader.reset()
 
     if not streaming:
+        per, n_sub, n_ins, n_del = [float(c.sum()) for c in compute_wer_batch(refs, hyps)]
         per /= n_phone
         n_sub /= n_phone
         n_ins /= n_phone
@@ -121,4 +126,6 @@ def eval_phone(models, dataloader, recog_params, epoch,
     logger.debug('PER (%s): %.2f %%' % (dataloader.set, per))
     logger.debug('SUB: %.2f / INS: %.2f / DEL: %.2f' % (n_sub, n_ins, n_del))
 
+    if return_n_tokens:
+        return per, (n_phone,)
     return per
@@ -10,9 +10,11 @@ import codecs
 import copy
 import logging
 import numpy as np
+import os
 from tqdm import tqdm
 
-from neural_sp.evaluators.edit_distance import compute_wer
+from neural_sp.evaluators.edit_distance import compute_wer_batch
+from neural_sp.evaluators.nbest import NbestWriter
 from neural_sp.evaluators.resolving_unk import resolve_unk
 from neural_sp.utils import mkdir_join
 
@@ -20,7 +22,7 @@ logger = logging.getLogger(__name__)
 
 
 def eval_word(models, dataloader, recog_params, epoch,
-              recog_dir=None, streaming=False, progressbar=False):
+              recog_dir=None, streaming=False, progressbar=False, return_n_tokens=False):
     """Evaluate the word-level model by WER.
 
     Args:
@@ -31,10 +33,12 @@ def eval_word(models, dataloader, recog_params, epoch,
         recog_dir (str):
         streaming (bool): streaming decoding for the session-level evaluation
         progressbar (bool): visualize the progressbar
+        return_n_tokens (bool): also return the number of reference tokens used to normalize error rates
     Returns:
         wer (float): Word error rate
         cer (float): Character error rate
         n_oov_total (int): totol number of OOV
+        n_tokens (tuple): number of reference words and characters (if return_n_tokens)
 
     """
     if recog_dir is None:
@@ -55,6 +59,12 @@ def eval_word(models, dataloader, recog_params, epoch,
     n_sub_c, n_ins_c, n_del_c = 0, 0, 0
     n_word, n_char = 0, 0
     n_oov_total = 0
+    refs_w, hyps_w = [], []
+    refs_c, hyps_c = [], []
+
+    nbest_writer = None
+    if recog_params.get('recog_nbest_export', False):
+        nbest_writer = NbestWriter()
 
     # Reset data counter
     dataloader.reset(recog_params['recog_batch_size'])
@@ -70,6 +80,13 @@ def eval_word(models, dataloader, recog_params, epoch,
                 best_hyps_id, _ = models[0].decode_streaming(
                     batch['xs'], recog_params, dataloader.idx2token[0],
                     exclude_eos=True)
+            elif recog_params['recog_long_form']:
+                best_hyps_id, _ = models[0].decode_long_form(
+                    batch['xs'], recog_params,
+                    idx2token=dataloader.idx2token[0] if progressbar else None,
+                    exclude_eos=True,
+                    speakers=batch['sessions' if dataloader.corpus == 'swbd' else 'speakers'])
+                aws = None
             else:
                 best_hyps_id, aws = models[0].decode(
                     batch['xs'], recog_params,
@@ -116,13 +133,8 @@ def eval_word(models, dataloader, recog_params, epoch,
                     if dataloader.corpus == 'csj':
                         ref_char = ref.replace(' ', '')
                         hyp_char = hyp.replace(' ', '')
-                    cer_b, sub_b, ins_b, del_b = compute_wer(ref=list(ref_char),
-                                                             hyp=list(hyp_char),
-                                                             normalize=False)
-                    cer += cer_b
-                    n_sub_c += sub_b
-                    n_ins_c += ins_b
-                    n_del_c += del_b
+                    refs_c.append(list(ref_char))
+                    hyps_c.append(list(hyp_char))
                     n_char += len(ref_char)
 
                 # Write to trn
@@ -138,15 +150,15 @@ def eval_word(models, dataloader, recog_params, epoch,
                 logger.debug('Hyp: %s' % hyp)
                 logger.debug('-' * 150)
 
+                if nbest_writer is not None and models[0].nbest_components is not None:
+                    nbest = models[0].nbest_components[b]
+                    nbest_writer.add(batch['utt_ids'][b], ref,
+                                     [dataloader.idx2token[0](h['hyp']) for h in nbest], nbest)
+
                 if not streaming:
                     # Compute WER
-                    wer_b, sub_b, ins_b, del_b = compute_wer(ref=ref.split(' '),
-                                                             hyp=hyp.split(' '),
-                                                             normalize=False)
-                    wer += wer_b
-                    n_sub_w += sub_b
-                    n_ins_w += ins_b
-                    n_del_w += del_b
+                    refs_w.append(ref.split(' '))
+                    hyps_w.append(hyp.split(' '))
                     n_word += len(ref.split(' '))
 
                 if progressbar:
@@ -161,13 +173,18 @@ def eval_word(models, dataloader, recog_params, epoch,
     # Reset data counters
     dataloader.reset()
 
+    if nbest_writer is not None:
+        nbest_writer.save(os.path.join(os.path.dirname(hyp_trn_path), 'nbest.npz'))
+
     if not streaming:
+        wer, n_sub_w, n_ins_w, n_del_w = [float(c.sum()) for c in compute_wer_batch(refs_w, hyps_w)]
         wer /= n_word
         n_sub_w /= n_word
         n_ins_w /= n_word
         n_del_w /= n_word
 
         if n_char > 0:
+            cer, n_sub_c, n_ins_c, n_del_c = [float(c.sum()) for c in compute_wer_batch(refs_c, hyps_c)]
             cer /= n_char
             n_sub_c /= n_char
             n_ins_c /= n_char
@@ -179,4 +196,6 @@ def eval_word(models, dataloader, recog_params, epoch,
     logger.debug('SUB: %.2f / INS: %.2f / DEL: %.2f' % (n_sub_c, n_ins_c, n_del_c))
     logger.debug('OOV (total): %d' % (n_oov_total))
 
+    if return_n_tokens:
+        return (wer, cer, n_oov_total), (n_word, n_char)
     return wer, cer, n_oov_total
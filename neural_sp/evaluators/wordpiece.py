@@ -8,9 +8,11 @@
 
 import codecs
 import logging
+import os
 from tqdm import tqdm
 
-from neural_sp.evaluators.edit_distance import compute_wer
+from neural_sp.evaluators.edit_distance import compute_wer_batch
+from neural_sp.evaluators.nbest import NbestWriter
 from neural_sp.utils import mkdir_join
 
 logger = logging.getLogger(__name__)
@@ -18,7 +20,7 @@ logger = logging.getLogger(__name__)
 
 def eval_wordpiece(models, dataloader, recog_params, epoch,
                    recog_dir=None, streaming=False, progressbar=False,
-                   fine_grained=False):
+                   fine_grained=False, return_n_tokens=False):
     """Evaluate the wordpiece-level model by WER.
 
     Args:
@@ -30,9 +32,11 @@ def eval_wordpiece(models, dataloader, recog_params, epoch,
         streaming (bool): streaming decoding for the session-level evaluation
         progressbar (bool): visualize the progressbar
         fine_grained (bool): calculate fine-grained WER distributions based on input lengths
+        return_n_tokens (bool): also return the number of reference tokens used to normalize error rates
     Returns:
         wer (float): Word error rate
         cer (float): Character error rate
+        n_tokens (tuple): number of reference words and characters (if return_n_tokens)
 
     """
     if recog_dir is None:
@@ -53,9 +57,15 @@ def eval_wordpiece(models, dataloader, recog_params, epoch,
     n_sub_c, n_ins_c, n_del_c = 0, 0, 0
     n_word, n_char = 0, 0
     wer_dist = {}  # calculate WER distribution based on input lengths
+    refs_w, hyps_w, xlen_bins = [], [], []
+    refs_c, hyps_c = [], []
     n_streamable, quantity_rate, n_utt = 0, 0, 0
     last_success_frame_ratio = 0
 
+    nbest_writer = None
+    if recog_params.get('recog_nbest_export', False):
+        nbest_writer = NbestWriter()
+
     # Reset data counter
     dataloader.reset(recog_params['recog_batch_size'])
 
@@ -70,6 +80,12 @@ def eval_wordpiece(models, dataloader, recog_params, epoch,
                 best_hyps_id, _ = models[0].decode_streaming(
                     batch['xs'], recog_params, dataloader.idx2token[0],
                     exclude_eos=True)
+            elif recog_params['recog_long_form']:
+                best_hyps_id, _ = models[0].decode_long_form(
+                    batch['xs'], recog_params,
+                    idx2token=dataloader.idx2token[0] if progressbar else None,
+                    exclude_eos=True,
+                    speakers=batch['sessions' if dataloader.corpus == 'swbd' else 'speakers'])
             else:
                 best_hyps_id, _ = models[0].decode(
                     batch['xs'], recog_params,
@@ -99,35 +115,24 @@ def eval_wordpiece(models, dataloader, recog_params, epoch,
                 logger.debug('Hyp: %s' % hyp)
                 logger.debug('-' * 150)
 
+                if nbest_writer is not None and models[0].nbest_components is not None:
+                    nbest = models[0].nbest_components[b]
+                    nbest_writer.add(batch['utt_ids'][b], ref,
+                                     [dataloader.idx2token[0](h['hyp']) for h in nbest], nbest)
+
                 if not streaming:
                     # Compute WER
-                    wer_b, sub_b, ins_b, del_b = compute_wer(ref=ref.split(' '),
-                                                             hyp=hyp.split(' '),
-                                                             normalize=False)
-                    wer += wer_b
-                    n_sub_w += sub_b
-                    n_ins_w += ins_b
-                    n_del_w += del_b
+                    refs_w.append(ref.split(' '))
+                    hyps_w.append(hyp.split(' '))
                     n_word += len(ref.split(' '))
-
-                    if fine_grained:
-                        xlen_bin = (batch['xlens'][b] // 200 + 1) * 200
-                        if xlen_bin in wer_dist.keys():
-                            wer_dist[xlen_bin] += [wer_b / 100]
-                        else:
-                            wer_dist[xlen_bin] = [wer_b / 100]
+                    xlen_bins.append((batch['xlens'][b] // 200 + 1) * 200)
 
                     # Compute CER
                     if dataloader.corpus == 'csj':
                         ref = ref.replace(' ', '')
                         hyp = hyp.replace(' ', '')
-                    cer_b, sub_b, ins_b, del_b = compute_wer(ref=list(ref),
-                                                             hyp=list(hyp),
-                                                             normalize=False)
-                    cer += cer_b
-                    n_sub_c += sub_b
-                    n_ins_c += ins_b
-                    n_del_c += del_b
+                    refs_c.append(list(ref))
+                    hyps_c.append(list(hyp))
                     n_char += len(ref)
                     if models[0].streamable():
                         n_streamable += 1
@@ -148,12 +153,18 @@ def eval_wordpiece(models, dataloader, recog_params, epoch,
     # Reset data counters
     dataloader.reset()
 
+    if nbest_writer is not None:
+        nbest_writer.save(os.path.join(os.path.dirname(hyp_trn_path), 'nbest.npz'))
+
     if not streaming:
+        wers, n_subs_w, n_inss_w, n_dels_w = compute_wer_batch(refs_w, hyps_w)
+        wer, n_sub_w, n_ins_w, n_del_w = [float(c.sum()) for c in [wers, n_subs_w, n_inss_w, n_dels_w]]
         wer /= n_word
         n_sub_w /= n_word
         n_ins_w /= n_word
         n_del_w /= n_word
 
+        cer, n_sub_c, n_ins_c, n_del_c = [float(c.sum()) for c in compute_wer_batch(refs_c, hyps_c)]
         cer /= n_char
         n_sub_c /= n_char
         n_ins_c /= n_char
@@ -165,6 +176,11 @@ def eval_wordpiece(models, dataloader, recog_params, epoch,
         quantity_rate /= n_utt
 
         if fine_grained:
+            for xlen_bin, wer_b in zip(xlen_bins, wers):
+                if xlen_bin in wer_dist.keys():
+                    wer_dist[xlen_bin] += [wer_b / 100]
+                else:
+                    wer_dist[xlen_bin] = [wer_b / 100]
             for len_bin, wers in sorted(wer_dist.items(), key=lambda x: x[0]):
                 logger.info('  WER (%s): %.2f %% (%d)' % (dataloader.set, sum(wers) / len(wers), len_bin))
 
@@ -177,4 +193,6 @@ def eval_wordpiece(models, dataloader, recog_params, epoch,
     logger.info('Quantity rate (%s): %.2f %%' % (dataloader.set, quantity_rate * 100))
     logger.info('Last success frame ratio (%s): %.2f %%' % (dataloader.set, last_success_frame_ratio))
 
+    if return_n_tokens:
+        return (wer, cer), (n_word, n_char)
     return wer, cer
@@ -19,8 +19,9 @@ import torch.nn.functional as F
 class MBR(torch.autograd.Function):
     """Minimum Bayes Risk (MBR) training.
 
-    Args:
-        vocab (int): number of nodes in softmax layer
+    The expected risk is returned in the forward pass and the gradient with
+    respect to each hypothesis is attached to its token log-probabilities
+    in the backward pass.
 
     """
     @staticmethod
@@ -29,25 +30,22 @@ class MBR(torch.autograd.Function):
 
         Args:
             log_probs (FloatTensor): `[N_best, L, vocab]`
-            hyps (LongTensor): `[N_best, L]`
+            hyps (LongTensor): `[N_best, L]` (padded with -1)
             exp_risk (FloatTensor): `[1]` (for forward)
-            grad (FloatTensor): `[1]` (for backward)
+            grad (FloatTensor): `[N_best]` (for backward)
         Returns:
             loss (FloatTensor): `[1]`
 
         """
-        device_id = torch.cuda.device_of(log_probs).idx
-        onehot = torch.eye(log_probs.size(-1)).cuda(device_id)[hyps]
-        grads = grad * onehot  # mask out other classes
-        log_probs = log_probs.requires_grad_()
-        ctx.save_for_backward(log_probs, grads)
+        onehot = log_probs.new_zeros(log_probs.size())
+        onehot.scatter_(2, hyps.clamp(min=0).unsqueeze(2), 1.)
+        onehot.masked_fill_((hyps < 0).unsqueeze(2), 0)  # mask out padding
+        ctx.grads = grad.view(-1, 1, 1) * onehot  # mask out other classes
         return exp_risk
 
     @staticmethod
     def backward(ctx, grad_output):
-        input, grads, = ctx.saved_tensors
-        input.grad = grads
-        return input, None, None, None
+        return ctx.grads * grad_output, None, None, None
 
 
 def cross_entropy_lsm(logits, ys, lsm_prob, ignore_index, training, normalize_length=False):
@@ -114,6 +112,29 @@ def distillation(logits_student, logits_teacher, ylens, temperature=5.0):
     return loss_mean
 
 
+def interval_latency(aws):
+    """Compute latency loss based on intervals between adjacent alignments.
+
+    The expected interval of the l-th token at the i-th frame from the
+    (l-1)-th token is sum_(j<i) (i - j) * aws_(l-1, j), which is computed
+    by cumulative sums over frames instead of a `[T, T]` delay matrix.
+
+    Args:
+        aws (FloatTensor): `[B, H, L, T]`
+    Returns:
+        loss_mean (FloatTensor): `[1]`
+
+    """
+    xmax = aws.size(-1)
+    aws_prev = torch.cat([aws.new_zeros(aws.size())[:, :, -1:], aws[:, :, :-1]], dim=2)
+    js = torch.arange(xmax, dtype=aws.dtype, device=aws.device)
+    mass_prev = torch.cumsum(aws_prev, dim=-1)  # `[B, H, L, T]`
+    moment_prev = torch.cumsum(aws_prev * js, dim=-1)  # `[B, H, L, T]`
+    interval = js * mass_prev - moment_prev  # `[B, H, L, T]`
+    loss = torch.pow(aws * interval, 2).sum(-1)  # `[B, H, L]`
+    return torch.mean(loss)
+
+
 def kldiv_lsm_ctc(logits, ylens):
     """Compute KL divergence loss for label smoothing of CTC and Transducer models.
 
@@ -13,9 +13,9 @@ def build_lm(args, save_path=None, wordlm=False, lm_dict_path=None, asr_dict_pat
     Args:
         args ():
         save_path (str):
-        wordlm (bool):
-        lm_dict_path (dict):
-        asr_dict_path (dict):
+        wordlm (bool): fuse a word-level LM with character/wordpiece ASR
+        lm_dict_path (str): path to the dictionary of the LM
+        asr_dict_path (str): path to the dictionary of the ASR model
     Returns:
         lm ():
 
@@ -33,4 +33,8 @@ def build_lm(args, save_path=None, wordlm=False, lm_dict_path=None, asr_dict_pat
         from neural_sp.models.lm.rnnlm import RNNLM
         lm = RNNLM(args, save_path)
 
+    if wordlm:
+        from neural_sp.models.lm.lookahead_wordlm import LookAheadWordLM
+        lm = LookAheadWordLM(lm, lm_dict_path, asr_dict_path)
+
     return lm
@@ -8,6 +8,7 @@
 
 from collections import OrderedDict
 import logging
+import torch
 import torch.nn as nn
 
 from neural_sp.models.lm.lm_base import LMBase
@@ -40,9 +41,11 @@ class GatedConvLM(LMBase):
         # for cache
         self.cache_theta = 0.2  # smoothing parameter
         self.cache_lambda = 0.2  # cache weight
-        self.cache_ids = []
-        self.cache_keys = []
-        self.cache_attn = []
+        self.reset_cache()
+
+        # for candidate-shortlist scoring
+        self.shortlist_partition_size = getattr(args, 'recog_lm_shortlist_partition_size', 1024)
+        self.shortlist_sample_ids = None
 
         self.embed = nn.Embedding(self.vocab, args.emb_dim, padding_idx=self.pad)
         self.dropout_embed = nn.Dropout(p=args.dropout_in)
@@ -132,6 +135,8 @@ class GatedConvLM(LMBase):
             raise NotImplementedError(model_size)
 
         self.blocks = nn.Sequential(blocks)
+        # size of the left context of each block for incremental decoding
+        self.state_sizes = [block.in_ch * (block.kernel_size - 1) for block in self.blocks]
 
         if args.adaptive_softmax:
             self.adaptive_softmax = nn.AdaptiveLogSoftmaxWithLoss(
@@ -188,32 +193,66 @@ class GatedConvLM(LMBase):
             else:
                 raise ValueError(n)
 
-    def decode(self, ys, state=None, mems=None, incremental=False):
+    def decode(self, ys, state=None, mems=None, cache=None, incremental=False, skip_output=False):
         """Decode function.
 
         Args:
             ys (LongTensor): `[B, L]`
-            state: dummy interfance for RNNLM
+            state (dict): left context of all blocks for incremental decoding
+                hxs (FloatTensor): `[1, B, sum(state_sizes)]`
+                cxs (FloatTensor): `[1, B, 0]`
+            mems: dummy interfance for TransformerXL
             cache: dummy interfance for TransformerLM/TransformerXL
-            incremental: dummy interfance for TransformerLM/TransformerXL
+            incremental (bool): ASR decoding mode
+            skip_output (bool): return inputs to the output layer instead of logits
         Returns:
             logits (FloatTensor): `[B, L, vocab]`
             out (FloatTensor): `[B, L, d_model]` (for cache)
-            new_cache: dummy interfance for RNNLM/TransformerLM/TransformerXL
-            new_mems: dummy interfance for TransformerXL
+            new_state (dict): left context of all blocks (None if not incremental)
+                hxs (FloatTensor): `[1, B, sum(state_sizes)]`
+                cxs (FloatTensor): `[1, B, 0]`
 
         """
         out = self.dropout_embed(self.embed(ys.long()))
         bs, max_ylen = out.size()[:2]
 
         # NOTE: consider embed_dim as in_ch
-        out = out.unsqueeze(3)
-        out = self.blocks(out.transpose(2, 1))  # [B, out_ch, T, 1]
+        out = out.unsqueeze(3).transpose(2, 1)  # `[B, in_ch, T, 1]`
+        new_state = None
+        if incremental:
+            # Convolve new tokens only with the last `kernel_size - 1` inputs of each block
+            if state is None:
+                state = self.zero_state(bs)
+            buffers = torch.split(state['hxs'][0], self.state_sizes, dim=-1)
+            new_buffers = []
+            for block, buffer in zip(self.blocks, buffers):
+                out, buffer = block.forward_incremental(out, buffer.view(bs, block.in_ch, -1, 1))
+                new_buffers.append(buffer.reshape(bs, -1))
+            new_state = {'hxs': torch.cat(new_buffers, dim=-1).unsqueeze(0),
+                         'cxs': state['cxs']}
+        else:
+            out = self.blocks(out)  # [B, out_ch, T, 1]
         out = out.transpose(2, 1).contiguous()  # `[B, T, out_ch, 1]`
         out = out.squeeze(3)
-        if self.adaptive_softmax is None:
+        if self.adaptive_softmax is None and not skip_output:
             logits = self.output(out)
         else:
             logits = out
 
-        return logits, out, None
+        return logits, out, new_state
+
+    def zero_state(self, batch_size):
+        """Initialize the left context of all blocks.
+
+        Args:
+            batch_size (int): batch size
+        Returns:
+            state (dict):
+                hxs (FloatTensor): `[1, B, sum(state_sizes)]`
+                cxs (FloatTensor): `[1, B, 0]`
+
+        """
+        w = next(self.parameters())
+        # NOTE: the same layout as the LSTM state of RNNLM so that beam search can handle both
+        return {'hxs': w.new_zeros(1, batch_size, sum(self.state_sizes)),
+                'cxs': w.new_zeros(1, batch_size, 0)}
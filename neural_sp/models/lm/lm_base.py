@@ -9,6 +9,7 @@
 import logging
 import numpy as np
 import torch
+import torch.nn.functional as F
 
 from neural_sp.models.base import ModelBase
 from neural_sp.models.criterion import cross_entropy_lsm
@@ -72,33 +73,13 @@ class LMBase(ModelBase):
             logits = logits[:, -1].unsqueeze(1)
 
         # Compute XE sequence loss
-        if n_caches > 0 and len(self.cache_ids) > 0:
-            assert ys_out.size(1) == 1
-            assert ys_out.size(0) == 1
-            if self.adaptive_softmax is None:
-                probs = torch.softmax(logits, dim=-1)
-            else:
-                probs = self.adaptive_softmax.log_prob(logits).exp()
-            cache_probs = probs.new_zeros(probs.size())
-
-            # Truncate cache
-            self.cache_ids = self.cache_ids[-n_caches:]  # list of `[B, 1]`
-            self.cache_keys = self.cache_keys[-n_caches:]  # list of `[B, 1, n_units]`
-
-            # Compute inner-product over caches
-            cache_attn = torch.softmax(self.cache_theta * torch.matmul(
-                torch.cat(self.cache_keys, dim=1), out.transpose(2, 1)).squeeze(2), dim=1)
-
-            # For visualization
-            if len(self.cache_ids) == n_caches:
-                self.cache_attn += [cache_attn.cpu().numpy()]
-                self.cache_attn = self.cache_attn[-n_caches:]
-
-            # Sum all probabilities
-            for offset, idx in enumerate(self.cache_ids):
-                cache_probs[:, :, idx] += cache_attn[:, offset]
-            probs = (1 - self.cache_lambda) * probs + self.cache_lambda * cache_probs
-            loss = -torch.log(probs[:, :, ys_out[:, -1]])
+        if n_caches > 0:
+            if predict_last:
+                out = out[:, -1:]
+            probs = self.cache_probs(logits, out, ys_out, n_caches)
+            mask = ys_out != self.pad
+            loss = -torch.log(torch.gather(probs, 2, ys_out.unsqueeze(2)).squeeze(2)[mask]).mean()
+            ppl = np.exp(loss.item())
         else:
             if self.adaptive_softmax is None:
                 loss, ppl = cross_entropy_lsm(logits, ys_out.contiguous(),
@@ -109,11 +90,6 @@ class LMBase(ModelBase):
                                              ys_out.contiguous().view(-1)).loss
                 ppl = np.exp(loss.item())
 
-        if n_caches > 0:
-            # Register to cache
-            self.cache_ids += [ys_out[0, -1].item()]
-            self.cache_keys += [out]
-
         # Compute token-level accuracy in teacher-forcing
         if self.adaptive_softmax is None:
             acc = compute_accuracy(logits, ys_out, pad=self.pad)
@@ -124,6 +100,85 @@ class LMBase(ModelBase):
         observation = {'loss.lm': loss.item(), 'acc.lm': acc, 'ppl.lm': ppl}
         return loss, new_state, observation
 
+    def reset_cache(self):
+        """Reset the neural cache."""
+        self.cache_keys = None  # `[B, n_caches, n_units]`
+        self.cache_ids = None  # `[B, n_caches]`
+        self.cache_steps = None  # `[n_caches]`, time step of each slot (-1 for empty slots)
+        self.cache_step = 0  # number of tokens seen so far
+        self.cache_attn = []  # for visualization
+
+    def cache_probs(self, logits, out, ys_out, n_caches):
+        """Interpolate output distributions with the neural cache (Grave et al., 2017).
+
+        Each token attends to hidden states of the previous `n_caches` tokens
+        (including those in previous calls) and the attention weights are
+        added to the probabilities of their next tokens. The cache is a ring
+        buffer shared by all tokens in a mini-batch, so the whole segment is
+        processed at once.
+
+        Args:
+            logits (FloatTensor): `[B, L, vocab]`
+            out (FloatTensor): `[B, L, n_units]`
+            ys_out (LongTensor): `[B, L]`
+            n_caches (int): number of cached tokens
+        Returns:
+            probs (FloatTensor): `[B, L, vocab]`
+
+        """
+        bs, ylen = ys_out.size()
+        if self.adaptive_softmax is None:
+            probs = torch.softmax(logits, dim=-1)
+        else:
+            probs = self.adaptive_softmax.log_prob(logits.view(-1, logits.size(2))).exp().view(bs, ylen, -1)
+
+        if self.cache_keys is None or self.cache_keys.size(0) != bs or self.cache_keys.size(1) != n_caches:
+            self.cache_keys = out.new_zeros(bs, n_caches, out.size(2))
+            self.cache_ids = ys_out.new_zeros(bs, n_caches)
+            self.cache_steps = ys_out.new_full((n_caches,), -1)
+            self.cache_step = 0
+
+        step_begin = self.cache_step
+        steps = torch.arange(ylen, device=ys_out.device) + step_begin  # `[L]`
+        keys = torch.cat([self.cache_keys, out], dim=1)  # `[B, n_caches + L, n_units]`
+        ids = torch.cat([self.cache_ids, ys_out], dim=1)  # `[B, n_caches + L]`
+        key_steps = torch.cat([self.cache_steps, steps])  # `[n_caches + L]`
+
+        # Each token attends to the previous `n_caches` tokens
+        diff = steps[:, None] - key_steps[None, :]  # `[L, n_caches + L]`
+        valid = (key_steps >= 0)[None] & (diff > 0) & (diff <= n_caches)
+        valid = valid[None] & (ids != self.pad)[:, None]  # `[B, L, n_caches + L]`
+
+        # Compute inner-product over caches
+        e = self.cache_theta * torch.matmul(out, keys.transpose(2, 1))  # `[B, L, n_caches + L]`
+        NEG_INF = float(np.finfo(torch.tensor(0, dtype=e.dtype).numpy().dtype).min)
+        cache_attn = torch.softmax(e.masked_fill(~valid, NEG_INF), dim=-1) * valid.float()
+
+        # Sum all probabilities
+        cache_probs = probs.new_zeros(probs.size()).scatter_add_(
+            2, ids.unsqueeze(1).expand(-1, ylen, -1), cache_attn)
+        cache_lambda = self.cache_lambda * valid.any(dim=2, keepdim=True).float()  # no cache for the first token
+        probs = (1 - cache_lambda) * probs + cache_lambda * cache_probs
+
+        # For visualization (from the oldest to the latest key)
+        is_full = steps >= n_caches
+        if is_full.any():
+            window = steps[is_full, None] - n_caches + torch.arange(n_caches, device=steps.device)
+            cols = torch.where(window >= step_begin, window - step_begin + n_caches, window % n_caches)
+            aws = cache_attn[:, is_full].gather(2, cols.unsqueeze(0).expand(bs, -1, -1))
+            self.cache_attn += list(aws.transpose(0, 1).cpu().numpy())
+            self.cache_attn = self.cache_attn[-n_caches:]
+
+        # Register to the ring buffer
+        n_new = min(ylen, n_caches)
+        slots = steps[-n_new:] % n_caches
+        self.cache_keys[:, slots] = out[:, -n_new:].detach()
+        self.cache_ids[:, slots] = ys_out[:, -n_new:]
+        self.cache_steps[slots] = steps[-n_new:]
+        self.cache_step += ylen
+
+        return probs
+
     def repackage_state(self, state):
         return state
 
@@ -131,10 +186,10 @@ class LMBase(ModelBase):
         # for TransformerXL
         self.mem_len = mem_len
 
-    def decode(self, ys, state=None, mems=None, incremental=False):
+    def decode(self, ys, state=None, mems=None, incremental=False, skip_output=False):
         raise NotImplementedError
 
-    def predict(self, ys, state=None, mems=None, cache=None):
+    def predict(self, ys, state=None, mems=None, cache=None, shortlist=False):
         """Precict function for ASR.
 
         Args:
@@ -144,9 +199,11 @@ class LMBase(ModelBase):
                     hxs (FloatTensor): `[n_layers, B, n_units]`
                     cxs (FloatTensor): `[n_layers, B, n_units]`
                 - TransformerLM (LongTensor): `[B, L]`
-                - TransformerXL (list): length `n_layers + 1`, each of which contains a tensor`[B, L, d_model]`
-            mems (list):
+                - TransformerXL (list): length `n_layers`, each of which contains keys and values `[B, L, d_model * 2]`
+            mems (XLMemory): memory of TransformerXL
             cache (list):
+            shortlist (bool): skip the output layer. Inputs to the output layer are
+                returned instead of `log_probs` and scored with `score_shortlist`
         Returns:
             lmout (FloatTensor): `[B, L, vocab]`, used for LM integration such as cold fusion
             state:
@@ -154,15 +211,68 @@ class LMBase(ModelBase):
                     hxs (FloatTensor): `[n_layers, B, n_units]`
                     cxs (FloatTensor): `[n_layers, B, n_units]`
                 - TransformerLM (LongTensor): `[B, L]`
-                - TransformerXL (list): length `n_layers + 1`, each of which contains a tensor`[B, L, d_model]`
-            log_probs (FloatTensor): `[B, L, vocab]`
+                - TransformerXL (list): length `n_layers`, each of which contains keys and values `[B, L, d_model * 2]`
+            log_probs (FloatTensor): `[B, L, vocab]` (`[B, L, n_units]` if shortlist is True)
 
         """
         logits, lmout, new_state = self.decode(ys, state, mems=mems, cache=cache,
-                                               incremental=True)
-        log_probs = torch.log_softmax(logits, dim=-1)
+                                               incremental=True, skip_output=shortlist)
+        if shortlist:
+            return lmout, new_state, logits
+        if self.adaptive_softmax is None:
+            log_probs = torch.log_softmax(logits, dim=-1)
+        else:
+            log_probs = self.adaptive_softmax.log_prob(
+                logits.view(-1, logits.size(2))).view(logits.size(0), logits.size(1), -1)
         return lmout, new_state, log_probs
 
+    def score_shortlist(self, feats, candidates):
+        """Compute log probabilities of candidate tokens only.
+
+        With adaptive softmax, log probabilities are exact and only tail clusters
+        containing candidates are evaluated. Otherwise, the partition function is
+        computed over the first `shortlist_partition_size` tokens (the most frequent
+        ones for word vocabularies) plus an estimate of the remaining tokens from
+        a fixed random sample of the same size. It is exact for small vocabularies.
+
+        Args:
+            feats (FloatTensor): inputs to the output layer. `[B, n_units]`
+            candidates (LongTensor): `[B, K]`
+        Returns:
+            log_probs (FloatTensor): `[B, K]`
+
+        """
+        if self.adaptive_softmax is not None:
+            asm = self.adaptive_softmax
+            head_log_probs = torch.log_softmax(asm.head(feats), dim=-1)  # `[B, shortlist_size + n_clusters]`
+            log_probs = head_log_probs.gather(1, candidates.clamp(max=asm.shortlist_size - 1))
+            for i in range(asm.n_clusters):
+                start, end = asm.cutoffs[i], asm.cutoffs[i + 1]
+                in_cluster = (candidates >= start) & (candidates < end)
+                if not in_cluster.any():
+                    continue
+                tail_log_probs = torch.log_softmax(asm.tail[i](feats), dim=-1)  # `[B, end - start]`
+                tail_log_probs = tail_log_probs.gather(1, (candidates - start).clamp(0, end - start - 1))
+                cluster_log_probs = head_log_probs[:, asm.shortlist_size + i].unsqueeze(1)
+                log_probs = torch.where(in_cluster, cluster_log_probs + tail_log_probs, log_probs)
+            return log_probs
+
+        weight, bias = self.output.weight, self.output.bias
+        logits = torch.einsum('bd,bkd->bk', feats, weight[candidates]) + bias[candidates]
+        n_head = self.shortlist_partition_size
+        if self.vocab <= n_head * 2:
+            return logits - torch.logsumexp(self.output(feats), dim=-1, keepdim=True)
+
+        if self.shortlist_sample_ids is None or self.shortlist_sample_ids.device != feats.device:
+            generator = torch.Generator().manual_seed(1)
+            sample_ids = torch.randperm(self.vocab - n_head, generator=generator)[:n_head] + n_head
+            self.shortlist_sample_ids = sample_ids.to(feats.device)
+        log_z_head = torch.logsumexp(F.linear(feats, weight[:n_head], bias[:n_head]), dim=-1)
+        log_z_tail = torch.logsumexp(F.linear(
+            feats, weight[self.shortlist_sample_ids], bias[self.shortlist_sample_ids]), dim=-1)
+        log_z_tail += np.log((self.vocab - n_head) / n_head)
+        return logits - torch.logaddexp(log_z_head, log_z_tail).unsqueeze(1)
+
     def plot_attention(self):
         # raise NotImplementedError
         pass
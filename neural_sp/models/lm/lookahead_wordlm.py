@@ -0,0 +1,429 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Look-ahead word-level LM for character and wordpiece ASR."""
+
+import codecs
+import logging
+import math
+import torch
+import torch.nn as nn
+
+from neural_sp.models.lm.gated_convlm import GatedConvLM
+from neural_sp.models.lm.rnnlm import RNNLM
+
+logger = logging.getLogger(__name__)
+
+NORMAL = 0
+BOUNDARY = 1
+EOS = 2
+SPECIAL = 3
+
+
+class LookAheadWordLM(nn.Module):
+    """Word-level LM fused with sub-word ASR via a lexicon prefix tree.
+
+    Each ASR hypothesis is mapped onto a node of a character-level prefix tree
+    of the LM vocabulary. Inside a word, a sub-word token is scored by the
+    look-ahead probability, i.e., the word-LM probability mass of all words
+    sharing the extended prefix divided by that of the current prefix.
+    The word LM is advanced only at word boundaries, so the sum of the token
+    scores over a word equals its word-LM log probability (normalized over
+    the lexicon). Out-of-lexicon words are scored by a fixed penalty.
+
+    Args:
+        wordlm (RNNLM or GatedConvLM): word-level LM
+        lm_dict_path (str): path to the dictionary of the word LM
+        asr_dict_path (str): path to the dictionary of the ASR model
+        oov_penalty (float): probability of out-of-lexicon words
+        zero (float): probability floor of tokens off the prefix tree
+        cache_size (int): maximum number of word LM states cached by word history
+
+    """
+
+    def __init__(self, wordlm, lm_dict_path, asr_dict_path, oov_penalty=1e-4, zero=1e-10,
+                 cache_size=10000):
+        super(LookAheadWordLM, self).__init__()
+        assert isinstance(wordlm, RNNLM) or isinstance(wordlm, GatedConvLM), \
+            'word LM must be RNNLM or GatedConvLM.'
+
+        self.wordlm = wordlm
+        self.log_oov_penalty = math.log(oov_penalty)
+        self.log_zero = math.log(zero)
+        self.zero = zero
+
+        # Word LM states are shared among hypotheses with the same word history.
+        # History indices are never reused, so that indices in states of
+        # hypotheses stay valid after the cache is cleared.
+        self.cache_size = cache_size
+        self.n_hists = 0
+        self.reset_cache()
+
+        # Load the word LM vocabulary
+        word2idx = {}
+        with codecs.open(lm_dict_path, 'r', 'utf-8') as f:
+            for line in f:
+                w, idx = line.strip().split(' ')
+                word2idx[w] = int(idx)
+        self.unk = word2idx['<unk>']
+        self.eos = word2idx['<eos>']
+
+        # Build a prefix tree over words sorted in the lexical order so that
+        # words under each node occupy a contiguous range
+        words = sorted(w for w in word2idx.keys() if not (w[0] == '<' and w[-1] == '>'))
+        self.register_buffer('lex_ids', torch.tensor([word2idx[w] for w in words], dtype=torch.int64))
+        self.node_children = [{}]
+        self.node_word = [-1]  # word index in the LM vocabulary
+        self.node_pos = [-1]  # word position in the lexical order
+        self.node_lo = [0]
+        self.node_hi = [len(words)]
+        for pos, w in enumerate(words):
+            n = 0
+            for c in w:
+                if c not in self.node_children[n]:
+                    self.node_children[n][c] = len(self.node_children)
+                    self.node_children.append({})
+                    self.node_word.append(-1)
+                    self.node_pos.append(-1)
+                    self.node_lo.append(pos)
+                    self.node_hi.append(pos)
+                n = self.node_children[n][c]
+                self.node_hi[n] = pos + 1
+            self.node_word[n] = word2idx[w]
+            self.node_pos[n] = pos
+        logger.info('Lexicon prefix tree: %d words, %d nodes' % (len(words), len(self.node_children)))
+        self.register_buffer('node_lo_t', torch.tensor(self.node_lo, dtype=torch.int64))
+        self.register_buffer('node_hi_t', torch.tensor(self.node_hi, dtype=torch.int64))
+        self.register_buffer('node_pos_t', torch.tensor(self.node_pos, dtype=torch.int64))
+
+        # Load the ASR vocabulary
+        token2idx = {'<blank>': 0}
+        with codecs.open(asr_dict_path, 'r', 'utf-8') as f:
+            for line in f:
+                t, idx = line.strip().split(' ')
+                token2idx[t] = int(idx)
+        self.vocab = max(token2idx.values()) + 1
+        # character units mark word boundaries with <space>, wordpieces with a leading '▁'
+        self.wordpiece = '<space>' not in token2idx.keys()
+
+        # Classify tokens and build a prefix tree over in-word token spellings
+        self.token_kind = [SPECIAL] * self.vocab
+        self.token_chars = [''] * self.vocab
+        tok_children, tok_ends = [{}], [[]]
+        for t, idx in token2idx.items():
+            if t == '<eos>':
+                self.token_kind[idx] = EOS
+            elif t == '<space>' or t[0] == '▁':
+                self.token_kind[idx] = BOUNDARY
+                self.token_chars[idx] = t[1:] if self.wordpiece else ''
+            elif not (t[0] == '<' and t[-1] == '>'):
+                self.token_kind[idx] = NORMAL
+                self.token_chars[idx] = t
+                n = 0
+                for c in t:
+                    if c not in tok_children[n]:
+                        tok_children[n][c] = len(tok_children)
+                        tok_children.append({})
+                        tok_ends.append([])
+                    n = tok_children[n][c]
+                tok_ends[n].append(idx)
+        self.tok_children = tok_children
+        self.tok_ends = tok_ends
+        self.successors = {}  # node -> {token index: child node}
+        self.successor_ranges = {}  # node -> (token indices, lo, hi)
+
+        # Nodes reached from the root by the characters following the word boundary
+        boundary_ids = [idx for idx in range(self.vocab) if self.token_kind[idx] == BOUNDARY]
+        boundary_nodes = [self.walk(0, self.token_chars[idx]) for idx in boundary_ids]
+        self.register_buffer('normal_ids', torch.tensor(
+            [idx for idx in range(self.vocab) if self.token_kind[idx] == NORMAL], dtype=torch.int64))
+        self.register_buffer('boundary_ids', torch.tensor(boundary_ids, dtype=torch.int64))
+        self.register_buffer('boundary_lo', torch.tensor(
+            [self.node_lo[n] if n >= 0 else 0 for n in boundary_nodes], dtype=torch.int64))
+        self.register_buffer('boundary_hi', torch.tensor(
+            [self.node_hi[n] if n >= 0 else 0 for n in boundary_nodes], dtype=torch.int64))
+
+    @property
+    def output_dim(self):
+        return self.vocab
+
+    def load_state_dict(self, state_dict, strict=True):
+        """Load parameters of the word LM."""
+        return self.wordlm.load_state_dict(state_dict, strict)
+
+    def reset_cache(self):
+        """Clear word LM states cached by word history."""
+        self.hist_next = {}  # (history index, word index) -> history index
+        self.hist_states = {}  # history index -> (word LM state, cumsum)
+
+    def walk(self, n, chars):
+        """Follow characters from the node.
+
+        Args:
+            n (int): node index
+            chars (str): characters
+        Returns:
+            n (int): node index (-1 when off the prefix tree)
+
+        """
+        for c in chars:
+            n = self.node_children[n].get(c, -1)
+            if n < 0:
+                break
+        return n
+
+    def get_successors(self, n):
+        """Enumerate in-word tokens that keep the prefix on the tree.
+
+        Args:
+            n (int): node index
+        Returns:
+            succ (dict): token index -> child node index
+
+        """
+        if n not in self.successors:
+            succ = {}
+            stack = [(n, 0)]
+            while len(stack) > 0:
+                wn, tn = stack.pop()
+                for c, tc in self.tok_children[tn].items():
+                    wc = self.node_children[wn].get(c)
+                    if wc is None:
+                        continue
+                    for idx in self.tok_ends[tc]:
+                        succ[idx] = wc
+                    stack.append((wc, tc))
+            self.successors[n] = succ
+            device = self.lex_ids.device
+            self.successor_ranges[n] = (torch.tensor(list(succ.keys()), dtype=torch.int64, device=device),
+                                        torch.tensor([self.node_lo[c] for c in succ.values()],
+                                                     dtype=torch.int64, device=device),
+                                        torch.tensor([self.node_hi[c] for c in succ.values()],
+                                                     dtype=torch.int64, device=device))
+        return self.successors[n]
+
+    def step_wordlm(self, ws, state):
+        """Advance the word LM by one word.
+
+        Args:
+            ws (LongTensor): `[B]`
+            state (dict): word LM state
+        Returns:
+            state (dict): word LM state
+            cumsum (FloatTensor): `[1, B, n_words + 1]`
+                cumulative word probabilities in the lexical order
+
+        """
+        _, state, log_probs = self.wordlm.predict(ws.unsqueeze(1), state)
+        probs = log_probs[:, -1].exp().index_select(1, self.lex_ids)
+        cumsum = torch.cat([probs.new_zeros(probs.size(0), 1), probs.cumsum(dim=1)], dim=1)
+        return state, cumsum.unsqueeze(0)
+
+    def advance(self, hists, words, lmstate=None, rows=None):
+        """Look up word LM states after appending words to word histories.
+
+        The word LM is run only for histories not in the cache.
+
+        Args:
+            hists (list): history indices (-1 for the empty history)
+            words (list): word indices in the LM vocabulary
+            lmstate (dict): word LM states after the histories, batched along dim 1
+            rows (list): indices of `lmstate` for each history
+        Returns:
+            new_hists (list): history indices after the words
+            state (dict): word LM states after the words
+            cumsum (FloatTensor): `[1, len(hists), n_words + 1]`
+
+        """
+        if len(self.hist_states) > self.cache_size:
+            self.reset_cache()
+
+        new_hists, misses = [], {}
+        for i, (h, w) in enumerate(zip(hists, words)):
+            if (h, w) not in self.hist_next:
+                self.hist_next[(h, w)] = self.n_hists
+                self.n_hists += 1
+            h_new = self.hist_next[(h, w)]
+            new_hists.append(h_new)
+            if h_new not in self.hist_states and h_new not in misses:
+                misses[h_new] = i
+
+        if len(misses) > 0:
+            ids = list(misses.values())
+            ws = self.lex_ids.new_tensor([words[i] for i in ids])
+            if lmstate is not None:
+                index = self.lex_ids.new_tensor([rows[i] for i in ids])
+                lmstate = {k: v.index_select(1, index) for k, v in lmstate.items()}
+            state_new, cumsum_new = self.step_wordlm(ws, lmstate)
+            for j, h_new in enumerate(misses.keys()):
+                self.hist_states[h_new] = ({k: v[:, j:j + 1] for k, v in state_new.items()},
+                                           cumsum_new[:, j:j + 1])
+
+        entries = [self.hist_states[h] for h in new_hists]
+        state = {k: torch.cat([e[0][k] for e in entries], dim=1) for k in entries[0][0].keys()}
+        cumsum = torch.cat([e[1] for e in entries], dim=1)
+        return new_hists, state, cumsum
+
+    def current_word(self, n):
+        """Word completed at the node (<unk> when off the prefix tree)."""
+        return self.node_word[n] if n > 0 and self.node_word[n] >= 0 else self.unk
+
+    def predict(self, ys, state=None, mems=None, cache=None, shortlist=False):
+        """Score the next sub-word token.
+
+        Args:
+            ys (LongTensor): `[B, L]`
+            state (dict):
+                hxs/cxs (FloatTensor): word LM state
+                cumsum (FloatTensor): `[1, B, n_words + 1]`
+                node (LongTensor): `[1, B]`
+                hist (LongTensor): `[1, B]`, index of the word history
+            mems: not used
+            cache: not used
+            shortlist (bool): log probabilities are returned in any case
+        Returns:
+            lmout: None
+            new_state (dict):
+            log_probs (FloatTensor): `[B, 1, vocab]`
+
+        """
+        bs = ys.size(0)
+        if state is None:
+            hists, lmstate, cumsum = self.advance([-1] * bs, [self.eos] * bs)
+            nodes = [0] * bs
+        else:
+            lmstate = {k: v for k, v in state.items() if k not in ['cumsum', 'node', 'hist']}
+            cumsum = state['cumsum']
+            nodes = state['node'][0].tolist()
+            hists = state['hist'][0].tolist()
+            ys_last = ys[:, -1].tolist()
+
+            # Follow the prefix tree and collect hypotheses completing a word
+            feed_ids = []
+            for b in range(bs):
+                n, y = nodes[b], ys_last[b]
+                kind = self.token_kind[y]
+                if kind == NORMAL:
+                    nodes[b] = self.get_successors(n).get(y, -1) if n >= 0 else -1
+                elif kind == SPECIAL:
+                    nodes[b] = -1
+                else:
+                    if not (self.wordpiece and n == 0):
+                        feed_ids.append((b, self.current_word(n)))
+                    nodes[b] = self.walk(0, self.token_chars[y])
+            if len(feed_ids) > 0:
+                rows = [b for b, _ in feed_ids]
+                feed_hists, lmstate_new, cumsum_new = self.advance(
+                    [hists[b] for b in rows], [w for _, w in feed_ids], lmstate, rows)
+                for b, h in zip(rows, feed_hists):
+                    hists[b] = h
+                ids = ys.new_tensor(rows)
+                lmstate = {k: v.index_copy(1, ids, lmstate_new[k]) for k, v in lmstate.items()}
+                cumsum = cumsum.index_copy(1, ids, cumsum_new)
+
+        new_state = dict(lmstate)
+        new_state.update({'cumsum': cumsum,
+                          'node': ys.new_tensor(nodes).unsqueeze(0),
+                          'hist': ys.new_tensor(hists).unsqueeze(0)})
+
+        # Wordpieces starting a new word are scored under the context after the current word,
+        # which is needed only where the current prefix can complete a word
+        next_ids = None
+        cumsum_next = None
+        if self.wordpiece:
+            next_ids = [b for b, n in enumerate(nodes) if n < 0 or (n > 0 and self.node_pos[n] >= 0)]
+            if len(next_ids) > 0:
+                _, _, cumsum_next = self.advance([hists[b] for b in next_ids],
+                                                 [self.current_word(nodes[b]) for b in next_ids],
+                                                 lmstate, next_ids)
+
+        log_probs = self._score(nodes, cumsum[0], next_ids, cumsum_next[0] if cumsum_next is not None else None)
+        return None, new_state, log_probs.unsqueeze(1)
+
+    def _score(self, nodes, cumsum, next_ids=None, cumsum_next=None):
+        """Compute look-ahead log probabilities of tokens following the nodes.
+
+        Args:
+            nodes (list): node indices (-1 when off the prefix tree)
+            cumsum (FloatTensor): `[B, n_words + 1]`
+            next_ids (list): indices of hypotheses whose current word can be completed (wordpiece only)
+            cumsum_next (FloatTensor): `[len(next_ids), n_words + 1]`,
+                cumulative word probabilities after the current word
+        Returns:
+            log_probs (FloatTensor): `[B, vocab]`
+
+        """
+        bs = len(nodes)
+        log_probs = cumsum.new_full((bs, self.vocab), self.log_zero)
+        n_t = self.node_lo_t.new_tensor(nodes)
+        oov = n_t < 0
+        n_t = n_t.clamp(min=0)
+        batch = torch.arange(bs, device=cumsum.device)
+        p_node = cumsum[batch, self.node_hi_t[n_t]] - cumsum[batch, self.node_lo_t[n_t]]  # `[B]`
+
+        # Tokens extending the prefix on the tree
+        batch_ids, token_ids, lo, hi = [], [], [], []
+        for b, n in enumerate(nodes):
+            if n < 0:
+                continue
+            self.get_successors(n)
+            ids, lo_n, hi_n = self.successor_ranges[n]
+            if len(ids) > 0:
+                batch_ids.append(torch.full_like(ids, b))
+                token_ids.append(ids)
+                lo.append(lo_n)
+                hi.append(hi_n)
+        if len(batch_ids) > 0:
+            batch_ids = torch.cat(batch_ids)
+            lo, hi = torch.cat(lo), torch.cat(hi)
+            log_probs[batch_ids, torch.cat(token_ids)] = (
+                (cumsum[batch_ids, hi] - cumsum[batch_ids, lo]).clamp(min=self.zero) / p_node[batch_ids]).log()
+
+        # Probability of completing the current word
+        pos = self.node_pos_t[n_t].clamp(min=0)
+        p_end = (cumsum[batch, pos + 1] - cumsum[batch, pos]).clamp(min=self.zero) / p_node
+        log_p_end = p_end.log().masked_fill(self.node_pos_t[n_t] < 0, self.log_zero)
+        log_p_end = log_p_end.masked_fill(n_t == 0, 0.).masked_fill(oov, self.log_oov_penalty)
+
+        # inside an out-of-lexicon word
+        log_probs[oov.nonzero().squeeze(1).unsqueeze(1), self.normal_ids.unsqueeze(0)] = 0.
+
+        # no word to complete at the root
+        in_word = oov | (n_t > 0)
+        log_probs[:, self.eos] = torch.where(in_word, log_p_end, log_probs[:, self.eos])
+        if len(self.boundary_ids) > 0:
+            log_probs_boundary = log_p_end.unsqueeze(1).expand(bs, len(self.boundary_ids))
+            if self.wordpiece:
+                # look-ahead of the first characters of the next word (normalized over the lexicon)
+                has_next = ~in_word
+                if next_ids is not None and len(next_ids) > 0:
+                    ids = batch.new_tensor(next_ids)
+                    cumsum = cumsum.index_copy(0, ids, cumsum_next)
+                    has_next = has_next.index_fill(0, ids, True)
+                p = (cumsum[:, self.boundary_hi] - cumsum[:, self.boundary_lo]).clamp(min=self.zero)
+                log_p = (p / cumsum[:, -1:].clamp(min=self.zero)).log()
+                log_probs_boundary = torch.where(has_next.unsqueeze(1), log_probs_boundary + log_p,
+                                                 log_probs_boundary)
+            else:
+                log_probs_boundary = torch.where(in_word.unsqueeze(1), log_probs_boundary,
+                                                 log_probs[:, self.boundary_ids])
+            log_probs[:, self.boundary_ids] = log_probs_boundary
+
+        # prefixes with negligible probability
+        return log_probs.masked_fill(((p_node < self.zero) & ~oov).unsqueeze(1), self.log_zero)
+
+    def score_shortlist(self, feats, candidates):
+        """Gather log probabilities of candidate tokens.
+
+        Args:
+            feats (FloatTensor): `[B, vocab]`
+                log probabilities returned by predict(shortlist=True)
+            candidates (LongTensor): `[B, K]`
+        Returns:
+            log_probs (FloatTensor): `[B, K]`
+
+        """
+        return feats.gather(1, candidates)
@@ -0,0 +1,290 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Backoff n-gram language model loaded from an ARPA file."""
+
+import codecs
+import gzip
+import logging
+import math
+import numpy as np
+import torch
+import torch.nn as nn
+
+logger = logging.getLogger(__name__)
+
+LOG10 = math.log(10)
+
+
+def is_arpa(path):
+    """Check if the path is an ARPA file."""
+    return isinstance(path, str) and (path.endswith('.arpa') or path.endswith('.arpa.gz'))
+
+
+def _searchsorted(keys, query):
+    """Find indices of queries in sorted keys (-1 if missing)."""
+    if len(keys) == 0:
+        return torch.full_like(query, -1)
+    idx = torch.searchsorted(keys, query).clamp(max=len(keys) - 1)
+    return torch.where(keys[idx] == query, idx, torch.full_like(idx, -1))
+
+
+class NgramLM(nn.Module):
+    """Backoff n-gram LM for shallow fusion and rescoring.
+
+    N-grams of each order are stored in a sorted array of hashed keys
+    `parent * (vocab + 1) + token`, where `parent` is the index of the
+    (n-1)-gram prefix in the table of the lower order. N-grams sharing
+    the same prefix occupy a contiguous range, so states of all hypotheses
+    are looked up by a single binary search per order. LM states are
+    indices of the suffixes of the token history for each order.
+
+    Args:
+        arpa_path (str): path to an ARPA file (optionally gzipped)
+        dict_path (str): path to the dictionary of the ASR model
+
+    """
+
+    def __init__(self, arpa_path, dict_path):
+        super(NgramLM, self).__init__()
+        logger.info(self.__class__.__name__)
+
+        # Load the dictionary
+        token2idx = {'<blank>': 0}
+        with codecs.open(dict_path, 'r', 'utf-8') as f:
+            for line in f:
+                t, idx = line.strip().split(' ')
+                token2idx[t] = int(idx)
+        self.vocab = max(token2idx.values()) + 1
+        self.unk = token2idx['<unk>']
+        self.eos = token2idx['<eos>']
+        self.pad = token2idx.get('<pad>', 3)
+        # <s> and </s> share <eos> in the dictionary
+        self.bos = self.vocab
+        token2idx['</s>'] = self.eos
+        token2idx['<s>'] = self.bos
+        self.size = self.vocab + 1  # radix of hashed keys
+
+        ngrams = self._load_arpa(arpa_path, token2idx)
+        self.order = len(ngrams)
+        assert self.order >= 1
+
+        # Unigrams are indexed by tokens themselves
+        words, logp, bo = ngrams[0]
+        uni_logp = np.full(self.size, -99. * LOG10, dtype=np.float32)
+        uni_bo = np.zeros(self.size, dtype=np.float32)
+        uni_logp[words[:, 0]] = logp
+        uni_bo[words[:, 0]] = bo
+        has_unigram = np.zeros(self.size, dtype=bool)
+        has_unigram[words[:, 0]] = True
+        # tokens out of the n-gram vocabulary are mapped to <unk>
+        ctx_map = np.arange(self.size)
+        if has_unigram[self.unk]:
+            uni_logp[~has_unigram] = uni_logp[self.unk]
+            ctx_map[~has_unigram] = self.unk
+        else:
+            ctx_map[~has_unigram] = -1
+        self.register_buffer('uni_logp', torch.from_numpy(uni_logp))
+        self.register_buffer('uni_bo', torch.from_numpy(uni_bo))
+        self.register_buffer('ctx_map', torch.from_numpy(ctx_map))
+
+        # Higher orders: tables of (n+1)-grams are indexed by the order of their prefixes
+        for n in range(1, self.order):
+            words, logp, bo = ngrams[n]
+            parents = torch.from_numpy(words[:, 0])
+            for k in range(1, n):
+                parents = self._find(k, parents, torch.from_numpy(words[:, k]))
+            keys = parents * self.size + torch.from_numpy(words[:, n])
+            valid = parents >= 0
+            if not valid.all():
+                logger.warning('%d %d-grams without the prefix are ignored' % ((~valid).sum().item(), n + 1))
+            keys, perm = keys[valid].sort()
+            self.register_buffer('keys_%d' % n, keys)
+            self.register_buffer('logp_%d' % n, torch.from_numpy(logp)[valid][perm])
+            self.register_buffer('bo_%d' % n, torch.from_numpy(bo)[valid][perm])
+            # range of (n+1)-grams following each n-gram
+            n_parents = self.size if n == 1 else len(self._table('keys', n - 1))
+            self.register_buffer('child_start_%d' % n, torch.searchsorted(
+                keys, torch.arange(n_parents + 1, dtype=torch.int64) * self.size))
+        logger.info('%d-gram LM: %s n-grams' % (self.order, ', '.join(str(len(ng[0])) for ng in ngrams)))
+
+    def _table(self, name, n):
+        """Return a table of (n+1)-grams (keys, logp, bo or child_start)."""
+        return getattr(self, '%s_%d' % (name, n))
+
+    @property
+    def device(self):
+        return self.uni_logp.device
+
+    def _load_arpa(self, arpa_path, token2idx):
+        """Load n-grams from an ARPA file.
+
+        Args:
+            arpa_path (str): path to an ARPA file
+            token2idx (dict): token -> index
+        Returns:
+            ngrams (list): A list of length `order`, each of which contains
+                words (np.ndarray): `[N, n]`
+                logp (np.ndarray): `[N]` (natural log)
+                bo (np.ndarray): `[N]` (natural log)
+
+        """
+        open_fn = gzip.open if arpa_path.endswith('.gz') else open
+        ngrams, n_skip = [], 0
+        n = 0
+        with open_fn(arpa_path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if len(line) == 0 or line == '\\data\\' or line.startswith('ngram '):
+                    continue
+                if line == '\\end\\':
+                    break
+                if line[0] == '\\' and line.endswith('-grams:'):
+                    n = int(line[1:-len('-grams:')])
+                    ngrams.append(([], [], []))
+                    continue
+                if n == 0:
+                    continue
+                fields = line.split()
+                ids = [token2idx.get(w) for w in fields[1:n + 1]]
+                if None in ids:
+                    n_skip += 1
+                    continue
+                ngrams[-1][0].append(ids)
+                ngrams[-1][1].append(float(fields[0]) * LOG10)
+                ngrams[-1][2].append(float(fields[n + 1]) * LOG10 if len(fields) > n + 1 else 0.)
+        if n_skip > 0:
+            logger.warning('%d n-grams containing tokens out of the dictionary are ignored' % n_skip)
+        return [(np.array(words, dtype=np.int64).reshape(-1, i + 1),
+                 np.array(logp, dtype=np.float32),
+                 np.array(bo, dtype=np.float32))
+                for i, (words, logp, bo) in enumerate(ngrams)]
+
+    def _find(self, n, parents, ys):
+        """Look up (n+1)-grams from indices of n-gram prefixes and the last tokens.
+
+        Args:
+            n (int): order of the prefixes
+            parents (LongTensor): `[B]` (-1 for missing prefixes)
+            ys (LongTensor): `[B]`
+        Returns:
+            idx (LongTensor): `[B]` (-1 for missing n-grams)
+
+        """
+        idx = _searchsorted(self._table('keys', n), parents.clamp(min=0) * self.size + ys)
+        return torch.where((parents >= 0) & (ys >= 0), idx, torch.full_like(idx, -1))
+
+    def zero_state(self, batch_size):
+        """Initialize LM states with an empty history.
+
+        Returns:
+            state (dict):
+                ctx (LongTensor): `[1, B, order - 1]`
+                    indices of the history suffixes of length 1 to order - 1
+
+        """
+        return {'ctx': torch.full((1, batch_size, self.order - 1), -1,
+                                  dtype=torch.int64, device=self.device)}
+
+    def update_state(self, state, ys):
+        """Append tokens to histories.
+
+        Args:
+            state (dict): LM states
+            ys (LongTensor): `[B]`
+        Returns:
+            state (dict): LM states
+
+        """
+        ctx = state['ctx'][0]
+        if self.order == 1:
+            return state
+        ys = self.ctx_map[torch.where(ys == self.eos, torch.full_like(ys, self.bos), ys)]
+        new_ctx = [ys]
+        for n in range(1, self.order - 1):
+            new_ctx.append(self._find(n, ctx[:, n - 1], ys))
+        return {'ctx': torch.stack(new_ctx, dim=1).unsqueeze(0)}
+
+    def log_probs(self, state):
+        """Compute log probabilities of all tokens given histories.
+
+        Args:
+            state (dict): LM states
+        Returns:
+            log_probs (FloatTensor): `[B, vocab]`
+
+        """
+        ctx = state['ctx'][0]
+        bs = ctx.size(0)
+        log_probs = self.uni_logp.unsqueeze(0).repeat(bs, 1)
+        for n in range(1, self.order):
+            parents = ctx[:, n - 1]
+            valid = parents >= 0
+            bo = self.uni_bo if n == 1 else self._table('bo', n - 1)
+            log_probs += torch.where(valid, bo[parents.clamp(min=0)], bo.new_zeros(bs)).unsqueeze(1)
+            # overwrite explicit n-grams
+            child_start = self._table('child_start', n)
+            start = child_start[parents.clamp(min=0)]
+            counts = torch.where(valid, child_start[parents.clamp(min=0) + 1] - start,
+                                 torch.zeros_like(start))
+            total = counts.sum().item()
+            if total == 0:
+                continue
+            b_idx = torch.repeat_interleave(torch.arange(bs, device=ctx.device), counts)
+            offsets = torch.cumsum(counts, dim=0) - counts
+            idx = torch.arange(total, device=ctx.device) - offsets.repeat_interleave(counts) + \
+                start.repeat_interleave(counts)
+            log_probs[b_idx, self._table('keys', n)[idx] % self.size] = self._table('logp', n)[idx]
+        return log_probs[:, :self.vocab]
+
+    def predict(self, ys, state=None, mems=None, cache=None, shortlist=False):
+        """Predict the next token for each position.
+
+        Args:
+            ys (LongTensor): `[B, L]`
+            state (dict): LM states (histories before ys)
+            mems: not used
+            cache: not used
+            shortlist (bool): return LM states instead of log probabilities
+                (see score_shortlist)
+        Returns:
+            lmout: None
+            new_state (dict): LM states
+            log_probs (FloatTensor): `[B, L, vocab]`
+                or LM states `[B, 1, order - 1]` when shortlist is True
+
+        """
+        if state is None:
+            state = self.zero_state(ys.size(0))
+        log_probs = []
+        for t in range(ys.size(1)):
+            state = self.update_state(state, ys[:, t])
+            if not shortlist:
+                log_probs.append(self.log_probs(state))
+        if shortlist:
+            return None, state, state['ctx'][0].unsqueeze(1)
+        return None, state, torch.stack(log_probs, dim=1)
+
+    def score_shortlist(self, ctx, candidates):
+        """Compute log probabilities of candidate tokens.
+
+        Args:
+            ctx (LongTensor): `[B, order - 1]`
+                LM states returned by predict(shortlist=True)
+            candidates (LongTensor): `[B, K]`
+        Returns:
+            log_probs (FloatTensor): `[B, K]`
+
+        """
+        bs, k = candidates.size()
+        log_probs = self.uni_logp[candidates]
+        for n in range(1, self.order):
+            parents = ctx[:, n - 1].unsqueeze(1).expand(bs, k).reshape(-1)
+            idx = self._find(n, parents, candidates.reshape(-1)).view(bs, k)
+            bo = self.uni_bo if n == 1 else self._table('bo', n - 1)
+            bo = torch.where(parents >= 0, bo[parents.clamp(min=0)], bo.new_zeros(bs * k)).view(bs, k)
+            log_probs = torch.where(idx >= 0, self._table('logp', n)[idx.clamp(min=0)], log_probs + bo)
+        return log_probs
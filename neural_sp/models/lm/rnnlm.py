@@ -47,9 +47,11 @@ class RNNLM(LMBase):
         # for cache
         self.cache_theta = 0.2  # smoothing parameter
         self.cache_lambda = 0.2  # cache weight
-        self.cache_ids = []
-        self.cache_keys = []
-        self.cache_attn = []
+        self.reset_cache()
+
+        # for candidate-shortlist scoring
+        self.shortlist_partition_size = getattr(args, 'recog_lm_shortlist_partition_size', 1024)
+        self.shortlist_sample_ids = None
 
         self.embed = nn.Embedding(self.vocab, args.emb_dim, padding_idx=self.pad)
         self.dropout_embed = nn.Dropout(p=args.dropout_in)
@@ -146,7 +148,7 @@ class RNNLM(LMBase):
             else:
                 raise ValueError(n)
 
-    def decode(self, ys, state, mems=None, cache=None, incremental=False):
+    def decode(self, ys, state, mems=None, cache=None, incremental=False, skip_output=False):
         """Decode function.
 
         Args:
@@ -156,6 +158,7 @@ class RNNLM(LMBase):
                 cxs (FloatTensor): `[n_layers, B, n_units]`
             cache: dummy interfance for TransformerLM/TransformerXL
             incremental: dummy interfance for TransformerLM/TransformerXL
+            skip_output (bool): return inputs to the output layer instead of logits
         Returns:
             logits (FloatTensor): `[B, L, vocab]`
             ys_emb (FloatTensor): `[B, L, n_units]` (for cache)
@@ -215,7 +218,7 @@ class RNNLM(LMBase):
         if self.adaptive_softmax is None:
             if self.output_proj is not None:
                 ys_emb = self.output_proj(ys_emb)
-            logits = self.output(ys_emb)
+            logits = ys_emb if skip_output else self.output(ys_emb)
         else:
             logits = ys_emb
 
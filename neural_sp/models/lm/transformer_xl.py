@@ -63,9 +63,11 @@ class TransformerXL(LMBase):
         # for cache
         self.cache_theta = 0.2  # smoothing parameter
         self.cache_lambda = 0.2  # cache weight
-        self.cache_ids = []
-        self.cache_keys = []
-        self.cache_attn = []
+        self.reset_cache()
+
+        # for candidate-shortlist scoring
+        self.shortlist_partition_size = getattr(args, 'recog_lm_shortlist_partition_size', 1024)
+        self.shortlist_sample_ids = None
 
         # positional embedding
         self.pos_emb = XLPositionalEmbedding(self.d_model, args.dropout_in)
@@ -156,72 +158,63 @@ class TransformerXL(LMBase):
         for n, p in self.named_parameters():
             init_like_transformer_xl(n, p, std=0.02)
 
-    def init_memory(self):
-        """Initialize memory."""
-        return [torch.empty(0, dtype=torch.float).to(self.device)
-                for _ in range(self.n_layers)]
+    def init_memory(self, bs=1):
+        """Initialize memory.
+
+        Args:
+            bs (int): batch size
+        Returns:
+            mems (XLMemory): empty memory of `mem_len` steps
+
+        """
+        return XLMemory(self.n_layers, bs, self.mem_len, self.d_model,
+                        device=self.device, dtype=self.embed.weight.dtype)
 
     def update_memory(self, memory_prev, hidden_states):
         """Update memory.
 
+        Hidden states are written into the ring buffer in place, so the cost does
+        not depend on the length of the previous memory.
+
         Args:
-            memory_prev (list): length `n_layers`, each of which contains `[B, mlen, d_model]`
+            memory_prev (XLMemory): memory of `n_layers` layers
             hidden_states (list): length `n_layers`, each of which contains `[B, L, d_model]`
         Returns:
-            new_mems (list): length `n_layers`, each of which contains `[B, mlen, d_model]`
+            new_mems (XLMemory): `memory_prev` updated in place
 
         """
+        if self.mem_len == 0:
+            return None
         if memory_prev is None:
-            memory_prev = self.init_memory()  # 0-th to L-1-th layer
-        assert len(hidden_states) == len(memory_prev)
-        mlen = memory_prev[0].size(1) if memory_prev[0].dim() > 1 else 0
-        qlen = hidden_states[0].size(1)
+            memory_prev = self.init_memory(hidden_states[0].size(0))  # 0-th to L-1-th layer
+        assert len(hidden_states) == memory_prev.n_layers
+        memory_prev.write(hidden_states)
+        return memory_prev
 
-        # There are `mlen + qlen` steps that can be cached into mems
-        # For the next step, the last `ext_len` of the `qlen` tokens
-        # will be used as the extended context. Hence, we only cache
-        # the tokens from `mlen + qlen - self.ext_len - self.mem_len`
-        # to `mlen + qlen - self.ext_len`.
-        with torch.no_grad():
-            new_mems = []
-            end_idx = mlen + qlen
-            start_idx = max(0, end_idx - self.mem_len)
-            for m, h in zip(memory_prev, hidden_states):
-                cat = torch.cat([m, h], dim=1)  # `[B, mlen + qlen, d_model]`
-                new_mems.append(cat[:, start_idx:end_idx].detach())  # `[B, self.mem_len, d_model]`
-
-        return new_mems
-
-    def decode(self, ys, state=None, mems=None, cache=None, incremental=False):
+    def decode(self, ys, state=None, mems=None, cache=None, incremental=False, skip_output=False):
         """Decode function.
 
         Args:
             ys (LongTensor): `[B, L]`
             state (list): dummy interfance for RNNLM
-            mems (list): length `n_layers`, each of which contains a FloatTensor `[B, mlen, d_model]`
-            cache (list): length `L`, each of which contains a FloatTensor `[B, L-1, d_model]`
+            mems (XLMemory): memory of `n_layers` layers, each of which contains `[B, mlen, d_model]`
+            cache (list): length `n_layers`, each of which contains a FloatTensor `[B, L-1, d_model * 2]`
             incremental (bool): ASR decoding mode
+            skip_output (bool): return inputs to the output layer instead of logits
         Returns:
             logits (FloatTensor): `[B, L, vocab]`
             out (FloatTensor): `[B, L, d_model]`
-            new_cache (list): length `n_layers`, each of which contains a FloatTensor `[B, L, d_model]`
+            new_mems (XLMemory): updated memory (new_cache is returned instead in the incremental mode)
 
         """
         # for ASR decoding
-        if cache is None:
-            cache = [None] * self.n_layers  # 1-th to L-th layer
-
-        if mems is None:
-            mems = self.init_memory()
-            mlen = 0
-        else:
-            mlen = mems[0].size(1)
+        if incremental:
+            return self.decode_incremental(ys, mems, cache, skip_output)
 
-        bs, ylen = ys.size()[:2]
-        if incremental and cache[0] is not None:
-            ylen = cache[0].size(1) + 1
+        mlen = mems.length if mems is not None else 0
 
         # Create the self-attention mask
+        bs, ylen = ys.size()[:2]
         causal_mask = ys.new_ones(ylen, ylen + mlen).byte()
         causal_mask = torch.tril(causal_mask, diagonal=0 + mlen, out=causal_mask).unsqueeze(0)
         causal_mask = causal_mask.repeat([bs, 1, 1])  # `[B, L, L+mlen]`
@@ -229,34 +222,71 @@ class TransformerXL(LMBase):
         out = self.dropout_emb(self.embed(ys.long()) * self.scale)
         pos_embs = self.pos_emb(ys, mlen=mlen, zero_center_offset=self.zero_center_offset)
 
-        new_mems = [None] * self.n_layers
-        new_cache = [None] * self.n_layers
         hidden_states = [out]
-        for lth, (mem, layer) in enumerate(zip(mems, self.layers)):
-            if incremental and mlen > 0 and mem.size(0) != bs:
-                mem = mem.repeat([bs, 1, 1])
-            out = layer(out, causal_mask, cache=cache[lth],
+        for lth, layer in enumerate(self.layers):
+            mem = mems[lth] if mlen > 0 else None
+            out = layer(out, causal_mask,
                         pos_embs=pos_embs, memory=mem, u_bias=self.u_bias, v_bias=self.v_bias)
-            if incremental:
-                new_cache[lth] = out
-            elif lth < self.n_layers - 1:
+            if lth < self.n_layers - 1:
                 hidden_states.append(out)
                 # NOTE: outputs from the last layer is not used for memory
             if not self.training and layer.yy_aws is not None:
                 setattr(self, 'yy_aws_layer%d' % lth, tensor2np(layer.yy_aws))
         out = self.norm_out(out)
-        if self.adaptive_softmax is None:
+        if self.adaptive_softmax is None and not skip_output:
             logits = self.output(out)
         else:
             logits = out
 
-        if incremental:
-            # NOTE: do not update memory here during ASR decoding
-            return logits, out, new_cache
+        # Update memory
+        new_mems = self.update_memory(mems, hidden_states)
+        return logits, out, new_mems
+
+    def decode_incremental(self, ys, mems=None, cache=None, skip_output=False):
+        """Decode function for ASR with cached keys and values of self-attention.
+
+        When the cache is given, only the last token is encoded. Keys and values of
+        memory are projected once and shared by all hypotheses until the memory is updated.
+        Memory is not updated here.
+
+        Args:
+            ys (LongTensor): `[B, L]`
+            mems (XLMemory): memory of `n_layers` layers, each of which contains `[1 or B, mlen, d_model]`
+            cache (list): length `n_layers`, each of which contains a FloatTensor `[B, L-1, d_model * 2]`
+            skip_output (bool): return inputs to the output layer instead of logits
+        Returns:
+            logits (FloatTensor): `[B, L, vocab]` (`[B, 1, vocab]` if the cache is given)
+            out (FloatTensor): `[B, L, d_model]` (`[B, 1, d_model]` if the cache is given)
+            new_cache (list): length `n_layers`, each of which contains a FloatTensor `[B, L, d_model * 2]`
+
+        """
+        mlen = mems.length if mems is not None else 0
+        pos_embs = self.pos_emb(ys, mlen=mlen, zero_center_offset=self.zero_center_offset)
+
+        if cache is None or cache[0] is None:
+            cache = [None] * self.n_layers  # 1-th to L-th layer
         else:
-            # Update memory
-            new_mems = self.update_memory(mems, hidden_states)
-            return logits, out, new_mems
+            ys = ys[:, -1:]
+
+        if mlen > 0 and mems.kv is None:
+            mems.kv = [layer.memory_kv(mems[lth]) for lth, layer in enumerate(self.layers)]
+
+        out = self.dropout_emb(self.embed(ys.long()) * self.scale)
+
+        new_cache = [None] * self.n_layers
+        for lth, layer in enumerate(self.layers):
+            out, new_cache[lth] = layer.forward_incremental(
+                out, cache[lth], pos_embs=pos_embs, memory_kv=mems.kv[lth] if mlen > 0 else None,
+                u_bias=self.u_bias, v_bias=self.v_bias)
+            if not self.training and layer.yy_aws is not None:
+                setattr(self, 'yy_aws_layer%d' % lth, tensor2np(layer.yy_aws))
+        out = self.norm_out(out)
+        if self.adaptive_softmax is None and not skip_output:
+            logits = self.output(out)
+        else:
+            logits = out
+
+        return logits, out, new_cache
 
     def plot_attention(self, n_cols=4):
         """Plot attention for each head in all layers."""
@@ -293,3 +323,64 @@ class TransformerXL(LMBase):
             fig.tight_layout()
             fig.savefig(os.path.join(save_path, 'layer%d.png' % (lth)), dvi=500)
             plt.close()
+
+
+class XLMemory(object):
+    """Ring buffer of hidden states used as memory of TransformerXL.
+
+    Hidden states of all layers are written in place into a preallocated buffer
+    of `mem_len` steps, and the write index wraps around.
+
+    Args:
+        n_layers (int): number of layers
+        bs (int): batch size
+        mem_len (int): number of steps in memory
+        d_model (int): dimension of hidden states
+        device (torch.device): device of the buffer
+        dtype (torch.dtype): data type of the buffer
+
+    """
+
+    def __init__(self, n_layers, bs, mem_len, d_model, device=None, dtype=torch.float):
+        self.n_layers = n_layers
+        self.mem_len = mem_len
+        self.buffer = torch.zeros(n_layers, bs, mem_len, d_model, device=device, dtype=dtype)
+        self.idx = 0  # write index
+        self.length = 0  # number of valid steps
+        self.kv = None  # projected keys and values of each layer for incremental decoding
+
+    def __len__(self):
+        return self.n_layers
+
+    def __getitem__(self, lth):
+        """Return memory of the `lth` layer in chronological order.
+
+        Args:
+            lth (int): layer index
+        Returns:
+            mem (FloatTensor): `[B, length, d_model]`
+
+        """
+        if lth >= self.n_layers:
+            raise IndexError(lth)
+        buf = self.buffer[lth]
+        if self.length < self.mem_len:
+            return buf[:, :self.length]  # not wrapped yet
+        return torch.cat([buf[:, self.idx:], buf[:, :self.idx]], dim=1)
+
+    def write(self, hidden_states):
+        """Write the last `mem_len` steps of hidden states in place.
+
+        Args:
+            hidden_states (list): length `n_layers`, each of which contains `[B, L, d_model]`
+
+        """
+        qlen = hidden_states[0].size(1)
+        n_write = min(qlen, self.mem_len)
+        pos = torch.arange(self.idx, self.idx + n_write, device=self.buffer.device) % self.mem_len
+        with torch.no_grad():
+            for lth, h in enumerate(hidden_states):
+                self.buffer[lth].index_copy_(1, pos, h[:, qlen - n_write:].detach())
+        self.idx = (self.idx + n_write) % self.mem_len
+        self.length = min(self.length + n_write, self.mem_len)
+        self.kv = None  # invalidate
@@ -48,6 +48,8 @@ class TransformerLM(LMBase):
         self.mem_len = args.mem_len
         if args.recog_mem_len > 0:
             self.mem_len = args.recog_mem_len
+        # for incremental decoding
+        self.kv_cache_len = getattr(args, 'recog_lm_kv_cache_len', 0)
 
         self.vocab = args.vocab
         self.eos = 2
@@ -57,9 +59,11 @@ class TransformerLM(LMBase):
         # for cache
         self.cache_theta = 0.2  # smoothing parameter
         self.cache_lambda = 0.2  # cache weight
-        self.cache_ids = []
-        self.cache_keys = []
-        self.cache_attn = []
+        self.reset_cache()
+
+        # for candidate-shortlist scoring
+        self.shortlist_partition_size = getattr(args, 'recog_lm_shortlist_partition_size', 1024)
+        self.shortlist_sample_ids = None
 
         self.embed = nn.Embedding(self.vocab, self.d_model, padding_idx=self.pad)
         self.pos_enc = PositionalEncoding(self.d_model, args.dropout_in, args.transformer_pe_type,
@@ -175,16 +179,19 @@ class TransformerLM(LMBase):
         # will be used as the extended context. Hence, we only cache
         # the tokens from `mlen + qlen - self.ext_len - self.mem_len`
         # to `mlen + qlen - self.ext_len`.
+        # NOTE: only the steps to be kept are copied so that the cost does not
+        # depend on the length of the previous memory
         with torch.no_grad():
             new_mems = []
-            end_idx = mlen + qlen
-            start_idx = max(0, end_idx - self.mem_len)
+            n_keep = max(0, min(mlen, self.mem_len - qlen))  # from the previous memory
             for m, h in zip(memory_prev, hidden_states):
-                cat = torch.cat([m, h], dim=1)  # `[B, mlen + qlen, d_model]`
-                new_mems.append(cat[:, start_idx:end_idx].detach())  # `[B, self.mem_len, d_model]`
+                h = h[:, qlen - min(qlen, self.mem_len):]
+                if n_keep > 0:
+                    h = torch.cat([m[:, mlen - n_keep:], h], dim=1)  # `[B, self.mem_len, d_model]`
+                new_mems.append(h.detach())
         return new_mems
 
-    def decode(self, ys, state=None, mems=None, cache=None, incremental=False):
+    def decode(self, ys, state=None, mems=None, cache=None, incremental=False, skip_output=False):
         """Decode function.
 
         Args:
@@ -193,6 +200,7 @@ class TransformerLM(LMBase):
             mems (list): length `n_layers`, each of which contains a FloatTensor `[B, mlen, d_model]`
             cache (list): length `L`, each of which contains a FloatTensor `[B, L-1, d_model]`
             incremental (bool): ASR decoding mode
+            skip_output (bool): return inputs to the output layer instead of logits
         Returns:
             logits (FloatTensor): `[B, L, vocab]`
             out (FloatTensor): `[B, L, d_model]`
@@ -200,6 +208,9 @@ class TransformerLM(LMBase):
 
         """
         # for ASR decoding
+        if incremental and '1dconv' not in self.pos_enc.pe_type:
+            return self.decode_incremental(ys, cache, skip_output)
+
         if cache is None:
             cache = [None] * self.n_layers  # 1-th to L-th layer
 
@@ -229,7 +240,7 @@ class TransformerLM(LMBase):
             if not self.training and layer.yy_aws is not None:
                 setattr(self, 'yy_aws_layer%d' % lth, tensor2np(layer.yy_aws))
         out = self.norm_out(out)
-        if self.adaptive_softmax is None:
+        if self.adaptive_softmax is None and not skip_output:
             logits = self.output(out)
         else:
             logits = out
@@ -244,6 +255,44 @@ class TransformerLM(LMBase):
         else:
             return logits, out, mems
 
+    def decode_incremental(self, ys, cache=None, skip_output=False):
+        """Decode function for ASR with cached keys and values of self-attention.
+
+        When the cache is given, only the last token is encoded.
+        The cache is truncated to the last `kv_cache_len` steps if `kv_cache_len` > 0.
+
+        Args:
+            ys (LongTensor): `[B, L]`
+            cache (list): length `n_layers`, each of which contains a FloatTensor `[B, L-1, d_model * 2]`
+            skip_output (bool): return inputs to the output layer instead of logits
+        Returns:
+            logits (FloatTensor): `[B, L, vocab]` (`[B, 1, vocab]` if the cache is given)
+            out (FloatTensor): `[B, L, d_model]` (`[B, 1, d_model]` if the cache is given)
+            new_cache (list): length `n_layers`, each of which contains a FloatTensor `[B, L, d_model * 2]`
+
+        """
+        offset = 0
+        if cache is None or cache[0] is None:
+            cache = [None] * self.n_layers  # 1-th to L-th layer
+        else:
+            offset = ys.size(1) - 1
+            ys = ys[:, offset:]
+
+        out = self.pos_enc(self.embed(ys.long()), offset=offset)
+
+        new_cache = [None] * self.n_layers
+        for lth, layer in enumerate(self.layers):
+            out, new_cache[lth] = layer.forward_incremental(out, cache[lth], self.kv_cache_len)
+            if not self.training and layer.yy_aws is not None:
+                setattr(self, 'yy_aws_layer%d' % lth, tensor2np(layer.yy_aws))
+        out = self.norm_out(out)
+        if self.adaptive_softmax is None and not skip_output:
+            logits = self.output(out)
+        else:
+            logits = out
+
+        return logits, out, new_cache
+
     def plot_attention(self, n_cols=4):
         """Plot attention for each head in all layers."""
         from matplotlib import pyplot as plt
@@ -29,13 +29,15 @@ class AttentionMechanism(nn.Module):
             This must be the odd number.
         dropout (float): dropout probability for attention weights
         lookahead (int): lookahead frames for triggered attention
+        triggered_key_projection (bool): project keys with w_key in triggered attention.
+            Models trained before this option was added used raw keys (kdim == adim).
 
     """
 
     def __init__(self, kdim, qdim, adim, atype,
                  sharpening_factor=1, sigmoid_smoothing=False,
                  conv_out_channels=10, conv_kernel_size=201, dropout=0.,
-                 lookahead=2):
+                 lookahead=2, triggered_key_projection=False):
 
         super().__init__()
 
@@ -46,6 +48,7 @@ class AttentionMechanism(nn.Module):
         self.sigmoid_smoothing = sigmoid_smoothing
         self.n_heads = 1
         self.lookahead = lookahead
+        self.triggered_key_projection = triggered_key_projection
         self.reset()
 
         # attention dropout applied after the softmax layer
@@ -93,6 +96,9 @@ class AttentionMechanism(nn.Module):
     def reset(self):
         self.key = None
         self.mask = None
+        self.future_mask = None
+        self.windows = None
+        self.step = 0
 
     def forward(self, key, value, query, mask=None, aw_prev=None,
                 cache=False, mode='', trigger_points=None):
@@ -107,7 +113,9 @@ class AttentionMechanism(nn.Module):
             aw_prev (FloatTensor): `[B, 1 (H), 1 (qlen), klen]`
             cache (bool): cache key and mask
             mode: dummy interface for MoChA/MMA
-            trigger_points (IntTensor): `[B]`
+            trigger_points (IntTensor): `[B, L]`
+                trigger points for all decoder steps in triggered attention,
+                which are consumed one step per call and reused after the last one
         Returns:
             cv (FloatTensor): `[B, 1, vdim]`
             aw (FloatTensor): `[B, 1 (H), 1 (qlen), klen]`
@@ -125,10 +133,13 @@ class AttentionMechanism(nn.Module):
 
         # Pre-computation of encoder-side features for computing scores
         if self.key is None or not cache:
-            if self.atype in ['add', 'trigerred_attention',
-                              'location', 'dot', 'luong_general']:
+            if self.atype in ['add', 'location', 'dot', 'luong_general']:
+                self.key = self.w_key(key)
+            elif self.atype == 'triggered_attention' and self.triggered_key_projection:
                 self.key = self.w_key(key)
             else:
+                # NOTE: keys were not projected in triggered attention because of a typo
+                # in the attention type, so keep raw keys for such models
                 self.key = key
             self.mask = mask
             if mask is not None:
@@ -138,11 +149,26 @@ class AttentionMechanism(nn.Module):
         if self.key.size(0) != query.size(0):
             self.key = self.key[0: 1, :, :].repeat([query.size(0), 1, 1])
 
+        # Restrict the encoder window to the right-most trigger point in the mini-batch
+        window = klen
+        if self.atype == 'triggered_attention':
+            assert trigger_points is not None
+            assert qlen == 1
+            if self.future_mask is None:
+                # Build masks for all steps at once, which avoids host synchronization per step
+                boundary = trigger_points.long() + self.lookahead  # `[B, L]`
+                positions = torch.arange(klen, device=key.device)
+                self.future_mask = positions.view(1, 1, klen) > boundary.unsqueeze(2)  # `[B, L, klen]`
+                self.windows = (boundary.max(0)[0] + 1).clamp(1, klen).tolist()  # `[L]`
+            j = min(self.step, len(self.windows) - 1)
+            window = self.windows[j]
+            self.step += 1
+
         if self.atype == 'no':
             raise NotImplementedError
 
         elif self.atype in ['add', 'triggered_attention']:
-            tmp = self.key.unsqueeze(1) + self.w_query(query).unsqueeze(2)
+            tmp = self.key[:, :window].unsqueeze(1) + self.w_query(query).unsqueeze(2)
             e = self.v(torch.tanh(tmp)).squeeze(3)
 
         elif self.atype == 'location':
@@ -160,24 +186,24 @@ class AttentionMechanism(nn.Module):
         elif self.atype == 'luong_concat':
             query = query.repeat([1, klen, 1])
             e = self.v(torch.tanh(self.w(torch.cat([self.key, query], dim=-1)))).transpose(2, 1)
-        assert e.size() == (bs, qlen, klen), (e.size(), (bs, qlen, klen))
+        assert e.size() == (bs, qlen, window), (e.size(), (bs, qlen, window))
 
         NEG_INF = float(np.finfo(torch.tensor(0, dtype=e.dtype).numpy().dtype).min)
 
         # Mask the right part from the trigger point
         if self.atype == 'triggered_attention':
-            assert trigger_points is not None
-            for b in range(bs):
-                e[b, :, trigger_points[b] + self.lookahead + 1:] = NEG_INF
+            e = e.masked_fill(self.future_mask[:, j:j + 1, :window], NEG_INF)
 
         # Compute attention weights, context vector
         if self.mask is not None:
-            e = e.masked_fill_(self.mask == 0, NEG_INF)
+            e = e.masked_fill_(self.mask[:, :, :window] == 0, NEG_INF)
         if self.sigmoid_smoothing:
             aw = torch.sigmoid(e) / torch.sigmoid(e).sum(-1).unsqueeze(-1)
         else:
             aw = torch.softmax(e * self.sharpening_factor, dim=-1)
         aw = self.dropout(aw)
-        cv = torch.bmm(aw, value)
+        cv = torch.bmm(aw, value[:, :window])
+        if window < klen:
+            aw = torch.cat([aw, aw.new_zeros(bs, qlen, klen - window)], dim=-1)
 
         return cv, aw.unsqueeze(1), None, None
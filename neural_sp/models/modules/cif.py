@@ -11,7 +11,6 @@ import torch
 import torch.nn as nn
 
 from neural_sp.models.modules.initialization import init_with_xavier_uniform
-from neural_sp.models.torch_utils import make_pad_mask
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +44,9 @@ class CIF(nn.Module):
         self.norm = nn.LayerNorm(enc_dim, eps=layer_norm_eps)
         self.proj = nn.Linear(enc_dim, 1)
 
+        # for incremental mode
+        self.reset()
+
         if param_init == 'xavier_uniform':
             self.reset_parameters()
         else:
@@ -56,14 +58,28 @@ class CIF(nn.Module):
         for n, p in self.named_parameters():
             init_with_xavier_uniform(n, p)
 
-    def forward(self, eouts, elens, ylens=None, mode='parallel'):
+    def reset(self):
+        """Reset the carry-over state for incremental mode."""
+        self.alpha_accum = None
+        self.state = None
+        self.n_tokens = None
+
+    def forward(self, eouts, elens, ylens=None, mode='parallel', is_last_chunk=False):
         """Forward pass.
 
+        In the incremental mode, eouts is a chunk of encoder outputs, and the
+        weight and the integrated state that have not fired yet are carried
+        over to the next call until reset() is called.
+        The number of tokens fired in each utterance is stored in self.n_tokens.
+        Note that 1dconv does not see the context across chunks.
+
         Args:
             eouts (FloatTensor): `[B, T, enc_dim]`
             elens (IntTensor): `[B]`
             ylens (IntTensor): `[B]`
             mode (str): parallel/incremental
+            is_last_chunk (bool): fire the remaining weight if it exceeds
+                the half of the threshold in the incremental mode
         Returns:
             cv (FloatTensor): `[B, L, enc_dim]`
             alpha (FloatTensor): `[B, T]`
@@ -71,89 +87,77 @@ class CIF(nn.Module):
 
         """
         bs, xmax, enc_dim = eouts.size()
+        device = eouts.device
 
         # 1d conv
         conv_feat = self.conv1d(eouts.transpose(2, 1)).transpose(2, 1)  # `[B, T, enc_dim]`
         conv_feat = torch.relu(self.norm(conv_feat))
         alpha = torch.sigmoid(self.proj(conv_feat)).squeeze(2)  # `[B, T]`
 
+        # padding
+        if elens is not None:
+            mask = torch.arange(xmax, device=device).unsqueeze(0) < elens.to(device).unsqueeze(1)
+            alpha = alpha.clone().masked_fill_(mask == 0, 0)
+
         # normalization
         if mode == 'parallel':
-            # padding
             assert ylens is not None
-            device = eouts.device
             ylens = ylens.to(device)
-            mask = make_pad_mask(elens.to(device))
-            alpha = alpha.clone().masked_fill_(mask == 0, 0)
-
-            alpha_norm = alpha / alpha.sum(1, keepdim=True) * ylens.float().unsqueeze(1)
+            alpha_norm = alpha / alpha.sum(1, keepdim=True) * (ylens.float() * self.beta).unsqueeze(1)
             ymax = int(ylens.max().item())
+            aws = self.integrate(alpha_norm, ymax)
+            # remove the residual weight after the last token
+            residual = torch.arange(ymax, device=device).view(1, ymax, 1) >= ylens.view(bs, 1, 1)
+            aws = aws.masked_fill(residual, 0)
+            cv = torch.bmm(aws, eouts)
         elif mode == 'incremental':
             alpha_norm = alpha  # infernece time
-            ymax = 1
-            if bs > 1:
-                raise NotImplementedError('Batch mode is not supported.')
-                # TODO(hirofumi0810): support batch mode
+            if self.alpha_accum is None:
+                self.alpha_accum = eouts.new_zeros(bs)
+                self.state = eouts.new_zeros(bs, enc_dim)
+            alpha_sum = self.alpha_accum + alpha_norm.sum(1)  # `[B]`
+            n_tokens = torch.floor(alpha_sum / self.beta).long()
+            if is_last_chunk:
+                # tail handling
+                n_tokens += (alpha_sum - n_tokens * self.beta >= self.beta * 0.5).long()
+            ymax = int(n_tokens.max().item())
+            aws = self.integrate(alpha_norm, ymax + 1, self.alpha_accum)  # `[B, ymax + 1, T]`
+            cv = torch.bmm(aws, eouts)
+            cv[:, 0] += self.state
+            # carry over the weight and the state of the unfired token
+            index = n_tokens.view(bs, 1, 1)
+            carry = (torch.arange(ymax + 1, device=device).view(1, ymax + 1, 1) == index).to(cv.dtype)
+            self.state = (carry * cv).sum(1) if not is_last_chunk else None
+            self.alpha_accum = (alpha_sum - n_tokens * self.beta) if not is_last_chunk else None
+            self.n_tokens = n_tokens
+            # remove unfired tokens
+            fired = torch.arange(ymax, device=device).view(1, ymax, 1) < index
+            cv = cv[:, :ymax].masked_fill(~fired, 0)
+            aws = aws[:, :ymax].masked_fill(~fired, 0)
         else:
             raise ValueError(mode)
 
-        cv = eouts.new_zeros(bs, ymax + 1, enc_dim)
-        aws = eouts.new_zeros(bs, ymax + 1, xmax)
-        n_tokens = torch.zeros(bs, dtype=torch.int64)
-        state = eouts.new_zeros(bs, self.enc_dim)
-        alpha_accum = eouts.new_zeros(bs)
-        for j in range(xmax):
-            alpha_accum_prev = alpha_accum
-            alpha_accum += alpha_norm[:, j]
-
-            if mode == 'parallel' and (alpha_accum >= self.beta).sum() == 0:
-                # No boundary is located in all utterances in mini-batch
-                # Carry over to the next frame
-                state += alpha_norm[:, j, None] * eouts[:, j]
-                aws[:, n_tokens, j] += alpha_norm[:, j]
-            else:
-                for b in range(bs):
-                    # skip the padding region
-                    if j > elens[b] - 1:
-                        continue
-
-                    # skip all-fired utterance
-                    if mode == 'parallel' and n_tokens[b].item() >= ylens[b]:
-                        continue
-
-                    if alpha_accum[b] < self.beta:
-                        # No boundary is located
-                        # Carry over to the next frame
-                        state[b] += alpha_norm[b, j, None] * eouts[b, j]
-                        aws[b, n_tokens[b], j] += alpha_norm[b, j]
-
-                        # tail handling
-                        if mode == 'incremental' and j == elens[b] - 1:
-                            if alpha_accum[b] >= 0.5:
-                                n_tokens[b] += 1
-                                cv[b, n_tokens[b]] = state[b]
-                            break
-                    else:
-                        # A boundary is located
-                        ak1 = 1 - alpha_accum_prev[b]
-                        ak2 = alpha_norm[b, j] - ak1
-                        cv[b, n_tokens[b]] = state[b] + ak1 * eouts[b, j]
-                        aws[b, n_tokens[b], j] += ak1
-                        n_tokens[b] += 1
-                        # Carry over to the next frame
-                        state[b] = ak2 * eouts[b, j]
-                        alpha_accum[b] = ak2
-                        aws[b, n_tokens[b], j] += ak2
-
-                        if mode == 'incremental':
-                            break
-
-                if mode == 'incremental' and n_tokens[0] >= 1:
-                    break
-                    # TODO(hirofumi0810): support batch mode
-
-        # truncate
-        cv = cv[:, :ymax]
-        aws = aws[:, :ymax]
-
         return cv, alpha, aws
+
+    def integrate(self, alpha, ymax, alpha_accum=None):
+        """Split frame weights into tokens by locating fire points on the cumulative sum.
+
+        The k-th token integrates the weights in the interval
+        `[k * beta, (k + 1) * beta)` of the cumulative sum, so the weight of
+        a frame across a fire point is split into the adjacent tokens.
+
+        Args:
+            alpha (FloatTensor): `[B, T]`
+            ymax (int): number of tokens
+            alpha_accum (FloatTensor): `[B]` weight carried over from previous frames
+        Returns:
+            aws (FloatTensor): `[B, ymax, T]`
+
+        """
+        alpha_cum = torch.cumsum(alpha, dim=1)  # `[B, T]`
+        if alpha_accum is not None:
+            alpha_cum = alpha_cum + alpha_accum.unsqueeze(1)
+        alpha_cum_prev = alpha_cum - alpha
+        lower = torch.arange(ymax, device=alpha.device, dtype=alpha.dtype).view(1, ymax, 1) * self.beta
+        aws = torch.min(alpha_cum.unsqueeze(1), lower + self.beta) - torch.max(alpha_cum_prev.unsqueeze(1), lower)
+        return torch.clamp(aws, min=0)
@@ -7,6 +7,7 @@
 """Gated Linear Units (GLU) block."""
 
 from collections import OrderedDict
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -45,6 +46,9 @@ class ConvGLUBlock(nn.Module):
 
         super().__init__()
 
+        self.kernel_size = kernel_size
+        self.in_ch = in_ch
+
         self.conv_residual = None
         if in_ch != out_ch:
             self.conv_residual = nn.utils.weight_norm(
@@ -63,7 +67,7 @@ class ConvGLUBlock(nn.Module):
                           kernel_size=(kernel_size, 1)), name='weight', dim=0)
             # TODO(hirofumi0810): padding?
             layers['dropout'] = nn.Dropout(p=dropout)
-            layers['glu'] = nn.GLU()
+            layers['glu'] = nn.GLU(dim=1)
 
         elif bottlececk_dim > 0:
             layers['conv_in'] = nn.utils.weight_norm(
@@ -76,12 +80,12 @@ class ConvGLUBlock(nn.Module):
                           out_channels=bottlececk_dim,
                           kernel_size=(kernel_size, 1)), name='weight', dim=0)
             layers['dropout'] = nn.Dropout(p=dropout)
-            layers['glu'] = nn.GLU()
             layers['conv_out'] = nn.utils.weight_norm(
                 nn.Conv2d(in_channels=bottlececk_dim,
                           out_channels=out_ch * 2,
                           kernel_size=(1, 1)), name='weight', dim=0)
             layers['dropout_out'] = nn.Dropout(p=dropout)
+            layers['glu'] = nn.GLU(dim=1)
 
         self.layers = nn.Sequential(layers)
 
@@ -101,3 +105,23 @@ class ConvGLUBlock(nn.Module):
         xs = self.layers(xs)  # `[B, out_ch * 2, T ,1]`
         xs = xs + residual
         return xs
+
+    def forward_incremental(self, xs, buffer):
+        """Forward pass for new frames given the left context.
+
+        Args:
+            xs (FloatTensor): `[B, in_ch, T, feat_dim]`
+            buffer (FloatTensor): last `kernel_size - 1` input frames. `[B, in_ch, kernel_size - 1, feat_dim]`
+        Returns:
+            out (FloatTensor): `[B, out_ch, T, feat_dim]`
+            new_buffer (FloatTensor): `[B, in_ch, kernel_size - 1, feat_dim]`
+
+        """
+        residual = xs
+        if self.conv_residual is not None:
+            residual = self.dropout_residual(self.conv_residual(residual))
+        xs = torch.cat([buffer, xs], dim=2)  # `[B, in_ch, kernel_size - 1 + T, feat_dim]`
+        new_buffer = xs[:, :, xs.size(2) - (self.kernel_size - 1):]
+        xs = self.layers(xs)  # `[B, out_ch, T, feat_dim]`
+        xs = xs + residual
+        return xs, new_buffer
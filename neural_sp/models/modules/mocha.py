@@ -12,15 +12,12 @@
 import logging
 import math
 import numpy as np
-import random
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 from neural_sp.models.modules.causal_conv import CausalConv1d
 
-random.seed(1)
-
 logger = logging.getLogger(__name__)
 
 
@@ -80,7 +77,7 @@ class MonotonicEnergy(nn.Module):
         if atype == 'add':
             self.v = nn.utils.weight_norm(self.v, name='weight', dim=0)
             # initialization
-            self.v.weight_g.data = torch.Tensor([1 / adim]).sqrt()
+            self.v.weight_g.data.fill_(math.sqrt(1 / adim))
         elif atype == 'scaled_dot':
             if param_init == 'xavier_uniform':
                 self.reset_parameters(bias)
@@ -384,19 +381,20 @@ class MoChA(nn.Module):
     def recursive(self, e_ma, aw_prev):
         bs, n_heads_ma, qlen, klen = e_ma.size()
         p_choose = torch.sigmoid(add_gaussian_noise(e_ma, self.noise_std))  # `[B, H_ma, qlen, klen]`
+        # The recurrence over key frames
+        #   q_j = (1 - p_choose_(j-1)) * q_(j-1) + aw_prev_j
+        #   alpha_j = p_choose_j * q_j
+        # is solved in closed form as
+        #   q_j = sum_(k<=j) aw_prev_k * prod_(k<=m<j) (1 - p_choose_m)
+        # with log-cumsum-exp in double precision, which stays exact where the
+        # division by the cumulative product in `parallel` would underflow
+        tiny = torch.finfo(torch.float64).tiny
+        log_cumprod_1mp = exclusive_cumsum(torch.log(torch.clamp(1 - p_choose.double(), min=tiny)))
         alpha = []
         for i in range(qlen):
-            # Compute [1, 1 - p_choose[0], 1 - p_choose[1], ..., 1 - p_choose[-2]]
-            shifted_1mp_choose = torch.cat([e_ma.new_ones(bs, self.n_heads_ma, 1, 1),
-                                            1 - p_choose[:, :, i:i + 1, :-1]], dim=-1)
-            # Compute attention distribution recursively as
-            # q_j = (1 - p_choose_j) * q_(j-1) + aw_prev_j
-            # alpha_j = p_choose_j * q_j
-            q = e_ma.new_zeros(bs, self.n_heads_ma, 1, klen + 1)
-            for j in range(klen):
-                q[:, :, i:i + 1, j + 1] = shifted_1mp_choose[:, :, i:i + 1, j].clone() * q[:, :, i:i + 1, j].clone() + \
-                    aw_prev[:, :, :, j].clone()
-            aw_prev = p_choose[:, :, i:i + 1] * q[:, :, i:i + 1, 1:]  # `[B, H_ma, 1, klen]`
+            log_q = log_cumprod_1mp[:, :, i:i + 1] + torch.logcumsumexp(
+                torch.log(torch.clamp(aw_prev.double(), min=tiny)) - log_cumprod_1mp[:, :, i:i + 1], dim=-1)
+            aw_prev = p_choose[:, :, i:i + 1] * torch.exp(log_q).to(p_choose.dtype)  # `[B, H_ma, 1, klen]`
             alpha.append(aw_prev)
         alpha = torch.cat(alpha, dim=2) if qlen > 1 else alpha[-1]  # `[B, H_ma, qlen, klen]`
         return alpha, p_choose
@@ -404,22 +402,27 @@ class MoChA(nn.Module):
     def parallel(self, e_ma, aw_prev, trigger_points):
         bs, n_heads_ma, qlen, klen = e_ma.size()
         p_choose = torch.sigmoid(add_gaussian_noise(e_ma, self.noise_std))  # `[B, H_ma, qlen, klen]`
-        alpha = []
         # safe_cumprod computes cumprod in logspace with numeric checks
         cumprod_1mp_choose = safe_cumprod(1 - p_choose, eps=self.eps)  # `[B, H_ma, qlen, klen]`
+        # Only the cumulative sum over the previous alignment depends on the
+        # previous query, so everything else is computed for all queries at once
+        emit = p_choose * cumprod_1mp_choose
+        if self.no_denom:
+            denom = cumprod_1mp_choose.new_ones(1, 1, 1, 1).expand(bs, n_heads_ma, qlen, 1)
+        else:
+            denom = torch.clamp(cumprod_1mp_choose, min=self.eps, max=1.0)
+        if self.decot:
+            # Mask the right part from the trigger point
+            assert trigger_points is not None
+            right_mask = torch.arange(klen, device=e_ma.device).view(1, 1, 1, klen) > \
+                (trigger_points[:, :qlen] + self.lookahead).view(bs, 1, qlen, 1)
+            emit = emit.masked_fill(right_mask, 0)
         # Compute recurrence relation solution
+        alpha = []
         for i in range(qlen):
-            denom = 1 if self.no_denom else torch.clamp(
-                cumprod_1mp_choose[:, :, i:i + 1], min=self.eps, max=1.0)
-            aw_prev = p_choose[:, :, i:i + 1] * cumprod_1mp_choose[:, :, i:i + 1] * torch.cumsum(
-                aw_prev / denom, dim=-1)  # `[B, H_ma, 1, klen]`
-            # Mask the right part from the trigger point
-            if self.decot:
-                assert trigger_points is not None
-                for b in range(bs):
-                    aw_prev[b, :, :, trigger_points[b, i:i + 1] + self.lookahead + 1:] = 0
+            aw_prev = emit[:, :, i:i + 1] * torch.cumsum(
+                aw_prev / denom[:, :, i:i + 1], dim=-1)  # `[B, H_ma, 1, klen]`
             alpha.append(aw_prev)
-
         alpha = torch.cat(alpha, dim=2) if qlen > 1 else alpha[-1]  # `[B, H_ma, qlen, klen]`
         return alpha, p_choose
 
@@ -430,51 +433,20 @@ class MoChA(nn.Module):
 
         aw_prev = aw_prev[:, :, :, -klen:]
 
-        if self.n_heads_ma == 1:
-            # assert aw_prev.sum() > 0
-            p_choose_i = (torch.sigmoid(e_ma) >= 0.5).float()[:, :, 0:1]
-            # Attend when monotonic energy is above threshold (Sigmoid > 0.5)
-            # Remove any probabilities before the index chosen at the last time step
-            p_choose_i *= torch.cumsum(
-                aw_prev[:, :, 0:1, -e_ma.size(3):], dim=-1)  # `[B, H_ma, 1 (qlen), klen]`
-            # Now, use exclusive cumprod to remove probabilities after the first
-            # chosen index, like so:
-            # p_choose_i                        = [0, 0, 0, 1, 1, 0, 1, 1]
-            # 1 - p_choose_i                    = [1, 1, 1, 0, 0, 1, 0, 0]
-            # exclusive_cumprod(1 - p_choose_i) = [1, 1, 1, 1, 0, 0, 0, 0]
-            # alpha: product of above           = [0, 0, 0, 1, 0, 0, 0, 0]
-            alpha = p_choose_i * exclusive_cumprod(1 - p_choose_i)  # `[B, H_ma, 1 (qlen), klen]`
-        else:
-            p_choose_i = (torch.sigmoid(e_ma) >= 0.5).float()[:, :, 0:1]
-            # Attend when monotonic energy is above threshold (Sigmoid > 0.5)
-            # Remove any probabilities before the index chosen at the last time step
-            p_choose_i *= torch.cumsum(aw_prev[:, :, 0:1], dim=-1)  # `[B, H_ma, 1 (qlen), klen]`
-            # Now, use exclusive cumprod to remove probabilities after the first
-            # chosen index, like so:
-            # p_choose_i                        = [0, 0, 0, 1, 1, 0, 1, 1]
-            # 1 - p_choose_i                    = [1, 1, 1, 0, 0, 1, 0, 0]
-            # exclusive_cumprod(1 - p_choose_i) = [1, 1, 1, 1, 0, 0, 0, 0]
-            # alpha: product of above           = [0, 0, 0, 1, 0, 0, 0, 0]
-            alpha = p_choose_i * exclusive_cumprod(1 - p_choose_i)  # `[B, H_ma, 1 (qlen), klen]`
-
-        if eps_wait > 0:
-            for b in range(bs):
-                # no boundary until the last frame for all heads
-                if alpha[b].sum() == 0:
-                    continue
-
-                leftmost = alpha[b, :, -1].nonzero()[:, -1].min().item()
-                rightmost = alpha[b, :, -1].nonzero()[:, -1].max().item()
-                for h in range(self.n_heads_ma):
-                    # no bondary at the h-th head
-                    if alpha[b, h, -1].sum().item() == 0:
-                        alpha[b, h, -1, min(rightmost, leftmost + eps_wait)] = 1
-                        continue
-
-                    # surpass acceptable latency
-                    if alpha[b, h, -1].nonzero()[:, -1].min().item() >= leftmost + eps_wait:
-                        alpha[b, h, -1, :] = 0  # reset
-                        alpha[b, h, -1, leftmost + eps_wait] = 1
+        # Attend when monotonic energy is above threshold (Sigmoid > 0.5)
+        p_choose_i = (torch.sigmoid(e_ma) >= 0.5).float()[:, :, 0:1]
+        # Remove any probabilities before the index chosen at the last time step
+        p_choose_i *= torch.cumsum(aw_prev[:, :, 0:1], dim=-1)  # `[B, H_ma, 1 (qlen), klen]`
+        # Now, use exclusive cumprod to remove probabilities after the first
+        # chosen index, like so:
+        # p_choose_i                        = [0, 0, 0, 1, 1, 0, 1, 1]
+        # 1 - p_choose_i                    = [1, 1, 1, 0, 0, 1, 0, 0]
+        # exclusive_cumprod(1 - p_choose_i) = [1, 1, 1, 1, 0, 0, 0, 0]
+        # alpha: product of above           = [0, 0, 0, 1, 0, 0, 0, 0]
+        alpha = p_choose_i * exclusive_cumprod(1 - p_choose_i)  # `[B, H_ma, 1 (qlen), klen]`
+
+        if eps_wait > 0 and self.n_heads_ma > 1:
+            alpha = head_synchronous_boundary(alpha, eps_wait)
 
         return alpha, None
 
@@ -629,17 +601,36 @@ def headdrop(alpha, n_heads_mono, dropout):
             alpha (FloatTensor): `[B, H_ma, qlen, klen]`
 
     """
-    n_effective_heads = n_heads_mono
-    head_mask = alpha.new_ones(alpha.size()).byte()
-    for h in range(n_heads_mono):
-        if random.random() < dropout:
-            head_mask[:, h] = 0
-            n_effective_heads -= 1
-    alpha = alpha.masked_fill_(head_mask == 0, 0)
-    # Normalization
-    if n_effective_heads > 0:
-        alpha = alpha * (n_heads_mono / n_effective_heads)
-    return alpha
+    head_mask = (alpha.new_empty(n_heads_mono).uniform_() >= dropout).to(alpha.dtype)
+    # Normalization (all heads are zero when no head survives)
+    scale = n_heads_mono / head_mask.sum().clamp(min=1)
+    return alpha * (head_mask * scale).view(1, n_heads_mono, 1, 1)
+
+
+def head_synchronous_boundary(alpha, eps_wait):
+    """Force all heads to detect boundaries within `eps_wait` frames from the leftmost one.
+
+        Args:
+            alpha (FloatTensor): `[B, H_ma, 1, klen]` (one-hot or all zero for each head)
+            eps_wait (int): wait time delay for head-synchronous decoding in MMA
+        Returns:
+            alpha (FloatTensor): `[B, H_ma, 1, klen]`
+
+    """
+    klen = alpha.size(-1)
+    detected = alpha[:, :, -1].sum(-1) > 0  # `[B, H_ma]`
+    boundary = alpha[:, :, -1].argmax(-1)  # `[B, H_ma]`
+    leftmost = boundary.masked_fill(~detected, klen).min(-1, keepdim=True)[0]  # `[B, 1]`
+    rightmost = boundary.masked_fill(~detected, -1).max(-1, keepdim=True)[0]  # `[B, 1]`
+    # heads without a boundary wait until the deadline, and heads
+    # surpassing acceptable latency are reset to the deadline
+    deadline = leftmost + eps_wait
+    boundary = torch.where(detected, torch.where(boundary >= deadline, deadline, boundary),
+                           torch.min(rightmost, deadline))
+    # no boundary until the last frame for all heads
+    boundary = boundary.masked_fill(~detected.any(-1, keepdim=True), -1)
+    alpha_new = (torch.arange(klen, device=alpha.device).view(1, 1, klen) == boundary.unsqueeze(2))
+    return alpha_new.to(alpha.dtype).unsqueeze(2)
 
 
 def add_gaussian_noise(xs, std):
@@ -699,7 +690,7 @@ def moving_sum(x, back, forward):
 
     """
     bs, n_heads_mono, n_heads_chunk, qlen, klen = x.size()
-    x = x.view(-1, klen)
+    x = x.reshape(-1, klen)
     # Moving sum is computed as a carefully-padded 1D convolution with ones
     x_padded = F.pad(x, pad=[back, forward])  # `[B * H_ma * H_ca * qlen, back + klen + forward]`
     # Add a "channel" dimension
@@ -153,3 +153,49 @@ class MultiheadAttentionMechanism(nn.Module):
         aw = aw.permute(0, 3, 1, 2)  # `[B, H, qlen, klen]`
 
         return cv, aw, None, None
+
+    def forward_incremental(self, ys, kv_cache=None, cache_len=0):
+        """Causal self-attention over cached keys and values for incremental decoding.
+
+        Keys and values are projected only for new inputs and appended to the cache,
+        so each step costs O(L) instead of O(L^2).
+
+        Args:
+            ys (FloatTensor): new inputs. `[B, qlen, kdim]`
+            kv_cache (FloatTensor): keys and values of previous inputs. `[B, klen - qlen, adim * 2]`
+            cache_len (int): maximum number of cached steps (sliding window).
+                Unbounded if 0.
+        Returns:
+            cv (FloatTensor): `[B, qlen, vdim]`
+            aw (FloatTensor): `[B, H, qlen, klen]`
+            new_kv_cache (FloatTensor): `[B, min(klen, cache_len), adim * 2]`
+
+        """
+        assert self.atype == 'scaled_dot'
+        bs, qlen = ys.size()[:2]
+
+        kv = torch.cat([self.w_key(ys), self.w_value(ys)], dim=-1)
+        if kv_cache is not None and kv_cache.size(1) > 0:
+            kv = torch.cat([kv_cache, kv], dim=1)
+        klen = kv.size(1)
+        key, value = kv.view(bs, klen, 2, self.n_heads, self.d_k).unbind(2)  # `[B, klen, H, d_k]`
+        query = self.w_query(ys).view(bs, qlen, self.n_heads, self.d_k)  # `[B, qlen, H, d_k]`
+
+        e = torch.einsum("bihd,bjhd->bijh", (query, key)) / self.scale  # `[B, qlen, klen, H]`
+        if qlen > 1:
+            causal_mask = torch.tril(ys.new_ones(qlen, klen, dtype=torch.bool), diagonal=klen - qlen)
+            NEG_INF = float(np.finfo(torch.tensor(0, dtype=e.dtype).numpy().dtype).min)
+            e = e.masked_fill_(~causal_mask[None, :, :, None], NEG_INF)
+        aw = torch.softmax(e, dim=2)
+        aw = self.dropout_attn(aw)
+
+        cv = torch.einsum("bijh,bjhd->bihd", (aw, value))  # `[B, qlen, H, d_k]`
+        cv = cv.contiguous().view(bs, -1, self.n_heads * self.d_k)  # `[B, qlen, H * d_k]`
+        cv = self.w_out(cv)
+        aw = aw.permute(0, 3, 1, 2)  # `[B, H, qlen, klen]`
+
+        # Evict the oldest steps
+        if cache_len > 0 and klen > cache_len:
+            kv = kv[:, -cache_len:]
+
+        return cv, aw, kv
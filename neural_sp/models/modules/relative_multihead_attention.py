@@ -178,3 +178,81 @@ class RelativeMultiheadAttentionMechanism(nn.Module):
         aw = aw.permute(0, 3, 1, 2)  # `[B, H, qlen, mlen+qlen]`
 
         return cv, aw
+
+    def forward_incremental(self, key, query, pos_embs, kv_cache=None, memory_kv=None,
+                            u_bias=None, v_bias=None):
+        """Causal self-attention over cached keys and values for incremental decoding.
+
+        Keys and values are projected only for new inputs and appended to the cache.
+        Keys and values of memory are projected once in advance and shared over
+        the mini-batch. The position-based term is computed by projecting queries
+        to the positional embedding space, so that relative positional embeddings
+        are not projected at every step.
+
+        Args:
+            key (FloatTensor): new inputs. `[B, qlen, kdim]`
+            query (FloatTensor): `[B, qlen, qdim]`
+            pos_embs (LongTensor): `[mlen+klen, 1, d_model]`
+            kv_cache (FloatTensor): keys and values of previous inputs. `[B, klen-qlen, adim * 2]`
+            memory_kv (FloatTensor): keys and values of memory. `[1 or B, mlen, adim * 2]`
+            u_bias (nn.Parameter): `[H, d_k]`
+            v_bias (nn.Parameter): `[H, d_k]`
+        Returns:
+            cv (FloatTensor): `[B, qlen, vdim]`
+            aw (FloatTensor): `[B, H, qlen, mlen+klen]`
+            new_kv_cache (FloatTensor): `[B, klen, adim * 2]`
+
+        """
+        bs, qlen = query.size()[:2]
+
+        new_kv_cache = self.project_kv(key)
+        if kv_cache is not None and kv_cache.size(1) > 0:
+            new_kv_cache = torch.cat([kv_cache, new_kv_cache], dim=1)
+        kv = new_kv_cache
+        if memory_kv is not None and memory_kv.size(1) > 0:
+            kv = torch.cat([memory_kv.expand(bs, -1, -1), kv], dim=1)
+        klen = kv.size(1)
+        k, v = kv.view(bs, klen, 2, self.n_heads, self.d_k).unbind(2)  # `[B, mlen+klen, H, d_k]`
+        q = self.w_query(query).view(bs, qlen, self.n_heads, self.d_k)  # `[B, qlen, H, d_k]`
+
+        # content-based attention term: (a) + (c)
+        q_u = q + u_bias[None, None] if u_bias is not None else q
+        AC = torch.einsum("bihd,bjhd->bijh", (q_u, k))  # `[B, qlen, mlen+klen, H]`
+
+        # position-based attention term: (b) + (d)
+        # NOTE: (q + v) W_pos p_j is computed as ((q + v) W_pos) p_j
+        q_v = q + v_bias[None, None] if v_bias is not None else q
+        w_pos = self.w_pos if self.xl_like else self.w_value
+        q_pos = torch.einsum("bihd,hdm->bihm", (q_v, w_pos.weight.view(self.n_heads, self.d_k, -1)))
+        BD = torch.einsum("bihm,jm->bijh", (q_pos, pos_embs.squeeze(1)))  # `[B, qlen, mlen+klen, H]`
+        if w_pos.bias is not None:
+            BD = BD + torch.einsum("bihd,hd->bih", (q_v, w_pos.bias.view(self.n_heads, self.d_k))).unsqueeze(2)
+        if qlen > 1:
+            BD = self._rel_shift(BD)
+        # NOTE: the last query does not need to be shifted
+
+        e = (AC + BD) / self.scale  # `[B, qlen, mlen+klen, H]`
+        if qlen > 1:
+            causal_mask = torch.tril(query.new_ones(qlen, klen, dtype=torch.bool), diagonal=klen - qlen)
+            NEG_INF = float(np.finfo(torch.tensor(0, dtype=e.dtype).numpy().dtype).min)
+            e = e.masked_fill_(~causal_mask[None, :, :, None], NEG_INF)
+        aw = torch.softmax(e, dim=2)
+        aw = self.dropout_attn(aw)
+
+        cv = torch.einsum("bijh,bjhd->bihd", (aw, v))  # `[B, qlen, H, d_k]`
+        cv = cv.contiguous().view(bs, -1, self.n_heads * self.d_k)  # `[B, qlen, H * d_k]`
+        cv = self.w_out(cv)
+        aw = aw.permute(0, 3, 1, 2)  # `[B, H, qlen, mlen+klen]`
+
+        return cv, aw, new_kv_cache
+
+    def project_kv(self, key):
+        """Project inputs to keys and values.
+
+        Args:
+            key (FloatTensor): `[B, klen, kdim]`
+        Returns:
+            kv (FloatTensor): `[B, klen, adim * 2]`
+
+        """
+        return torch.cat([self.w_key(key), self.w_value(key)], dim=-1)
@@ -259,6 +259,61 @@ class TransformerDecoderBlock(nn.Module):
 
         return out
 
+    def forward_incremental(self, ys, kv_cache=None, cache_len=0,
+                            pos_embs=None, memory_kv=None, u_bias=None, v_bias=None):
+        """Transformer decoder forward pass with cached keys and values of self-attention.
+
+        Only new inputs are processed. This is supported for decoder-only
+        architectures (i.e., TransformerLM and TransformerXL) in the inference stage.
+
+        Args:
+            ys (FloatTensor): new inputs. `[B, qlen, d_model]`
+            kv_cache (FloatTensor): `[B, L_prev, d_model * 2]`
+            cache_len (int): maximum number of cached steps. Unbounded if 0.
+                Not used for TransformerXL.
+            pos_embs (LongTensor): `[mlen + L_prev + qlen, 1, d_model]`
+            memory_kv (FloatTensor): keys and values of memory. `[1 or B, mlen, d_model * 2]`
+            u_bias (FloatTensor): global parameter for TransformerXL
+            v_bias (FloatTensor): global parameter for TransformerXL
+        Returns:
+            out (FloatTensor): `[B, qlen, d_model]`
+            new_kv_cache (FloatTensor): `[B, L_prev + qlen, d_model * 2]`
+
+        """
+        assert not (self.src_tgt_attention or self.lm_fusion)
+        self.reset_visualization()
+
+        # self-attention
+        residual = ys
+        ys = self.norm1(ys)
+        if self.memory_transformer:
+            out, self._yy_aws, new_kv_cache = self.self_attn.forward_incremental(
+                ys, ys, pos_embs, kv_cache, memory_kv, u_bias, v_bias)
+        else:
+            out, self._yy_aws, new_kv_cache = self.self_attn.forward_incremental(
+                ys, kv_cache, cache_len)
+        out = self.dropout(out) + residual
+
+        # position-wise feed-forward
+        residual = out
+        out = self.norm3(out)
+        out = self.feed_forward(out)
+        out = self.dropout(out) + residual
+
+        return out, new_kv_cache
+
+    def memory_kv(self, memory):
+        """Project memory of TransformerXL to keys and values of self-attention.
+
+        Args:
+            memory (FloatTensor): `[B, mlen, d_model]`
+        Returns:
+            memory_kv (FloatTensor): `[B, mlen, d_model * 2]`
+
+        """
+        assert self.memory_transformer
+        return self.self_attn.project_kv(self.norm1(memory))
+
 
 class SyncBidirTransformerDecoderBlock(nn.Module):
     """A single layer of the synchronous bidirectional Transformer decoder.
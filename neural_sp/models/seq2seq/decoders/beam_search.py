@@ -6,7 +6,8 @@
 
 """Utility funcitons for beam search decoding."""
 
-# import logging
+from collections import OrderedDict
+import logging
 # import math
 # import numpy as np
 # import os
@@ -17,6 +18,8 @@ import torch
 
 from neural_sp.models.torch_utils import tensor2np
 
+logger = logging.getLogger(__name__)
+
 
 class BeamSearch(object):
     def __init__(self, beam_width, eos, ctc_weight, device, beam_width_bwd=0):
@@ -67,12 +70,120 @@ class BeamSearch(object):
     def add_lm_score(self, after_topk=True):
         raise NotImplementedError
 
-    def update_rnnlm_state_batch(self, lm, hyps, y):
+    def update_rnnlm_state_batch(self, lm, hyps, y, lm_cache=None, shortlist=False):
         lmout, lmstate, scores_lm = None, None, None
         if lm is not None:
             if hyps[0]['lmstate'] is not None:
-                lm_hxs = torch.cat([beam['lmstate']['hxs'] for beam in hyps], dim=1)
-                lm_cxs = torch.cat([beam['lmstate']['cxs'] for beam in hyps], dim=1)
-                lmstate = {'hxs': lm_hxs, 'cxs': lm_cxs}
-            lmout, lmstate, scores_lm = lm.predict(y, lmstate)
+                lmstate = {k: torch.cat([beam['lmstate'][k] for beam in hyps], dim=1)
+                           for k in hyps[0]['lmstate'].keys()}
+            if lm_cache is not None:
+                lmout, lmstate, scores_lm = lm_cache.predict(lm, [beam['hyp'] for beam in hyps], y, lmstate,
+                                                             shortlist=shortlist)
+            else:
+                lmout, lmstate, scores_lm = lm.predict(y, lmstate, shortlist=shortlist)
         return lmout, lmstate, scores_lm
+
+
+class LMStateCache(object):
+    """LRU cache of LM states and output distributions keyed by token prefixes.
+
+    LM states only depend on the token prefix when they are not carried over
+    from previous utterances, so they are shared among hypotheses in the beam
+    and across utterances.
+
+    Args:
+        lm (RNNLM or TransformerLM or TransformerXL):
+        capacity (int): maximum number of prefixes to cache
+
+    """
+
+    def __init__(self, lm, capacity):
+        self.lm = lm
+        self.capacity = capacity
+        self.cache = OrderedDict()
+        self.n_hits = 0
+        self.n_queries = 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    @property
+    def hit_rate(self):
+        return self.n_hits / self.n_queries if self.n_queries > 0 else 0.
+
+    def report(self):
+        logger.info('LM state cache: %d prefixes, hit rate: %.2f %% (%d/%d)' %
+                    (len(self.cache), self.hit_rate * 100, self.n_hits, self.n_queries))
+
+    def predict(self, lm, prefixes, ys, state, mems=None, cache=None, shortlist=False):
+        """Drop-in replacement of `lm.predict` for a batch of hypotheses.
+
+        Args:
+            lm (RNNLM or TransformerLM or TransformerXL): same as the one in the constructor
+            prefixes (list): A list of length `[B]`, which contains token ID lists
+                (including the last input token) used as cache keys
+            ys (LongTensor): `[B, L]`
+            state (dict or list): LM states of all hypotheses
+            mems (XLMemory): memory of TransformerXL (cache is not used when it is given)
+            cache (list): cached Transformer states (the same as `state` for TransformerLM)
+            shortlist (bool): return inputs to the output layer instead of `log_probs`
+        Returns:
+            lmout (FloatTensor): `[B, 1, n_units]`
+            state (dict or list): new LM states
+            log_probs (FloatTensor): `[B, 1, vocab]`
+
+        """
+        assert lm is self.lm
+        if mems is not None:
+            return lm.predict(ys, state, mems=mems, cache=cache, shortlist=shortlist)
+
+        keys = [tuple(p) for p in prefixes]
+        self.n_queries += len(keys)
+        entries = [self.cache.get(k) for k in keys]
+        miss = [j for j, e in enumerate(entries) if e is None]
+        for j, e in enumerate(entries):
+            if e is not None:
+                self.n_hits += 1
+                self.cache.move_to_end(keys[j])
+
+        if len(miss) > 0:
+            # Run the LM only for hypotheses not in the cache
+            miss_ids = ys.new_tensor(miss)
+            state_miss = _index_lmstate(state, miss_ids)
+            cache_miss = _index_lmstate(cache, miss_ids)
+            lmout, new_state, log_probs = lm.predict(ys[miss_ids], state_miss, cache=cache_miss,
+                                                     shortlist=shortlist)
+            for i, j in enumerate(miss):
+                # NOTE: clone not to keep the whole mini-batch alive in the cache
+                entries[j] = (lmout[i:i + 1, -1:].clone() if lmout is not None else None,
+                              _index_lmstate(new_state, miss_ids.new_tensor([i])),
+                              log_probs[i:i + 1, -1:].clone())
+                if keys[j] not in self.cache:
+                    self.cache[keys[j]] = entries[j]
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+
+        lmout = torch.cat([e[0] for e in entries], dim=0) if entries[0][0] is not None else None
+        new_state = _cat_lmstate([e[1] for e in entries])
+        log_probs = torch.cat([e[2] for e in entries], dim=0)
+        return lmout, new_state, log_probs
+
+
+def _index_lmstate(state, ids):
+    """Select hypotheses from LM states."""
+    if state is None:
+        return None
+    if isinstance(state, dict):  # RNNLM
+        return {k: v.index_select(1, ids) if v is not None else None for k, v in state.items()}
+    return [s.index_select(0, ids) if s is not None else None for s in state]
+
+
+def _cat_lmstate(states):
+    """Concatenate LM states of hypotheses."""
+    if states[0] is None:
+        return None
+    if isinstance(states[0], dict):  # RNNLM
+        return {k: torch.cat([s[k] for s in states], dim=1) if states[0][k] is not None else None
+                for k in states[0].keys()}
+    return [torch.cat([s[lth] for s in states], dim=0) if states[0][lth] is not None else None
+            for lth in range(len(states[0]))]
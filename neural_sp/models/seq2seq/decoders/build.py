@@ -94,6 +94,7 @@ def build_decoder(args, special_symbols, enc_n_units, vocab,
             attn_dim=args.attn_dim,
             attn_sharpening_factor=args.attn_sharpening_factor,
             attn_sigmoid_smoothing=args.attn_sigmoid,
+            triggered_attn_key_projection=getattr(args, 'triggered_attn_key_projection', False),
             attn_conv_out_channels=args.attn_conv_n_channels,
             attn_conv_kernel_size=args.attn_conv_width,
             attn_n_heads=args.attn_n_heads,
@@ -151,55 +151,43 @@ class CTC(DecoderBase):
             eouts (FloatTensor): `[B, T, enc_n_units]`
             elens (IntTensor): `[B]`
         Returns:
-            hyps (IntTensor): `[B, L]`
+            trigger_points (IntTensor): `[B, L + 1]`
+                the left-most frame of each token in the CTC best path.
+                Positions after the last token including <eos> are filled with
+                the last frame of each utterance.
 
         """
         bs, xmax, _ = eouts.size()
-        log_probs = torch.log_softmax(self.output(eouts), dim=-1)
-        best_paths = log_probs.argmax(-1)  # `[B, L]`
-
-        hyps = []
-        for b in range(bs):
-            indices = [best_paths[b, t].item() for t in range(elens[b])]
-
-            # Step 1. Collapse repeated labels
-            collapsed_indices = [x[0] for x in groupby(indices)]
-
-            # Step 2. Remove all blank labels
-            best_hyp = [x for x in filter(lambda x: x != self.blank, collapsed_indices)]
-            hyps.append(best_hyp)
-
-        ymax = max([len(h) for h in hyps])
-
-        # pick up trigger points
-        trigger_points = log_probs.new_zeros((bs, ymax + 1), dtype=torch.int32)  # +1 for <eos>
-        for b in range(bs):
-            n_triggers = 0
-            for t in range(elens[b]):
-                token_idx = best_paths[b, t]
-
-                if token_idx == self.blank:
-                    continue
-                if not (t == 0 or token_idx != best_paths[b, t - 1]):
-                    continue
-
-                # NOTE: select the most left trigger points
-                trigger_points[b, n_triggers] = t
-                n_triggers += 1
-
-        return trigger_points
-
-    def greedy(self, eouts, elens):
+        best_paths = self.output(eouts).argmax(-1)  # `[B, T]`
+        elens = elens.to(best_paths.device).long()
+
+        # NOTE: select the most left trigger points
+        t = torch.arange(xmax, device=best_paths.device).unsqueeze(0)  # `[1, T]`
+        is_trigger = (best_paths != self.blank) & (t < elens.unsqueeze(1))
+        is_trigger[:, 1:] &= best_paths[:, 1:] != best_paths[:, :-1]
+        n_triggers = is_trigger.sum(1)  # `[B]`
+        ymax = n_triggers.max().item() if bs > 0 else 0
+
+        # +1 for <eos>
+        trigger_points = (elens - 1).clamp(min=0).unsqueeze(1).repeat(1, ymax + 1)
+        rank = is_trigger.long().cumsum(1) - 1  # `[B, T]`
+        b_idx, t_idx = is_trigger.nonzero(as_tuple=True)
+        trigger_points[b_idx, rank[b_idx, t_idx]] = t_idx
+        return trigger_points.int()
+
+    def greedy(self, eouts, elens, log_probs=None):
         """Greedy decoding.
 
         Args:
             eouts (FloatTensor): `[B, T, enc_n_units]`
             elens (np.ndarray): `[B]`
+            log_probs (FloatTensor): `[B, T, vocab]`, precomputed CTC log-probabilities
         Returns:
-            hyps (np.ndarray): Best path hypothesis. `[B, L]`
+            hyps (list): Best path hypothesis. A list of length `[B]`, which contains arrays of size `[L]`
 
         """
-        log_probs = torch.log_softmax(self.output(eouts), dim=-1)
+        if log_probs is None:
+            log_probs = torch.log_softmax(self.output(eouts), dim=-1)
         best_paths = log_probs.argmax(-1)  # `[B, L]`
 
         hyps = []
@@ -213,11 +201,11 @@ class CTC(DecoderBase):
             best_hyp = [x for x in filter(lambda x: x != self.blank, collapsed_indices)]
             hyps.append(np.array(best_hyp))
 
-        return np.array(hyps)
+        return hyps
 
     def beam_search(self, eouts, elens, params, idx2token,
                     lm=None, lm_second=None, lm_second_rev=None,
-                    nbest=1, refs_id=None, utt_ids=None, speakers=None):
+                    nbest=1, refs_id=None, utt_ids=None, speakers=None, log_probs=None):
         """Beam search decoding.
 
         Args:
@@ -237,6 +225,7 @@ class CTC(DecoderBase):
             refs_id (list): reference list
             utt_ids (list): utterance id list
             speakers (list): speaker list
+            log_probs (FloatTensor): `[B, T, vocab]`, precomputed CTC log-probabilities
         Returns:
             best_hyps (list): Best path hypothesis. `[B, L]`
 
@@ -255,8 +244,13 @@ class CTC(DecoderBase):
             assert lm_weight_second > 0
             lm_second.eval()
 
+        lm_cache = self.get_lm_cache(lm, params)
+        # score only the top-K candidates of CTC with the LM
+        lm_shortlist = lm is not None and params.get('recog_lm_shortlist', 0) > 0
+
         best_hyps = []
-        log_probs = torch.log_softmax(self.output(eouts), dim=-1)
+        if log_probs is None:
+            log_probs = torch.log_softmax(self.output(eouts), dim=-1)
         for b in range(bs):
             # Elements in the beam are (prefix, (p_b, p_no_blank))
             # Initialize the beam with the empty sequence, a probability of
@@ -299,11 +293,19 @@ class CTC(DecoderBase):
                                      'lmstate': beam[i_beam]['lmstate']})
 
                     # Update LM states for shallow fusion
-                    if lm is not None:
+                    if lm_cache is not None:
+                        _, lmstate, lm_log_probs = lm_cache.predict(
+                            lm, [hyp], eouts.new_zeros(1, 1).fill_(hyp[-1]).long(), beam[i_beam]['lmstate'],
+                            shortlist=lm_shortlist)
+                    elif lm is not None:
                         _, lmstate, lm_log_probs = lm.predict(
-                            eouts.new_zeros(1, 1).fill_(hyp[-1]), beam[i_beam]['lmstate'])
+                            eouts.new_zeros(1, 1).fill_(hyp[-1]).long(), beam[i_beam]['lmstate'],
+                            shortlist=lm_shortlist)
                     else:
                         lmstate = None
+                    if lm_shortlist:
+                        lm_log_probs = eouts.new_full((1, 1, self.vocab), float('-inf')).scatter_(
+                            2, topk_ids.unsqueeze(0), lm.score_shortlist(lm_log_probs[:, -1], topk_ids).unsqueeze(0))
 
                     # case 2. hyp is extended
                     new_p_b = LOG_0
@@ -379,7 +381,7 @@ class CTC(DecoderBase):
                                     (beam[k]['score_lm_second'] * lm_weight_second))
                     logger.info('-' * 50)
 
-        return np.array(best_hyps)
+        return best_hyps
 
 
 def _label_to_path(labels, blank):
@@ -13,6 +13,7 @@ import torch
 import shutil
 
 from neural_sp.models.base import ModelBase
+from neural_sp.models.seq2seq.decoders.beam_search import LMStateCache
 from neural_sp.models.torch_utils import np2tensor
 from neural_sp.models.torch_utils import pad_list
 
@@ -128,7 +129,7 @@ class DecoderBase(ModelBase):
 
     def decode_ctc(self, eouts, elens, params, idx2token,
                    lm=None, lm_second=None, lm_second_bwd=None,
-                   nbest=1, refs_id=None, utt_ids=None, speakers=None):
+                   nbest=1, refs_id=None, utt_ids=None, speakers=None, log_probs=None):
         """Decoding with CTC scores in the inference stage.
 
         Args:
@@ -143,6 +144,7 @@ class DecoderBase(ModelBase):
             lm: firsh path LM
             lm_second: second path LM
             lm_second_bwd: secoding path backward LM
+            log_probs (FloatTensor): `[B, T, vocab]`, precomputed CTC log-probabilities
         Returns:
             probs (FloatTensor): `[B, T, vocab]`
             topk_ids (LongTensor): `[B, T, topk]`
@@ -150,11 +152,11 @@ class DecoderBase(ModelBase):
 
         """
         if params['recog_beam_width'] == 1:
-            best_hyps = self.ctc.greedy(eouts, elens)
+            best_hyps = self.ctc.greedy(eouts, elens, log_probs)
         else:
             best_hyps = self.ctc.beam_search(eouts, elens, params, idx2token,
                                              lm, lm_second, lm_second_bwd,
-                                             nbest, refs_id, utt_ids, speakers)
+                                             nbest, refs_id, utt_ids, speakers, log_probs)
         return best_hyps
 
     def ctc_probs(self, eouts, temperature=1.):
@@ -197,19 +199,221 @@ class DecoderBase(ModelBase):
         _, topk_ids = torch.topk(probs, k=topk, dim=-1, largest=True, sorted=True)
         return probs, topk_ids
 
+    def skip_blank_frames(self, eouts, elens, threshold, margin=1):
+        """Compress encoder outputs to non-blank frames based on CTC posteriors.
+
+        Frames whose blank probability is less than `threshold` are kept together
+        with `margin` frames on both sides. At least one frame is kept per utterance.
+
+        Args:
+            eouts (FloatTensor): `[B, T, enc_units]`
+            elens (IntTensor): `[B]`
+            threshold (float): blank probability to skip frames
+            margin (int): number of context frames kept around non-blank frames
+        Returns:
+            eouts (FloatTensor): `[B, T', enc_units]`
+            elens (IntTensor): `[B]`
+            keep (BoolTensor): `[B, T]` (True for kept frames)
+
+        """
+        bs, xmax = eouts.size()[:2]
+        blank_probs = self.ctc_probs(eouts)[:, :, self.blank]  # `[B, T]`
+        valid = torch.arange(xmax, device=eouts.device).unsqueeze(0) < elens.to(eouts.device).unsqueeze(1)
+        keep = (blank_probs < threshold) & valid
+        if margin > 0:
+            keep = torch.nn.functional.max_pool1d(keep.float().unsqueeze(1), kernel_size=2 * margin + 1,
+                                                  stride=1, padding=margin).squeeze(1) > 0
+            keep &= valid
+        keep[:, 0] |= ~keep.any(1)
+
+        elens_skip = keep.sum(1)
+        eouts_skip = eouts.new_zeros(bs, elens_skip.max().item(), eouts.size(2))
+        rank = keep.long().cumsum(1) - 1
+        b_idx, t_idx = keep.nonzero(as_tuple=True)
+        eouts_skip[b_idx, rank[b_idx, t_idx]] = eouts[b_idx, t_idx]
+        return eouts_skip, elens_skip.int().to(elens.device), keep
+
+    @staticmethod
+    def restore_skipped_frames(aws, keep):
+        """Map attention weights over kept frames back to the original frames.
+
+        Args:
+            aws (list): length `B`, each of which contains arrays of size `[H, L, T']`
+                (or a list of such arrays for N-best hypotheses)
+            keep (BoolTensor): `[B, T]` returned by `skip_blank_frames`
+        Returns:
+            aws (list): length `B`, each of which contains arrays of size `[H, L, T]`.
+                Weights of skipped frames are zero.
+
+        """
+        def restore(aw, t_kept):
+            if isinstance(aw, list):
+                return [restore(aw_n, t_kept) for aw_n in aw]
+            aw_restored = np.zeros(aw.shape[:-1] + (keep.shape[1],), dtype=aw.dtype)
+            aw_restored[..., t_kept] = aw[..., :len(t_kept)]
+            return aw_restored
+
+        keep = keep.cpu().numpy()
+        return [restore(aw, np.where(keep[b])[0]) for b, aw in enumerate(aws)]
+
+    def ctc_vocab_candidates(self, ctc_log_probs, elens, threshold, min_size):
+        """Select output tokens having non-negligible CTC posteriors in each utterance.
+
+        A token is kept if its CTC posterior exceeds `threshold` at any frame.
+        <eos> is always kept, and the top-`min_size` tokens by the peak posterior
+        are added so that the beam can be filled.
+
+        Args:
+            ctc_log_probs (FloatTensor): `[B, T, vocab]`
+            elens (IntTensor): `[B]`
+            threshold (float): CTC posterior to keep tokens
+            min_size (int): minimum number of kept tokens
+        Returns:
+            vocab_ids (list): length `B`, each of which contains LongTensor of size `[V']`
+
+        """
+        bs, xmax, vocab = ctc_log_probs.size()
+        valid = torch.arange(xmax, device=ctc_log_probs.device).unsqueeze(0) < \
+            elens.to(ctc_log_probs.device).unsqueeze(1)
+        peak_probs = ctc_log_probs.masked_fill(~valid.unsqueeze(2), float('-inf')).max(1)[0].exp()  # `[B, vocab]`
+        peak_probs[:, self.blank] = -1  # blank is not emitted by the decoder
+        keep = peak_probs >= threshold
+        keep[:, self.eos] = True
+        keep.scatter_(1, torch.topk(peak_probs, k=min(min_size, vocab), dim=1)[1], True)
+        return [keep[b].nonzero(as_tuple=True)[0] for b in range(bs)]
+
+    def pruned_output(self, vocab_ids):
+        """Slice the output layer to candidate tokens.
+
+        Args:
+            vocab_ids (LongTensor): `[V']`
+        Returns:
+            output (callable): projection to `[..., V']`
+
+        """
+        weight = self.output.weight[vocab_ids]
+        bias = self.output.bias[vocab_ids] if self.output.bias is not None else None
+        return lambda x: torch.nn.functional.linear(x, weight, bias)
+
+    def get_lm_cache(self, lm, params):
+        """Return the LM state cache shared across utterances.
+
+        Args:
+            lm: first path LM
+            params (dict): hyperparameters for decoding
+        Returns:
+            lm_cache (LMStateCache): None if disabled
+
+        """
+        capacity = params.get('recog_lm_cache_size', 0)
+        if lm is None or capacity <= 0 or params.get('recog_lm_state_carry_over', False):
+            return None
+        if getattr(self, 'lm_cache', None) is None or self.lm_cache.lm is not lm:
+            self.lm_cache = LMStateCache(lm, capacity)
+        return self.lm_cache
+
     def lm_rescoring(self, hyps, lm, lm_weight, reverse=False, tag=''):
-        for i in range(len(hyps)):
-            ys = hyps[i]['hyp']  # include <sos>
-            if reverse:
-                ys = ys[::-1]
+        """Rescore complete hypotheses with a second-pass LM.
 
-            ys = [np2tensor(np.fromiter(ys, dtype=np.int64), self.device)]
-            ys_in = pad_list([y[:-1] for y in ys], -1)  # `[1, L-1]`
-            ys_out = pad_list([y[1:] for y in ys], -1)  # `[1, L-1]`
+        All hypotheses are scored with a single padded forward pass of the LM.
+        A hypothesis that is a prefix of another one (including duplicates)
+        is scored by reusing the token log-probabilities of the longer one.
 
-            lmout, lmstate, scores_lm = lm.predict(ys_in, None)
-            score_lm = sum([scores_lm[0, t, ys_out[0, t]] for t in range(ys_out.size(1))])
-            score_lm /= ys_out.size(1)
+        Args:
+            hyps (list): hypotheses in beam search (updated in place)
+            lm (RNNLM or TransformerLM or TransformerXL):
+            lm_weight (float): weight of the LM score
+            reverse (bool): score token sequences in the reverse order
+            tag (str): suffix of the key for the LM score
 
+        """
+        if len(hyps) == 0 or max(len(h['hyp']) for h in hyps) < 2:
+            return
+
+        seqs = []
+        for h in hyps:
+            ys = h['hyp']  # include <sos>
+            if reverse:
+                ys = ys[::-1]
+            seqs.append(tuple(ys))
+
+        # Deduplicate prefixes: assign each sequence to the longest sequence it is a prefix of
+        uniq = sorted(set(seqs), key=lambda x: len(x), reverse=True)
+        carriers, seq2carrier = [], {}
+        for seq in uniq:
+            for c_idx, carrier in enumerate(carriers):
+                if carrier[:len(seq)] == seq:
+                    seq2carrier[seq] = c_idx
+                    break
+            else:
+                seq2carrier[seq] = len(carriers)
+                carriers.append(seq)
+
+        ys = [np2tensor(np.fromiter(seq, dtype=np.int64), self.device) for seq in carriers]
+        ys_in = pad_list([y[:-1] for y in ys], self.eos)  # `[N, L-1]`
+        ys_out = pad_list([y[1:] for y in ys], 0)  # `[N, L-1]`
+        _, _, scores_lm = lm.predict(ys_in, None)
+        scores_lm = scores_lm.gather(2, ys_out.unsqueeze(2)).squeeze(2)  # `[N, L-1]`
+        scores_lm = scores_lm.cumsum(dim=1).cpu().tolist()
+
+        for i, seq in enumerate(seqs):
+            n_tokens = len(seq) - 1
+            score_lm = scores_lm[seq2carrier[seq]][n_tokens - 1] / n_tokens if n_tokens > 0 else 0.
             hyps[i]['score'] += score_lm * lm_weight
             hyps[i]['score_lm_' + tag] = score_lm
+
+    @staticmethod
+    def missing_components(ctc_prefix_scorer, lm, lm_second, lm_second_bwd, coverage=True):
+        """Names of score components not computed in beam search.
+
+        Args:
+            ctc_prefix_scorer (CTCPrefixScore): None if CTC scores are not computed
+            lm (RNNLM or TransformerLM): first-pass LM for shallow fusion
+            lm_second (RNNLM or TransformerLM): second-pass LM
+            lm_second_bwd (RNNLM or TransformerLM): second-pass backward LM
+            coverage (bool): coverage is computed
+        Returns:
+            missing (list): names of score components
+
+        """
+        missing = []
+        for name, computed in [('ctc', ctc_prefix_scorer is not None),
+                               ('lm', lm is not None),
+                               ('lm_second', lm_second is not None),
+                               ('lm_second_bwd', lm_second_bwd is not None),
+                               ('cp', coverage)]:
+            if not computed:
+                missing.append(name)
+        return missing
+
+    def score_components(self, hyps, missing=[]):
+        """Split scores of complete hypotheses into unweighted components.
+
+        Args:
+            hyps (list): hypotheses in beam search
+            missing (list): names of score components not computed in beam search,
+                which are set to NaN so that they are not used for rescoring
+        Returns:
+            nbest (list): A list of dicts, each of which contains token IDs (`hyp`)
+                and score components (see neural_sp.evaluators.nbest.COMPONENTS)
+
+        """
+        nbest = []
+        for h in hyps:
+            ys = h['hyp'][1:]
+            length = len(ys)
+            if length > 0 and ys[-1] == self.eos:
+                ys = ys[:-1]
+            if getattr(self, 'bwd', False):
+                ys = ys[::-1]
+            nbest.append({'hyp': np.array(ys, dtype=np.int64),
+                          'att': float(h.get('score_att', 0.)),
+                          'ctc': float(h.get('score_ctc', 0.)),
+                          'lm': float(h.get('score_lm', 0.)),
+                          'lm_second': float(h.get('score_lm_second', 0.)),
+                          'lm_second_bwd': float(h.get('score_lm_second_bwd', 0.)),
+                          'length': float(length),
+                          'cp': float(h.get('score_cp', 0.))})
+            for name in missing:
+                nbest[-1][name] = float('nan')
+        return nbest
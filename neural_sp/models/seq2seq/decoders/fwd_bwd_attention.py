@@ -6,102 +6,374 @@
 
 """Forward-backward attention decoding."""
 
+import copy
+from distutils.version import LooseVersion
 import logging
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from neural_sp.models.modules.attention import AttentionMechanism
+from neural_sp.models.modules.multihead_attention import MultiheadAttentionMechanism
 
 logger = logging.getLogger(__name__)
 
+NEG_INF = -float('inf')
+
+
+def fwd_bwd_beam_search(dec_fwd, dec_bwd, eouts, elens, params, idx2token,
+                        lm_fwd, lm_bwd, ctc_log_probs, nbest,
+                        refs_id=None, utt_ids=None, speakers=None, stacked=None):
+    """Forward and backward beam search in lockstep.
+
+    Hypotheses of both directions for the same utterance are expanded
+    by a single stacked decoder step when both decoders support it.
+    Otherwise, decoder steps of each direction are run one after the other.
+    The stacked step saves kernel launches on GPU, but the overhead of
+    `vmap` cancels out the gain on CPU.
+
+    Args:
+        dec_fwd (RNNDecoder): forward decoder
+        dec_bwd (RNNDecoder): backward decoder
+        eouts (FloatTensor): `[B, T, enc_n_units]`
+        elens (IntTensor): `[B]`
+        params (dict): hyperparameters for decoding
+        idx2token (): converter from index to token
+        lm_fwd: forward LM
+        lm_bwd: backward LM
+        ctc_log_probs (FloatTensor): `[B, T, vocab]`
+        nbest (int): number of N-best list
+        refs_id (list): reference list
+        utt_ids (list): utterance id list
+        speakers (list): speaker list
+        stacked (bool): use the stacked decoder step (on GPU by default)
+    Returns:
+        outputs (list): outputs of `beam_search` of the forward and backward decoders
+
+    """
+    decs = [dec_fwd, dec_bwd]
+    lms = [(lm_fwd, lm_bwd), (lm_bwd, lm_fwd)]
+    if not all(hasattr(dec, 'beam_search_steps') for dec in decs):
+        return [dec.beam_search(eouts, elens, params, idx2token, lm, None, lm_rev, ctc_log_probs,
+                                nbest, False, refs_id, utt_ids, speakers)
+                for dec, (lm, lm_rev) in zip(decs, lms)]
+
+    steps = [dec.beam_search_steps(eouts, elens, params, idx2token, lm, None, lm_rev, ctc_log_probs,
+                                   nbest, False, refs_id, utt_ids, speakers)
+             for dec, (lm, lm_rev) in zip(decs, lms)]
+    if stacked is None:
+        stacked = eouts.is_cuda
+    stacked_step = None
+    if stacked and StackedRNNDecoderStep.is_supported(decs):
+        stacked_step = StackedRNNDecoderStep(decs)
+
+    requests, outputs = [None, None], [None, None]
+
+    def send(d, response):
+        try:
+            requests[d] = steps[d].send(response)
+        except StopIteration as e:
+            requests[d] = None
+            outputs[d] = e.value
+
+    for d in range(2):
+        send(d, None)
+    while any(r is not None for r in requests):
+        active = [d for d in range(2) if requests[d] is not None]
+        utt = min(requests[d][0] for d in active)
+        active = [d for d in active if requests[d][0] == utt]
+        # NOTE: the direction that finishes an utterance earlier waits for the other one
+        if stacked_step is not None and len(active) == 2:
+            responses = stacked_step(utt, *requests)
+        else:
+            responses = [None, None]
+            for d in active:
+                if stacked_step is not None:
+                    stacked_step.restore_cache(utt, d, decs[d])
+                responses[d] = decs[d].beam_search_step(*requests[d][2:])
+        for d in active:
+            send(d, responses[d])
+
+    return outputs
+
+
+class StackedRNNDecoderStep(object):
+    """Decoder step of RNN decoders with the same architecture in a single batched pass.
+
+    Parameters of the decoders are stacked and the decoder step is vectorized
+    over them with `torch.func.vmap`. The number of hypotheses is padded to
+    the largest one among the decoders.
+
+    Args:
+        decs (list): RNNDecoder with the same architecture
+
+    """
+
+    def __init__(self, decs):
+        from torch.func import stack_module_state
+        self.params, self.buffers = stack_module_state([_RNNDecoderStep(dec) for dec in decs])
+        self.base = _RNNDecoderStep(copy.deepcopy(decs[0])).to('meta')
+        self.utt = None
+        self.score_cache = {}
+
+    @staticmethod
+    def is_supported(decs):
+        """Check if decoder steps can be stacked."""
+        if LooseVersion(torch.__version__) < LooseVersion("2.0.0"):
+            return False
+        for dec in decs:
+            if not hasattr(dec, 'recurrency') or getattr(dec, 'att_weight', 0) == 0 or dec.lm is not None:
+                return False
+            if type(dec.score) not in [AttentionMechanism, MultiheadAttentionMechanism] or \
+                    dec.score.atype == 'triggered_attention':
+                return False
+        shapes = [[(n, p.size()) for n, p in dec.named_parameters()] for dec in decs]
+        return all(s == shapes[0] for s in shapes[1:])
+
+    def restore_cache(self, utt, d, dec):
+        """Set cached keys of attention for a decoder running alone after stacked steps."""
+        if self.utt == utt and dec.score.key is None:
+            for k, v in self.score_cache.items():
+                setattr(dec.score, k, v[d])
+
+    def __call__(self, utt, *requests):
+        """Decoder step for hypotheses of all decoders.
+
+        Args:
+            utt (int): utterance index
+            requests (list): inputs of `beam_search_step` yielded by `beam_search_steps`
+        Returns:
+            responses (list): outputs of `beam_search_step` for each decoder
+
+        """
+        from torch.func import functional_call, vmap
+
+        if self.utt != utt:
+            self.utt = utt
+            self.score_cache = {}
+        eouts = requests[0][2]
+        n_hyps = [r[4].size(0) for r in requests]
+        n_max = max(n_hyps)
+
+        def stack(xs, dim=0):
+            return torch.stack([_pad(x, n_max, dim) for x in xs], dim=0)
+
+        hxs = stack([r[3]['dstate'][0] for r in requests], dim=1)
+        cxs = stack([r[3]['dstate'][1] for r in requests], dim=1) if requests[0][3]['dstate'][1] is not None \
+            else torch.zeros_like(hxs)
+        cv = stack([r[4] for r in requests])
+        y = stack([r[5] for r in requests])
+        aw = stack([r[6] for r in requests]) if requests[0][6] is not None else None
+        output = any(r[8] for r in requests)
+
+        def step(params, buffers, score_cache, hxs, cxs, cv, y, aw):
+            return functional_call(self.base, (params, buffers), (score_cache, eouts, hxs, cxs, cv, y, aw))
+
+        in_dims = (0, 0, 0, 0, 0, 0, 0, 0 if aw is not None else None)
+        hxs, cxs, cv, aw, attn_v, logits, self.score_cache = vmap(step, in_dims=in_dims)(
+            self.params, self.buffers, self.score_cache, hxs, cxs, cv, y, aw)
+
+        responses = []
+        for d, n in enumerate(n_hyps):
+            dstates = {'dstate': (hxs[d][:, :n], cxs[d][:, :n] if requests[d][3]['dstate'][1] is not None else None)}
+            responses.append((dstates, cv[d, :n], aw[d, :n], attn_v[d, :n], logits[d, :n] if output else None))
+        return responses
+
+
+class _RNNDecoderStep(nn.Module):
+    """Decoder step of RNNDecoder as a pure function of parameters for `torch.func`.
+
+    Cached keys (and values) of attention are passed and returned explicitly.
+    nn.LSTMCell and nn.GRUCell are computed with their parameters because
+    they do not support `vmap`.
+
+    """
+
+    def __init__(self, dec):
+        super().__init__()
+        self.dec = dec
+
+    def forward(self, score_cache, eouts, hxs, cxs, cv, y, aw):
+        dec = self.dec
+        dec.score.reset()
+        for k, v in score_cache.items():
+            setattr(dec.score, k, v)
+
+        # recurrency
+        dout = torch.cat([dec.dropout_emb(dec.embed(y)), cv], dim=-1).squeeze(1)
+        new_hxs, new_cxs = [], []
+        for lth in range(dec.n_layers):
+            h, c = _rnn_cell(dec.rnn[lth], dout, hxs[lth], cxs[lth])
+            new_hxs.append(h)
+            new_cxs.append(c)
+            dout = dec.dropout(h)
+            if dec.proj is not None:
+                dout = torch.tanh(dec.proj[lth](dout))
+            # use output in the first layer for attention scoring
+            if lth == 0:
+                dout_score = dout.unsqueeze(1)
+
+        eouts = eouts.expand(cv.size(0), -1, -1)
+        cv, aw, _, _ = dec.score(eouts, eouts, dout_score, None, aw, cache=True)
+        attn_v = dec.generate(cv, dout.unsqueeze(1), None)
+        logits = dec.output(attn_v).squeeze(1)
+
+        score_cache = {k: getattr(dec.score, k) for k in ['key', 'value']
+                       if getattr(dec.score, k, None) is not None}
+        dec.score.reset()
+        return torch.stack(new_hxs, dim=0), torch.stack(new_cxs, dim=0), cv, aw, attn_v, logits, score_cache
+
+
+def _rnn_cell(cell, x, h, c):
+    """Compute nn.LSTMCell or nn.GRUCell with its parameters."""
+    gates_i = F.linear(x, cell.weight_ih, cell.bias_ih)
+    gates_h = F.linear(h, cell.weight_hh, cell.bias_hh)
+    if isinstance(cell, nn.LSTMCell):
+        i, f, g, o = (gates_i + gates_h).chunk(4, dim=-1)
+        c = torch.sigmoid(f) * c + torch.sigmoid(i) * torch.tanh(g)
+        h = torch.sigmoid(o) * torch.tanh(c)
+    else:
+        i_r, i_z, i_n = gates_i.chunk(3, dim=-1)
+        h_r, h_z, h_n = gates_h.chunk(3, dim=-1)
+        r = torch.sigmoid(i_r + h_r)
+        z = torch.sigmoid(i_z + h_z)
+        h = (1 - z) * torch.tanh(i_n + r * h_n) + z * h
+        c = h  # dummy
+    return h, c
+
+
+def _pad(x, n, dim):
+    """Pad `x` to the size of `n` along `dim` by repeating the last element."""
+    if x.size(dim) == n:
+        return x
+    index = torch.arange(n, device=x.device).clamp(max=x.size(dim) - 1)
+    return x.index_select(dim, index)
+
+
+def _pad_nbest(nbest_hyps, aws, scores, eos, flip_time=False, max_time=None):
+    """Pad an N-best list and remove <eos>.
+
+    Args:
+        nbest_hyps (list): A list of length `N`, which contains arrays of size `[L]`
+        aws (list): A list of length `N`, which contains arrays of size `[H, L, T]` or `[L, T]`
+        scores (list): A list of length `N`, which contains arrays of size `[L]`
+            (cumulative log probabilities in the decoding direction)
+        eos (int): index for <eos>
+        flip_time (bool): flip the encoder indices
+        max_time (int): number of encoder frames
+    Returns:
+        ys (np.ndarray): `[N, L]` (-1 for padding)
+        times (np.ndarray): `[N, L]` (frames with the maximum attention weight)
+        scores (np.ndarray): `[N, L]`
+        ylens (np.ndarray): `[N]`
+
+    """
+    n = len(nbest_hyps)
+    ylens = np.array([len(y) for y in nbest_hyps], dtype=np.int64)
+    ymax = max(1, ylens.max())
+    ys = np.full((n, ymax), -1, dtype=np.int64)
+    times = np.zeros((n, ymax), dtype=np.int64)
+    scores_pad = np.zeros((n, ymax), dtype=np.float64)
+    for i in range(n):
+        if ylens[i] == 0:
+            continue
+        aw = aws[i].mean(0) if aws[i].ndim == 3 else aws[i]  # `[L, T]`
+        ys[i, :ylens[i]] = nbest_hyps[i]
+        times[i, :ylens[i]] = aw.argmax(-1)
+        scores_pad[i, :ylens[i]] = scores[i]
+    if flip_time:
+        times = max_time - 1 - times
+    ys[ys == eos] = -1
+    return ys, times, scores_pad, ylens
+
 
 def fwd_bwd_attention(nbest_hyps_fwd, aws_fwd, scores_fwd,
                       nbest_hyps_bwd, aws_bwd, scores_bwd,
                       eos, gnmt_decoding, lp_weight, idx2token, refs_id, flip=False):
     """Decoding with the forward and backward attention-based decoders.
 
+    The same token at the same time in forward and backward hypotheses is
+    merged into a new hypothesis, which consists of the prefix of the forward
+    hypothesis and the suffix of the backward hypothesis. All pairs of
+    hypotheses and token positions are matched at once by broadcasting.
+
     Args:
         nbest_hyps_fwd (list): A list of length `[B]`, which contains list of n hypotheses
-        aws_fwd (list): A list of length `[B]`, which contains arrays of size `[L, T]`
-        scores_fwd (list):
-        nbest_hyps_bwd (list):
-        aws_bwd (list):
-        scores_bwd (list):
-        eos (int):
-        gnmt_decoding (float):
-        lp_weight (float):
+        aws_fwd (list): A list of length `[B]`, which contains arrays of size `[H, L, T]`
+        scores_fwd (list): A list of length `[B]`, which contains arrays of size `[L]`
+            (cumulative log probabilities from the left)
+        nbest_hyps_bwd (list): hypotheses of the backward decoder (in the natural order)
+        aws_bwd (list): attention weights of the backward decoder (in the natural order)
+        scores_bwd (list): cumulative log probabilities from the right
+        eos (int): index for <eos>
+        gnmt_decoding (float): not used
+        lp_weight (float): not used
         idx2token (): converter from index to token
-        refs_id ():
-        flip (bool): flip the encoder indices
+        refs_id (list): gold token IDs
+        flip (bool): flip the encoder indices of the backward decoder
     Returns:
+        best_hyps (list): A list of length `[B]`, which contains arrays of size `[L]`
 
     """
     bs = len(nbest_hyps_fwd)
-    nbest = len(nbest_hyps_fwd[0])
 
     best_hyps = []
     for b in range(bs):
-        max_time = len(aws_fwd[b][0])
-
-        merged = []
-        for n in range(nbest):
-            # forward
-            if len(nbest_hyps_fwd[b][n]) > 1:
-                if nbest_hyps_fwd[b][n][-1] == eos:
-                    merged.append({'hyp': nbest_hyps_fwd[b][n][:-1],
-                                   'score': scores_fwd[b][n][-2]})
-                    # NOTE: remove eos probability
-                else:
-                    merged.append({'hyp': nbest_hyps_fwd[b][n],
-                                   'score': scores_fwd[b][n][-1]})
-            else:
-                # <eos> only
-                logger.info(nbest_hyps_fwd[b][n])
-
-            # backward
-            if len(nbest_hyps_bwd[b][n]) > 1:
-                if nbest_hyps_bwd[b][n][0] == eos:
-                    merged.append({'hyp': nbest_hyps_bwd[b][n][1:],
-                                   'score': scores_bwd[b][n][1]})
-                    # NOTE: remove eos probability
-                else:
-                    merged.append({'hyp': nbest_hyps_bwd[b][n],
-                                   'score': scores_bwd[b][n][0]})
-            else:
-                # <eos> only
-                logger.info(nbest_hyps_bwd[b][n])
-
-        for n_f in range(nbest):
-            for n_b in range(nbest):
-                for i_f in range(len(aws_fwd[b][n_f]) - 1):
-                    for i_b in range(len(aws_bwd[b][n_b]) - 1):
-                        if flip:
-                            # the encoder is not shared between forward and backward decoders
-                            t_prev = max_time - aws_bwd[b][n_b][i_b + 1].argmax(-2)
-                            t_curr = aws_fwd[b][n_f][i_f].argmax(-2)
-                            t_next = max_time - aws_bwd[b][n_b][i_b - 1].argmax(-2)
-                        else:
-                            t_prev = aws_bwd[b][n_b][i_b + 1].argmax(-2)
-                            t_curr = aws_fwd[b][n_f][i_f].argmax(-2)
-                            t_next = aws_bwd[b][n_b][i_b - 1].argmax(-2)
-
-                        # the same token at the same time
-                        if t_curr >= t_prev and t_curr <= t_next and nbest_hyps_fwd[b][n_f][i_f] == nbest_hyps_bwd[b][n_b][i_b]:
-                            new_hyp = nbest_hyps_fwd[b][n_f][:i_f + 1].tolist() + \
-                                nbest_hyps_bwd[b][n_b][i_b + 1:].tolist()
-                            score_curr_fwd = scores_fwd[b][n_f][i_f] - scores_fwd[b][n_f][i_f - 1]
-                            score_curr_bwd = scores_bwd[b][n_b][i_b] - scores_bwd[b][n_b][i_b + 1]
-                            score_curr = max(score_curr_fwd, score_curr_bwd)
-                            new_score = scores_fwd[b][n_f][i_f - 1] + scores_bwd[b][n_b][i_b + 1] + score_curr
-                            merged.append({'hyp': new_hyp, 'score': new_score})
-
-                            logger.info('time matching')
-                            if refs_id is not None:
-                                logger.info('Ref: %s' % idx2token(refs_id[b]))
-                            logger.info('hyp (fwd): %s' % idx2token(nbest_hyps_fwd[b][n_f]))
-                            logger.info('hyp (bwd): %s' % idx2token(nbest_hyps_bwd[b][n_b]))
-                            logger.info('hyp (fwd-bwd): %s' % idx2token(new_hyp))
-                            logger.info('log prob (fwd): %.3f' % scores_fwd[b][n_f][-1])
-                            logger.info('log prob (bwd): %.3f' % scores_bwd[b][n_b][0])
-                            logger.info('log prob (fwd-bwd): %.3f' % new_score)
-
-        merged = sorted(merged, key=lambda x: x['score'], reverse=True)
-        best_hyps.append(merged[0]['hyp'])
+        max_time = aws_fwd[b][0].shape[-1]
+        ys_f, t_f, s_f, ylens_f = _pad_nbest(nbest_hyps_fwd[b], aws_fwd[b], scores_fwd[b], eos)
+        ys_b, t_b, s_b, ylens_b = _pad_nbest(nbest_hyps_bwd[b], aws_bwd[b], scores_bwd[b], eos,
+                                             flip_time=flip, max_time=max_time)
+        n_f, l_f = ys_f.shape
+        n_b, l_b = ys_b.shape
+
+        # scores of the prefix before each forward token and the suffix after each backward token
+        s_f_prev = np.concatenate([np.zeros((n_f, 1)), s_f[:, :-1]], axis=1)  # `[N_f, L_f]`
+        s_b_next = np.concatenate([s_b[:, 1:], np.zeros((n_b, 1))], axis=1)  # `[N_b, L_b]`
+
+        # hypotheses without <eos>
+        candidates = []
+        for n in range(n_f):
+            if (ys_f[n] >= 0).any():
+                last = np.nonzero(ys_f[n] >= 0)[0][-1]
+                candidates.append((s_f[n, last], nbest_hyps_fwd[b][n][:last + 1]))
+        for n in range(n_b):
+            if (ys_b[n] >= 0).any():
+                first = np.nonzero(ys_b[n] >= 0)[0][0]
+                candidates.append((s_b[n, first], nbest_hyps_bwd[b][n][first:]))
+
+        # the same token at the same time, where the time of the forward token is
+        # between those of the adjacent tokens in the backward hypothesis
+        t_b_prev = np.concatenate([np.zeros((n_b, 1), dtype=np.int64), t_b[:, :-1]], axis=1)
+        t_b_next = np.concatenate([t_b[:, 1:], np.full((n_b, 1), max_time - 1)], axis=1)
+        t_b_next[np.arange(n_b), ylens_b - 1] = max_time - 1
+        match = (ys_f[:, None, :, None] == ys_b[None, :, None, :]) & (ys_f[:, None, :, None] >= 0)
+        match &= (t_f[:, None, :, None] >= t_b_prev[None, :, None, :])
+        match &= (t_f[:, None, :, None] <= t_b_next[None, :, None, :])  # `[N_f, N_b, L_f, L_b]`
+        if match.any():
+            score_curr = np.maximum((s_f - s_f_prev)[:, None, :, None],
+                                    (s_b - s_b_next)[None, :, None, :])
+            new_scores = s_f_prev[:, None, :, None] + s_b_next[None, :, None, :] + score_curr
+            new_scores = np.where(match, new_scores, NEG_INF)
+            n_f_best, n_b_best, i_f, i_b = np.unravel_index(new_scores.argmax(), new_scores.shape)
+            new_hyp = np.concatenate([nbest_hyps_fwd[b][n_f_best][:i_f + 1],
+                                      nbest_hyps_bwd[b][n_b_best][i_b + 1:]])
+            new_hyp = new_hyp[new_hyp != eos]
+            candidates.append((new_scores[n_f_best, n_b_best, i_f, i_b], new_hyp))
+
+            logger.info('time matching')
+            if idx2token is not None:
+                if refs_id is not None:
+                    logger.info('Ref: %s' % idx2token(refs_id[b]))
+                logger.info('hyp (fwd): %s' % idx2token(nbest_hyps_fwd[b][n_f_best]))
+                logger.info('hyp (bwd): %s' % idx2token(nbest_hyps_bwd[b][n_b_best]))
+                logger.info('hyp (fwd-bwd): %s' % idx2token(new_hyp))
+            logger.info('log prob (fwd-bwd): %.3f' % new_scores[n_f_best, n_b_best, i_f, i_b])
+
+        if len(candidates) == 0:
+            # <eos> only
+            best_hyps.append(np.zeros(0, dtype=np.int64))
+            continue
+        best_hyps.append(np.array(max(candidates, key=lambda x: x[0])[1], dtype=np.int64))
 
     return best_hyps
@@ -14,11 +14,15 @@ import random
 import torch
 import torch.nn as nn
 
-from neural_sp.evaluators.edit_distance import compute_wer
+from neural_sp.evaluators.edit_distance import compute_edit_distance_batch
 from neural_sp.models.criterion import cross_entropy_lsm
 from neural_sp.models.criterion import distillation
+from neural_sp.models.criterion import interval_latency
 from neural_sp.models.criterion import MBR
 # from neural_sp.models.criterion import minimum_bayes_risk
+from neural_sp.models.lm.gated_convlm import GatedConvLM
+from neural_sp.models.lm.lookahead_wordlm import LookAheadWordLM
+from neural_sp.models.lm.ngram import NgramLM
 from neural_sp.models.lm.rnnlm import RNNLM
 from neural_sp.models.lm.transformerlm import TransformerLM
 from neural_sp.models.lm.transformer_xl import TransformerXL
@@ -103,6 +107,7 @@ class RNNDecoder(DecoderBase):
         replace_sos (bool): replace <sos> with special tokens
         distillation_weight (float): soft label weight for knowledge distillation
         discourse_aware (str): state_carry_over
+        triggered_attn_key_projection (bool): project encoder outputs in triggered attention
 
     """
 
@@ -121,7 +126,8 @@ class RNNDecoder(DecoderBase):
                  mocha_init_r, mocha_eps, mocha_std, mocha_no_denominator,
                  mocha_1dconv, mocha_decot_lookahead, quantity_loss_weight,
                  latency_metric, latency_loss_weight,
-                 gmm_attn_n_mixtures, replace_sos, distillation_weight, discourse_aware):
+                 gmm_attn_n_mixtures, replace_sos, distillation_weight, discourse_aware,
+                 triggered_attn_key_projection=False):
 
         super(RNNDecoder, self).__init__()
 
@@ -224,7 +230,8 @@ class RNNDecoder(DecoderBase):
                         conv_out_channels=attn_conv_out_channels,
                         conv_kernel_size=attn_conv_kernel_size,
                         dropout=dropout_att,
-                        lookahead=2)
+                        lookahead=2,
+                        triggered_key_projection=triggered_attn_key_projection)
 
             # Decoder
             self.rnn = nn.ModuleList()
@@ -321,6 +328,9 @@ class RNNDecoder(DecoderBase):
                            help='')
         group.add_argument('--attn_sigmoid', type=strtobool, default=False, nargs='?',
                            help='')
+        group.add_argument('--triggered_attn_key_projection', type=strtobool, default=False,
+                           help='project encoder outputs in triggered attention. '
+                                'Models trained before this option was added did not project them.')
         group.add_argument('--gmm_attn_n_mixtures', type=int, default=5,
                            help='number of mixtures for GMM attention')
         # streaming
@@ -474,65 +484,50 @@ class RNNDecoder(DecoderBase):
             N_best = recog_params['recog_beam_width']
             alpha = 1.0
             assert N_best >= 2
-            loss_mbr = 0.
-            loss_ce = 0.
             bs = eouts.size(0)
-            for b in range(bs):
-                # 1. beam search
-                self.eval()
-                with torch.no_grad():
+
+            # 1. generate N-best lists for the whole mini-batch
+            training = self.training
+            self.eval()
+            with torch.no_grad():
+                if recog_params['mbr_nbest_type'] == 'sampling':
+                    nbest_hyps_id, log_scores = self.sample(
+                        eouts, elens, recog_params['recog_max_len_ratio'], nbest=N_best)
+                else:
                     nbest_hyps_id, _, log_scores = self.beam_search(
-                        eouts[b:b + 1], elens[b:b + 1], params=recog_params,
-                        nbest=N_best, exclude_eos=True)
-                nbest_hyps_id_b = [np.fromiter(y, dtype=np.int64) for y in nbest_hyps_id[0]]
-                log_scores_b = np2tensor(np.array(log_scores[0], dtype=np.float32), eouts.device)
-                scores_b_norm = torch.softmax(alpha * log_scores_b, dim=-1)  # `[N_best]`
-                # print((scores_b_norm * 100).int())
-
-                # 2. calculate expected WER
-                wers_b = np2tensor(np.array([
-                    compute_wer(ref=idx2token(ys[b]).split(' '),
-                                hyp=idx2token(nbest_hyps_id_b[n]).split(' '))[0] / 100
-                    for n in range(N_best)], dtype=np.float32), eouts.device)
-                exp_wer_b = (scores_b_norm * wers_b).sum()
-                grad_b = (scores_b_norm * (wers_b - exp_wer_b)).sum()
-                # print(wers_b)
-                # print(exp_wer_b)
-                # print(scores_b_norm * (wers_b - exp_wer_b))
-                # print(grad_b)
-
-                # 3. forward pass (teacher-forcing with hypotheses)
-                self.train()
-                logits_b = self.forward_mbr(eouts[b:b + 1].repeat([N_best, 1, 1]),
-                                            elens[b:b + 1].repeat([N_best]),
-                                            nbest_hyps_id_b)
-                log_probs_b = torch.log_softmax(logits_b, dim=-1)  # `[nbest, L, vocab]`
-
-                # 4. backward pass (attach gradient)
-                _eos = eouts.new_zeros((1,), dtype=torch.int64).fill_(self.eos)
-                nbest_hyps_id_b_pad = pad_list([torch.cat([np2tensor(y, eouts.device), _eos], dim=0)
-                                                for y in nbest_hyps_id_b], self.pad)
-                loss_mbr += self.mbr(log_probs_b, nbest_hyps_id_b_pad, exp_wer_b, grad_b)
-
-                # 4. calculate MBR loss
-                # loss_mbr_b, scores_b = minimum_bayes_risk(log_probs_b, nbest_hyps_id_b, wers_b,
-                #                                           self.eos, self.pad)
-                # loss_mbr += loss_mbr_b
-
-                # 5. CE loss regularization
-                loss_ce += self.forward_att(eouts[b:b + 1], elens[b:b + 1], ys[b:b + 1])[0]
-
-                # ys_out_b = append_sos_eos([ys[b]], self.eos, self.eos, self.pad, eouts.device)[1]
-                # ys_out_b = ys_out_b.repeat([N_best, 1])
-                # # NOTE: truncate to match the lengths
-                # ymax = min(logits_b.size(1), ys_out_b.size(1))
-                # logits_b = logits_b[:, :ymax].contiguous()
-                # ys_out_b = ys_out_b[:, :ymax].contiguous()
-                # for k in range(N_best):
-                #     loss_ce_k = cross_entropy_lsm(logits_b, ys_out_b, 0, self.pad, self.training)[0]
-                #     loss_ce += loss_ce_k * scores_b_norm[k]
-
-            # NOTE: MBR loss is accumlated over N-best and mini-batch
+                        eouts, elens, params=recog_params, nbest=N_best, exclude_eos=True)
+                    nbest_hyps_id = [y for nbest_hyps_id_b in nbest_hyps_id for y in nbest_hyps_id_b]
+                    log_scores = eouts.new_tensor(log_scores)
+                scores_norm = torch.softmax(alpha * log_scores, dim=-1)  # `[B, N_best]`
+            self.train(training)
+
+            # 2. calculate expected risk with token-level edit distance
+            _eos = eouts.new_zeros((1,), dtype=torch.int64).fill_(self.eos)
+            hyps = [np2tensor(np.fromiter(y, dtype=np.int64), eouts.device) for y in nbest_hyps_id]
+            hyps_pad = pad_list(hyps + [_eos], -1)[:-1]  # `[B * N_best, L]`
+            hlens = eouts.new_tensor([len(y) for y in hyps], dtype=torch.int64)
+            refs = [np2tensor(np.fromiter(y, dtype=np.int64), eouts.device) for y in ys]
+            refs_pad = pad_list(refs + [_eos], -1)[:-1].repeat_interleave(N_best, dim=0)
+            rlens = eouts.new_tensor([len(y) for y in ys], dtype=torch.int64).repeat_interleave(N_best)
+            risks = compute_edit_distance_batch(hyps_pad, hlens, refs_pad, rlens).float()
+            risks = (risks / rlens.clamp(min=1).float()).view(bs, N_best)
+            exp_risk = (scores_norm * risks).sum(-1)  # `[B]`
+            grads = alpha * scores_norm * (risks - exp_risk.unsqueeze(1))  # `[B, N_best]`
+
+            # 3. forward pass (teacher-forcing with hypotheses)
+            logits = self.forward_mbr(eouts.repeat_interleave(N_best, dim=0),
+                                      elens.repeat_interleave(N_best, dim=0),
+                                      nbest_hyps_id)
+            log_probs = torch.log_softmax(logits, dim=-1)  # `[B * N_best, L, vocab]`
+
+            # 4. backward pass (attach gradient)
+            hyps_pad = pad_list([torch.cat([y, _eos], dim=0) for y in hyps], -1)
+            loss_mbr = self.mbr(log_probs, hyps_pad, exp_risk.sum(0, keepdim=True), grads.view(-1))
+
+            # 5. CE loss regularization
+            loss_ce = self.forward_att(eouts, elens, ys)[0]
+
+            # NOTE: MBR loss is accumlated over mini-batch
             loss = loss_mbr + loss_ce * self.mbr_ce_weight
             observation['loss_mbr'] = tensor2scalar(loss_mbr)
             observation['loss_att'] = tensor2scalar(loss_ce)
@@ -650,6 +645,11 @@ class RNNDecoder(DecoderBase):
         src_mask = make_pad_mask(elens.to(eouts.device)).unsqueeze(1)  # `[B, 1, T]`
         tgt_mask = (ys_out != self.pad).unsqueeze(2)  # `[B, L, 1]`
         logits = []
+        if forced_trigger_points is not None and self.attn_type == 'triggered_attention':
+            # triggered attention consumes trigger points step by step
+            trigger_points = forced_trigger_points
+        else:
+            trigger_points = None
         for i in range(ymax):
             is_sample = i > 0 and self._ss_prob > 0 and random.random() < self._ss_prob
 
@@ -665,7 +665,8 @@ class RNNDecoder(DecoderBase):
                 self.output(logits[-1]).detach().argmax(-1))) if is_sample else ys_emb[:, i:i + 1]
             dstates, cv, aw, attn_v, beta, p_choose = self.decode_step(
                 eouts, dstates, cv, y_emb, src_mask, aw, lmout, mode='parallel',
-                trigger_points=forced_trigger_points[:, i:i + 1] if forced_trigger_points is not None else None)
+                trigger_points=trigger_points if trigger_points is not None else (
+                    forced_trigger_points[:, i:i + 1] if forced_trigger_points is not None else None))
             aws.append(aw)  # `[B, H, 1, T]`
             if beta is not None:
                 betas.append(beta)  # `[B, H, 1, T]`
@@ -732,15 +733,7 @@ class RNNDecoder(DecoderBase):
         loss_latency = 0.
         if self.latency_metric == 'interval':
             assert ctc_trigger_points is None
-            assert aws.size(1) == 1  # TODO: extend to multi-head
-            aws_prev = torch.cat([aws.new_zeros(aws.size())[:, :, -1:], aws.clone()[:, :, :-1]], dim=2)
-            aws_mat = aws_prev.unsqueeze(3) * aws.unsqueeze(4)  # `[B, H, L, T, T]`
-            delay_mat = aws.new_ones(xmax, xmax).float()
-            delay_mat = torch.tril(delay_mat, diagonal=-1, out=delay_mat)
-            delay_mat = torch.cumsum(delay_mat, dim=-2).unsqueeze(0)
-            delay_mat = delay_mat.unsqueeze(1).unsqueeze(2).expand_as(aws_mat)
-            loss_latency = torch.pow((aws_mat * delay_mat).sum(-1), 2).sum(-1)
-            loss_latency = torch.mean(loss_latency.squeeze(1))
+            loss_latency = interval_latency(aws)
         elif ctc_trigger_points is not None or forced_trigger_points is not None:
             if 'ctc_sync' in self.latency_metric:
                 trigger_points = ctc_trigger_points
@@ -882,7 +875,8 @@ class RNNDecoder(DecoderBase):
             refs_id (list): reference list
             utt_ids (list): utterance id list
             speakers (list): speaker list
-            trigger_points (IntTensor): `[B, T]`
+            trigger_points (IntTensor): `[B, L]`
+                computed from the CTC best path for triggered attention if not given
         Returns:
             hyps (list): length `B`, each of which contains arrays of size `[L]`
             aws (list): length `B`, each of which contains arrays of size `[H, L, T]`
@@ -905,8 +899,8 @@ class RNNDecoder(DecoderBase):
         # Create the attention mask
         src_mask = make_pad_mask(elens.to(eouts.device)).unsqueeze(1)  # `[B, 1, T]`
 
-        if self.attn_type == 'triggered_attention':
-            assert trigger_points is not None
+        if self.attn_type == 'triggered_attention' and trigger_points is None:
+            trigger_points = self.ctc.trigger_points(eouts, elens)
 
         hyps_batch, aws_batch = [], []
         ylens = torch.zeros(bs).int()
@@ -919,9 +913,11 @@ class RNNDecoder(DecoderBase):
 
             # Recurrency -> Score -> Generate
             y_emb = self.dropout_emb(self.embed(y))
+            # NOTE: triggered attention keeps attending up to the last trigger point
+            # after <eos> is expected
             dstates, cv, aw, attn_v, _, _ = self.decode_step(
                 eouts, dstates, cv, y_emb, src_mask, aw, lmout,
-                trigger_points=trigger_points[:, i:i + 1] if trigger_points is not None else None)
+                trigger_points=trigger_points)
             aws_batch += [aw]  # `[B, H, 1, T]`
 
             # Pick up 1-best
@@ -996,6 +992,69 @@ class RNNDecoder(DecoderBase):
 
         return hyps, aws
 
+    def sample(self, eouts, elens, max_len_ratio, nbest=1):
+        """Draw N hypotheses per utterance by ancestral sampling in a single batch.
+
+        Args:
+            eouts (FloatTensor): `[B, T, enc_units]`
+            elens (IntTensor): `[B]`
+            max_len_ratio (int): maximum sequence length of tokens
+            nbest (int): number of samples per utterance
+        Returns:
+            hyps (list): length `B * nbest`, each of which contains arrays of size `[L]` (without <eos>)
+            log_scores (FloatTensor): `[B, nbest]`
+
+        """
+        bs, xmax = eouts.size()[:2]
+        eouts = eouts.repeat_interleave(nbest, dim=0)
+        elens = elens.repeat_interleave(nbest, dim=0)
+        n_hyps = bs * nbest
+
+        # Initialization
+        dstates = self.zero_state(n_hyps)
+        cv = eouts.new_zeros(n_hyps, 1, self.enc_n_units)
+        self.score.reset()
+        aw = None
+        lmout, lmstate = None, None
+        y = eouts.new_zeros((n_hyps, 1), dtype=torch.int64).fill_(self.eos)
+
+        # Create the attention mask
+        src_mask = make_pad_mask(elens.to(eouts.device)).unsqueeze(1)  # `[B * nbest, 1, T]`
+
+        hyps_batch = []
+        log_scores = eouts.new_zeros(n_hyps)
+        ylens = eouts.new_zeros(n_hyps, dtype=torch.int64)
+        eos_flags = eouts.new_zeros(n_hyps, dtype=torch.bool)
+        ymax = math.ceil(xmax * max_len_ratio)
+        for i in range(ymax):
+            # Update LM states for LM fusion
+            if self.lm is not None:
+                lmout, lmstate, _ = self.lm.predict(y, lmstate)
+
+            # Recurrency -> Score -> Generate
+            y_emb = self.dropout_emb(self.embed(y))
+            dstates, cv, aw, attn_v, _, _ = self.decode_step(
+                eouts, dstates, cv, y_emb, src_mask, aw, lmout)
+            log_probs = torch.log_softmax(self.output(attn_v).squeeze(1), dim=-1)
+
+            # Sample the next token
+            y = torch.multinomial(log_probs.exp(), num_samples=1)  # `[B * nbest, 1]`
+            hyps_batch += [y]
+            log_scores += log_probs.gather(1, y).squeeze(1).masked_fill(eos_flags, 0)
+            ylens += (~eos_flags).long()
+            eos_flags |= (y.squeeze(1) == self.eos)
+
+            # Break if <eos> is outputed in all samples
+            if bool(eos_flags.all()):
+                break
+
+        # Truncate by the first <eos> and exclude it
+        hyps_batch = tensor2np(torch.cat(hyps_batch, dim=1))
+        ylens = tensor2np(ylens)
+        eos_flags = tensor2np(eos_flags)
+        hyps = [hyps_batch[n, :ylens[n] - int(eos_flags[n])] for n in range(n_hyps)]
+        return hyps, log_scores.view(bs, nbest)
+
     def beam_search(self, eouts, elens, params, idx2token=None,
                     lm=None, lm_second=None, lm_second_bwd=None, ctc_log_probs=None,
                     nbest=1, exclude_eos=False,
@@ -1003,6 +1062,56 @@ class RNNDecoder(DecoderBase):
                     ensmbl_eouts=[], ensmbl_elens=[], ensmbl_decs=[], cache_states=True):
         """Beam search decoding.
 
+        See `beam_search_steps` for arguments and returns.
+
+        """
+        steps = self.beam_search_steps(eouts, elens, params, idx2token,
+                                       lm, lm_second, lm_second_bwd, ctc_log_probs,
+                                       nbest, exclude_eos, refs_id, utt_ids, speakers,
+                                       ensmbl_eouts, ensmbl_elens, ensmbl_decs, cache_states)
+        try:
+            request = next(steps)
+            while True:
+                request = steps.send(self.beam_search_step(*request[2:]))
+        except StopIteration as e:
+            return e.value
+
+    def beam_search_step(self, eouts, dstates, cv, y, aw, lmout, output=True):
+        """Decoder step for all hypotheses of an utterance in beam search.
+
+        Args:
+            eouts (FloatTensor): `[1, T, enc_n_units]`
+            dstates (dict): decoder states of `B` hypotheses
+            cv (FloatTensor): `[B, 1, enc_n_units]`
+            y (LongTensor): `[B, 1]`
+            aw (FloatTensor): `[B, H, 1, T]`
+            lmout (FloatTensor): `[B, 1, lm_n_units]`
+            output (bool): compute logits over the full vocabulary
+        Returns:
+            dstates (dict): new decoder states
+            cv (FloatTensor): `[B, 1, enc_n_units]`
+            aw (FloatTensor): `[B, H, 1, T]`
+            attn_v (FloatTensor): `[B, 1, dec_n_units]`
+            logits (FloatTensor): `[B, vocab]` (None if output is False)
+
+        """
+        dstates, cv, aw, attn_v, _, _ = self.decode_step(
+            eouts.repeat([cv.size(0), 1, 1]), dstates, cv, self.dropout_emb(self.embed(y)), None, aw, lmout)
+        logits = self.output(attn_v).squeeze(1) if output else None
+        return dstates, cv, aw, attn_v, logits
+
+    def beam_search_steps(self, eouts, elens, params, idx2token=None,
+                          lm=None, lm_second=None, lm_second_bwd=None, ctc_log_probs=None,
+                          nbest=1, exclude_eos=False,
+                          refs_id=None, utt_ids=None, speakers=None,
+                          ensmbl_eouts=[], ensmbl_elens=[], ensmbl_decs=[], cache_states=True):
+        """Beam search decoding as a generator of decoder steps.
+
+        Inputs of each decoder step are yielded as a tuple of
+        `(utterance index, step index, eouts, dstates, cv, y, aw, lmout, output)`
+        and outputs of `beam_search_step` are sent back, so that the caller can
+        run several beam searches in lockstep (e.g., forward-backward decoding).
+
         Args:
             eouts (FloatTensor): `[B, T, enc_n_units]`
             elens (IntTensor): `[B]`
@@ -1047,6 +1156,7 @@ class RNNDecoder(DecoderBase):
         asr_state_CO = params['recog_asr_state_carry_over']
         lm_state_CO = params['recog_lm_state_carry_over']
         softmax_smoothing = params['recog_softmax_smoothing']
+        nbest_export = params.get('recog_nbest_export', False)
 
         if lm is not None:
             assert lm_weight > 0
@@ -1058,12 +1168,25 @@ class RNNDecoder(DecoderBase):
             assert lm_weight_second_bwd > 0
             lm_second_bwd.eval()
         trfm_lm = isinstance(lm, TransformerLM) or isinstance(lm, TransformerXL)
-
+        # LMs whose states are dicts of tensors batched along dim 1
+        rnnlm_like = isinstance(lm, RNNLM) or isinstance(lm, GatedConvLM) or \
+            isinstance(lm, LookAheadWordLM) or isinstance(lm, NgramLM)
+        lm_cache = None if self.replace_sos else self.get_lm_cache(lm, params)
+        # score only the top-K candidates of the ASR model with the LM
+        lm_shortlist = lm is not None and self.lm is None and params.get('recog_lm_shortlist', 0) > 0
+
+        # exclude tokens with negligible CTC posteriors in the utterance from the output layer
+        ctc_vocab = None
         if ctc_log_probs is not None:
             assert ctc_weight > 0
+            if params.get('recog_ctc_vocab_threshold', 0) > 0:
+                ctc_vocab = self.ctc_vocab_candidates(ctc_log_probs, elens, params['recog_ctc_vocab_threshold'],
+                                                      beam_width)
             ctc_log_probs = tensor2np(ctc_log_probs)
 
         nbest_hyps_idx, aws, scores = [], [], []
+        self.nbest_components = []  # for N-best rescoring
+        self.nbest_scores_att_cum = []  # for forward-backward attention decoding
         eos_flags = []
         for b in range(bs):
             # Initialization per utterance
@@ -1075,10 +1198,15 @@ class RNNDecoder(DecoderBase):
             # For joint CTC-Attention decoding
             ctc_prefix_scorer = None
             if ctc_log_probs is not None:
+                # exclude padded frames before reversing for the backward decoder
+                ctc_log_probs_b = ctc_log_probs[b, :elens[b]]
                 if self.bwd:
-                    ctc_prefix_scorer = CTCPrefixScore(ctc_log_probs[b][::-1], self.blank, self.eos)
+                    ctc_prefix_scorer = CTCPrefixScore(ctc_log_probs_b[::-1], self.blank, self.eos)
                 else:
-                    ctc_prefix_scorer = CTCPrefixScore(ctc_log_probs[b], self.blank, self.eos)
+                    ctc_prefix_scorer = CTCPrefixScore(ctc_log_probs_b, self.blank, self.eos)
+            output_b = self.pruned_output(ctc_vocab[b]) if ctc_vocab is not None else None
+            ensmbl_outputs_b = [dec.pruned_output(ctc_vocab[b]) for dec in ensmbl_decs] \
+                if ctc_vocab is not None else None
 
             # Ensemble initialization
             ensmbl_dstate, ensmbl_cv = [], []
@@ -1093,7 +1221,7 @@ class RNNDecoder(DecoderBase):
                     if asr_state_CO:
                         dstates = self.dstates_final
                     if lm_state_CO:
-                        if isinstance(lm, RNNLM):
+                        if rnnlm_like:
                             lmstate = self.lmstate_final
                         elif isinstance(lm, TransformerLM):
                             ys_prev = self.lmstate_final
@@ -1118,6 +1246,7 @@ class RNNDecoder(DecoderBase):
                      'ys': ys,
                      'score': 0.,
                      'score_att': 0.,
+                     'score_att_cum': [],
                      'score_ctc': 0.,
                      'score_lm': 0.,
                      'dstates': dstates,
@@ -1156,9 +1285,9 @@ class RNNDecoder(DecoderBase):
                         y_lm = y
 
                     if i > 0 or (i == 0 and trfm_lm and lm_state_CO and self.lmstate_final is not None):
-                        if isinstance(lm, RNNLM):
-                            lmstate = {'hxs': torch.cat([beam['lmstate']['hxs'] for beam in hyps], dim=1),
-                                       'cxs': torch.cat([beam['lmstate']['cxs'] for beam in hyps], dim=1)}
+                        if rnnlm_like:
+                            lmstate = {k: torch.cat([beam['lmstate'][k] for beam in hyps], dim=1)
+                                       for k in hyps[0]['lmstate'].keys()}
                         elif trfm_lm:
                             if isinstance(lm, TransformerLM):
                                 lmstate = [torch.cat([beam['lmstate'][lth] for beam in hyps], dim=0)
@@ -1169,16 +1298,26 @@ class RNNDecoder(DecoderBase):
 
                     if self.lm is not None:  # cold/deep fusion
                         lmout, lmstate, scores_lm = self.lm.predict(y_lm, lmstate)
+                    elif lm_cache is not None:  # shallow fusion with cached LM states
+                        lmout, lmstate, scores_lm = lm_cache.predict(lm, [beam['hyp'] for beam in hyps],
+                                                                     y_lm, lmstate,
+                                                                     mems=self.lmmemory,
+                                                                     cache=lmstate if cache_states else None,
+                                                                     shortlist=lm_shortlist)
                     elif lm is not None:  # shallow fusion
                         lmout, lmstate, scores_lm = lm.predict(y_lm, lmstate,
                                                                mems=self.lmmemory,
-                                                               cache=lmstate if cache_states else None)
+                                                               cache=lmstate if cache_states else None,
+                                                               shortlist=lm_shortlist)
 
                 # for the main model
-                dstates, cv, aw, attn_v, _, _ = self.decode_step(
-                    eouts[b:b + 1, :elens[b]].repeat([cv.size(0), 1, 1]),
-                    dstates, cv, self.dropout_emb(self.embed(y)), None, aw, lmout)
-                probs = torch.softmax(self.output(attn_v).squeeze(1) * softmax_smoothing, dim=1)
+                dstates, cv, aw, attn_v, logits = yield (
+                    b, i, eouts[b:b + 1, :elens[b]], dstates, cv, y, aw, lmout, output_b is None)
+                if output_b is not None:
+                    probs = attn_v.new_zeros(attn_v.size(0), self.vocab)
+                    probs[:, ctc_vocab[b]] = torch.softmax(output_b(attn_v.squeeze(1)) * softmax_smoothing, dim=1)
+                else:
+                    probs = torch.softmax(logits * softmax_smoothing, dim=1)
 
                 # for the ensemble
                 ensmbl_dstate, ensmbl_cv, ensmbl_aws = [], [], []
@@ -1198,13 +1337,17 @@ class RNNDecoder(DecoderBase):
                                                   dstates_e['dstate'][1][:, j:j + 1])}]
                     ensmbl_cv += [cv_e[j:j + 1]]
                     ensmbl_aws += [beam['ensmbl_aws'][i_e] + [aw_e[j:j + 1]]]
-                    probs += torch.softmax(dec.output(attn_v_e).squeeze(1), dim=1)
+                    if ensmbl_outputs_b is not None:
+                        probs[:, ctc_vocab[b]] += torch.softmax(ensmbl_outputs_b[i_e](attn_v_e.squeeze(1)), dim=1)
+                    else:
+                        probs += torch.softmax(dec.output(attn_v_e).squeeze(1), dim=1)
                     # NOTE: sum in the probability scale (not log-scale)
 
                 # Ensemble
                 scores_att = torch.log(probs / n_models)
 
-                new_hyps = []
+                # NOTE: hypotheses are created only for candidates surviving local pruning
+                candidates, beam_scores = [], []
                 for j, beam in enumerate(hyps):
                     # Attention scores
                     total_scores_att = beam['score_att'] + scores_att[j:j + 1]
@@ -1214,7 +1357,11 @@ class RNNDecoder(DecoderBase):
 
                     # Add LM score <after> top-K selection
                     if lm is not None:
-                        total_scores_lm = beam['score_lm'] + scores_lm[j, -1, topk_ids[0]]
+                        if lm_shortlist:
+                            scores_lm_topk = lm.score_shortlist(scores_lm[j:j + 1, -1], topk_ids)[0]
+                        else:
+                            scores_lm_topk = scores_lm[j, -1, topk_ids[0]]
+                        total_scores_lm = beam['score_lm'] + scores_lm_topk
                         total_scores_topk += total_scores_lm * lm_weight
                     else:
                         total_scores_lm = eouts.new_zeros(beam_width)
@@ -1228,14 +1375,14 @@ class RNNDecoder(DecoderBase):
                             total_scores_topk += (len(beam['hyp'][1:]) + 1) * lp_weight
 
                     # Add coverage penalty
-                    if cp_weight > 0:
+                    # NOTE: computed without the penalty for exporting N-best lists
+                    if cp_weight > 0 or nbest_export:
                         aw_mat = torch.cat(beam['aws'][1:] + [aw[j:j + 1]], dim=2)  # `[B, H, L, T]`
                         aw_mat = aw_mat[:, 0, :, :]  # `[B, L, T]`
                         if gnmt_decoding:
                             aw_mat = torch.log(aw_mat.sum(-1))
                             cp = torch.where(aw_mat < 0, aw_mat, aw_mat.new_zeros(aw_mat.size())).sum()
                             # TODO(hirofumi): mask by elens[b]
-                            total_scores_topk += cp * cp_weight
                         else:
                             # Recompute converage penalty at each step
                             if cp_threshold == 0:
@@ -1243,6 +1390,7 @@ class RNNDecoder(DecoderBase):
                             else:
                                 cp = torch.where(aw_mat > cp_threshold, aw_mat,
                                                  aw_mat.new_zeros(aw_mat.size())).sum() / self.score.n_heads
+                        if cp_weight > 0:
                             total_scores_topk += cp * cp_weight
                     else:
                         cp = 0.
@@ -1252,11 +1400,9 @@ class RNNDecoder(DecoderBase):
                         beam['hyp'], topk_ids, beam['ctc_state'],
                         total_scores_topk, ctc_prefix_scorer)
 
-                    for k in range(beam_width):
-                        idx = topk_ids[0, k].item()
-                        length_norm_factor = len(beam['hyp'][1:]) + 1 if length_norm else 1
-                        total_score = total_scores_topk[0, k].item() / length_norm_factor
-
+                    beam_scores.append((total_scores_att, total_scores_ctc, total_scores_lm, new_ctc_states, cp))
+                    length_norm_factor = len(beam['hyp'][1:]) + 1 if length_norm else 1
+                    for k, (idx, total_score) in enumerate(zip(topk_ids[0].tolist(), total_scores_topk[0].tolist())):
                         if idx == self.eos:
                             # Exclude short hypotheses
                             if len(beam['hyp'][1:]) < elens[b] * min_len_ratio:
@@ -1266,39 +1412,43 @@ class RNNDecoder(DecoderBase):
                             max_score_no_eos = max(max_score_no_eos, scores_att[j, idx + 1:].max(0)[0].item())
                             if scores_att[j, idx].item() <= eos_threshold * max_score_no_eos:
                                 continue
-
-                        new_lmstate = None
-                        if lmstate is not None:
-                            if isinstance(lm, RNNLM) or isinstance(self.lm, RNNLM):
-                                new_lmstate = {'hxs': lmstate['hxs'][:, j:j + 1],
-                                               'cxs': lmstate['cxs'][:, j:j + 1]}
-                            elif trfm_lm:
-                                new_lmstate = [lmstate_l[j:j + 1] for lmstate_l in lmstate]
-                            else:
-                                raise ValueError
-
-                        ys = torch.cat([beam['ys'], eouts.new_zeros((1, 1), dtype=torch.int64).fill_(idx)], dim=-1)
-
-                        new_hyps.append(
-                            {'hyp': beam['hyp'] + [idx],
-                             'ys': ys,
-                             'score': total_score,
-                             'score_att': total_scores_att[0, idx].item(),
-                             'score_cp': cp,
-                             'score_ctc': total_scores_ctc[k].item(),
-                             'score_lm': total_scores_lm[k].item(),
-                             'dstates': {'dstate': (dstates['dstate'][0][:, j:j + 1],
-                                                    dstates['dstate'][1][:, j:j + 1])},
-                             'cv': cv[j:j + 1],
-                             'aws': beam['aws'] + [aw[j:j + 1]],
-                             'lmstate': new_lmstate,
-                             'ctc_state': new_ctc_states[k] if ctc_prefix_scorer is not None else None,
-                             'ensmbl_dstate': ensmbl_dstate,
-                             'ensmbl_cv': ensmbl_cv,
-                             'ensmbl_aws': ensmbl_aws})
+                        candidates.append((total_score / length_norm_factor, j, k, idx))
 
                 # Local pruning
-                new_hyps_sorted = sorted(new_hyps, key=lambda x: x['score'], reverse=True)[:beam_width]
+                new_hyps_sorted = []
+                for total_score, j, k, idx in sorted(candidates, key=lambda x: x[0], reverse=True)[:beam_width]:
+                    beam = hyps[j]
+                    total_scores_att, total_scores_ctc, total_scores_lm, new_ctc_states, cp = beam_scores[j]
+
+                    new_lmstate = None
+                    if lmstate is not None:
+                        if rnnlm_like or isinstance(self.lm, RNNLM):
+                            new_lmstate = {k: v[:, j:j + 1] for k, v in lmstate.items()}
+                        elif trfm_lm:
+                            new_lmstate = [lmstate_l[j:j + 1] for lmstate_l in lmstate]
+                        else:
+                            raise ValueError
+
+                    ys = torch.cat([beam['ys'], eouts.new_zeros((1, 1), dtype=torch.int64).fill_(idx)], dim=-1)
+
+                    new_hyps_sorted.append(
+                        {'hyp': beam['hyp'] + [idx],
+                         'ys': ys,
+                         'score': total_score,
+                         'score_att': total_scores_att[0, idx].item(),
+                         'score_att_cum': beam['score_att_cum'] + [total_scores_att[0, idx].item()],
+                         'score_cp': cp,
+                         'score_ctc': total_scores_ctc[k].item(),
+                         'score_lm': total_scores_lm[k].item(),
+                         'dstates': {'dstate': (dstates['dstate'][0][:, j:j + 1],
+                                                dstates['dstate'][1][:, j:j + 1])},
+                         'cv': cv[j:j + 1],
+                         'aws': beam['aws'] + [aw[j:j + 1]],
+                         'lmstate': new_lmstate,
+                         'ctc_state': new_ctc_states[k] if ctc_prefix_scorer is not None else None,
+                         'ensmbl_dstate': ensmbl_dstate,
+                         'ensmbl_cv': ensmbl_cv,
+                         'ensmbl_aws': ensmbl_aws})
 
                 # Remove complete hypotheses
                 new_hyps, end_hyps, is_finish = helper.remove_complete_hyp(
@@ -1323,6 +1473,9 @@ class RNNDecoder(DecoderBase):
 
             # Sort by score
             end_hyps = sorted(end_hyps, key=lambda x: x['score'], reverse=True)
+            self.nbest_components.append(self.score_components(
+                end_hyps, missing=self.missing_components(ctc_prefix_scorer, lm, lm_second, lm_second_bwd,
+                                                          coverage=cp_weight > 0 or nbest_export)))
 
             if idx2token is not None:
                 if utt_ids is not None:
@@ -1353,9 +1506,12 @@ class RNNDecoder(DecoderBase):
             if self.bwd:
                 # Reverse the order
                 nbest_hyps_idx += [[np.array(end_hyps[n]['hyp'][1:][::-1]) for n in range(nbest)]]
+                self.nbest_scores_att_cum += [[np.array(end_hyps[n]['score_att_cum'][::-1])
+                                               for n in range(nbest)]]
                 aws += [[tensor2np(torch.cat(end_hyps[n]['aws'][1:][::-1], dim=2).squeeze(0)) for n in range(nbest)]]
             else:
                 nbest_hyps_idx += [[np.array(end_hyps[n]['hyp'][1:]) for n in range(nbest)]]
+                self.nbest_scores_att_cum += [[np.array(end_hyps[n]['score_att_cum']) for n in range(nbest)]]
                 aws += [[tensor2np(torch.cat(end_hyps[n]['aws'][1:], dim=2).squeeze(0)) for n in range(nbest)]]
             if length_norm:
                 scores += [[end_hyps[n]['score_att'] / len(end_hyps[n]['hyp'][1:]) for n in range(nbest)]]
@@ -1378,22 +1534,51 @@ class RNNDecoder(DecoderBase):
 
         # Store ASR/LM state
         self.dstates_final = end_hyps[0]['dstates']
-        if isinstance(lm, RNNLM):
+        if rnnlm_like:
             self.lmstate_final = end_hyps[0]['lmstate']
         elif trfm_lm:
+            ys = end_hyps[0]['ys']
+            # Exclude the last state corresponding to <eos>
+            if ys[0, -1].item() == self.eos:
+                ys = ys[:, :-1]
             if isinstance(lm, TransformerXL):
-                self.lmmemory = lm.update_memory(self.lmmemory, end_hyps[0]['lmstate'])
-                logging.info('Memory: %d' % self.lmmemory[0].size(1))
+                # Encode the best hypothesis once to write hidden states into the memory
+                # NOTE: cached states contain keys and values of self-attention only
+                self.lmmemory = lm.decode(ys, mems=self.lmmemory, skip_output=True)[2]
+                if self.lmmemory is not None:
+                    logging.info('Memory: %d' % self.lmmemory.length)
             else:
-                ys = end_hyps[0]['ys']
-                # Exclude the last state corresponding to <eos>
-                if ys[0, -1].item() == self.eos:
-                    ys = ys[:, :-1]
                 ys = ys[:, -lm.mem_len:]  # Truncate by BPTT length
             self.lmstate_final = ys
 
         return nbest_hyps_idx, aws, scores
 
+    def get_stream_state(self):
+        """Return states carried over chunks in chunk-synchronous decoding of a stream."""
+        return {'n_frames': getattr(self, 'n_frames', 0),
+                'chunk_size': getattr(self, 'chunk_size', 0),
+                'ctc_prefix_scorer': getattr(self, 'ctc_prefix_scorer', None),
+                'dstates_final': self.dstates_final,
+                'lmstate_final': self.lmstate_final,
+                'key_prev_tail': getattr(self.score, 'key_prev_tail', None)}
+
+    def set_stream_state(self, state):
+        """Restore states returned by `get_stream_state` to resume decoding of a stream.
+
+        Args:
+            state (dict): None represents a new stream
+
+        """
+        if state is None:
+            state = {'n_frames': 0, 'chunk_size': 0, 'ctc_prefix_scorer': None,
+                     'dstates_final': None, 'lmstate_final': None, 'key_prev_tail': None}
+        self.n_frames = state['n_frames']
+        self.chunk_size = state['chunk_size']
+        self.ctc_prefix_scorer = state['ctc_prefix_scorer']
+        self.dstates_final = state['dstates_final']
+        self.lmstate_final = state['lmstate_final']
+        self.score.key_prev_tail = state['key_prev_tail']
+
     def beam_search_chunk_sync(self, eouts, params, idx2token,
                                lm=None, ctc_log_probs=None,
                                hyps=False, state_carry_over=False, ignore_eos=False):
@@ -1422,8 +1607,9 @@ class RNNDecoder(DecoderBase):
         ctc_state = None
 
         # For joint CTC-Attention decoding
-        self.ctc_prefix_scorer = None
-        if ctc_log_probs is not None:
+        if ctc_log_probs is None:
+            self.ctc_prefix_scorer = None
+        else:
             assert ctc_weight > 0
             ctc_log_probs = tensor2np(ctc_log_probs)
             if hyps is None:
@@ -1560,8 +1746,7 @@ class RNNDecoder(DecoderBase):
                          'dstates': {'dstate': (dstates['dstate'][0][:, j:j + 1], dstates['dstate'][1][:, j:j + 1])},
                          'cv': cv[j:j + 1],
                          'aws': beam['aws'] + [aw[j:j + 1]],
-                         'lmstate': {'hxs': lmstate['hxs'][:, j:j + 1],
-                                     'cxs': lmstate['cxs'][:, j:j + 1]} if lmstate is not None else None,
+                         'lmstate': {k: v[:, j:j + 1] for k, v in lmstate.items()} if lmstate is not None else None,
                          'ctc_state': new_ctc_states[k] if self.ctc_prefix_scorer is not None else None,
                          'no_boundary': no_boundary})
 
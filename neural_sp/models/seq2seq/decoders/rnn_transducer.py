@@ -394,6 +394,60 @@ class RNNTransducer(DecoderBase):
 
         return hyps, None
 
+    def greedy_chunk_sync(self, eouts, elens, states=None):
+        """Frame-synchronous greedy decoding over a chunk of multiple streams.
+
+        Args:
+            eouts (FloatTensor): `[B, T_chunk, enc_units]`
+            elens (IntTensor): `[B]`
+            states (list): A list of length `[B]`, which contains prediction network
+                states carried over from the previous chunk. None represents a new stream.
+        Returns:
+            hyps (list): length `B`, each of which contains a list of tokens emitted in the chunk
+            states (list): A list of length `[B]`, which contains prediction network states
+                dout (FloatTensor): `[1, 1, dec_n_units]`
+                dstate (dict):
+                    hxs (FloatTensor): `[n_layers, 1, dec_n_units]`
+                    cxs (FloatTensor): `[n_layers, 1, dec_n_units]`
+
+        """
+        bs = eouts.size(0)
+        if states is None:
+            states = [None] * bs
+
+        # Initialization for new streams
+        y = eouts.new_zeros((bs, 1), dtype=torch.int64).fill_(self.eos)
+        dout_init, dstate_init = self.recurrency(self.dropout_emb(self.embed(y)), None)
+        dout = torch.cat([dout_init[b:b + 1] if state is None else state['dout']
+                          for b, state in enumerate(states)], dim=0)
+        dstate = {k: torch.cat([v[:, b:b + 1] if state is None else state['dstate'][k]
+                                for b, state in enumerate(states)], dim=1) if v is not None else None
+                  for k, v in dstate_init.items()}
+
+        hyps = [[] for _ in range(bs)]
+        elens = elens.to(eouts.device)
+        for t in range(eouts.size(1)):
+            # Pick up 1-best per frame
+            out = self.joint(eouts[:, t:t + 1], dout)
+            y = out.squeeze(2).argmax(-1)  # `[B, 1]`
+            is_emitted = (y[:, 0] != self.blank) & (t < elens)
+            if not is_emitted.any():
+                continue
+            for b in is_emitted.nonzero(as_tuple=True)[0].tolist():
+                hyps[b].append(y[b, 0].item())
+
+            # Update prediction network only for streams predicting non-blank labels
+            dout_new, dstate_new = self.recurrency(self.dropout_emb(self.embed(y)), dstate)
+            dout = torch.where(is_emitted.view(bs, 1, 1), dout_new, dout)
+            for k in dstate.keys():
+                if dstate[k] is not None:
+                    dstate[k] = torch.where(is_emitted.view(1, bs, 1), dstate_new[k], dstate[k])
+
+        states = [{'dout': dout[b:b + 1],
+                   'dstate': {k: v[:, b:b + 1] if v is not None else None for k, v in dstate.items()}}
+                  for b in range(bs)]
+        return hyps, states
+
     def beam_search(self, eouts, elens, params, idx2token=None,
                     lm=None, lm_second=None, lm_second_bwd=None, ctc_log_probs=None,
                     nbest=1, exclude_eos=False,
@@ -449,6 +503,8 @@ class RNNTransducer(DecoderBase):
             assert ctc_weight > 0
             ctc_log_probs = tensor2np(ctc_log_probs)
 
+        lm_cache = self.get_lm_cache(lm, params)
+
         nbest_hyps_idx = []
         eos_flags = []
         for b in range(bs):
@@ -495,10 +551,12 @@ class RNNTransducer(DecoderBase):
                 lmstate, scores_lm = None, None
                 if lm is not None:
                     if hyps[0]['lmstate'] is not None:
-                        lm_hxs = torch.cat([beam['lmstate']['hxs'] for beam in hyps], dim=1)
-                        lm_cxs = torch.cat([beam['lmstate']['cxs'] for beam in hyps], dim=1)
-                        lmstate = {'hxs': lm_hxs, 'cxs': lm_cxs}
-                    lmout, lmstate, scores_lm = lm.predict(y, lmstate)
+                        lmstate = {k: torch.cat([beam['lmstate'][k] for beam in hyps], dim=1)
+                                   for k in hyps[0]['lmstate'].keys()}
+                    if lm_cache is not None:
+                        lmout, lmstate, scores_lm = lm_cache.predict(lm, [beam['hyp'] for beam in hyps], y, lmstate)
+                    else:
+                        lmout, lmstate, scores_lm = lm.predict(y, lmstate)
 
                 new_hyps = []
                 for j, beam in enumerate(hyps):
@@ -554,8 +612,7 @@ class RNNTransducer(DecoderBase):
                         self.state_cache[hyp_str] = {
                             'dout': dout,
                             'dstate': new_dstate,
-                            'lmstate': {'hxs': lmstate['hxs'][:, j:j + 1],
-                                        'cxs': lmstate['cxs'][:, j:j + 1]} if lmstate is not None else None,
+                            'lmstate': {k: v[:, j:j + 1] for k, v in lmstate.items()} if lmstate is not None else None,
                         }
 
                         new_hyps.append({'hyp': hyp_ids,
@@ -565,8 +622,7 @@ class RNNTransducer(DecoderBase):
                                          'score_lm': total_scores_lm[k].item(),
                                          'dout': dout,
                                          'dstate': new_dstate,
-                                         'lmstate': {'hxs': lmstate['hxs'][:, j:j + 1],
-                                                     'cxs': lmstate['cxs'][:, j:j + 1]} if lmstate is not None else None,
+                                         'lmstate': {k: v[:, j:j + 1] for k, v in lmstate.items()} if lmstate is not None else None,
                                          'ctc_state': new_ctc_states[k] if ctc_prefix_scorer is not None else None})
 
                 # Merge hypotheses having the same token sequences
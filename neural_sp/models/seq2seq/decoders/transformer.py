@@ -618,11 +618,22 @@ class TransformerDecoder(DecoderBase):
             assert lm_weight_second_bwd > 0
             lm_second_bwd.eval()
 
+        # exclude tokens with negligible CTC posteriors in the utterance from the output layer
+        ctc_vocab = None
         if ctc_log_probs is not None:
             assert ctc_weight > 0
+            if params.get('recog_ctc_vocab_threshold', 0) > 0:
+                ctc_vocab = self.ctc_vocab_candidates(ctc_log_probs, elens, params['recog_ctc_vocab_threshold'],
+                                                      beam_width)
             ctc_log_probs = tensor2np(ctc_log_probs)
 
+        lm_cache = self.get_lm_cache(lm, params)
+        # score only the top candidates of the ASR model with the LM
+        lm_shortlist = params.get('recog_lm_shortlist', 0) if lm is not None else 0
+
         nbest_hyps_idx, aws, scores = [], [], []
+        self.nbest_components = []  # for N-best rescoring
+        self.nbest_scores_att_cum = []  # for forward-backward attention decoding
         eos_flags = []
         for b in range(bs):
             # Initialization per utterance
@@ -632,10 +643,15 @@ class TransformerDecoder(DecoderBase):
             # For joint CTC-Attention decoding
             ctc_prefix_scorer = None
             if ctc_log_probs is not None:
+                # exclude padded frames before reversing for the backward decoder
+                ctc_log_probs_b = ctc_log_probs[b, :elens[b]]
                 if self.bwd:
-                    ctc_prefix_scorer = CTCPrefixScore(ctc_log_probs[b][::-1], self.blank, self.eos)
+                    ctc_prefix_scorer = CTCPrefixScore(ctc_log_probs_b[::-1], self.blank, self.eos)
                 else:
-                    ctc_prefix_scorer = CTCPrefixScore(ctc_log_probs[b], self.blank, self.eos)
+                    ctc_prefix_scorer = CTCPrefixScore(ctc_log_probs_b, self.blank, self.eos)
+            output_b = self.pruned_output(ctc_vocab[b]) if ctc_vocab is not None else None
+            ensmbl_outputs_b = [dec.pruned_output(ctc_vocab[b]) for dec in ensmbl_decs] \
+                if ctc_vocab is not None else None
 
             if speakers is not None:
                 if speakers[b] == self.prev_spk:
@@ -651,6 +667,7 @@ class TransformerDecoder(DecoderBase):
                      'cache': None,
                      'score': 0.,
                      'score_att': 0.,
+                     'score_att_cum': [],
                      'score_ctc': 0.,
                      'score_lm': 0.,
                      'aws': [None],
@@ -678,7 +695,8 @@ class TransformerDecoder(DecoderBase):
 
                 # Update LM states for shallow fusion
                 y_lm = ys[:, -1:].clone()  # NOTE: this is important
-                _, lmstate, scores_lm = helper.update_rnnlm_state_batch(lm, hyps, y_lm)
+                _, lmstate, scores_lm = helper.update_rnnlm_state_batch(lm, hyps, y_lm, lm_cache,
+                                                                        shortlist=lm_shortlist > 0)
 
                 # for the main model
                 causal_mask = eouts.new_ones(i + 1, i + 1).byte()
@@ -703,8 +721,12 @@ class TransformerDecoder(DecoderBase):
                     new_cache[lth] = out
                     if xy_aws is not None:
                         xy_aws_layers.append(xy_aws)
-                logits = self.output(self.norm_out(out))
-                probs = torch.softmax(logits[:, -1] * softmax_smoothing, dim=1)
+                if output_b is not None:
+                    probs = out.new_zeros(out.size(0), self.vocab)
+                    probs[:, ctc_vocab[b]] = torch.softmax(output_b(self.norm_out(out[:, -1])) * softmax_smoothing,
+                                                           dim=1)
+                else:
+                    probs = torch.softmax(self.output(self.norm_out(out[:, -1])) * softmax_smoothing, dim=1)
                 xy_aws_layers = torch.stack(xy_aws_layers, dim=1)  # `[B, H, n_layers, L, T]`
 
                 # Ensemble initialization
@@ -723,8 +745,12 @@ class TransformerDecoder(DecoderBase):
                         out_e = dec.layers[lth](out_e, causal_mask, eouts_e, None,
                                                 cache=ensmbl_cache[i_e][lth])
                         ensmbl_new_cache[i_e][lth] = out_e
-                    logits_e = dec.output(dec.norm_out(out_e))
-                    probs += torch.softmax(logits_e[:, -1] * softmax_smoothing, dim=1)
+                    if ensmbl_outputs_b is not None:
+                        logits_e = ensmbl_outputs_b[i_e](dec.norm_out(out_e[:, -1]))
+                        probs[:, ctc_vocab[b]] += torch.softmax(logits_e * softmax_smoothing, dim=1)
+                    else:
+                        logits_e = dec.output(dec.norm_out(out_e))
+                        probs += torch.softmax(logits_e[:, -1] * softmax_smoothing, dim=1)
                     # NOTE: sum in the probability scale (not log-scale)
 
                 # Ensemble
@@ -738,7 +764,14 @@ class TransformerDecoder(DecoderBase):
 
                     # Add LM score <before> top-K selection
                     if lm is not None:
-                        total_scores_lm = beam['score_lm'] + scores_lm[j:j + 1, -1]
+                        if lm_shortlist > 0:
+                            cand_ids = torch.topk(total_scores, k=min(max(lm_shortlist, beam_width), self.vocab),
+                                                  dim=1)[1]
+                            scores_lm_j = total_scores.new_full(total_scores.size(), float('-inf')).scatter_(
+                                1, cand_ids, lm.score_shortlist(scores_lm[j:j + 1, -1], cand_ids))
+                        else:
+                            scores_lm_j = scores_lm[j:j + 1, -1]
+                        total_scores_lm = beam['score_lm'] + scores_lm_j
                         total_scores += total_scores_lm * lm_weight
                     else:
                         total_scores_lm = eouts.new_zeros(1, self.vocab)
@@ -801,11 +834,11 @@ class TransformerDecoder(DecoderBase):
                              'cache': [new_cache_l[j:j + 1] for new_cache_l in new_cache] if cache_states else cache,
                              'score': total_score,
                              'score_att': total_scores_att[0, idx].item(),
+                             'score_att_cum': beam['score_att_cum'] + [total_scores_att[0, idx].item()],
                              'score_ctc': total_scores_ctc[k].item(),
                              'score_lm': total_scores_lm[0, idx].item(),
                              'aws': new_aws,
-                             'lmstate': {'hxs': lmstate['hxs'][:, j:j + 1],
-                                         'cxs': lmstate['cxs'][:, j:j + 1]} if lmstate is not None else None,
+                             'lmstate': {k: v[:, j:j + 1] for k, v in lmstate.items()} if lmstate is not None else None,
                              'ctc_state': new_ctc_states[k] if ctc_prefix_scorer is not None else None,
                              'ensmbl_cache': [[new_cache_e_l[j:j + 1] for new_cache_e_l in new_cache_e] for new_cache_e in ensmbl_new_cache] if cache_states else None,
                              'streamable': streamable_global,
@@ -838,6 +871,9 @@ class TransformerDecoder(DecoderBase):
 
             # Sort by score
             end_hyps = sorted(end_hyps, key=lambda x: x['score'], reverse=True)
+            self.nbest_components.append(self.score_components(
+                end_hyps, missing=self.missing_components(ctc_prefix_scorer, lm, lm_second, lm_second_bwd,
+                                                          coverage=False)))
 
             for j in range(len(end_hyps[0]['aws'][1:])):
                 tmp = end_hyps[0]['aws'][j + 1]
@@ -889,9 +925,12 @@ class TransformerDecoder(DecoderBase):
             if self.bwd:
                 # Reverse the order
                 nbest_hyps_idx += [[np.array(end_hyps[n]['hyp'][1:][::-1]) for n in range(nbest)]]
+                self.nbest_scores_att_cum += [[np.array(end_hyps[n]['score_att_cum'][::-1])
+                                               for n in range(nbest)]]
                 aws += [[tensor2np(torch.cat(end_hyps[n]['aws'][1:][::-1], dim=2).squeeze(0)) for n in range(nbest)]]
             else:
                 nbest_hyps_idx += [[np.array(end_hyps[n]['hyp'][1:]) for n in range(nbest)]]
+                self.nbest_scores_att_cum += [[np.array(end_hyps[n]['score_att_cum']) for n in range(nbest)]]
                 aws += [[tensor2np(torch.cat(end_hyps[n]['aws'][1:], dim=2).squeeze(0)) for n in range(nbest)]]
             scores += [[end_hyps[n]['score_att'] for n in range(nbest)]]
 
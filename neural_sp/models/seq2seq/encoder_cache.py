@@ -0,0 +1,99 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Cache of encoder outputs and CTC posteriors for repeated decoding."""
+
+import logging
+import numpy as np
+import os
+import torch
+
+from neural_sp.models.torch_utils import tensor2np
+
+logger = logging.getLogger(__name__)
+
+
+class EncoderCache(object):
+    """Per-utterance cache of encoder outputs on disk.
+
+    Outputs of the encoder (and the CTC layer) are deterministic in the
+    inference stage, so they are computed once per utterance and checkpoint
+    and reused when decoding hyper-parameters are tuned. Each entry is saved
+    as a .npy file and loaded with memory mapping, so that it is copied only
+    once into the padded mini-batch.
+
+    Args:
+        cache_dir (str): directory to save cache for a checkpoint
+        fp16 (bool): save in half precision to reduce disk usage
+
+    """
+
+    def __init__(self, cache_dir, fp16=False):
+        self.cache_dir = cache_dir
+        self.dtype = np.float16 if fp16 else np.float32
+        self.n_hits = 0
+        self.n_misses = 0
+        logger.info('Encoder cache: %s' % cache_dir)
+
+    def _path(self, utt_id, task, name):
+        return os.path.join(self.cache_dir, task, str(utt_id).replace('/', '_') + '.' + name + '.npy')
+
+    def load(self, utt_ids, task, name, device):
+        """Load cached outputs for a mini-batch.
+
+        Args:
+            utt_ids (list): name of utterances
+            task (str): ys/ys_sub1/ys_sub2
+            name (str): eout/ctc
+            device (torch.device):
+        Returns:
+            xs (FloatTensor): `[B, T, dim]`, or None if any utterance is not cached
+            xlens (IntTensor): `[B]`
+
+        """
+        paths = [self._path(utt_id, task, name) for utt_id in utt_ids]
+        if not all(os.path.isfile(p) for p in paths):
+            self.n_misses += 1
+            return None, None
+        self.n_hits += 1
+        xs = [np.load(p, mmap_mode='r') for p in paths]
+        xlens = torch.IntTensor([len(x) for x in xs])
+        xs_pad = torch.zeros(len(xs), int(xlens.max()), xs[0].shape[1], dtype=torch.float32)
+        xs_pad_np = xs_pad.numpy()
+        for b, x in enumerate(xs):
+            xs_pad_np[b, :len(x)] = x  # read from the mapped file (and cast to fp32)
+        return xs_pad.to(device), xlens
+
+    @property
+    def hit_rate(self):
+        n_queries = self.n_hits + self.n_misses
+        return self.n_hits / n_queries if n_queries > 0 else 0.
+
+    def report(self):
+        logger.info('Encoder cache: hit rate: %.2f %% (%d/%d)' %
+                    (self.hit_rate * 100, self.n_hits, self.n_hits + self.n_misses))
+
+    def save(self, utt_ids, task, name, xs, xlens):
+        """Save outputs for a mini-batch.
+
+        Args:
+            utt_ids (list): name of utterances
+            task (str): ys/ys_sub1/ys_sub2
+            name (str): eout/ctc
+            xs (FloatTensor): `[B, T, dim]`
+            xlens (IntTensor or list): `[B]`
+
+        """
+        xs = tensor2np(xs)
+        for b, utt_id in enumerate(utt_ids):
+            path = self._path(utt_id, task, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            # write to a temporary file first for concurrent decoding processes
+            tmp_path = path + '.tmp' + str(os.getpid())
+            with open(tmp_path, 'wb') as f:
+                np.save(f, xs[b, :int(xlens[b])].astype(self.dtype))
+            os.replace(tmp_path, path)
@@ -419,21 +419,16 @@ def update_lens_1d(seq_lens, layer):
     """
     if seq_lens is None:
         return seq_lens
-    assert isinstance(seq_lens, torch.IntTensor)
+    assert seq_lens.dtype == torch.int32
     assert type(layer) in [nn.Conv1d, nn.MaxPool1d]
-    # seq_lens = [_update_1d(seq_len.item(), layer) for seq_len in seq_lens]
-    seq_lens = [_update_1d(seq_len, layer) for seq_len in seq_lens]
-    seq_lens = torch.IntTensor(seq_lens)
-    return seq_lens
+    return _update_1d(seq_lens, layer)
 
 
 def _update_1d(seq_len, layer):
     if type(layer) == nn.MaxPool1d and layer.ceil_mode:
-        return math.ceil(
-            (seq_len + 1 + 2 * layer.padding - (layer.kernel_size - 1) - 1) // layer.stride + 1)
+        return (seq_len + 2 * layer.padding - (layer.kernel_size - 1) - 1 + layer.stride - 1) // layer.stride + 1
     else:
-        return math.floor(
-            (seq_len + 2 * layer.padding[0] - (layer.kernel_size[0] - 1) - 1) // layer.stride[0] + 1)
+        return (seq_len + 2 * layer.padding[0] - (layer.kernel_size[0] - 1) - 1) // layer.stride[0] + 1
 
 
 def update_lens_2d(seq_lens, layer, dim=0):
@@ -449,21 +444,17 @@ def update_lens_2d(seq_lens, layer, dim=0):
     """
     if seq_lens is None:
         return seq_lens
-    assert isinstance(seq_lens, torch.IntTensor)
+    assert seq_lens.dtype == torch.int32
     assert type(layer) in [nn.Conv2d, nn.MaxPool2d]
-    # seq_lens = [_update_2d(seq_len.item(), layer, dim) for seq_len in seq_lens]
-    seq_lens = [_update_2d(seq_len, layer, dim) for seq_len in seq_lens]
-    seq_lens = torch.IntTensor(seq_lens)
-    return seq_lens
+    return _update_2d(seq_lens, layer, dim)
 
 
 def _update_2d(seq_len, layer, dim):
     if type(layer) == nn.MaxPool2d and layer.ceil_mode:
-        return math.ceil(
-            (seq_len + 1 + 2 * layer.padding[dim] - (layer.kernel_size[dim] - 1) - 1) // layer.stride[dim] + 1)
+        stride = layer.stride[dim]
+        return (seq_len + 2 * layer.padding[dim] - (layer.kernel_size[dim] - 1) - 1 + stride - 1) // stride + 1
     else:
-        return math.floor(
-            (seq_len + 2 * layer.padding[dim] - (layer.kernel_size[dim] - 1) - 1) // layer.stride[dim] + 1)
+        return (seq_len + 2 * layer.padding[dim] - (layer.kernel_size[dim] - 1) - 1) // layer.stride[dim] + 1
 
 
 def parse_cnn_config(channels, kernel_sizes, strides, poolings):
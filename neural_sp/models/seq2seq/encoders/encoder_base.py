@@ -41,6 +41,12 @@ class EncoderBase(ModelBase):
     def reset_cache(self):
         raise NotImplementedError
 
+    def merge_cache(self, caches):
+        raise NotImplementedError
+
+    def split_cache(self, bs):
+        raise NotImplementedError
+
     def turn_on_ceil_mode(self, encoder):
         if isinstance(encoder, torch.nn.Module):
             for name, module in encoder.named_children():
@@ -261,6 +261,29 @@ class RNNEncoder(EncoderBase):
         self.hx_fwd = [None] * self.n_layers
         logger.debug('Reset cache.')
 
+    def merge_cache(self, caches):
+        """Batchfy caches of multiple streams for streaming encoding.
+
+        Args:
+            caches (list): A list of length `[B]`, which contains per-stream caches
+                returned by `split_cache`. None represents a new stream.
+
+        """
+        caches = [c if c is not None else [None] * self.n_layers for c in caches]
+        self.hx_fwd = [merge_states([c[lth] for c in caches]) for lth in range(self.n_layers)]
+
+    def split_cache(self, bs):
+        """Split the cache of batchfied streams after streaming encoding.
+
+        Args:
+            bs (int): batch size
+        Returns:
+            caches (list): A list of length `[B]`, which contains per-stream caches
+
+        """
+        states = [split_states(hx, bs) for hx in self.hx_fwd]
+        return [[states[lth][b] for lth in range(self.n_layers)] for b in range(bs)]
+
     def forward(self, xs, xlens, task, streaming=False, lookback=False, lookahead=False):
         """Forward pass.
 
@@ -287,7 +310,12 @@ class RNNEncoder(EncoderBase):
 
         # Sort by lenghts in the descending order for pack_padded_sequence
         if not self.lc_bidir:
-            xlens, perm_ids = torch.IntTensor(xlens).sort(0, descending=True)
+            if streaming:
+                # keep the order of streams because states are cached along the batch dimension
+                xlens = torch.IntTensor(xlens)
+                perm_ids = torch.arange(xlens.size(0))
+            else:
+                xlens, perm_ids = torch.IntTensor(xlens).sort(0, descending=True)
             xs = xs[perm_ids]
             _, perm_ids_unsort = perm_ids.sort()
 
@@ -496,6 +524,43 @@ class RNNEncoder(EncoderBase):
         return xs_sub, xlens_sub
 
 
+def merge_states(states):
+    """Concatenate RNN states of multiple streams along the batch dimension.
+
+    Args:
+        states (list): A list of length `[B]`, which contains FloatTensors of size
+            `[n_layers * n_dirs, 1, n_units]`, tuples of them (for LSTM), or None
+    Returns:
+        state (FloatTensor or tuple): `[n_layers * n_dirs, B, n_units]`.
+            None states are filled with zeros. None if all states are None.
+
+    """
+    ref = next((s for s in states if s is not None), None)
+    if ref is None:
+        return None
+    if isinstance(ref, tuple):
+        return tuple(merge_states([s[i] if s is not None else None for s in states])
+                     for i in range(len(ref)))
+    return torch.cat([s if s is not None else torch.zeros_like(ref) for s in states], dim=1)
+
+
+def split_states(state, bs):
+    """Split batchfied RNN states into those of each stream.
+
+    Args:
+        state (FloatTensor or tuple): `[n_layers * n_dirs, B, n_units]`
+        bs (int): batch size
+    Returns:
+        states (list): A list of length `[B]`
+
+    """
+    if state is None:
+        return [None] * bs
+    if isinstance(state, tuple):
+        return list(zip(*[split_states(s, bs) for s in state]))
+    return list(state.split(1, dim=1))
+
+
 class Padding(nn.Module):
     """Padding variable length of sequences."""
 
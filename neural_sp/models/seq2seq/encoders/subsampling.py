@@ -6,7 +6,6 @@
 
 """Subsampling layers."""
 
-import math
 import torch
 import torch.nn as nn
 
@@ -38,20 +37,19 @@ class ConcatSubsampler(nn.Module):
         if self.subsampling_factor == 1:
             return xs, xlens
 
-        if batch_first:
-            xs = xs.transpose(1, 0).contiguous()
+        if not batch_first:
+            xs = xs.transpose(1, 0)
 
-        xs = [torch.cat([xs[t - r:t - r + 1] for r in range(self.subsampling_factor - 1, -1, -1)], dim=-1)
-              for t in range(xs.size(0)) if (t + 1) % self.subsampling_factor == 0]
-        xs = torch.cat(xs, dim=0)
+        bs, xmax, idim = xs.size()
+        xmax = xmax // self.subsampling_factor
         # NOTE: Exclude the last frames if the length is not divisible
+        xs = xs[:, :xmax * self.subsampling_factor].reshape(bs, xmax, idim * self.subsampling_factor)
         xs = torch.relu(self.proj(xs))
 
-        if batch_first:
+        if not batch_first:
             xs = xs.transpose(1, 0)
 
-        xlens = [max(1, i.item() // self.subsampling_factor) for i in xlens]
-        xlens = torch.IntTensor(xlens)
+        xlens = torch.clamp(xlens // self.subsampling_factor, min=1)
         return xs, xlens
 
 
@@ -127,8 +125,7 @@ class DropSubsampler(nn.Module):
         else:
             xs = xs[::self.subsampling_factor]
 
-        xlens = [max(1, math.ceil(i.item() / self.subsampling_factor)) for i in xlens]
-        xlens = torch.IntTensor(xlens)
+        xlens = torch.clamp((xlens + self.subsampling_factor - 1) // self.subsampling_factor, min=1)
         return xs, xlens
 
 
@@ -173,8 +170,7 @@ class AddSubsampler(nn.Module):
 
         xs = xs_odd + xs_even
 
-        xlens = [max(1, math.ceil(i.item() / self.subsampling_factor)) for i in xlens]
-        xlens = torch.IntTensor(xlens)
+        xlens = torch.clamp((xlens + self.subsampling_factor - 1) // self.subsampling_factor, min=1)
         return xs, xlens
 
 
@@ -0,0 +1,125 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Streaming log-mel filterbank extraction compatible with Kaldi."""
+
+import kaldiio
+import numpy as np
+
+
+def mel_scale(freq):
+    return 1127. * np.log(1. + freq / 700.)
+
+
+def mel_banks(n_mels, n_fft, sample_rate, low_freq=20., high_freq=0.):
+    """Triangular mel filterbank in the same way as Kaldi.
+
+    Args:
+        n_mels (int): number of mel bins
+        n_fft (int): FFT size
+        sample_rate (int): sampling frequency
+        low_freq (float): low cutoff frequency
+        high_freq (float): high cutoff frequency (offset from the Nyquist frequency if <= 0)
+    Returns:
+        banks (np.ndarray): `[n_fft // 2, n_mels]`
+
+    """
+    nyquist = 0.5 * sample_rate
+    if high_freq <= 0:
+        high_freq += nyquist
+    mel_low, mel_high = mel_scale(low_freq), mel_scale(high_freq)
+    mel_delta = (mel_high - mel_low) / (n_mels + 1)
+    left = mel_low + np.arange(n_mels) * mel_delta  # `[n_mels]`
+    center = left + mel_delta
+    right = center + mel_delta
+
+    mel = mel_scale(np.arange(n_fft // 2) * sample_rate / n_fft)[:, None]  # `[n_fft // 2, 1]`
+    up = (mel - left) / (center - left)
+    down = (right - mel) / (right - center)
+    return np.maximum(0., np.minimum(up, down))
+
+
+def load_cmvn(cmvn_path, var_floor=1e-20):
+    """Load global mean and variance normalization statistics.
+
+    Args:
+        cmvn_path (str): path to Kaldi statistics computed by compute-cmvn-stats
+        var_floor (float): floor of variance
+    Returns:
+        mean (np.ndarray): `[input_dim]`
+        std (np.ndarray): `[input_dim]`
+
+    """
+    stats = kaldiio.load_mat(cmvn_path)  # `[2, input_dim + 1]`
+    count = stats[0, -1]
+    mean = stats[0, :-1] / count
+    var = np.maximum(stats[1, :-1] / count - mean ** 2, var_floor)
+    return mean.astype(np.float32), np.sqrt(var).astype(np.float32)
+
+
+class Fbank(object):
+    """Streaming log-mel filterbank extraction.
+
+    Waveform samples are buffered over calls, and features are computed for
+    all complete frames. The default configuration corresponds to conf/fbank.conf
+    in recipes without dithering (hamming window, 25ms window, 10ms shift).
+
+    Args:
+        n_mels (int): number of mel bins
+        sample_rate (int): sampling frequency
+        frame_length (float): window length in milliseconds
+        frame_shift (float): window shift in milliseconds
+        preemphasis (float): pre-emphasis coefficient
+        low_freq (float): low cutoff frequency
+        high_freq (float): high cutoff frequency
+        cmvn (tuple): mean and standard deviation returned by `load_cmvn`
+
+    """
+
+    def __init__(self, n_mels=80, sample_rate=16000, frame_length=25., frame_shift=10.,
+                 preemphasis=0.97, low_freq=20., high_freq=0., cmvn=None):
+        self.window_size = int(sample_rate * frame_length / 1000)
+        self.window_shift = int(sample_rate * frame_shift / 1000)
+        self.n_fft = 1 << (self.window_size - 1).bit_length()
+        self.preemphasis = preemphasis
+        self.window = np.hamming(self.window_size)
+        self.banks = mel_banks(n_mels, self.n_fft, sample_rate, low_freq, high_freq)
+        self.cmvn = cmvn
+
+        self.buffer = np.zeros(0, dtype=np.float64)
+
+    def reset(self):
+        self.buffer = np.zeros(0, dtype=np.float64)
+
+    def __call__(self, wav):
+        """Extract features for complete frames.
+
+        Args:
+            wav (np.ndarray): `[n_samples]`, in the range of 16-bit integers
+        Returns:
+            xs (np.ndarray): `[T, n_mels]`
+
+        """
+        self.buffer = np.concatenate([self.buffer, np.asarray(wav, dtype=np.float64)])
+        n_frames = 0
+        if len(self.buffer) >= self.window_size:
+            n_frames = 1 + (len(self.buffer) - self.window_size) // self.window_shift
+        if n_frames == 0:
+            return np.zeros((0, self.banks.shape[1]), dtype=np.float32)
+
+        indices = np.arange(n_frames)[:, None] * self.window_shift + np.arange(self.window_size)
+        frames = self.buffer[indices]  # `[T, window_size]`
+        self.buffer = self.buffer[n_frames * self.window_shift:]
+
+        frames = frames - frames.mean(axis=1, keepdims=True)
+        frames = np.concatenate([frames[:, :1] * (1 - self.preemphasis),
+                                 frames[:, 1:] - self.preemphasis * frames[:, :-1]], axis=1)
+        power = np.abs(np.fft.rfft(frames * self.window, n=self.n_fft)) ** 2
+        xs = np.log(np.maximum(power[:, :self.n_fft // 2].dot(self.banks), np.finfo(np.float32).eps))
+
+        if self.cmvn is not None:
+            xs = (xs - self.cmvn[0]) / self.cmvn[1]
+        return xs.astype(np.float32)
@@ -9,6 +9,92 @@
 import torch
 
 
+def blank_frames(ctc_probs, blank, spike_threshold):
+    """Detect frames regarded as blank for CTC-based segmentation.
+
+    Args:
+        ctc_probs (FloatTensor): `[T, vocab]`
+        blank (int): index for <blank>
+        spike_threshold (float): non-blank frames whose posterior is less than
+            this are also regarded as blank
+    Returns:
+        is_blank (BoolTensor): `[T]`
+
+    """
+    max_probs, topk_ids = ctc_probs.max(-1)
+    return (topk_ids == blank) | (max_probs < spike_threshold)
+
+
+def count_successive_blanks(is_blank, n_blanks_prev=0):
+    """Count successive blank frames up to each frame.
+
+    Args:
+        is_blank (BoolTensor): `[T]`
+        n_blanks_prev (int): number of successive blank frames before the first frame
+    Returns:
+        n_blanks (LongTensor): `[T]`
+
+    """
+    t = torch.arange(is_blank.size(0), device=is_blank.device)
+    last_spike = torch.cummax(torch.where(is_blank, torch.full_like(t, -1), t), dim=0)[0]
+    return torch.where(last_spike >= 0, t - last_spike, t + 1 + n_blanks_prev)
+
+
+def ctc_segmentation(ctc_probs, blank, blank_threshold, spike_threshold, max_n_frames=0):
+    """Segment a long recording at successive blank frames in CTC posteriors.
+
+    Frames in runs of at least `blank_threshold` blank frames are regarded as
+    non-speech, and each speech region is extended into the surrounding
+    non-speech frames by half of `blank_threshold`. Segments longer than
+    `max_n_frames` are split at the frame following the longest run of blank
+    frames in their latter half.
+
+    Args:
+        ctc_probs (FloatTensor): `[T, vocab]`
+        blank (int): index for <blank>
+        blank_threshold (int): number of successive blank frames to segment
+        spike_threshold (float): non-blank frames whose posterior is less than
+            this are also regarded as blank
+        max_n_frames (int): maximum number of frames per segment (0 means unlimited)
+    Returns:
+        segments (LongTensor): `[N, 2]`, start and end (exclusive) frames of segments
+
+    """
+    xmax = ctc_probs.size(0)
+    is_blank = blank_frames(ctc_probs, blank, spike_threshold)
+    n_blanks = count_successive_blanks(is_blank)
+
+    # length of the run of blank frames each frame belongs to
+    is_end = is_blank.clone()
+    is_end[:-1] &= ~is_blank[1:]
+    t = torch.arange(xmax, device=ctc_probs.device)
+    run_end = torch.flip(torch.cummin(torch.flip(torch.where(is_end, t, torch.full_like(t, xmax)), [0]), dim=0)[0],
+                         [0]).clamp(max=xmax - 1)
+    run_len = torch.where(is_blank, n_blanks[run_end], torch.zeros_like(n_blanks))
+    is_speech = run_len < blank_threshold
+
+    is_start = is_speech.clone()
+    is_start[1:] &= ~is_speech[:-1]
+    is_last = is_speech.clone()
+    is_last[:-1] &= ~is_speech[1:]
+    margin = blank_threshold // 2
+    starts = (t[is_start] - margin).clamp(min=0)
+    ends = (t[is_last] + 1 + margin).clamp(max=xmax)
+    segments = torch.stack([starts, ends], dim=1)
+
+    if max_n_frames > 0:
+        segments_split = []
+        for start, end in segments.tolist():
+            while end - start > max_n_frames:
+                lo = start + max_n_frames // 2
+                boundary = lo + n_blanks[lo:start + max_n_frames].argmax().item() + 1
+                segments_split.append([start, boundary])
+                start = boundary
+            segments_split.append([start, end])
+        segments = segments.new_tensor(segments_split).view(-1, 2)
+    return segments
+
+
 class Streaming(object):
     """Streaming encoding interface."""
 
@@ -129,27 +215,21 @@ class Streaming(object):
                 is_reset = True
             return is_reset
 
-        n_blanks_tmp = self.n_blanks
-        for j in range(xmax_chunk):
-            if topk_ids_chunk[j] == self.blank:
-                self.n_blanks += 1
-                if stdout:
-                    print('CTC (T:%d): <blank>' % (self.offset + (j + 1) * self.factor))
+        is_blank = blank_frames(ctc_probs_chunk[0], self.blank, self.SPIKE_THRESHOLD)
+        n_blanks = count_successive_blanks(is_blank, self.n_blanks)  # `[T_chunk]`
+        if stdout:
+            for j in range(xmax_chunk):
+                token = '<blank>' if topk_ids_chunk[j] == self.blank else self.idx2token([topk_ids_chunk[j].item()])
+                print('CTC (T:%d): %s' % (self.offset + (j + 1) * self.factor, token))
 
-            else:
-                if ctc_probs_chunk[0, j, topk_ids_chunk[j]] < self.SPIKE_THRESHOLD:
-                    self.n_blanks += 1
-                else:
-                    self.n_blanks = 0
-                if stdout:
-                    print('CTC (T:%d): %s' % (self.offset + (j + 1) * self.factor,
-                                              self.idx2token([topk_ids_chunk[j].item()])))
-
-            # if not is_reset and (self.n_blanks * self.factor >= self.BLANK_THRESHOLD):# NOTE: select the leftmost blank offset
-            if self.n_blanks * self.factor >= self.BLANK_THRESHOLD:  # NOTE: select the rightmost blank offset
-                self.bd_offset = j
-                is_reset = True
-                n_blanks_tmp = self.n_blanks
+        # NOTE: select the rightmost blank offset
+        boundaries = (n_blanks * self.factor >= self.BLANK_THRESHOLD).nonzero(as_tuple=True)[0]
+        n_blanks_tmp = self.n_blanks
+        if len(boundaries) > 0:
+            self.bd_offset = boundaries[-1].item()
+            is_reset = True
+            n_blanks_tmp = n_blanks[self.bd_offset].item()
+        self.n_blanks = n_blanks[-1].item()
 
         if stdout and is_reset:
             print('--- Segment (%d >= %d) ---' % (n_blanks_tmp * self.factor, self.BLANK_THRESHOLD))
@@ -18,6 +18,7 @@ from neural_sp.models.base import ModelBase
 from neural_sp.models.lm.rnnlm import RNNLM
 from neural_sp.models.seq2seq.decoders.build import build_decoder
 from neural_sp.models.seq2seq.decoders.fwd_bwd_attention import fwd_bwd_attention
+from neural_sp.models.seq2seq.decoders.fwd_bwd_attention import fwd_bwd_beam_search
 from neural_sp.models.seq2seq.decoders.rnn_transducer import RNNTransducer
 from neural_sp.models.seq2seq.encoders.build import build_encoder
 from neural_sp.models.seq2seq.frontends.frame_stacking import stack_frame
@@ -91,6 +92,12 @@ class Speech2Text(ModelBase):
         # for discourse-aware model
         self.utt_id_prev = None
 
+        # cache of encoder outputs for decoding (set in the evaluation stage)
+        self.encoder_cache = None
+
+        # score components of N-best hypotheses in the last beam search
+        self.nbest_components = None
+
         # Feature extraction
         self.input_noise_std = args.input_noise_std
         self.n_stacks = args.n_stacks
@@ -406,6 +413,46 @@ class Speech2Text(ModelBase):
 
         return eout_dict
 
+    def encode_cached(self, xs, task, utt_ids):
+        """Encode acoustic features or load encoder outputs from the cache.
+
+        Args:
+            xs (list): A list of length `[B]`, which contains Tensor of size `[T, input_dim]`
+            task (str): ys*/ys_sub1*/ys_sub2*
+            utt_ids (list): name of utterances
+        Returns:
+            eout_dict (dict):
+
+        """
+        task_key = task.split('.')[0]
+        eouts, elens = self.encoder_cache.load(utt_ids, task_key, 'eout', self.device)
+        if eouts is None:
+            eout_dict = self.encode(xs, task)
+            self.encoder_cache.save(utt_ids, task_key, 'eout',
+                                    eout_dict[task_key]['xs'], eout_dict[task_key]['xlens'])
+            return eout_dict
+        return {task_key: {'xs': eouts, 'xlens': elens}}
+
+    def ctc_log_probs_cached(self, eout_dict_task, task, utt_ids, dec=None):
+        """Compute CTC log-probabilities or load them from the cache.
+
+        Args:
+            eout_dict_task (dict): encoder outputs for the task
+            task (str): ys*
+            utt_ids (list): name of utterances
+            dec (DecoderBase): decoder with the CTC layer (dec_fwd by default)
+        Returns:
+            ctc_log_probs (FloatTensor): `[B, T, vocab]`
+
+        """
+        task_key = task.split('.')[0]
+        ctc_log_probs, _ = self.encoder_cache.load(utt_ids, task_key, 'ctc', self.device)
+        if ctc_log_probs is None:
+            dec = self.dec_fwd if dec is None else dec
+            ctc_log_probs = dec.ctc_log_probs(eout_dict_task['xs'])
+            self.encoder_cache.save(utt_ids, task_key, 'ctc', ctc_log_probs, eout_dict_task['xlens'])
+        return ctc_log_probs
+
     def get_ctc_probs(self, xs, task='ys', temperature=1, topk=None):
         self.eval()
         with torch.no_grad():
@@ -453,7 +500,11 @@ class Speech2Text(ModelBase):
         assert self.input_type == 'speech'
         assert self.ctc_weight > 0
         assert self.fwd_weight > 0
-        assert len(xs) == 1  # batch size
+        if len(xs) > 1:
+            # decode utterances in a mini-batch as concurrent streams
+            from neural_sp.models.seq2seq.streaming_engine import StreamingEngine
+            engine = StreamingEngine(self, params, idx2token)
+            return engine.decode(xs), [None] * len(xs)
         # assert params['recog_length_norm']
         global_params = copy.deepcopy(params)
         global_params['recog_max_len_ratio'] = 1.0
@@ -585,6 +636,95 @@ class Speech2Text(ModelBase):
             else:
                 return [[]], [None]
 
+    def decode_long_form(self, xs, params, idx2token, exclude_eos=True, speakers=None, task='ys'):
+        """Decode long recordings by CTC-based segmentation and batched segment decoding.
+
+        Each recording is encoded by blocks of `recog_long_form_block_size` frames
+        in mini-batches to obtain CTC posteriors, and segmented at successive blank
+        frames (see ctc_segmentation). Segments of all recordings are sorted by
+        length and decoded by the offline decoder in mini-batches of
+        `recog_batch_size`. If decoder/LM states are carried over, segments are
+        instead decoded one by one in the chronological order of each recording.
+
+        Args:
+            xs (list): A list of length `[B]`, which contains arrays of size `[T, input_dim]`
+            params (dict): hyper-parameters for decoding
+            idx2token (): converter from index to token
+            exclude_eos (bool): exclude <eos> from best_hyps_id
+            speakers (list): recording (session) ids for state carry-over
+            task (str): ys* or ys_sub1* or ys_sub2*
+        Returns:
+            best_hyps_id (list): A list of length `[B]`, which contains arrays of size `[L]`
+                stitched over segments
+            segments (list): A list of length `[B]`, which contains arrays of size `[N_seg, 2]`
+                (start and end input frames of segments)
+
+        """
+        from neural_sp.models.seq2seq.frontends.streaming import ctc_segmentation
+
+        assert self.input_type == 'speech'
+        dec = getattr(self, 'dec_' + task.split('.')[0].replace('ys', 'fwd'))
+        assert getattr(dec, 'ctc_weight', 0) > 0
+        factor = self.enc.subsampling_factor * (self.n_skips if self.n_stacks > 1 else 1)
+        block_size = params.get('recog_long_form_block_size', 4000)
+        batch_size = max(1, params['recog_batch_size'])
+        assert block_size % factor == 0
+        carry_over = params['recog_asr_state_carry_over'] or params['recog_lm_state_carry_over']
+        assert not carry_over or speakers is not None
+
+        self.eval()
+        with torch.no_grad():
+            # Step 1. CTC posteriors of whole recordings by batches of blocks
+            blocks = [(b, t) for b, x in enumerate(xs) for t in range(0, len(x), block_size)]
+            ctc_probs = [[] for _ in xs]
+            for i in range(0, len(blocks), batch_size):
+                eout_dict = self.encode([xs[b][t:t + block_size] for b, t in blocks[i:i + batch_size]], task)
+                probs = dec.ctc_probs(eout_dict[task]['xs'])
+                for j, (b, _) in enumerate(blocks[i:i + batch_size]):
+                    ctc_probs[b].append(probs[j, :eout_dict[task]['xlens'][j]])
+
+            # Step 2. CTC-based segmentation
+            segments = []
+            for b in range(len(xs)):
+                if len(ctc_probs[b]) == 0:
+                    segments.append(np.zeros((0, 2), dtype=np.int64))
+                    continue
+                segments_b = ctc_segmentation(
+                    torch.cat(ctc_probs[b], dim=0), dec.blank,
+                    params['recog_ctc_vad_blank_threshold'] // factor,
+                    params['recog_ctc_vad_spike_threshold'],
+                    params.get('recog_long_form_max_segment_frames', 0) // factor)
+                segments.append(np.minimum(tensor2np(segments_b) * factor, len(xs[b])))
+            logger.debug('Long-form decoding: %d segments' % sum(len(s) for s in segments))
+
+            # Step 3. Decode segments in mini-batches
+            segs = [(b, n) for b in range(len(xs)) for n in range(len(segments[b]))]
+            if carry_over:
+                batches = [[seg] for seg in segs]
+            else:
+                segs = sorted(segs, key=lambda x: segments[x[0]][x[1], 0] - segments[x[0]][x[1], 1])
+                batches = [segs[i:i + batch_size] for i in range(0, len(segs), batch_size)]
+            hyps_seg = {}
+            for batch in batches:
+                xs_seg = [xs[b][segments[b][n, 0]:segments[b][n, 1]] for b, n in batch]
+                best_hyps_id, _ = self.decode(
+                    xs_seg, params, idx2token, exclude_eos=exclude_eos,
+                    speakers=[speakers[b] for b, _ in batch] if carry_over else None,
+                    task=task)
+                for (b, n), hyp in zip(batch, best_hyps_id):
+                    hyps_seg[(b, n)] = np.array(hyp, dtype=np.int64)
+
+        # Step 4. Stitch results
+        best_hyps_id = []
+        for b in range(len(xs)):
+            hyps_b = [hyps_seg[(b, n)] for n in range(len(segments[b]))]
+            if exclude_eos:
+                hyps_b = [h[:-1] if len(h) > 0 and h[-1] == self.eos else h for h in hyps_b]
+            best_hyps_id.append(np.concatenate(hyps_b) if len(hyps_b) > 0 else np.zeros(0, dtype=np.int64))
+        # NOTE: N-best lists of the last segment mini-batch do not correspond to recordings
+        self.nbest_components = None
+        return best_hyps_id, segments
+
     def streamable(self):
         return getattr(self.dec_fwd, 'streamable', False)
 
@@ -611,6 +751,9 @@ class Speech2Text(ModelBase):
                 lm_weight (float): the weight of RNNLM score
                 resolving_unk (bool): not used (to make compatible)
                 fwd_bwd_attention (bool):
+                ctc_blank_skip_threshold (float): skip frames whose CTC blank probability
+                    is larger than this before attention decoding (0 disables)
+                ctc_blank_skip_margin (int): number of context frames kept around non-blank frames
             idx2token (): converter from index to token
             exclude_eos (bool): exclude <eos> from best_hyps_id
             refs_id (list): gold token IDs to compute log likelihood
@@ -638,23 +781,45 @@ class Speech2Text(ModelBase):
                 self.reset_session()
             self.utt_id_prev = utt_ids[0]
 
+        self.nbest_components = None
         self.eval()
         with torch.no_grad():
             # Encode input features
-            if self.input_type == 'speech' and self.mtl_per_batch and 'bwd' in dir:
+            if self.encoder_cache is not None and utt_ids is not None:
+                eout_dict = self.encode_cached(xs, task, utt_ids)
+            elif self.input_type == 'speech' and self.mtl_per_batch and 'bwd' in dir:
                 eout_dict = self.encode(xs, task)
             else:
                 eout_dict = self.encode(xs, task)
 
+            ctc_only = (self.fwd_weight == 0 and self.bwd_weight == 0) or \
+                (self.ctc_weight > 0 and params['recog_ctc_weight'] == 1)
+
+            # Compress encoder outputs to non-blank frames before source attention
+            keep = None  # `[B, T]` frames kept by blank skipping
+            dec_ctc = self.dec_fwd if dir == 'bwd' else getattr(self, 'dec_' + dir)
+            if params.get('recog_ctc_blank_skip_threshold', 0) > 0 and not ctc_only and \
+                    getattr(dec_ctc, 'ctc_weight', 0) > 0 and not isinstance(dec_ctc, RNNTransducer):
+                xlens = eout_dict[task]['xlens']
+                eout_dict[task]['xs'], eout_dict[task]['xlens'], keep = dec_ctc.skip_blank_frames(
+                    eout_dict[task]['xs'], xlens,
+                    params['recog_ctc_blank_skip_threshold'], params.get('recog_ctc_blank_skip_margin', 1))
+                logger.debug('Blank skipping: %d/%d frames' % (eout_dict[task]['xlens'].sum(), xlens.sum()))
+
             # CTC
-            if (self.fwd_weight == 0 and self.bwd_weight == 0) or (self.ctc_weight > 0 and params['recog_ctc_weight'] == 1):
+            if ctc_only:
                 lm = getattr(self, 'lm_' + dir, None)
                 lm_second = getattr(self, 'lm_second', None)
                 lm_second_bwd = None  # TODO
 
+                ctc_log_probs = None
+                if self.encoder_cache is not None and utt_ids is not None:
+                    ctc_log_probs = self.ctc_log_probs_cached(eout_dict[task], task, utt_ids,
+                                                              dec=getattr(self, 'dec_' + dir))
                 best_hyps_id = getattr(self, 'dec_' + dir).decode_ctc(
                     eout_dict[task]['xs'], eout_dict[task]['xlens'], params, idx2token,
-                    lm, lm_second, lm_second_bwd, 1, refs_id, utt_ids, speakers)
+                    lm, lm_second, lm_second_bwd, 1, refs_id, utt_ids, speakers,
+                    log_probs=ctc_log_probs)
                 return best_hyps_id, None
 
             # Attention/RNN-T
@@ -664,28 +829,25 @@ class Speech2Text(ModelBase):
                     params['recog_max_len_ratio'], idx2token,
                     exclude_eos, refs_id, utt_ids, speakers)
             else:
-                assert params['recog_batch_size'] == 1
-
                 ctc_log_probs = None
                 if params['recog_ctc_weight'] > 0:
-                    ctc_log_probs = self.dec_fwd.ctc_log_probs(eout_dict[task]['xs'])
+                    if self.encoder_cache is not None and utt_ids is not None and keep is None:
+                        ctc_log_probs = self.ctc_log_probs_cached(eout_dict[task], task, utt_ids)
+                    else:
+                        ctc_log_probs = self.dec_fwd.ctc_log_probs(eout_dict[task]['xs'])
 
                 # forward-backward decoding
                 if params['recog_fwd_bwd_attention']:
                     lm_fwd = getattr(self, 'lm_fwd', None)
                     lm_bwd = getattr(self, 'lm_bwd', None)
 
-                    # forward decoder
-                    nbest_hyps_id_fwd, aws_fwd, scores_fwd = self.dec_fwd.beam_search(
-                        eout_dict[task]['xs'], eout_dict[task]['xlens'],
-                        params, idx2token, lm_fwd, None, lm_bwd, ctc_log_probs,
-                        params['recog_beam_width'], False, refs_id, utt_ids, speakers)
-
-                    # backward decoder
-                    nbest_hyps_id_bwd, aws_bwd, scores_bwd, _ = self.dec_bwd.beam_search(
-                        eout_dict[task]['xs'], eout_dict[task]['xlens'],
-                        params, idx2token, lm_bwd, None, lm_fwd, ctc_log_probs,
-                        params['recog_beam_width'], False, refs_id, utt_ids, speakers)
+                    # forward and backward decoders in lockstep
+                    (nbest_hyps_id_fwd, aws_fwd, _), (nbest_hyps_id_bwd, aws_bwd, _) = fwd_bwd_beam_search(
+                        self.dec_fwd, self.dec_bwd, eout_dict[task]['xs'], eout_dict[task]['xlens'],
+                        params, idx2token, lm_fwd, lm_bwd, ctc_log_probs,
+                        params['recog_beam_width'], refs_id, utt_ids, speakers)
+                    scores_fwd = self.dec_fwd.nbest_scores_att_cum
+                    scores_bwd = self.dec_bwd.nbest_scores_att_cum
 
                     # forward-backward attention
                     best_hyps_id = fwd_bwd_attention(
@@ -718,5 +880,9 @@ class Speech2Text(ModelBase):
                         1, exclude_eos, refs_id, utt_ids, speakers,
                         ensmbl_eouts, ensmbl_elens, ensmbl_decs)
                     best_hyps_id = [hyp[0] for hyp in nbest_hyps_id]
+                    self.nbest_components = getattr(getattr(self, 'dec_' + dir), 'nbest_components', None)
+
+            if keep is not None and aws is not None:
+                aws = dec_ctc.restore_skipped_frames(aws, keep)
 
             return best_hyps_id, aws
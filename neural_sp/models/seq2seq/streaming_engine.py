@@ -0,0 +1,403 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Batched streaming inference over multiple sessions."""
+
+from collections import OrderedDict
+import copy
+import logging
+import numpy as np
+import torch
+
+from neural_sp.models.seq2seq.decoders.rnn_transducer import RNNTransducer
+from neural_sp.models.seq2seq.frontends.streaming import Streaming
+
+logger = logging.getLogger(__name__)
+
+
+class StreamingSession(Streaming):
+    """State of an audio stream decoded by StreamingEngine.
+
+    Input features are appended by `feed` while the stream is active. Frames
+    before the current chunk (and its CNN context) are discarded after each step.
+
+    Args:
+        session_id (str): name of the session
+        params (dict): decoding hyper-parameters
+        encoder (EncoderBase): streaming encoder
+        idx2token (): converter from index to token
+
+    """
+
+    def __init__(self, session_id, params, encoder, idx2token, blank=0):
+        super(StreamingSession, self).__init__(None, params, encoder, idx2token)
+
+        self.session_id = session_id
+        self.is_final = False  # no more input features
+        self.is_done = False  # all input features are decoded
+        self.n_frames_trimmed = 0
+
+        # for the current chunk
+        self.x_chunk = None
+        self.is_last_chunk = False
+        self.is_reset = True  # for the first chunk
+
+        # caches carried over chunks
+        self.enc_cache = None
+        self.dec_state = None
+        self.hyps = None
+        self.ctc_prev = blank
+
+        self.best_hyp_id_stream = []
+        self.best_hyp_id_prefix = []
+        self.segment_ends = []  # indices of best_hyp_id_stream where segments end
+
+        # endpointing
+        self.max_segment_frames = 0
+        self.n_frames_segment = 0
+
+    def reset(self, stdout=False):
+        super(StreamingSession, self).reset(stdout)
+        self.n_frames_segment = 0
+
+    def feed(self, xs, is_final=False):
+        """Append input features.
+
+        Args:
+            xs (np.ndarray): `[T, input_dim]`
+            is_final (bool): the end of the stream
+
+        """
+        assert not self.is_final, 'Session %s has already been finalized.' % self.session_id
+        if xs is not None and len(xs) > 0:
+            self.x_whole = xs if self.x_whole is None else np.concatenate([self.x_whole, xs], axis=0)
+        self.is_final = is_final
+        if is_final and self.x_whole is None:
+            self.is_done = True  # empty stream
+
+    def is_ready(self):
+        """Whether the next chunk can be encoded.
+
+        Chunks except for the last one are encoded after all frames including
+        the lookahead ones are fed so that the result does not depend on how
+        input features are split.
+
+        """
+        if self.is_done or self.x_whole is None:
+            return False
+        if self.is_final:
+            return True
+        end = self.offset + (self.N_l + self.N_r) + self.conv_lookahead_n_frames
+        return end < len(self.x_whole)
+
+    def trim(self):
+        """Discard input features that are no longer necessary."""
+        n_frames = max(0, self.offset - self.conv_lookback_n_frames)
+        if n_frames > 0:
+            self.x_whole = self.x_whole[n_frames:]
+            self.offset -= n_frames
+            self.n_frames_trimmed += n_frames
+
+    def hyp(self):
+        """Return the best hypothesis so far.
+
+        Returns:
+            hyp (np.ndarray): `[L]`
+
+        """
+        return np.array(self.best_hyp_id_stream + self.best_hyp_id_prefix, dtype=np.int64)
+
+
+class StreamingEngine(object):
+    """Batched streaming inference over multiple sessions.
+
+    At each step, the next chunks of all sessions whose input features are
+    ready are encoded as a mini-batch, where the encoder caches of sessions are
+    batchfied along the batch dimension. Chunks of the same length and CNN
+    context are grouped into the same mini-batch. Encoder outputs are then
+    decoded per session by the chunk-synchronous beam search (MoChA), or per
+    mini-batch by CTC or RNN-T greedy decoding.
+
+    Args:
+        model (Speech2Text): ASR model with a streaming encoder
+        params (dict): decoding hyper-parameters
+        idx2token (): converter from index to token
+        max_batch_size (int): maximum number of chunks encoded in a step (0 means unlimited)
+        max_segment_frames (int): maximum number of input frames per segment (0 means unlimited)
+
+    """
+
+    def __init__(self, model, params, idx2token=None, max_batch_size=0, max_segment_frames=0):
+        assert model.input_type == 'speech'
+        assert model.fwd_weight > 0 or model.ctc_weight > 0
+
+        self.model = model
+        self.enc = model.enc
+        self.dec = model.dec_fwd
+        self.params = params
+        self.global_params = copy.deepcopy(params)
+        self.global_params['recog_max_len_ratio'] = 1.0
+        self.idx2token = idx2token
+        self.max_batch_size = max_batch_size
+        self.max_segment_frames = max_segment_frames
+
+        self.blank = 0
+        self.use_ctc = getattr(self.dec, 'ctc_weight', 0) > 0
+        self.ctc_only = (model.fwd_weight == 0 and model.bwd_weight == 0) or \
+            (model.ctc_weight > 0 and params['recog_ctc_weight'] == 1)
+        self.transducer = isinstance(self.dec, RNNTransducer) and not self.ctc_only
+        self.chunk_sync = params['recog_chunk_sync']
+        self.lm = getattr(model, 'lm_fwd', None)
+        self.lm_second = getattr(model, 'lm_second', None)
+
+        self.sessions = OrderedDict()
+        self.n_sessions = 0
+
+        self.model.eval()
+
+    def open(self, session_id=None):
+        """Start a new session.
+
+        Args:
+            session_id (str): name of the session
+        Returns:
+            session_id (str):
+
+        """
+        if session_id is None:
+            session_id = str(self.n_sessions)
+        assert session_id not in self.sessions, 'Session %s already exists.' % session_id
+        session = StreamingSession(session_id, self.params, self.enc, self.idx2token, self.blank)
+        session.is_ctc_vad = session.is_ctc_vad and self.use_ctc
+        session.max_segment_frames = self.max_segment_frames
+        self.sessions[session_id] = session
+        self.n_sessions += 1
+        return session_id
+
+    def feed(self, session_id, xs, is_final=False):
+        """Append input features to a session.
+
+        Args:
+            session_id (str): name of the session
+            xs (np.ndarray): `[T, input_dim]`
+            is_final (bool): the end of the stream
+
+        """
+        self.sessions[session_id].feed(xs, is_final)
+
+    def result(self, session_id):
+        """Return the best hypothesis of a session so far.
+
+        Args:
+            session_id (str): name of the session
+        Returns:
+            hyp (np.ndarray): `[L]`
+
+        """
+        return self.sessions[session_id].hyp()
+
+    def is_done(self, session_id):
+        return self.sessions[session_id].is_done
+
+    def close(self, session_id):
+        """Finish a session and return the best hypothesis.
+
+        Input features that have not been decoded yet are decoded before closing.
+
+        Args:
+            session_id (str): name of the session
+        Returns:
+            hyp (np.ndarray): `[L]`
+
+        """
+        session = self.sessions[session_id]
+        if not session.is_final:
+            session.feed(None, is_final=True)
+        while not session.is_done:
+            self._step([session])
+        del self.sessions[session_id]
+        return session.hyp()
+
+    def step(self):
+        """Encode and decode the next chunks of all ready sessions.
+
+        Returns:
+            session_ids (list): names of sessions advanced in this step
+
+        """
+        sessions = [s for s in self.sessions.values() if s.is_ready()]
+        if self.max_batch_size > 0:
+            sessions = sessions[:self.max_batch_size]
+        if len(sessions) == 0:
+            return []
+        self._step(sessions)
+        # sessions advanced in this step are served last in the next step
+        for s in sessions:
+            if s.session_id in self.sessions:
+                self.sessions.move_to_end(s.session_id)
+        return [s.session_id for s in sessions]
+
+    def decode(self, xs):
+        """Decode utterances as concurrent streams.
+
+        Args:
+            xs (list): A list of length `[B]`, which contains arrays of size `[T, input_dim]`
+        Returns:
+            best_hyps_id (list): A list of length `[B]`, which contains arrays of size `[L]`
+
+        """
+        session_ids = []
+        for x in xs:
+            session_id = self.open()
+            self.feed(session_id, x, is_final=True)
+            session_ids.append(session_id)
+        while len(self.step()) > 0:
+            pass
+        return [self.close(session_id) for session_id in session_ids]
+
+    def _step(self, sessions):
+        groups = OrderedDict()
+        for s in sessions:
+            s.x_chunk, is_last_chunk, lookback, lookahead = s.extract_feature()
+            s.is_last_chunk = is_last_chunk and s.is_final
+            key = (len(s.x_chunk), lookback, lookahead)
+            if key not in groups:
+                groups[key] = []
+            groups[key].append(s)
+
+        with torch.no_grad():
+            for (_, lookback, lookahead), group in groups.items():
+                self._step_group(group, lookback, lookahead)
+
+    def _step_group(self, group, lookback, lookahead):
+        """Advance sessions whose chunks have the same length and CNN context.
+
+        Args:
+            group (list): A list of StreamingSession
+            lookback (bool): truncate leftmost frames for lookback in CNN context
+            lookahead (bool): truncate rightmost frames for lookahead in CNN context
+
+        """
+        bs = len(group)
+
+        # Encode chunks of all sessions at once
+        self.enc.merge_cache([None if s.is_reset else s.enc_cache for s in group])
+        eouts = self.model.encode([s.x_chunk for s in group], 'ys',
+                                  streaming=True,
+                                  lookback=lookback,
+                                  lookahead=lookahead)['ys']['xs']
+        for s, cache in zip(group, self.enc.split_cache(bs)):
+            s.enc_cache = cache
+
+        ctc_probs = None
+        if self.use_ctc and (self.ctc_only or any(s.is_ctc_vad for s in group)):
+            ctc_probs = self.dec.ctc_probs(eouts)
+
+        # CTC-based VAD
+        elens = []
+        ctc_log_probs = [None] * bs
+        for b, s in enumerate(group):
+            s.is_reset = False
+            if s.is_ctc_vad:
+                if self.params['recog_ctc_weight'] > 0:
+                    ctc_log_probs[b] = torch.log(ctc_probs[b:b + 1])
+                s.is_reset = s.ctc_vad(ctc_probs[b:b + 1])
+            # Segment at the end of the chunk if the segment is too long
+            s.n_frames_segment += s.N_l
+            if not s.is_reset and 0 < s.max_segment_frames <= s.n_frames_segment:
+                s.bd_offset = -1
+                s.is_reset = True
+            # Truncate the most right frames
+            if s.is_reset and not s.is_last_chunk and s.bd_offset >= 0:
+                elens.append(s.bd_offset)
+            else:
+                elens.append(eouts.size(1))
+
+        # Decoding
+        if self.ctc_only:
+            best_paths = ctc_probs.argmax(-1).tolist()  # `[B, T]`
+            for b, s in enumerate(group):
+                for idx in best_paths[b][:elens[b]]:
+                    if idx != self.blank and idx != s.ctc_prev:
+                        s.best_hyp_id_stream.append(idx)
+                    s.ctc_prev = idx
+        elif self.transducer:
+            hyps, states = self.dec.greedy_chunk_sync(eouts, torch.IntTensor(elens),
+                                                      [s.dec_state for s in group])
+            for b, s in enumerate(group):
+                s.best_hyp_id_stream.extend(hyps[b])
+                s.dec_state = states[b]
+
+        is_attention = not (self.ctc_only or self.transducer)
+        for b, s in enumerate(group):
+            if is_attention:
+                self.dec.set_stream_state(s.dec_state)
+                self._decode_attention(s, eouts[b:b + 1, :elens[b]], ctc_log_probs[b])
+
+            if s.is_reset:
+                self._finalize_segment(s)
+            s.next_chunk()
+            if s.is_last_chunk:
+                self._finalize_segment(s)
+                s.is_done = True
+            else:
+                # next chunk will start from the frame next to the boundary
+                s.backoff(s.x_chunk, self.dec)
+                s.trim()
+            s.x_chunk = None
+
+            if is_attention:
+                s.dec_state = self.dec.get_stream_state()
+
+    def _decode_attention(self, s, eout_chunk, ctc_log_probs_chunk):
+        if not self.chunk_sync:
+            s.eout_chunks.append(eout_chunk)
+            return
+
+        # Chunk-synchronous attention decoding
+        end_hyps, s.hyps, _ = self.dec.beam_search_chunk_sync(
+            eout_chunk, self.params, self.idx2token, self.lm,
+            ctc_log_probs=ctc_log_probs_chunk, hyps=s.hyps,
+            state_carry_over=False,
+            ignore_eos=self.enc.enc_type in ['lstm', 'conv_lstm'])
+        merged_hyps = sorted(end_hyps + s.hyps, key=lambda x: x['score'], reverse=True)
+        if len(merged_hyps) == 0:
+            return
+        s.best_hyp_id_prefix = merged_hyps[0]['hyp'][1:]
+        if len(s.best_hyp_id_prefix) > 0 and s.best_hyp_id_prefix[-1] == self.dec.eos:
+            # reset beam if <eos> is generated from the best hypothesis
+            s.best_hyp_id_prefix = s.best_hyp_id_prefix[:-1]  # exclude <eos>
+            # Segmentation strategy 2:
+            # If <eos> is emitted from the decoder (not CTC),
+            # the current chunk is segmented.
+            if not s.is_reset:
+                s.bd_offset = eout_chunk.size(1) - 1
+                s.is_reset = True
+
+    def _finalize_segment(self, s):
+        """Commit the best hypothesis of the current segment and reset the session."""
+        if self.ctc_only:
+            s.ctc_prev = self.blank
+        elif self.transducer:
+            s.dec_state = None
+        elif self.chunk_sync:
+            s.best_hyp_id_stream.extend(s.best_hyp_id_prefix)
+            s.best_hyp_id_prefix = []
+        elif len(s.eout_chunks) > 0:
+            # Global decoding over the segmented region
+            eout = torch.cat(s.eout_chunks, dim=1)
+            elens = torch.IntTensor([eout.size(1)])
+            ctc_log_probs = None
+            if self.params['recog_ctc_weight'] > 0:
+                ctc_log_probs = torch.log(self.dec.ctc_probs(eout))
+            nbest_hyps_id = self.dec.beam_search(
+                eout, elens, self.global_params, self.idx2token, self.lm, self.lm_second,
+                ctc_log_probs=ctc_log_probs)[0]
+            s.best_hyp_id_stream.extend(nbest_hyps_id[0][0])
+        if len(s.best_hyp_id_stream) > (s.segment_ends[-1] if len(s.segment_ends) > 0 else 0):
+            s.segment_ends.append(len(s.best_hyp_id_stream))
+        s.reset()
+        s.hyps = None
@@ -0,0 +1,235 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2020 Kyoto University (Hirofumi Inaguma)
+#  Apache 2.0  (http://www.apache.org/licenses/LICENSE-2.0)
+
+"""Session-based streaming speech recognition API."""
+
+import copy
+import logging
+import numpy as np
+import time
+
+from neural_sp.models.seq2seq.frontends.fbank import Fbank
+from neural_sp.models.seq2seq.frontends.fbank import load_cmvn
+from neural_sp.models.seq2seq.streaming_engine import StreamingEngine
+
+logger = logging.getLogger(__name__)
+
+
+def common_prefix_length(hyps):
+    """Length of the longest common prefix of token sequences.
+
+    Args:
+        hyps (list): A list of token sequences
+    Returns:
+        n (int):
+
+    """
+    n = min(len(h) for h in hyps)
+    for i in range(n):
+        if any(h[i] != hyps[0][i] for h in hyps[1:]):
+            return i
+    return n
+
+
+class StreamingRecognizer(object):
+    """Session-based streaming speech recognition.
+
+    Input features (or waveforms) are pushed chunk by chunk to each session,
+    and chunks of all sessions are decoded in mini-batches by StreamingEngine.
+    Each push returns results of the session in the following form:
+
+        session_id (str): name of the session
+        segment (int): index of the segment in the session
+        hyp (np.ndarray): `[L]`, token indices in the segment
+        text (str): hyp converted by idx2token
+        n_stable (int): number of leading tokens in hyp that will not change
+        is_final (bool): the segment is finalized by endpointing
+
+    A partial result is returned whenever the hypothesis of the current segment
+    changes. In chunk-synchronous beam search, leading tokens shared by all
+    hypotheses in the beam are regarded as stable. Segments are finalized when
+    successive blank frames are detected by CTC, <eos> is emitted from the
+    decoder, a segment gets longer than `endpoint_max_segment_frames`, or the
+    session is closed.
+
+    Args:
+        model (Speech2Text): ASR model with a streaming encoder
+        params (dict): decoding hyper-parameters
+        idx2token (): converter from index to token
+        endpoint_blank_threshold (int): number of successive blank input frames
+            to finalize a segment. recog_ctc_vad_blank_threshold is used if None.
+        endpoint_max_segment_frames (int): maximum number of input frames per segment (0 means unlimited)
+        fbank_conf (dict): configuration of Fbank for waveform input
+        cmvn_path (str): path to global CMVN statistics for waveform input
+        max_batch_size (int): maximum number of chunks encoded in a step (0 means unlimited)
+
+    """
+
+    def __init__(self, model, params, idx2token=None,
+                 endpoint_blank_threshold=None, endpoint_max_segment_frames=0,
+                 fbank_conf=None, cmvn_path=None, max_batch_size=0):
+        params = copy.deepcopy(params)
+        if endpoint_blank_threshold is not None:
+            params['recog_ctc_vad'] = endpoint_blank_threshold > 0
+            if endpoint_blank_threshold > 0:
+                params['recog_ctc_vad_blank_threshold'] = endpoint_blank_threshold
+        self.engine = StreamingEngine(model, params, idx2token,
+                                      max_batch_size=max_batch_size,
+                                      max_segment_frames=endpoint_max_segment_frames)
+        self.idx2token = idx2token
+
+        self.fbank_conf = fbank_conf if fbank_conf is not None else {}
+        self.cmvn = load_cmvn(cmvn_path) if cmvn_path is not None else None
+
+        self.sessions = {}
+        self.stats = {}
+
+    def open(self, session_id=None):
+        """Start a new session.
+
+        Args:
+            session_id (str): name of the session
+        Returns:
+            session_id (str):
+
+        """
+        session_id = self.engine.open(session_id)
+        self.sessions[session_id] = {'fbank': None,
+                                     'n_segments': 0,
+                                     'hyp_prev': None,
+                                     'n_stable_prev': 0,
+                                     't_push': None}
+        self.stats[session_id] = {'n_frames': 0,
+                                  'n_segments': 0,
+                                  'first_token_frame': None,
+                                  'first_token_latency': None,
+                                  'finalization_latency': None}
+        return session_id
+
+    def push_features(self, session_id, xs, is_final=False):
+        """Push input features to a session.
+
+        Args:
+            session_id (str): name of the session
+            xs (np.ndarray): `[T, input_dim]`
+            is_final (bool): the end of the stream, which closes the session
+        Returns:
+            results (list): results of the session
+
+        """
+        state = self.sessions[session_id]
+        state['t_push'] = time.time()
+        if xs is not None:
+            self.stats[session_id]['n_frames'] += len(xs)
+        self.engine.feed(session_id, xs, is_final=is_final)
+        if is_final:
+            return self.close(session_id)
+        while len(self.engine.step()) > 0:
+            pass
+        return self._collect(session_id)
+
+    def push_waveform(self, session_id, wav, is_final=False):
+        """Push waveform samples to a session.
+
+        Args:
+            session_id (str): name of the session
+            wav (np.ndarray): `[n_samples]`, in the range of 16-bit integers
+            is_final (bool): the end of the stream, which closes the session
+        Returns:
+            results (list): results of the session
+
+        """
+        state = self.sessions[session_id]
+        if state['fbank'] is None:
+            state['fbank'] = Fbank(cmvn=self.cmvn, **self.fbank_conf)
+        return self.push_features(session_id, state['fbank'](wav), is_final=is_final)
+
+    def close(self, session_id):
+        """Decode the rest of a session and finish it.
+
+        Args:
+            session_id (str): name of the session
+        Returns:
+            results (list): results of the session, the last of which is final
+
+        """
+        state = self.sessions[session_id]
+        if state['t_push'] is None or not self.engine.sessions[session_id].is_final:
+            state['t_push'] = time.time()
+        session = self.engine.sessions[session_id]
+        self.engine.close(session_id)
+        results = self._collect(session_id, session=session, is_closed=True)
+        self.stats[session_id]['finalization_latency'] = time.time() - state['t_push']
+        del self.sessions[session_id]
+        return results
+
+    def latency(self, session_id):
+        """Return latency statistics of a session.
+
+        Returns:
+            stats (dict):
+                n_frames (int): number of input frames
+                n_segments (int): number of finalized segments
+                first_token_frame (int): number of input frames pushed before the first token is emitted
+                first_token_latency (float): time from the push to the emission of the first token [sec]
+                finalization_latency (float): time from the end of the stream to the final result [sec]
+
+        """
+        return self.stats[session_id]
+
+    def _result(self, session_id, hyp, n_stable, is_final):
+        state = self.sessions[session_id]
+        return {'session_id': session_id,
+                'segment': state['n_segments'],
+                'hyp': np.array(hyp, dtype=np.int64),
+                'text': self.idx2token(hyp) if self.idx2token is not None else None,
+                'n_stable': n_stable,
+                'is_final': is_final}
+
+    def _collect(self, session_id, session=None, is_closed=False):
+        """Collect final results of finished segments and a partial result of the current segment."""
+        state = self.sessions[session_id]
+        stats = self.stats[session_id]
+        s = self.engine.sessions[session_id] if session is None else session
+        results = []
+
+        if stats['first_token_latency'] is None and len(s.best_hyp_id_stream + s.best_hyp_id_prefix) > 0:
+            stats['first_token_frame'] = stats['n_frames']
+            stats['first_token_latency'] = time.time() - state['t_push']
+
+        # Finalized segments
+        start = s.segment_ends[state['n_segments'] - 1] if state['n_segments'] > 0 else 0
+        for end in s.segment_ends[state['n_segments']:]:
+            hyp = s.best_hyp_id_stream[start:end]
+            results.append(self._result(session_id, hyp, len(hyp), is_final=True))
+            state['n_segments'] += 1
+            state['hyp_prev'] = None
+            state['n_stable_prev'] = 0
+            start = end
+
+        hyp = s.best_hyp_id_stream[start:] + s.best_hyp_id_prefix
+        if is_closed:
+            # the last segment
+            if len(hyp) > 0 or state['n_segments'] == 0:
+                results.append(self._result(session_id, hyp, len(hyp), is_final=True))
+                state['n_segments'] += 1
+            stats['n_segments'] = state['n_segments']
+            return results
+        stats['n_segments'] = state['n_segments']
+
+        # Partial result of the current segment
+        if hyp != state['hyp_prev']:
+            n_stable = len(s.best_hyp_id_stream) - start
+            if self.engine.chunk_sync and s.hyps is not None and not (self.engine.ctc_only or self.engine.transducer):
+                n_stable += common_prefix_length([s.best_hyp_id_prefix] + [h['hyp'][1:] for h in s.hyps])
+            else:
+                n_stable += len(s.best_hyp_id_prefix)
+            if state['hyp_prev'] is not None and hyp[:state['n_stable_prev']] == state['hyp_prev'][:state['n_stable_prev']]:
+                n_stable = max(n_stable, state['n_stable_prev'])
+            results.append(self._result(session_id, hyp, n_stable, is_final=False))
+            state['hyp_prev'] = hyp
+            state['n_stable_prev'] = n_stable
+        return results
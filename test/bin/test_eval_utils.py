@@ -0,0 +1,132 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Test for sharded evaluation."""
+
+import codecs
+import numpy as np
+import os
+import pandas as pd
+import pytest
+
+from neural_sp.bin.eval_utils import _average_results
+from neural_sp.bin.eval_utils import _merge_nbest
+from neural_sp.bin.eval_utils import _merge_trn
+from neural_sp.bin.eval_utils import split_shards
+from neural_sp.evaluators.nbest import COMPONENTS
+from neural_sp.evaluators.nbest import load_nbest
+from neural_sp.evaluators.nbest import save_nbest
+
+
+def make_df():
+    # sessions are interleaved and index labels are not contiguous
+    sessions = ['A', 'B', 'A', 'C', 'B', 'A', 'D', 'C']
+    xlens = [100, 400, 300, 50, 200, 80, 500, 60]
+    return pd.DataFrame({'utt_id': ['%s-%d' % (s, i) for i, s in enumerate(sessions)],
+                         'session': sessions,
+                         'xlen': xlens},
+                        index=[10 + 2 * i for i in range(len(sessions))])
+
+
+@pytest.mark.parametrize("n_shards", [1, 2, 3, 8, 20])
+def test_split_shards(n_shards):
+    df = make_df()
+    shards = split_shards(df, n_shards)
+    assert len(shards) == min(n_shards, len(df))
+    # every utterance is assigned exactly once and the original order is kept
+    assert sorted(sum(shards, [])) == sorted(df.index)
+    for labels in shards:
+        assert labels == sorted(labels)
+    # balanced: no shard is longer than the ideal load plus the longest utterance
+    loads = [df.loc[labels, 'xlen'].sum() for labels in shards]
+    assert max(loads) <= df['xlen'].sum() / len(shards) + df['xlen'].max()
+    assert split_shards(df, n_shards) == shards  # deterministic
+
+
+@pytest.mark.parametrize("n_shards", [1, 2, 3, 8])
+def test_split_shards_by_session(n_shards):
+    df = make_df()
+    shards = split_shards(df, n_shards, by_session=True)
+    assert len(shards) == min(n_shards, df['session'].nunique())
+    assert sorted(sum(shards, [])) == sorted(df.index)
+    for session, utts in df.groupby('session'):
+        # all utterances of a session are in the same shard in the original order
+        shard = [labels for labels in shards if utts.index[0] in labels][0]
+        assert [i for i in shard if i in utts.index] == list(utts.index)
+    if n_shards == 2:
+        # A: 480, B: 600, C: 110, D: 500
+        assert [df.loc[labels, 'xlen'].sum() for labels in shards] == [710, 980]
+
+
+def write_trn(path, utt_ids, texts):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with codecs.open(path, 'w', encoding='utf-8') as f:
+        for utt_id, text in zip(utt_ids, texts):
+            f.write(text + ' (' + utt_id.split('-')[0].replace('-', '_') + '-' + utt_id + ')\n')
+
+
+def test_merge_trn(tmp_path):
+    df = make_df()
+    utt_ids = list(df['utt_id'])
+    shards = split_shards(df, 3, by_session=True)
+    shard_dirs = [str(tmp_path / ('shard' + str(k))) for k in range(len(shards))]
+    for shard_dir, labels in zip(shard_dirs, shards):
+        # decoding order in each shard may differ from the original order
+        ids = list(reversed(df.loc[labels, 'utt_id'].values))
+        write_trn(os.path.join(shard_dir, 'hyp.trn'), ids, ['hyp of ' + i for i in ids])
+
+    _merge_trn(shard_dirs, str(tmp_path), utt_ids, 'hyp.trn')
+    with codecs.open(str(tmp_path / 'hyp.trn'), 'r', encoding='utf-8') as f:
+        lines = f.readlines()
+    assert lines == ['hyp of %s (%s-%s)\n' % (i, i.split('-')[0], i) for i in utt_ids]
+
+
+def test_merge_nbest(tmp_path):
+    df = make_df()
+    utt_ids = list(df['utt_id'])
+    shards = split_shards(df, 3)
+    shard_dirs = [str(tmp_path / ('shard' + str(k))) for k in range(len(shards))]
+    for shard_dir, labels in zip(shard_dirs, shards):
+        os.makedirs(shard_dir)
+        ids = list(reversed(df.loc[labels, 'utt_id'].values))
+        hyps, hyp2utt = [], []
+        for n, utt_id in enumerate(ids):
+            for j in range(n % 3 + 1):
+                hyps.append('%s/%d' % (utt_id, j))
+                hyp2utt.append(n)
+        save_nbest(os.path.join(shard_dir, 'nbest.npz'),
+                   {'utt_ids': ids,
+                    'refs': ['ref of ' + i for i in ids],
+                    'hyps': hyps,
+                    'hyp2utt': hyp2utt,
+                    'scores': np.random.randn(len(hyps), len(COMPONENTS))})
+
+    _merge_nbest(shard_dirs, str(tmp_path), utt_ids)
+    nbest = load_nbest([str(tmp_path / 'nbest.npz')])
+    nbest_shards = load_nbest([os.path.join(d, 'nbest.npz') for d in shard_dirs])
+    assert list(nbest['utt_ids']) == utt_ids
+    assert list(nbest['refs']) == ['ref of ' + i for i in utt_ids]
+    for n, utt_id in enumerate(utt_ids):
+        # N-best lists are kept in the same order with scores
+        hyp_ids = np.where(nbest['hyp2utt'] == n)[0]
+        hyp_ids_shard = np.where(nbest_shards['utt_ids'][nbest_shards['hyp2utt']] == utt_id)[0]
+        assert list(nbest['hyps'][hyp_ids]) == ['%s/%d' % (utt_id, j) for j in range(len(hyp_ids))]
+        assert np.array_equal(nbest['scores'][hyp_ids], nbest_shards['scores'][hyp_ids_shard])
+
+
+def test_average_results():
+    # eval_word: (wer, cer, n_oov) with (n_word, n_char)
+    results = [(10., 5., 3), (40., 20., 1)]
+    n_tokens = [(30, 90), (10, 0)]
+    wer, cer, n_oov = _average_results(results, n_tokens)
+    assert wer == pytest.approx((10. * 30 + 40. * 10) / 40)
+    assert cer == pytest.approx(5.)  # CER is not computed in the second shard
+    assert n_oov == 4
+
+    # eval_phone: per with (n_phone,)
+    per = _average_results([10., 30.], [(1,), (3,)])
+    assert not isinstance(per, tuple)
+    assert per == pytest.approx(25.)
+
+    # no reference tokens
+    assert _average_results([(0., 0.)], [(0, 0)]) == (0., 0.)
@@ -5,13 +5,17 @@
 
 import argparse
 import importlib
+import logging
 import numpy as np
 import pytest
+import time
 import torch
 
 from neural_sp.models.torch_utils import np2tensor
 from neural_sp.models.torch_utils import pad_list
 
+logger = logging.getLogger(__name__)
+
 
 ENC_N_UNITS = 16
 VOCAB = 10
@@ -173,6 +177,82 @@ def test_forward(args):
     #                 assert not p.requires_grad
 
 
+def interval_latency_dense(aws):
+    """Interval latency loss with a `[T, T]` delay matrix."""
+    xmax = aws.size(-1)
+    aws_prev = torch.cat([aws.new_zeros(aws.size())[:, :, -1:], aws.clone()[:, :, :-1]], dim=2)
+    aws_mat = aws_prev.unsqueeze(3) * aws.unsqueeze(4)  # `[B, H, L, T, T]`
+    delay_mat = aws.new_ones(xmax, xmax)
+    delay_mat = torch.tril(delay_mat, diagonal=-1, out=delay_mat)
+    delay_mat = torch.cumsum(delay_mat, dim=-2).unsqueeze(0)
+    delay_mat = delay_mat.unsqueeze(1).unsqueeze(2).expand_as(aws_mat)
+    loss_latency = torch.pow((aws_mat * delay_mat).sum(-1), 2).sum(-1)
+    return torch.mean(loss_latency)
+
+
+@pytest.mark.parametrize(
+    "n_heads",
+    [1, 4]
+)
+def test_interval_latency(n_heads):
+    batch_size = 4
+    ymax = 6
+    emax = 40
+
+    module = importlib.import_module('neural_sp.models.criterion')
+    logits = torch.randn(batch_size, n_heads, ymax, emax, dtype=torch.float64, requires_grad=True)
+    aws = torch.softmax(logits, dim=-1)
+    loss = module.interval_latency(aws)
+    grad, = torch.autograd.grad(loss, logits, retain_graph=True)
+    loss_ref = interval_latency_dense(aws)
+    grad_ref, = torch.autograd.grad(loss_ref, logits)
+    assert torch.allclose(loss, loss_ref)
+    assert torch.allclose(grad, grad_ref)
+
+    # decoder with multi-head monotonic attention
+    args = make_args(attn_type='mocha', mocha_chunk_size=4, mocha_n_heads_mono=n_heads,
+                     latency_metric='interval', latency_loss_weight=1.0)
+    eouts = torch.randn(batch_size, emax, ENC_N_UNITS)
+    elens = torch.IntTensor([emax] * batch_size)
+    ys = [np.random.randint(4, VOCAB, ylen).astype(np.int32) for ylen in [4, 5, 3, 5]]
+    module = importlib.import_module('neural_sp.models.seq2seq.decoders.las')
+    dec = module.RNNDecoder(**args)
+    loss, observation = dec(eouts, elens, ys, task='all')
+    assert observation['loss_latency'] >= 0
+    loss.backward()
+
+
+@pytest.mark.parametrize(
+    "mbr_nbest_type",
+    ['beam', 'sampling']
+)
+def test_forward_mbr(mbr_nbest_type):
+    args = make_args(mbr_training=True)
+    params = make_decode_params(recog_beam_width=2, mbr_nbest_type=mbr_nbest_type)
+
+    batch_size = 4
+    emax = 40
+    device = "cpu"
+
+    eouts = np.random.randn(batch_size, emax, ENC_N_UNITS).astype(np.float32)
+    elens = torch.IntTensor([len(x) for x in eouts])
+    eouts = pad_list([np2tensor(x, device).float() for x in eouts], 0.)
+    ylens = [4, 5, 3, 7]
+    ys = [np.random.randint(4, VOCAB, ylen).astype(np.int32) for ylen in ylens]
+
+    module = importlib.import_module('neural_sp.models.seq2seq.decoders.las')
+    dec = module.RNNDecoder(**args)
+    dec = dec.to(device)
+
+    loss, observation = dec(eouts, elens, ys, task='all', recog_params=params)
+    assert loss.dim() == 1
+    assert loss.size(0) == 1
+    assert observation['loss_mbr'] >= 0
+    assert dec.training
+    loss.backward()
+    assert dec.output.weight.grad is not None
+
+
 def make_decode_params(**kwargs):
     args = dict(
         recog_batch_size=1,
@@ -247,6 +327,7 @@ def make_args_rnnlm(**kwargs):
         (False, '', {'recog_coverage_penalty': 0.1, 'recog_gnmt_decoding': True}),
         # shallow fusion
         (False, '', {'recog_beam_width': 4, 'recog_lm_weight': 0.1}),
+        (False, '', {'recog_beam_width': 4, 'recog_lm_weight': 0.1, 'recog_lm_shortlist': 4}),
         # cold fusion
         (False, 'cold', {'recog_beam_width': 4}),
         (False, 'cold', {'recog_beam_width': 4, 'recog_lm_weight': 0.1}),
@@ -355,6 +436,9 @@ def test_decoding(backward, lm_fusion, params):
             assert isinstance(scores, list)
             assert len(scores) == batch_size
             assert len(scores[0]) == params['nbest']
+            assert len(dec.nbest_components) == batch_size
+            assert len(dec.nbest_components[0]) >= params['nbest']
+            assert dec.nbest_components[0][0]['length'] >= len(dec.nbest_components[0][0]['hyp'])
 
             # ensemble
             ensmbl_eouts, ensmbl_elens, ensmbl_decs = [], [], []
@@ -381,3 +465,657 @@ def test_decoding(backward, lm_fusion, params):
             assert isinstance(scores, list)
             assert len(scores) == batch_size
             assert len(scores[0]) == params['nbest']
+
+
+def test_lm_state_cache():
+    args = make_args()
+    params = make_decode_params(recog_beam_width=4, recog_lm_weight=0.5, nbest=4)
+
+    batch_size = 2
+    emax = 40
+    device = "cpu"
+
+    eouts = np.random.randn(batch_size, emax, ENC_N_UNITS).astype(np.float32)
+    elens = torch.IntTensor([len(x) for x in eouts])
+    eouts = pad_list([np2tensor(x, device).float() for x in eouts], 0.)
+
+    module_rnnlm = importlib.import_module('neural_sp.models.lm.rnnlm')
+    lm = module_rnnlm.RNNLM(make_args_rnnlm()).to(device)
+
+    module = importlib.import_module('neural_sp.models.seq2seq.decoders.las')
+    dec = module.RNNDecoder(**args)
+    dec = dec.to(device)
+
+    dec.eval()
+    with torch.no_grad():
+        out = dec.beam_search(eouts, elens, params, lm=lm, nbest=params['nbest'])
+        assert getattr(dec, 'lm_cache', None) is None
+
+        params['recog_lm_cache_size'] = 1000
+        for _ in range(2):
+            out_cache = dec.beam_search(eouts, elens, params, lm=lm, nbest=params['nbest'])
+            for b in range(batch_size):
+                for n in range(params['nbest']):
+                    assert np.array_equal(out[0][b][n], out_cache[0][b][n])
+                    assert abs(out[2][b][n] - out_cache[2][b][n]) < 1e-4
+        # the second pass hits the cache for all prefixes
+        assert dec.lm_cache.hit_rate >= 0.5
+        assert len(dec.lm_cache) <= 1000
+
+
+def test_decoding_wordlm(tmp_path):
+    args = make_args()
+    params = make_decode_params(recog_beam_width=4, recog_lm_weight=0.5, nbest=4)
+
+    batch_size = 2
+    emax = 40
+    device = "cpu"
+
+    eouts = np.random.randn(batch_size, emax, ENC_N_UNITS).astype(np.float32)
+    elens = torch.IntTensor([len(x) for x in eouts])
+    eouts = pad_list([np2tensor(x, device).float() for x in eouts], 0.)
+
+    # character ASR and word LM
+    words = ['a', 'cat', 'do', 'dot', 'to']
+    for path, tokens in [(tmp_path / 'dict.txt', ['<space>', 'a', 'c', 'd', 'o', 't']),
+                         (tmp_path / 'dict_word.txt', words)]:
+        with open(path, 'w') as f:
+            f.write('<unk> 1\n<eos> 2\n<pad> 3\n')
+            for i, t in enumerate(tokens):
+                f.write('%s %d\n' % (t, i + 4))
+    module_build = importlib.import_module('neural_sp.models.lm.build')
+    lm = module_build.build_lm(make_args_rnnlm(vocab=4 + len(words)), wordlm=True,
+                               lm_dict_path=str(tmp_path / 'dict_word.txt'),
+                               asr_dict_path=str(tmp_path / 'dict.txt'))
+    assert lm.vocab == VOCAB
+
+    module = importlib.import_module('neural_sp.models.seq2seq.decoders.las')
+    dec = module.RNNDecoder(**args)
+    dec = dec.to(device)
+
+    dec.eval()
+    with torch.no_grad():
+        out = dec.beam_search(eouts, elens, params, lm=lm, nbest=params['nbest'])
+        params['recog_lm_cache_size'] = 1000
+        out_cache = dec.beam_search(eouts, elens, params, lm=lm, nbest=params['nbest'])
+        for b in range(batch_size):
+            for n in range(params['nbest']):
+                assert np.array_equal(out[0][b][n], out_cache[0][b][n])
+                assert abs(out[2][b][n] - out_cache[2][b][n]) < 1e-4
+
+
+def test_decoding_ngram(tmp_path):
+    args = make_args()
+    params = make_decode_params(recog_beam_width=4, recog_lm_weight=0.5,
+                                recog_lm_second_weight=0.5, nbest=4)
+
+    batch_size = 2
+    emax = 40
+    device = "cpu"
+
+    eouts = np.random.randn(batch_size, emax, ENC_N_UNITS).astype(np.float32)
+    elens = torch.IntTensor([len(x) for x in eouts])
+    eouts = pad_list([np2tensor(x, device).float() for x in eouts], 0.)
+
+    # bigram LM over all tokens
+    tokens = ['t%d' % i for i in range(4, VOCAB)]
+    with open(tmp_path / 'dict.txt', 'w') as f:
+        f.write('<unk> 1\n<eos> 2\n<pad> 3\n')
+        for i, t in enumerate(tokens):
+            f.write('%s %d\n' % (t, i + 4))
+    rng = np.random.RandomState(0)
+    with open(tmp_path / 'lm.arpa', 'w') as f:
+        f.write('\\data\\\nngram 1=%d\nngram 2=%d\n\n\\1-grams:\n' % (len(tokens) + 3, len(tokens) ** 2))
+        for t in ['<unk>', '<s>', '</s>'] + tokens:
+            f.write('%.4f %s %.4f\n' % (-rng.rand() - 1, t, -rng.rand()))
+        f.write('\n\\2-grams:\n')
+        for t1 in tokens:
+            for t2 in tokens:
+                f.write('%.4f %s %s\n' % (-rng.rand(), t1, t2))
+        f.write('\n\\end\\\n')
+    module_ngram = importlib.import_module('neural_sp.models.lm.ngram')
+    lm = module_ngram.NgramLM(str(tmp_path / 'lm.arpa'), str(tmp_path / 'dict.txt'))
+
+    module = importlib.import_module('neural_sp.models.seq2seq.decoders.las')
+    dec = module.RNNDecoder(**args)
+    dec = dec.to(device)
+
+    dec.eval()
+    with torch.no_grad():
+        out = dec.beam_search(eouts, elens, params, lm=lm, lm_second=lm, nbest=params['nbest'])
+        params['recog_lm_shortlist'] = 4
+        out_shortlist = dec.beam_search(eouts, elens, params, lm=lm, lm_second=lm, nbest=params['nbest'])
+        for b in range(batch_size):
+            for n in range(params['nbest']):
+                assert np.array_equal(out[0][b][n], out_shortlist[0][b][n])
+                assert abs(out[2][b][n] - out_shortlist[2][b][n]) < 1e-4
+
+
+def fwd_bwd_attention_loop(nbest_fwd, aws_fwd, scores_fwd, nbest_bwd, aws_bwd, scores_bwd, eos):
+    """Forward-backward attention decoding for a single utterance by loops over pairs."""
+    max_time = aws_fwd[0].shape[-1]
+    candidates = []
+    for hyp, scores in zip(nbest_fwd, scores_fwd):
+        n_tokens = len(hyp) - int(len(hyp) > 0 and hyp[-1] == eos)
+        if n_tokens > 0:
+            candidates.append((scores[n_tokens - 1], list(hyp[:n_tokens])))
+    for hyp, scores in zip(nbest_bwd, scores_bwd):
+        offset = int(len(hyp) > 0 and hyp[0] == eos)
+        if len(hyp) > offset:
+            candidates.append((scores[offset], list(hyp[offset:])))
+    for hyp_f, aw_f, s_f in zip(nbest_fwd, aws_fwd, scores_fwd):
+        for hyp_b, aw_b, s_b in zip(nbest_bwd, aws_bwd, scores_bwd):
+            t_f = aw_f.mean(0).argmax(-1)
+            t_b = aw_b.mean(0).argmax(-1)
+            for i_f in range(len(hyp_f)):
+                for i_b in range(len(hyp_b)):
+                    if hyp_f[i_f] != hyp_b[i_b] or hyp_f[i_f] == eos:
+                        continue
+                    t_prev = t_b[i_b - 1] if i_b > 0 else 0
+                    t_next = t_b[i_b + 1] if i_b < len(hyp_b) - 1 else max_time - 1
+                    if not (t_prev <= t_f[i_f] <= t_next):
+                        continue
+                    s_f_prev = s_f[i_f - 1] if i_f > 0 else 0.
+                    s_b_next = s_b[i_b + 1] if i_b < len(hyp_b) - 1 else 0.
+                    score = s_f_prev + s_b_next + max(s_f[i_f] - s_f_prev, s_b[i_b] - s_b_next)
+                    candidates.append((score, list(hyp_f[:i_f + 1]) + list(hyp_b[i_b + 1:])))
+    return max(candidates, key=lambda x: x[0])
+
+
+def test_decoding_fwd_bwd_attention():
+    params = make_decode_params(recog_beam_width=4, nbest=4)
+
+    batch_size = 2
+    emax = 40
+    device = "cpu"
+
+    eouts = np.random.randn(batch_size, emax, ENC_N_UNITS).astype(np.float32)
+    elens = torch.IntTensor([len(x) for x in eouts])
+    eouts = pad_list([np2tensor(x, device).float() for x in eouts], 0.)
+
+    module = importlib.import_module('neural_sp.models.seq2seq.decoders.las')
+    dec_fwd = module.RNNDecoder(**make_args())
+    dec_bwd = module.RNNDecoder(**make_args(backward=True))
+    dec_fwd.eval()
+    dec_bwd.eval()
+    with torch.no_grad():
+        nbest_fwd, aws_fwd, scores = dec_fwd.beam_search(eouts, elens, params, nbest=params['nbest'])
+        nbest_bwd, aws_bwd, _ = dec_bwd.beam_search(eouts, elens, params, nbest=params['nbest'])
+    scores_fwd = dec_fwd.nbest_scores_att_cum
+    scores_bwd = dec_bwd.nbest_scores_att_cum
+    for b in range(batch_size):
+        for n in range(params['nbest']):
+            assert len(scores_fwd[b][n]) == len(nbest_fwd[b][n])
+            assert len(scores_bwd[b][n]) == len(nbest_bwd[b][n])
+            assert abs(scores_fwd[b][n][-1] - scores[b][n]) < 1e-4
+
+    module_fwd_bwd = importlib.import_module('neural_sp.models.seq2seq.decoders.fwd_bwd_attention')
+    best_hyps = module_fwd_bwd.fwd_bwd_attention(nbest_fwd, aws_fwd, scores_fwd,
+                                                 nbest_bwd, aws_bwd, scores_bwd,
+                                                 dec_fwd.eos, False, 0., None, None)
+    assert len(best_hyps) == batch_size
+    for b in range(batch_size):
+        _, hyp_ref = fwd_bwd_attention_loop(nbest_fwd[b], aws_fwd[b], scores_fwd[b],
+                                            nbest_bwd[b], aws_bwd[b], scores_bwd[b], dec_fwd.eos)
+        assert best_hyps[b].tolist() == hyp_ref
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ({}),
+        ({'attn_type': 'add', 'n_projs': 8}),
+        ({'attn_type': 'dot', 'n_layers': 1}),
+        ({'attn_type': 'luong_general'}),
+        ({'attn_type': 'add', 'attn_n_heads': 4}),
+        ({'rnn_type': 'gru'}),
+    ]
+)
+def test_stacked_decoder_step(args):
+    emax = 40
+    n_hyps = [4, 3]
+
+    module = importlib.import_module('neural_sp.models.seq2seq.decoders.las')
+    dec_fwd = module.RNNDecoder(**make_args(**args))
+    dec_bwd = module.RNNDecoder(**make_args(backward=True, **args))
+    decs = [dec_fwd, dec_bwd]
+    for dec in decs:
+        dec.eval()
+
+    module_fwd_bwd = importlib.import_module('neural_sp.models.seq2seq.decoders.fwd_bwd_attention')
+    assert module_fwd_bwd.StackedRNNDecoderStep.is_supported(decs)
+    stacked_step = module_fwd_bwd.StackedRNNDecoderStep(decs)
+
+    eouts = torch.randn(1, emax, ENC_N_UNITS)
+    requests = []
+    for dec, n in zip(decs, n_hyps):
+        hxs = torch.randn(dec.n_layers, n, dec.dec_n_units)
+        cxs = torch.randn(dec.n_layers, n, dec.dec_n_units) if dec.rnn_type == 'lstm' else None
+        cv = torch.randn(n, 1, ENC_N_UNITS)
+        y = torch.randint(0, VOCAB, (n, 1))
+        aw = torch.softmax(torch.randn(n, dec.score.n_heads, 1, emax), dim=-1)
+        requests.append((0, 1, eouts, {'dstate': (hxs, cxs)}, cv, y, aw, None, True))
+
+    with torch.no_grad():
+        # two steps to use cached keys of attention
+        for i in range(2):
+            responses = stacked_step(0, *requests)
+            for d, dec in enumerate(decs):
+                if i == 0:
+                    dec.score.reset()
+                dstates_ref, cv_ref, aw_ref, attn_v_ref, logits_ref = dec.beam_search_step(*requests[d][2:])
+                dstates, cv, aw, attn_v, logits = responses[d]
+                assert cv.size() == cv_ref.size()
+                assert torch.allclose(dstates['dstate'][0], dstates_ref['dstate'][0], atol=1e-6)
+                if dec.rnn_type == 'lstm':
+                    assert torch.allclose(dstates['dstate'][1], dstates_ref['dstate'][1], atol=1e-6)
+                else:
+                    assert dstates['dstate'][1] is None
+                assert torch.allclose(cv, cv_ref, atol=1e-6)
+                assert torch.allclose(aw, aw_ref, atol=1e-6)
+                assert torch.allclose(attn_v, attn_v_ref, atol=1e-6)
+                assert torch.allclose(logits, logits_ref, atol=1e-5)
+                requests[d] = (0, 2, eouts, dstates, cv, requests[d][5], aw, None, True)
+
+
+@pytest.mark.parametrize(
+    "args, params",
+    [
+        ({}, {}),
+        ({'attn_type': 'add', 'n_projs': 8}, {}),
+        ({'attn_type': 'add', 'attn_n_heads': 4}, {}),
+        ({'ctc_weight': 0.5}, {'recog_ctc_weight': 0.5}),
+    ]
+)
+def test_fwd_bwd_beam_search(monkeypatch, args, params):
+    params = make_decode_params(recog_beam_width=4, nbest=4, **params)
+
+    batch_size = 3
+    emax = 40
+    device = "cpu"
+
+    eouts = np.random.randn(batch_size, emax, ENC_N_UNITS).astype(np.float32)
+    elens = torch.IntTensor([emax, emax - 15, emax - 7])
+    eouts = pad_list([np2tensor(x, device).float() for x in eouts], 0.)
+
+    module = importlib.import_module('neural_sp.models.seq2seq.decoders.las')
+    dec_fwd = module.RNNDecoder(**make_args(**args))
+    dec_bwd = module.RNNDecoder(**make_args(backward=True, **args))
+    for dec in [dec_fwd, dec_bwd]:
+        dec.eval()
+        # NOTE: hypotheses of untrained decoders with the default initialization
+        # have nearly tied scores, which makes beam search sensitive to rounding errors
+        for p in dec.parameters():
+            torch.nn.init.normal_(p, std=0.5)
+    ctc_log_probs = None
+    if params['recog_ctc_weight'] > 0:
+        ctc_log_probs = dec_fwd.ctc_log_probs(eouts)
+
+    with torch.no_grad():
+        outs_ref = [dec.beam_search(eouts, elens, params, None, None, None, None, ctc_log_probs, params['nbest'])
+                    for dec in [dec_fwd, dec_bwd]]
+        scores_ref = [dec_fwd.nbest_scores_att_cum, dec_bwd.nbest_scores_att_cum]
+
+        module_fwd_bwd = importlib.import_module('neural_sp.models.seq2seq.decoders.fwd_bwd_attention')
+        n_steps = {'stacked': 0}
+        stacked_call = module_fwd_bwd.StackedRNNDecoderStep.__call__
+
+        def stacked_spy(self, *args):
+            n_steps['stacked'] += 1
+            return stacked_call(self, *args)
+        monkeypatch.setattr(module_fwd_bwd.StackedRNNDecoderStep, '__call__', stacked_spy)
+
+        outs = module_fwd_bwd.fwd_bwd_beam_search(dec_fwd, dec_bwd, eouts, elens, params, None,
+                                                  None, None, ctc_log_probs, params['nbest'], stacked=True)
+        scores = [dec_fwd.nbest_scores_att_cum, dec_bwd.nbest_scores_att_cum]
+
+    # decoder steps are shared by both directions until either one finishes an utterance
+    assert n_steps['stacked'] > 0
+    for d in range(2):
+        nbest_hyps_ref, aws_ref, scores_total_ref = outs_ref[d]
+        nbest_hyps, aws, scores_total = outs[d]
+        for b in range(batch_size):
+            assert len(nbest_hyps[b]) == len(nbest_hyps_ref[b])
+            for n in range(len(nbest_hyps[b])):
+                # NOTE: hypotheses with tied scores can be ranked in a different order
+                n_ref = [m for m, hyp_ref in enumerate(nbest_hyps_ref[b]) if np.array_equal(nbest_hyps[b][n], hyp_ref)]
+                assert len(n_ref) > 0
+                assert np.isclose(scores_total[b][n], scores_total_ref[b][n_ref[0]], rtol=1e-4, atol=1e-4)
+                assert np.allclose(aws[b][n], aws_ref[b][n_ref[0]], atol=1e-4)
+                assert np.allclose(scores[d][b][n], scores_ref[d][b][n_ref[0]], rtol=1e-4, atol=1e-4)
+
+
+def trigger_points_loop(best_paths, elens, blank):
+    """Left-most frames of tokens in CTC best paths by loops over frames."""
+    hyps = []
+    for b in range(len(elens)):
+        hyps.append([t for t in range(elens[b])
+                     if best_paths[b][t] != blank and (t == 0 or best_paths[b][t] != best_paths[b][t - 1])])
+    ymax = max(len(h) for h in hyps)
+    return [h + [elens[b] - 1] * (ymax + 1 - len(h)) for b, h in enumerate(hyps)]
+
+
+class FixedLogits(torch.nn.Module):
+    def __init__(self, logits):
+        super().__init__()
+        self.logits = logits
+
+    def forward(self, xs):
+        return self.logits
+
+
+@pytest.mark.parametrize("triggered_attn_key_projection", [False, True])
+def test_decoding_triggered_attention(triggered_attn_key_projection):
+    batch_size = 4
+    emax = 40
+    device = "cpu"
+
+    eouts = torch.randn(batch_size, emax, ENC_N_UNITS)
+    elens = torch.IntTensor([40, 33, 12, 1])
+    eouts = eouts.masked_fill((torch.arange(emax).unsqueeze(0) >= elens.unsqueeze(1)).unsqueeze(2), 0.)
+
+    module = importlib.import_module('neural_sp.models.seq2seq.decoders.las')
+    dec = module.RNNDecoder(**make_args(attn_type='triggered_attention', ctc_weight=0.5,
+                                        triggered_attn_key_projection=triggered_attn_key_projection))
+    dec = dec.to(device)
+    dec.eval()
+    with torch.no_grad():
+        best_paths = dec.ctc.output(eouts).argmax(-1).tolist()
+        # a repeated token after a blank is another trigger
+        best_paths[0][:4] = [5, 0, 5, 5]
+        best_paths_t = torch.tensor(best_paths)
+        dec.ctc.output = FixedLogits(torch.nn.functional.one_hot(best_paths_t, VOCAB).float())
+        trigger_points = dec.ctc.trigger_points(eouts, elens)
+        assert trigger_points.dtype == torch.int32
+        assert trigger_points.tolist() == trigger_points_loop(best_paths, elens.tolist(), dec.blank)
+
+        hyps, aws = dec.greedy(eouts, elens, max_len_ratio=1.0, idx2token=None,
+                               refs_id=None, utt_ids=None, speakers=None)
+    assert len(hyps) == batch_size
+    for b in range(batch_size):
+        for i in range(len(hyps[b])):
+            j = min(i, trigger_points.size(1) - 1)
+            boundary = trigger_points[b, j].item() + dec.score.lookahead + 1
+            assert aws[b][:, i, boundary:].sum() == 0
+
+
+def skip_blank_frames_loop(eouts, elens, blank_probs, threshold, margin):
+    """Kept frames for blank skipping by loops over frames."""
+    eouts_skip = []
+    for b in range(len(elens)):
+        keep = [t for t in range(elens[b])
+                if any(blank_probs[b][s] < threshold for s in range(max(0, t - margin), min(elens[b], t + margin + 1)))]
+        eouts_skip.append(eouts[b, keep if len(keep) > 0 else [0]])
+    return eouts_skip
+
+
+@pytest.mark.parametrize(
+    "margin",
+    [0, 2]
+)
+def test_skip_blank_frames(margin):
+    params = make_decode_params(recog_beam_width=2, recog_ctc_weight=0.1)
+
+    batch_size = 4
+    emax = 200
+    device = "cpu"
+
+    eouts = torch.randn(batch_size, emax, ENC_N_UNITS)
+    elens = torch.IntTensor([200, 150, 60, 10])
+
+    module = importlib.import_module('neural_sp.models.seq2seq.decoders.las')
+    dec = module.RNNDecoder(**make_args(ctc_weight=0.5))
+    dec = dec.to(device)
+    dec.eval()
+
+    # blank-dominant CTC posteriors with sparse spikes
+    logits = torch.randn(batch_size, emax, VOCAB)
+    logits[:, :, dec.blank] += 8.
+    logits[:, ::20, dec.blank] -= 16.
+    logits[3, :, dec.blank] += 16.  # all blank
+    output = dec.ctc.output
+    dec.ctc.output = FixedLogits(logits)
+    blank_probs = torch.softmax(logits, dim=-1)[:, :, dec.blank].tolist()
+
+    with torch.no_grad():
+        eouts_skip, elens_skip, keep = dec.skip_blank_frames(eouts, elens, 0.9, margin)
+        assert elens_skip.dtype == torch.int32
+        assert keep.size() == (batch_size, emax)
+        eouts_ref = skip_blank_frames_loop(eouts, elens.tolist(), blank_probs, 0.9, margin)
+        assert elens_skip.tolist() == [len(x) for x in eouts_ref]
+        for b in range(batch_size):
+            assert torch.equal(eouts_skip[b, :elens_skip[b]], eouts_ref[b])
+            assert eouts_skip[b, elens_skip[b]:].sum() == 0
+
+        # keep all frames with a threshold larger than one
+        eouts_all, elens_all, _ = dec.skip_blank_frames(eouts, elens, 1.1, margin)
+        assert torch.equal(elens_all, elens)
+        mask = (torch.arange(emax).unsqueeze(0) < elens.unsqueeze(1)).unsqueeze(2)
+        assert torch.equal(eouts_all, eouts * mask)
+
+        # decoding cost scales with the number of non-blank frames
+        dec.ctc.output = output
+        speed = {}
+        for name, (xs, xlens) in [('full', (eouts, elens)), ('skip', (eouts_skip, elens_skip))]:
+            ctc_log_probs = dec.ctc_log_probs(xs)
+            start = time.time()
+            nbest_hyps, _, _ = dec.beam_search(xs, xlens, params, ctc_log_probs=ctc_log_probs)
+            speed[name] = time.time() - start
+            assert len(nbest_hyps) == batch_size
+    logger.info('beam search: %.3f sec (%d frames), %.3f sec (%d frames) with blank skipping' %
+                (speed['full'], elens.sum(), speed['skip'], elens_skip.sum()))
+
+
+def ctc_vocab_candidates_ref(ctc_log_probs, elens, threshold, min_size, blank, eos):
+    """Candidate tokens by loops over utterances."""
+    vocab_ids = []
+    for b in range(len(elens)):
+        peak = ctc_log_probs[b, :elens[b]].exp().max(0)[0].tolist()
+        peak[blank] = -1
+        order = sorted(range(len(peak)), key=lambda v: -peak[v])[:min_size]
+        vocab_ids.append(sorted(set(v for v in range(len(peak)) if peak[v] >= threshold) | {eos} | set(order)))
+    return vocab_ids
+
+
+def test_decoding_ctc_vocab_pruning():
+    params = make_decode_params(recog_beam_width=4, nbest=4, recog_ctc_weight=0.3)
+
+    batch_size = 2
+    emax = 40
+    device = "cpu"
+
+    eouts = torch.randn(batch_size, emax, ENC_N_UNITS)
+    elens = torch.IntTensor([40, 30])
+    ctc_logits = torch.randn(batch_size, emax, VOCAB)
+    ctc_logits[:, :, 4:7] -= 20.  # negligible tokens
+    ctc_log_probs = torch.log_softmax(ctc_logits, dim=-1)
+
+    module = importlib.import_module('neural_sp.models.seq2seq.decoders.las')
+    dec = module.RNNDecoder(**make_args())
+    dec = dec.to(device)
+    dec.eval()
+    # blank is never emitted by the attention decoder
+    dec.output.bias.data[dec.blank] = -1e4
+
+    with torch.no_grad():
+        vocab_ids = dec.ctc_vocab_candidates(ctc_log_probs, elens, 0.05, params['recog_beam_width'])
+        vocab_ids_ref = ctc_vocab_candidates_ref(ctc_log_probs, elens.tolist(), 0.05, params['recog_beam_width'],
+                                                 dec.blank, dec.eos)
+        assert [v.tolist() for v in vocab_ids] == vocab_ids_ref
+
+        params['recog_ctc_vocab_threshold'] = 0.05
+        nbest_hyps, _, scores = dec.beam_search(eouts, elens, params, ctc_log_probs=ctc_log_probs,
+                                                nbest=params['nbest'])
+        for b in range(batch_size):
+            for hyp in nbest_hyps[b]:
+                assert set(hyp.tolist()) <= set(vocab_ids_ref[b])
+
+        # ensemble members are also restricted to the candidates, so averaging
+        # the same decoder does not change the scores
+        nbest_hyps_ensmbl, _, scores_ensmbl = dec.beam_search(
+            eouts, elens, params, ctc_log_probs=ctc_log_probs, nbest=params['nbest'],
+            ensmbl_eouts=[eouts], ensmbl_elens=[elens], ensmbl_decs=[dec])
+        for b in range(batch_size):
+            for n in range(params['nbest']):
+                assert np.array_equal(nbest_hyps_ensmbl[b][n], nbest_hyps[b][n])
+                assert np.isclose(scores_ensmbl[b][n], scores[b][n], rtol=1e-5, atol=1e-4)
+
+        # identical to the full output layer if no token is pruned
+        params['recog_ctc_vocab_threshold'] = 1e-30
+        nbest_hyps, _, scores = dec.beam_search(eouts, elens, params, ctc_log_probs=ctc_log_probs,
+                                                nbest=params['nbest'])
+        params['recog_ctc_vocab_threshold'] = 0
+        nbest_hyps_ref, _, scores_ref = dec.beam_search(eouts, elens, params, ctc_log_probs=ctc_log_probs,
+                                                        nbest=params['nbest'])
+    for b in range(batch_size):
+        for n in range(params['nbest']):
+            assert np.array_equal(nbest_hyps[b][n], nbest_hyps_ref[b][n])
+            assert abs(scores[b][n] - scores_ref[b][n]) < 1e-4
+
+
+@pytest.mark.parametrize(
+    "backward",
+    [False, True]
+)
+def test_decoding_batch_ctc(backward):
+    """Joint CTC/attention beam search does not depend on other utterances in a mini-batch."""
+    params = make_decode_params(recog_beam_width=3, nbest=3, recog_ctc_weight=0.5)
+
+    batch_size = 3
+    emax = 40
+    device = "cpu"
+
+    torch.manual_seed(0)
+    eouts = torch.randn(batch_size, emax, ENC_N_UNITS)
+    elens = torch.IntTensor([40, 12, 25])
+    # peaky CTC posteriors also in padded frames
+    ctc_log_probs = torch.log_softmax(torch.randn(batch_size, emax, VOCAB) * 5, dim=-1)
+
+    module = importlib.import_module('neural_sp.models.seq2seq.decoders.las')
+    dec = module.RNNDecoder(**make_args(backward=backward))
+    dec = dec.to(device)
+    dec.eval()
+
+    with torch.no_grad():
+        nbest_hyps, _, scores = dec.beam_search(eouts, elens, params, ctc_log_probs=ctc_log_probs,
+                                                nbest=params['nbest'])
+        for b in range(batch_size):
+            nbest_hyps_b, _, scores_b = dec.beam_search(
+                eouts[b:b + 1, :elens[b]], elens[b:b + 1], params,
+                ctc_log_probs=ctc_log_probs[b:b + 1, :elens[b]], nbest=params['nbest'])
+            for n in range(params['nbest']):
+                assert np.array_equal(nbest_hyps[b][n], nbest_hyps_b[0][n])
+                assert abs(scores[b][n] - scores_b[0][n]) < 1e-4
+
+
+@pytest.mark.parametrize(
+    "nbest_export, cp_weight",
+    [
+        (True, 0.0),
+        (True, 0.5),
+        (False, 0.0),
+    ]
+)
+def test_nbest_components(nbest_export, cp_weight):
+    args = make_args()
+    params = make_decode_params(recog_beam_width=4, recog_lm_weight=0.5, nbest=4,
+                                recog_coverage_penalty=cp_weight,
+                                recog_coverage_threshold=0.0,
+                                recog_nbest_export=nbest_export)
+
+    batch_size = 2
+    emax = 40
+    device = "cpu"
+
+    eouts = np.random.randn(batch_size, emax, ENC_N_UNITS).astype(np.float32)
+    elens = torch.IntTensor([len(x) for x in eouts])
+    eouts = pad_list([np2tensor(x, device).float() for x in eouts], 0.)
+
+    module_rnnlm = importlib.import_module('neural_sp.models.lm.rnnlm')
+    lm = module_rnnlm.RNNLM(make_args_rnnlm()).to(device)
+
+    module = importlib.import_module('neural_sp.models.seq2seq.decoders.las')
+    dec = module.RNNDecoder(**args)
+    dec = dec.to(device)
+
+    dec.eval()
+    with torch.no_grad():
+        dec.beam_search(eouts, elens, params, lm=lm, nbest=params['nbest'])
+    for b in range(batch_size):
+        for comp in dec.nbest_components[b]:
+            # components not computed in beam search are marked as NaN
+            for name in ['ctc', 'lm_second', 'lm_second_bwd']:
+                assert np.isnan(comp[name])
+            assert not np.isnan(comp['att'])
+            assert not np.isnan(comp['lm'])
+            if nbest_export or cp_weight > 0:
+                # coverage is computed even without the penalty
+                assert comp['cp'] > 0
+            else:
+                assert np.isnan(comp['cp'])
+
+
+@pytest.mark.parametrize(
+    "lm_type, reverse",
+    [
+        ('lstm', False),
+        ('lstm', True),
+        ('transformer', False),
+        ('transformer', True),
+    ]
+)
+def test_lm_rescoring(lm_type, reverse):
+    args = make_args()
+    device = "cpu"
+
+    if lm_type == 'transformer':
+        module_lm = importlib.import_module('neural_sp.models.lm.transformerlm')
+        args_lm = make_args_rnnlm(lm_type='transformer',
+                                  transformer_attn_type='scaled_dot',
+                                  transformer_n_heads=4,
+                                  transformer_d_model=16,
+                                  transformer_d_ff=64,
+                                  transformer_layer_norm_eps=1e-12,
+                                  transformer_ffn_activation='relu',
+                                  transformer_pe_type='add',
+                                  dropout_att=0.1,
+                                  dropout_layer=0.0,
+                                  transformer_param_init='xavier_uniform',
+                                  mem_len=0,
+                                  recog_mem_len=0,
+                                  recog_lm_kv_cache_len=0)
+        lm = module_lm.TransformerLM(args_lm).to(device)
+    else:
+        module_lm = importlib.import_module('neural_sp.models.lm.rnnlm')
+        lm = module_lm.RNNLM(make_args_rnnlm()).to(device)
+    lm.eval()
+
+    module = importlib.import_module('neural_sp.models.seq2seq.decoders.las')
+    dec = module.RNNDecoder(**args)
+    dec = dec.to(device)
+    eos = dec.eos
+
+    # different lengths, shared prefixes, duplicates and an empty hypothesis
+    seqs = [[eos, 4, 5, 6, 7, eos],
+            [eos, 4, 5, eos],
+            [eos, 4, 5],
+            [eos, 4, 5, 6],
+            [eos, 4, 5, 6],
+            [eos, 8, eos],
+            [eos, 9, 4, 5, 6, 7, 8, 9, eos],
+            [eos]]
+    hyps = [{'hyp': seq, 'score': 1.0} for seq in seqs]
+    with torch.no_grad():
+        dec.lm_rescoring(hyps, lm, lm_weight=0.5, reverse=reverse, tag='second')
+
+        # score each hypothesis separately
+        for h, seq in zip(hyps, seqs):
+            ys = seq[::-1] if reverse else seq
+            if len(ys) < 2:
+                score_lm = 0.
+            else:
+                ys_in = torch.LongTensor([ys[:-1]])
+                _, _, scores_lm = lm.predict(ys_in, None)
+                score_lm = sum(scores_lm[0, t, ys[t + 1]].item() for t in range(len(ys) - 1)) / (len(ys) - 1)
+            assert abs(h['score_lm_second'] - score_lm) < 1e-5
+            assert abs(h['score'] - (1.0 + score_lm * 0.5)) < 1e-5
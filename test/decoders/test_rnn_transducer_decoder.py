@@ -203,3 +203,46 @@ def test_decoding(params):
             assert len(nbest_hyps[0]) == params['nbest']
             assert aws is None
             assert scores is None
+
+
+@pytest.mark.parametrize(
+    "rnn_type",
+    ['lstm_transducer', 'gru_transducer']
+)
+def test_greedy_chunk_sync(rnn_type):
+    args = make_args(rnn_type=rnn_type)
+
+    batch_size = 4
+    emax = 40
+    chunk_size = 8
+    device = "cpu"
+
+    eouts = np.random.randn(batch_size, emax, ENC_N_UNITS).astype(np.float32)
+    elens = torch.IntTensor([40, 33, 17, 8])
+    eouts = pad_list([np2tensor(x, device).float() for x in eouts], 0.)
+
+    module = importlib.import_module('neural_sp.models.seq2seq.decoders.rnn_transducer')
+    dec = module.RNNTransducer(**args)
+    dec = dec.to(device)
+    # emit non-blank labels frequently
+    dec.output.bias.data[0] -= 2.
+
+    dec.eval()
+    with torch.no_grad():
+        hyps_ref, _ = dec.greedy(eouts, elens, max_len_ratio=1.0, idx2token=None)
+
+        # chunk by chunk decoding of streams, where the last stream starts from the second chunk
+        hyps = [[] for _ in range(batch_size)]
+        states = [None] * batch_size
+        for t in range(0, emax + chunk_size, chunk_size):
+            offsets = [t] * (batch_size - 1) + [t - chunk_size]
+            active = [b for b in range(batch_size) if 0 <= offsets[b] < emax]
+            eouts_chunk = torch.cat([eouts[b:b + 1, offsets[b]:offsets[b] + chunk_size] for b in active], dim=0)
+            elens_chunk = torch.IntTensor([min(chunk_size, max(0, elens[b].item() - offsets[b])) for b in active])
+            hyps_chunk, states_chunk = dec.greedy_chunk_sync(eouts_chunk, elens_chunk, [states[b] for b in active])
+            for i, b in enumerate(active):
+                hyps[b] += hyps_chunk[i]
+                states[b] = states_chunk[i]
+
+        assert hyps == hyps_ref
+        assert sum(len(h) for h in hyps) > 0
@@ -211,6 +211,7 @@ def make_args_rnnlm(**kwargs):
         (False, {'recog_length_norm': True}),
         # shallow fusion
         (False, {'recog_beam_width': 4, 'recog_lm_weight': 0.1}),
+        (False, {'recog_beam_width': 4, 'recog_lm_weight': 0.1, 'recog_lm_shortlist': 8}),
         # rescoring
         (False, {'recog_beam_width': 4, 'recog_lm_second_weight': 0.1}),
         (False, {'recog_beam_width': 4, 'recog_lm_bwd_weight': 0.1}),
@@ -329,3 +330,105 @@ def test_decoding(backward, params):
             assert isinstance(scores, list)
             assert len(scores) == batch_size
             assert len(scores[0]) == params['nbest']
+
+
+def ctc_vocab_candidates_ref(ctc_log_probs, elens, threshold, min_size, blank, eos):
+    """Candidate tokens by loops over utterances."""
+    vocab_ids = []
+    for b in range(len(elens)):
+        peak = ctc_log_probs[b, :elens[b]].exp().max(0)[0].tolist()
+        peak[blank] = -1
+        order = sorted(range(len(peak)), key=lambda v: -peak[v])[:min_size]
+        vocab_ids.append(sorted(set(v for v in range(len(peak)) if peak[v] >= threshold) | {eos} | set(order)))
+    return vocab_ids
+
+
+def test_decoding_ctc_vocab_pruning():
+    params = make_decode_params(recog_beam_width=4, nbest=4, recog_ctc_weight=0.3)
+
+    batch_size = 2
+    emax = 40
+    device = "cpu"
+
+    eouts = torch.randn(batch_size, emax, ENC_N_UNITS)
+    elens = torch.IntTensor([40, 30])
+    ctc_logits = torch.randn(batch_size, emax, VOCAB)
+    ctc_logits[:, :, 4:7] -= 20.  # negligible tokens
+    ctc_log_probs = torch.log_softmax(ctc_logits, dim=-1)
+
+    module = importlib.import_module('neural_sp.models.seq2seq.decoders.transformer')
+    dec = module.TransformerDecoder(**make_args())
+    dec = dec.to(device)
+    dec.eval()
+    # blank is never emitted by the attention decoder
+    dec.output.bias.data[dec.blank] = -1e4
+
+    with torch.no_grad():
+        vocab_ids = dec.ctc_vocab_candidates(ctc_log_probs, elens, 0.05, params['recog_beam_width'])
+        vocab_ids_ref = ctc_vocab_candidates_ref(ctc_log_probs, elens.tolist(), 0.05, params['recog_beam_width'],
+                                                 dec.blank, dec.eos)
+        assert [v.tolist() for v in vocab_ids] == vocab_ids_ref
+
+        params['recog_ctc_vocab_threshold'] = 0.05
+        nbest_hyps, _, scores = dec.beam_search(eouts, elens, params, ctc_log_probs=ctc_log_probs,
+                                                nbest=params['nbest'])
+        for b in range(batch_size):
+            for hyp in nbest_hyps[b]:
+                assert set(hyp.tolist()) <= set(vocab_ids_ref[b])
+
+        # ensemble members are also restricted to the candidates, so averaging
+        # the same decoder does not change the scores
+        nbest_hyps_ensmbl, _, scores_ensmbl = dec.beam_search(
+            eouts, elens, params, ctc_log_probs=ctc_log_probs, nbest=params['nbest'],
+            ensmbl_eouts=[eouts], ensmbl_elens=[elens], ensmbl_decs=[dec])
+        for b in range(batch_size):
+            for n in range(params['nbest']):
+                assert np.array_equal(nbest_hyps_ensmbl[b][n], nbest_hyps[b][n])
+                assert np.isclose(scores_ensmbl[b][n], scores[b][n], rtol=1e-5, atol=1e-4)
+
+        # identical to the full output layer if no token is pruned
+        params['recog_ctc_vocab_threshold'] = 1e-30
+        nbest_hyps, _, scores = dec.beam_search(eouts, elens, params, ctc_log_probs=ctc_log_probs,
+                                                nbest=params['nbest'])
+        params['recog_ctc_vocab_threshold'] = 0
+        nbest_hyps_ref, _, scores_ref = dec.beam_search(eouts, elens, params, ctc_log_probs=ctc_log_probs,
+                                                        nbest=params['nbest'])
+    for b in range(batch_size):
+        for n in range(params['nbest']):
+            assert np.array_equal(nbest_hyps[b][n], nbest_hyps_ref[b][n])
+            assert abs(scores[b][n] - scores_ref[b][n]) < 1e-4
+
+
+@pytest.mark.parametrize(
+    "backward",
+    [False, True]
+)
+def test_decoding_batch_ctc(backward):
+    """Joint CTC/attention beam search does not depend on other utterances in a mini-batch."""
+    params = make_decode_params(recog_beam_width=3, nbest=3, recog_ctc_weight=0.5)
+
+    batch_size = 3
+    emax = 40
+    device = "cpu"
+
+    torch.manual_seed(0)
+    eouts = torch.randn(batch_size, emax, ENC_N_UNITS)
+    elens = torch.IntTensor([40, 12, 25])
+    # peaky CTC posteriors also in padded frames
+    ctc_log_probs = torch.log_softmax(torch.randn(batch_size, emax, VOCAB) * 5, dim=-1)
+
+    module = importlib.import_module('neural_sp.models.seq2seq.decoders.transformer')
+    dec = module.TransformerDecoder(**make_args(backward=backward))
+    dec = dec.to(device)
+    dec.eval()
+
+    with torch.no_grad():
+        nbest_hyps, _, scores = dec.beam_search(eouts, elens, params, ctc_log_probs=ctc_log_probs,
+                                                nbest=params['nbest'])
+        for b in range(batch_size):
+            nbest_hyps_b, _, scores_b = dec.beam_search(
+                eouts[b:b + 1, :elens[b]], elens[b:b + 1], params,
+                ctc_log_probs=ctc_log_probs[b:b + 1, :elens[b]], nbest=params['nbest'])
+            for n in range(params['nbest']):
+                assert np.array_equal(nbest_hyps[b][n], nbest_hyps_b[0][n])
+                assert abs(scores[b][n] - scores_b[0][n]) < 1e-4
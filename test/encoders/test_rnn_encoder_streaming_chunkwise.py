@@ -185,3 +185,69 @@ def test_forward_streaming_chunkwise(args):
             assert torch.equal(enc_out_dict['ys']['xs'], eouts_stream)
             assert elens_stream.item() == eouts_stream.size(1)
             assert torch.equal(enc_out_dict['ys']['xlens'], elens_stream)
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ({'enc_type': 'blstm', 'chunk_size_left': 20, 'chunk_size_right': 20}),
+        ({'enc_type': 'lstm', 'chunk_size_left': 8}),
+        ({'enc_type': 'gru', 'chunk_size_left': 8}),
+        ({'enc_type': 'conv_blstm', 'chunk_size_left': 32, 'chunk_size_right': 16}),
+    ]
+)
+def test_forward_streaming_batch(args):
+    args = make_args(**args)
+    unidir = args['enc_type'] in ['conv_lstm', 'conv_gru', 'lstm', 'gru']
+
+    n_streams = 3
+    n_chunks = 4
+    N_l = args['chunk_size_left']
+    N_r = args['chunk_size_right']
+    if unidir:
+        args['chunk_size_left'] = 0
+        args['chunk_size_right'] = 0
+    module = importlib.import_module('neural_sp.models.seq2seq.encoders.rnn')
+    enc = module.RNNEncoder(**args)
+    if enc.conv is not None:
+        enc.turn_off_ceil_mode(enc)
+    context = enc.conv.n_frames_context if enc.conv is not None else 0
+
+    xmax = N_l * n_chunks + N_r + context + 1
+    xs = [np.random.randn(xmax, args['input_dim']).astype(np.float32) for _ in range(n_streams)]
+
+    def chunk(x, j):
+        return np2tensor(x[max(0, j - context):j + N_l + N_r + context]).float()
+
+    enc.eval()
+    with torch.no_grad():
+        # encode each stream separately
+        eouts_ref = []
+        for x in xs:
+            enc.reset_cache()
+            eouts_ref.append([])
+            for chunk_idx in range(n_chunks):
+                j = chunk_idx * N_l
+                x_chunk = chunk(x, j).unsqueeze(0)
+                eouts_ref[-1].append(enc(x_chunk, torch.IntTensor([x_chunk.size(1)]), task='all', streaming=True,
+                                         lookback=j - context >= 0, lookahead=True)['ys']['xs'])
+
+        # encode streams at once, where the last stream starts one chunk later
+        caches = [None] * n_streams
+        for chunk_idx in range(n_chunks + 1):
+            groups = {}
+            for b in range(n_streams):
+                j = (chunk_idx - (b == n_streams - 1)) * N_l
+                if 0 <= j < n_chunks * N_l:
+                    # chunks with the same length and CNN context are batchfied
+                    key = (chunk(xs[b], j).size(0), j - context >= 0)
+                    groups[key] = groups.get(key, []) + [(b, j)]
+            for (_, lookback), group in groups.items():
+                xs_chunk = torch.stack([chunk(xs[b], j) for b, j in group], dim=0)
+                enc.merge_cache([caches[b] for b, _ in group])
+                eouts = enc(xs_chunk, torch.IntTensor([xs_chunk.size(1)] * len(group)), task='all', streaming=True,
+                            lookback=lookback, lookahead=True)['ys']['xs']
+                for (b, j), cache in zip(group, enc.split_cache(len(group))):
+                    caches[b] = cache
+                for i, (b, j) in enumerate(group):
+                    assert torch.allclose(eouts[i:i + 1], eouts_ref[b][j // N_l], atol=1e-6)
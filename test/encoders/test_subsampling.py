@@ -0,0 +1,90 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Test for subsampling layers."""
+
+import importlib
+import math
+import pytest
+import torch
+import torch.nn as nn
+
+
+@pytest.mark.parametrize(
+    "subsample_type, factor",
+    [
+        ('concat', 1),
+        ('concat', 2),
+        ('concat', 3),
+        ('conv1d', 2),
+        ('conv1d', 3),
+        ('drop', 2),
+        ('drop', 3),
+        ('add', 2),
+        ('max_pool', 2),
+        ('max_pool', 3),
+    ]
+)
+def test_forward(subsample_type, factor):
+    batch_size = 4
+    xmax = 41
+    n_units = 16
+
+    module = importlib.import_module('neural_sp.models.seq2seq.encoders.subsampling')
+    if subsample_type == 'concat':
+        subsampler = module.ConcatSubsampler(factor, n_units)
+    elif subsample_type == 'conv1d':
+        subsampler = module.Conv1dSubsampler(factor, n_units)
+    elif subsample_type == 'drop':
+        subsampler = module.DropSubsampler(factor)
+    elif subsample_type == 'add':
+        subsampler = module.AddSubsampler(factor)
+    elif subsample_type == 'max_pool':
+        subsampler = module.MaxpoolSubsampler(factor)
+
+    xs = torch.randn(batch_size, xmax, n_units)
+    xlens = torch.IntTensor([41, 30, 8, 1])
+
+    xs_sub, xlens_sub = subsampler(xs, xlens)
+    assert xlens_sub.dtype == torch.int32
+    assert xs_sub.size(0) == batch_size
+    if subsample_type == 'concat':
+        assert xs_sub.size(1) == xmax // factor
+        assert xlens_sub.tolist() == [max(1, x // factor) for x in xlens.tolist()]
+    else:
+        assert xs_sub.size(1) == math.ceil(xmax / factor)
+        assert xlens_sub.tolist() == [max(1, math.ceil(x / factor)) for x in xlens.tolist()]
+
+    # time-first input
+    xs_sub_tf, xlens_sub_tf = subsampler(xs.transpose(1, 0), xlens, batch_first=False)
+    assert torch.allclose(xs_sub_tf.transpose(1, 0), xs_sub, atol=1e-6)
+    assert torch.equal(xlens_sub_tf, xlens_sub)
+
+    if subsample_type == 'concat' and factor > 1:
+        # successive frames are concatenated in the chronological order
+        t = 2
+        xs_cat = torch.cat([xs[:, t * factor + r] for r in range(factor)], dim=-1)
+        assert torch.allclose(xs_sub[:, t], torch.relu(subsampler.proj(xs_cat)), atol=1e-6)
+
+
+def test_update_lens():
+    module = importlib.import_module('neural_sp.models.seq2seq.encoders.conv')
+    xlens = torch.IntTensor([1, 5, 40, 41])
+
+    conv = nn.Conv1d(1, 1, kernel_size=3, stride=2, padding=1)
+    xlens_conv = module.update_lens_1d(xlens, conv)
+    assert xlens_conv.dtype == torch.int32
+    for x, x_conv in zip(xlens.tolist(), xlens_conv.tolist()):
+        assert conv(torch.zeros(1, 1, x)).size(2) == x_conv
+
+    for factor in [2, 3]:
+        pool = nn.MaxPool1d(kernel_size=factor, stride=factor, padding=0, ceil_mode=True)
+        xlens_pool = module.update_lens_1d(xlens, pool)
+        for x, x_pool in zip(xlens.tolist(), xlens_pool.tolist()):
+            assert pool(torch.zeros(1, 1, x)).size(2) == x_pool
+
+        pool = nn.MaxPool2d(kernel_size=(factor, 2), stride=(factor, 2), padding=(0, 0), ceil_mode=True)
+        xlens_pool = module.update_lens_2d(xlens, pool, dim=0)
+        assert xlens_pool.dtype == torch.int32
+        for x, x_pool in zip(xlens.tolist(), xlens_pool.tolist()):
+            assert pool(torch.zeros(1, 1, x, 4)).size(2) == x_pool
@@ -0,0 +1,90 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Test for edit distance."""
+
+import numpy as np
+import pytest
+import torch
+
+from neural_sp.evaluators.edit_distance import compute_edit_distance_batch
+from neural_sp.evaluators.edit_distance import compute_wer
+from neural_sp.evaluators.edit_distance import compute_wer_batch
+from neural_sp.models.torch_utils import pad_list
+
+
+def levenshtein(ref, hyp):
+    d = list(range(len(hyp) + 1))
+    for i in range(1, len(ref) + 1):
+        prev, d[0] = d[0], i
+        for j in range(1, len(hyp) + 1):
+            prev, d[j] = d[j], min(d[j] + 1, d[j - 1] + 1, prev + (ref[i - 1] != hyp[j - 1]))
+    return d[-1]
+
+
+def make_pairs(n_pairs, vocab, max_len):
+    refs = [np.random.randint(0, vocab, np.random.randint(1, max_len)).tolist() for _ in range(n_pairs)]
+    hyps = [np.random.randint(0, vocab, np.random.randint(0, max_len)).tolist() for _ in range(n_pairs)]
+    return refs, hyps
+
+
+@pytest.mark.parametrize(
+    "vocab, max_len",
+    [
+        (3, 10),
+        (10, 30),
+    ]
+)
+def test_compute_wer(vocab, max_len):
+    refs, hyps = make_pairs(50, vocab, max_len)
+    for ref, hyp in zip(refs, hyps):
+        wer, n_sub, n_ins, n_del = compute_wer(ref, hyp)
+        assert wer == levenshtein(ref, hyp) * 100
+        assert wer == n_sub + n_ins + n_del
+
+
+def test_compute_wer_long():
+    # NOTE: the distance exceeds the range of uint16
+    ref = ['a'] * 70000
+    hyp = ['b'] * 10
+    wer, n_sub, n_ins, n_del = compute_wer(ref, hyp)
+    assert wer == 70000 * 100
+    assert n_sub == 10 * 100
+    assert n_del == 69990 * 100
+
+
+@pytest.mark.parametrize(
+    "return_alignment, batch_size",
+    [
+        (False, 256),
+        (False, 7),
+        (True, 256),
+    ]
+)
+def test_compute_wer_batch(return_alignment, batch_size):
+    refs, hyps = make_pairs(50, 4, 20)
+    refs += [['a'], []]
+    hyps += [[], ['a', 'b']]
+    out = compute_wer_batch(refs, hyps, return_alignment=return_alignment, batch_size=batch_size)
+    for n, (ref, hyp) in enumerate(zip(refs, hyps)):
+        if len(ref) > 0:
+            assert tuple(o[n] for o in out[:4]) == compute_wer(ref, hyp)
+        else:
+            assert out[0][n] == len(hyp) * 100
+    if return_alignment:
+        alignments = out[4]
+        assert len(alignments) == len(refs)
+        for n, (ref, hyp) in enumerate(zip(refs, hyps)):
+            assert alignments[n].count('S') * 100 == out[1][n]
+            assert len(ref) == len(alignments[n]) - alignments[n].count('I')
+            assert len(hyp) == len(alignments[n]) - alignments[n].count('D')
+
+
+def test_compute_edit_distance_batch():
+    refs, hyps = make_pairs(16, 5, 15)
+    refs_pad = pad_list([torch.LongTensor(y) for y in refs], -1)
+    hyps_pad = pad_list([torch.LongTensor(y) for y in hyps] + [torch.LongTensor([0])], -1)[:-1]
+    rlens = torch.LongTensor([len(y) for y in refs])
+    hlens = torch.LongTensor([len(y) for y in hyps])
+    dists = compute_edit_distance_batch(hyps_pad, hlens, refs_pad, rlens)
+    assert dists.tolist() == [levenshtein(ref, hyp) for ref, hyp in zip(refs, hyps)]
@@ -0,0 +1,73 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Test for N-best export and rescoring."""
+
+import os
+import pytest
+
+from neural_sp.evaluators.nbest import load_nbest
+from neural_sp.evaluators.nbest import NbestWriter
+from neural_sp.evaluators.nbest import rescore_nbest
+
+
+def make_grid(**kwargs):
+    grid = dict(
+        ctc_weight=[0.0],
+        lm_weight=[0.0],
+        lm_second_weight=[0.0],
+        lm_bwd_weight=[0.0],
+        length_penalty=[0.0],
+        coverage_penalty=[0.0],
+    )
+    grid.update(kwargs)
+    return grid
+
+
+def test_rescore(tmp_path):
+    writer = NbestWriter()
+    # the LM prefers the correct hypothesis, the attention model does not
+    writer.add('utt1', 'a b c', ['a b d', 'a b c'],
+               [{'att': -1.0, 'lm': -5.0, 'length': 4},
+                {'att': -2.0, 'lm': -1.0, 'length': 4}])
+    writer.add('utt2', 'x y', ['x y', 'x'],
+               [{'att': -1.0, 'lm': -2.0, 'length': 3},
+                {'att': -1.5, 'lm': -1.0, 'length': 2}])
+    path = os.path.join(str(tmp_path), 'nbest.npz')
+    writer.save(path)
+
+    nbest = load_nbest([path, path])
+    assert len(nbest['utt_ids']) == 4
+    assert len(nbest['hyps']) == 8
+    assert nbest['hyp2utt'].tolist() == [0, 0, 1, 1, 2, 2, 3, 3]
+
+    results = rescore_nbest(load_nbest([path]), make_grid(lm_weight=[0.0, 0.5]))
+    assert len(results) == 2
+    assert results[0][0]['lm_weight'] == 0.0
+    assert abs(results[0][1] - 100 / 5) < 1e-6  # 1 substitution
+    assert results[1][1] == 0
+
+    # a large length penalty prefers longer hypotheses
+    results = rescore_nbest(load_nbest([path]), make_grid(lm_weight=[1.0], length_penalty=[10.0]))
+    assert results[0][1] == 0
+
+    # CER
+    results = rescore_nbest(load_nbest([path]), make_grid(), char_level=True, remove_space=True)
+    assert abs(results[0][1] - 100 / 5) < 1e-6
+
+
+def test_rescore_missing_components(tmp_path):
+    writer = NbestWriter()
+    # CTC scores were not computed in beam search
+    writer.add('utt1', 'a b c', ['a b d', 'a b c'],
+               [{'att': -1.0, 'ctc': float('nan'), 'lm': -5.0, 'length': 4},
+                {'att': -2.0, 'ctc': float('nan'), 'lm': -1.0, 'length': 4}])
+    path = os.path.join(str(tmp_path), 'nbest.npz')
+    writer.save(path)
+
+    results = rescore_nbest(load_nbest([path]), make_grid(lm_weight=[0.0, 0.5]))
+    assert abs(results[0][1] - 100 / 3) < 1e-6
+    assert results[1][1] == 0
+
+    with pytest.raises(ValueError):
+        rescore_nbest(load_nbest([path]), make_grid(ctc_weight=[0.0, 0.3]))
@@ -0,0 +1,81 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Test for streaming log-mel filterbank extraction."""
+
+import kaldiio
+import numpy as np
+import pytest
+
+from neural_sp.models.seq2seq.frontends.fbank import Fbank
+from neural_sp.models.seq2seq.frontends.fbank import load_cmvn
+from neural_sp.models.seq2seq.frontends.fbank import mel_banks
+
+
+def test_mel_banks():
+    banks = mel_banks(80, 512, 16000)
+    assert banks.shape == (256, 80)
+    assert (banks >= 0).all() and (banks <= 1).all()
+    # every bin covers at least one FFT bin and the center frequencies increase
+    assert (banks.sum(0) > 0).all()
+    assert (np.diff(banks.argmax(0)) >= 0).all()
+
+
+@pytest.mark.parametrize(
+    "n_mels,frame_shift",
+    [(80, 10.), (40, 10.), (80, 20.)]
+)
+def test_streaming(n_mels, frame_shift):
+    rng = np.random.RandomState(0)
+    wav = rng.randint(-1000, 1000, size=16000 * 2).astype(np.float64)
+    n_frames_ref = 1 + (len(wav) - 400) // int(16 * frame_shift)
+
+    xs_ref = Fbank(n_mels=n_mels, frame_shift=frame_shift)(wav)
+    assert xs_ref.shape == (n_frames_ref, n_mels)
+    assert xs_ref.dtype == np.float32
+
+    # the result does not depend on how waveforms are split
+    fbank = Fbank(n_mels=n_mels, frame_shift=frame_shift)
+    xs, offset = [], 0
+    while offset < len(wav):
+        n_samples = rng.randint(1, 3000)
+        xs.append(fbank(wav[offset:offset + n_samples]))
+        offset += n_samples
+    xs = np.concatenate(xs, axis=0)
+    assert np.allclose(xs, xs_ref, atol=1e-4)
+
+    fbank.reset()
+    assert np.allclose(fbank(wav), xs_ref, atol=1e-4)
+
+
+def test_tone():
+    sample_rate = 16000
+    t = np.arange(sample_rate) / sample_rate
+    fbank = Fbank()
+    peaks = []
+    for freq in [300, 1000, 4000]:
+        xs = fbank(10000 * np.sin(2 * np.pi * freq * t))
+        fbank.reset()
+        peaks.append(np.bincount(xs.argmax(1)).argmax())
+    # higher tones have peaks in higher mel bins
+    assert peaks[0] < peaks[1] < peaks[2]
+
+
+def test_cmvn(tmp_path):
+    rng = np.random.RandomState(0)
+    feats = rng.randn(1000, 80) * 3 + 2
+    stats = np.zeros((2, 81))
+    stats[0, :-1] = feats.sum(0)
+    stats[0, -1] = len(feats)
+    stats[1, :-1] = (feats ** 2).sum(0)
+    cmvn_path = str(tmp_path / 'cmvn.ark')
+    kaldiio.save_mat(cmvn_path, stats)
+
+    mean, std = load_cmvn(cmvn_path)
+    assert np.allclose(mean, feats.mean(0), atol=1e-4)
+    assert np.allclose(std, feats.std(0), atol=1e-4)
+
+    wav = rng.randint(-1000, 1000, size=8000)
+    xs = Fbank()(wav)
+    xs_norm = Fbank(cmvn=(mean, std))(wav)
+    assert np.allclose(xs_norm, (xs - mean) / std, atol=1e-4)
@@ -0,0 +1,123 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Test for CTC-based segmentation."""
+
+import argparse
+import pytest
+import torch
+
+from neural_sp.models.seq2seq.frontends.streaming import count_successive_blanks
+from neural_sp.models.seq2seq.frontends.streaming import ctc_segmentation
+from neural_sp.models.seq2seq.frontends.streaming import Streaming
+
+VOCAB = 10
+
+
+def make_ctc_probs(xmax, seed=0):
+    """CTC posteriors with blank regions of various lengths and weak spikes."""
+    torch.manual_seed(seed)
+    logits = torch.randn(xmax, VOCAB)
+    logits[:, 0] += 4.
+    for start, end in [(30, 60), (100, 103), (150, 230), (300, 305)]:
+        logits[start:end, 0] += 100.
+    logits[::7, 4] += 8.
+    return torch.softmax(logits, dim=-1)
+
+
+def blank_loop(ctc_probs, spike_threshold):
+    ids = ctc_probs.argmax(-1).tolist()
+    return [ids[t] == 0 or ctc_probs[t, ids[t]] < spike_threshold for t in range(len(ids))]
+
+
+def ctc_segmentation_loop(ctc_probs, blank_threshold, spike_threshold):
+    is_blank = blank_loop(ctc_probs, spike_threshold)
+    xmax = len(is_blank)
+    is_speech = [True] * xmax
+    t = 0
+    while t < xmax:
+        if not is_blank[t]:
+            t += 1
+            continue
+        end = t
+        while end < xmax and is_blank[end]:
+            end += 1
+        if end - t >= blank_threshold:
+            is_speech[t:end] = [False] * (end - t)
+        t = end
+    margin = blank_threshold // 2
+    segments = []
+    for t in range(xmax):
+        if is_speech[t] and (t == 0 or not is_speech[t - 1]):
+            start = t
+        if is_speech[t] and (t == xmax - 1 or not is_speech[t + 1]):
+            segments.append([max(0, start - margin), min(xmax, t + 1 + margin)])
+    return segments
+
+
+def test_count_successive_blanks():
+    is_blank = torch.tensor([1, 1, 0, 1, 1, 1, 0, 0, 1], dtype=torch.bool)
+    assert count_successive_blanks(is_blank).tolist() == [1, 2, 0, 1, 2, 3, 0, 0, 1]
+    assert count_successive_blanks(is_blank, 5).tolist() == [6, 7, 0, 1, 2, 3, 0, 0, 1]
+    assert count_successive_blanks(torch.ones(3, dtype=torch.bool), 2).tolist() == [3, 4, 5]
+
+
+@pytest.mark.parametrize(
+    "blank_threshold",
+    [4, 10, 40]
+)
+def test_ctc_segmentation(blank_threshold):
+    xmax = 400
+    ctc_probs = make_ctc_probs(xmax)
+    segments = ctc_segmentation(ctc_probs, 0, blank_threshold, 0.1)
+    assert segments.tolist() == ctc_segmentation_loop(ctc_probs, blank_threshold, 0.1)
+
+    # split long segments
+    max_n_frames = 50
+    segments_split = ctc_segmentation(ctc_probs, 0, blank_threshold, 0.1, max_n_frames)
+    assert (segments_split[:, 1] - segments_split[:, 0]).max() <= max_n_frames
+    n = 0
+    for start, end in segments.tolist():
+        assert segments_split[n, 0] == start
+        while segments_split[n, 1] < end:
+            assert segments_split[n + 1, 0] == segments_split[n, 1]
+            n += 1
+        assert segments_split[n, 1] == end
+        n += 1
+    assert n == len(segments_split)
+
+    # all blank
+    ctc_probs = torch.zeros(100, VOCAB)
+    ctc_probs[:, 0] = 1
+    assert len(ctc_segmentation(ctc_probs, 0, blank_threshold, 0.1)) == 0
+
+
+def test_ctc_vad():
+    factor = 4
+    encoder = argparse.Namespace(conv=None, subsampling_factor=factor, chunk_size_left=40, chunk_size_right=20)
+    params = {'recog_ctc_vad': True,
+              'recog_ctc_vad_blank_threshold': 40,
+              'recog_ctc_vad_spike_threshold': 0.1,
+              'recog_ctc_vad_n_accum_frames': 0}
+    streaming = Streaming(torch.zeros(1000, 8), params, encoder, idx2token=None)
+
+    ctc_probs = make_ctc_probs(400, seed=1)
+    is_blank = blank_loop(ctc_probs, 0.1)
+    n_blanks = 0
+    for start in range(0, 400, 10):
+        # reference: loop over frames
+        bd_offset = -1
+        if (ctc_probs[start:start + 10].argmax(-1) == 0).all():
+            n_blanks += 10
+            is_reset_ref = n_blanks * factor >= 40
+        else:
+            for j in range(10):
+                n_blanks = n_blanks + 1 if is_blank[start + j] else 0
+                if n_blanks * factor >= 40:
+                    bd_offset = j
+            is_reset_ref = bd_offset >= 0
+        is_reset = streaming.ctc_vad(ctc_probs[start:start + 10].unsqueeze(0))
+        assert is_reset == is_reset_ref
+        assert streaming.bd_offset == bd_offset
+        assert streaming.n_blanks == n_blanks
+        streaming.bd_offset = -1
@@ -0,0 +1,87 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Test for GatedConvLM."""
+
+import argparse
+import importlib
+import numpy as np
+import pytest
+import torch
+
+
+VOCAB = 100  # large for adaptive softmax
+
+
+def make_args(**kwargs):
+    args = dict(
+        lm_type='gated_conv_custom',
+        n_units=16,
+        n_projs=0,
+        n_layers=3,
+        kernel_size=4,
+        emb_dim=16,
+        vocab=VOCAB,
+        dropout_in=0.1,
+        dropout_hidden=0.1,
+        lsm_prob=0.0,
+        param_init=0.1,
+        adaptive_softmax=False,
+        tie_embedding=False,
+    )
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+@pytest.mark.parametrize(
+    "args", [
+        ({'kernel_size': 1}),
+        ({'kernel_size': 4}),
+        ({'n_projs': 8}),
+        ({'emb_dim': 8}),
+        ({'adaptive_softmax': True}),
+        ({'tie_embedding': True}),
+    ]
+)
+def test_forward(args):
+    args = make_args(**args)
+
+    ylens = [4, 5, 3, 7] * 20
+    ys = [np.random.randint(0, VOCAB, ylen).astype(np.int64) for ylen in ylens]
+    device = "cpu"
+
+    module = importlib.import_module('neural_sp.models.lm.gated_convlm')
+    lm = module.GatedConvLM(args)
+    lm = lm.to(device)
+    loss, state, observation = lm(ys, state=None, n_caches=0)
+    assert loss.item() >= 0
+    assert isinstance(observation, dict)
+
+
+@pytest.mark.parametrize(
+    "args", [
+        ({'kernel_size': 1}),
+        ({'kernel_size': 4}),
+        ({'n_projs': 8}),
+        ({'emb_dim': 8}),
+    ]
+)
+def test_predict_incremental(args):
+    args = make_args(**args)
+    device = "cpu"
+
+    module = importlib.import_module('neural_sp.models.lm.gated_convlm')
+    lm = module.GatedConvLM(args)
+    lm = lm.to(device)
+    lm.eval()
+
+    ys = torch.from_numpy(np.random.randint(0, VOCAB, (4, 8)).astype(np.int64))
+    with torch.no_grad():
+        # reference: convolution over the whole sequence as in training
+        logits_full, _, _ = lm.decode(ys, incremental=False)
+        log_probs_full = torch.log_softmax(logits_full, dim=-1)
+        state = None
+        for t in range(ys.size(1)):
+            _, state, log_probs = lm.predict(ys[:, t:t + 1], state)
+            assert state['hxs'].size() == (1, 4, sum(lm.state_sizes))
+            assert torch.allclose(log_probs[:, 0], log_probs_full[:, t], atol=1e-5)
@@ -0,0 +1,174 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Test for look-ahead word-level LM."""
+
+import argparse
+import codecs
+import importlib
+import pytest
+import torch
+
+
+WORDS = ['the', 'a', 'cat', 'cats', 'car', 'dog', 'do', 'done']
+
+
+def make_args(**kwargs):
+    args = dict(
+        lm_type='lstm',
+        n_units=32,
+        n_projs=0,
+        n_layers=1,
+        residual=False,
+        use_glu=False,
+        n_units_null_context=0,
+        bottleneck_dim=16,
+        emb_dim=16,
+        vocab=4 + len(WORDS),
+        dropout_in=0.1,
+        dropout_hidden=0.1,
+        lsm_prob=0.0,
+        param_init=0.1,
+        adaptive_softmax=False,
+        tie_embedding=False,
+    )
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def write_dict(path, tokens):
+    with codecs.open(path, 'w', 'utf-8') as f:
+        f.write('<unk> 1\n<eos> 2\n<pad> 3\n')
+        for i, t in enumerate(tokens):
+            f.write('%s %d\n' % (t, i + 4))
+    return str(path)
+
+
+def encode(tokens, units):
+    return [tokens.index(u) + 4 for u in units]
+
+
+@pytest.mark.parametrize(
+    "unit", ['char', 'wp']
+)
+def test_predict(tmp_path, unit):
+    if unit == 'char':
+        tokens = ['<space>'] + sorted(set(''.join(WORDS)))
+        units = ['c', 'a', 't', '<space>', 'd', 'o', 'g', '<space>']
+    else:
+        tokens = ['▁the', '▁a', '▁ca', '▁do', 't', 's', 'r', 'g', 'ne']
+        units = ['▁ca', 't', '▁do', 'g', '▁a']
+    lm_dict_path = write_dict(tmp_path / 'dict_word.txt', WORDS)
+    asr_dict_path = write_dict(tmp_path / 'dict.txt', tokens)
+
+    module_rnnlm = importlib.import_module('neural_sp.models.lm.rnnlm')
+    wordlm = module_rnnlm.RNNLM(make_args())
+    wordlm.eval()
+    module = importlib.import_module('neural_sp.models.lm.lookahead_wordlm')
+    lm = module.LookAheadWordLM(wordlm, lm_dict_path, asr_dict_path)
+    assert lm.vocab == len(tokens) + 4
+
+    # score a token sequence
+    ys = [2] + encode(tokens, units)
+    score = 0.
+    state = None
+    log_probs = None
+    with torch.no_grad():
+        for t in range(len(ys)):
+            if log_probs is not None:
+                score += log_probs[0, -1, ys[t]].item()
+            _, state, log_probs = lm.predict(torch.tensor([ys[:t + 1]]), state)
+            assert log_probs.size() == (1, 1, lm.vocab)
+
+    # the same score by the word LM normalized over the lexicon
+    word_ids = [2, WORDS.index('cat') + 4, WORDS.index('dog') + 4]
+    lex_ids = torch.tensor([w + 4 for w in range(len(WORDS))])
+    score_ref = 0.
+    with torch.no_grad():
+        _, _, log_probs_w = wordlm.predict(torch.tensor([word_ids]), None)
+    for t in range(1, len(word_ids)):
+        score_ref += log_probs_w[0, t - 1, word_ids[t]].item()
+        score_ref -= log_probs_w[0, t - 1, lex_ids].exp().sum().log().item()
+    if unit == 'wp':
+        # the first characters of the third word
+        p_a = log_probs_w[0, -1, [WORDS.index('a') + 4]].exp().sum()
+        score_ref += (p_a / log_probs_w[0, -1, lex_ids].exp().sum()).log().item()
+    assert abs(score - score_ref) < 1e-4
+
+    # batch
+    with torch.no_grad():
+        ys_batch = torch.tensor([ys, ys])
+        _, state_batch, log_probs_batch = lm.predict(ys_batch[:, :1], None)
+        for t in range(1, len(ys)):
+            _, state_batch, log_probs_batch = lm.predict(ys_batch[:, :t + 1], state_batch)
+    assert torch.allclose(log_probs_batch[0], log_probs[0])
+    assert torch.allclose(log_probs_batch[1], log_probs[0])
+
+
+def test_oov(tmp_path):
+    tokens = ['<space>'] + sorted(set(''.join(WORDS)) | set('xz'))
+    lm_dict_path = write_dict(tmp_path / 'dict_word.txt', WORDS)
+    asr_dict_path = write_dict(tmp_path / 'dict.txt', tokens)
+
+    module_rnnlm = importlib.import_module('neural_sp.models.lm.rnnlm')
+    module = importlib.import_module('neural_sp.models.lm.lookahead_wordlm')
+    lm = module.LookAheadWordLM(module_rnnlm.RNNLM(make_args()), lm_dict_path, asr_dict_path)
+    lm.eval()
+
+    ys = [2] + encode(tokens, ['x', 'z'])
+    state = None
+    with torch.no_grad():
+        for t in range(len(ys)):
+            _, state, log_probs = lm.predict(torch.tensor([ys[:t + 1]]), state)
+    assert state['node'][0, 0].item() == -1
+    assert log_probs[0, -1, encode(tokens, ['a'])[0]].item() == 0.
+    assert abs(log_probs[0, -1, encode(tokens, ['<space>'])[0]].item() - lm.log_oov_penalty) < 1e-6
+
+
+def test_cache(tmp_path):
+    tokens = ['▁the', '▁a', '▁ca', '▁do', 't', 's', 'r', 'g', 'ne']
+    lm_dict_path = write_dict(tmp_path / 'dict_word.txt', WORDS)
+    asr_dict_path = write_dict(tmp_path / 'dict.txt', tokens)
+
+    module_rnnlm = importlib.import_module('neural_sp.models.lm.rnnlm')
+    module = importlib.import_module('neural_sp.models.lm.lookahead_wordlm')
+    lm = module.LookAheadWordLM(module_rnnlm.RNNLM(make_args()), lm_dict_path, asr_dict_path)
+    lm.eval()
+
+    # count the number of word histories fed to the word LM
+    n_fed = []
+    predict = lm.wordlm.predict
+
+    def predict_count(ys, state, **kwargs):
+        n_fed.append(ys.size(0))
+        return predict(ys, state, **kwargs)
+    lm.wordlm.predict = predict_count
+
+    def decode(seqs):
+        ys = torch.tensor([[2] + encode(tokens, units) for units in seqs])
+        state = None
+        outs = []
+        with torch.no_grad():
+            for t in range(ys.size(1)):
+                _, state, log_probs = lm.predict(ys[:, :t + 1], state)
+                outs.append(log_probs)
+        return torch.cat(outs, dim=1)
+
+    # the beam shares the first word and the same prefix of the second word
+    seqs = [['▁ca', 't', '▁do', 'g', '▁a'],
+            ['▁ca', 't', '▁do', 'ne', '▁a'],
+            ['▁ca', 'r', '▁do', 'g', '▁a']]
+    log_probs = decode(seqs)
+    # the word LM is run only where the prefix completes a word, once per word history:
+    # <eos>, {cat, car}, {cat do, car do}, {cat dog, cat done, car dog}, {cat dog a, cat done a, car dog a}
+    assert n_fed == [1, 2, 2, 3, 3]
+
+    # every history is cached
+    n_fed.clear()
+    log_probs_cache = decode(seqs)
+    assert sum(n_fed) == 0
+    assert torch.equal(log_probs, log_probs_cache)
+
+    # the same scores after the cache is cleared
+    lm.reset_cache()
+    assert torch.allclose(decode(seqs[:1])[0], log_probs[0])
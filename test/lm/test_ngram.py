@@ -0,0 +1,175 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Test for n-gram LM."""
+
+import argparse
+import codecs
+import gzip
+import importlib
+import logging
+import math
+import numpy as np
+import pytest
+import time
+import torch
+
+logger = logging.getLogger(__name__)
+
+VOCAB = 20
+
+
+def make_args(**kwargs):
+    args = dict(
+        lm_type='lstm',
+        n_units=256,
+        n_projs=0,
+        n_layers=2,
+        residual=False,
+        use_glu=False,
+        n_units_null_context=0,
+        bottleneck_dim=256,
+        emb_dim=256,
+        vocab=VOCAB,
+        dropout_in=0.1,
+        dropout_hidden=0.1,
+        lsm_prob=0.0,
+        param_init=0.1,
+        adaptive_softmax=False,
+        tie_embedding=False,
+    )
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def make_corpus(n_sents=50, seed=0):
+    rng = np.random.RandomState(seed)
+    return [rng.randint(4, VOCAB, rng.randint(1, 10)).tolist() for _ in range(n_sents)]
+
+
+def write_files(tmp_path, order, gz=False):
+    """Write a dictionary and an ARPA file with random probabilities over n-grams in a corpus."""
+    tokens = ['t%d' % i for i in range(4, VOCAB)]
+    dict_path = str(tmp_path / 'dict.txt')
+    with codecs.open(dict_path, 'w', 'utf-8') as f:
+        f.write('<unk> 1\n<eos> 2\n<pad> 3\n')
+        for i, t in enumerate(tokens):
+            f.write('%s %d\n' % (t, i + 4))
+
+    rng = np.random.RandomState(1)
+    ngrams = [set() for _ in range(order)]
+    for sent in make_corpus():
+        # drop some tokens from the n-gram vocabulary to exercise <unk>
+        sent = ['<s>'] + ['t%d' % i for i in sent if i != VOCAB - 1] + ['</s>']
+        for n in range(order):
+            for t in range(len(sent) - n):
+                ngrams[n].add(tuple(sent[t:t + n + 1]))
+    ngrams[0].add(('<unk>',))
+    arpa = {}
+    for n in range(order):
+        for ngram in sorted(ngrams[n]):
+            logp = -99. if ngram == ('<s>',) else -rng.rand() * 2
+            bo = -rng.rand() if n < order - 1 else None
+            arpa[ngram] = (logp, bo)
+
+    arpa_path = str(tmp_path / ('lm.arpa.gz' if gz else 'lm.arpa'))
+    with (gzip.open if gz else open)(arpa_path, 'wt') as f:
+        f.write('\\data\\\n')
+        for n in range(order):
+            f.write('ngram %d=%d\n' % (n + 1, len(ngrams[n])))
+        for n in range(order):
+            f.write('\n\\%d-grams:\n' % (n + 1))
+            for ngram in sorted(ngrams[n]):
+                logp, bo = arpa[ngram]
+                f.write('%.6f\t%s' % (logp, ' '.join(ngram)))
+                f.write('\t%.6f\n' % bo if bo is not None else '\n')
+        f.write('\n\\end\\\n')
+    return arpa_path, dict_path, arpa
+
+
+def reference_logprob(arpa, history, w):
+    """Backoff n-gram probability (natural log) by recursion on dicts."""
+    order = max(len(k) for k in arpa.keys())
+    history = tuple(history[max(0, len(history) - order + 1):])
+    if history + (w,) in arpa:
+        return arpa[history + (w,)][0] * math.log(10)
+    if len(history) == 0:
+        return arpa[('<unk>',)][0] * math.log(10)
+    bo = arpa[history][1] if history in arpa else 0.
+    return bo * math.log(10) + reference_logprob(arpa, history[1:], w)
+
+
+def to_token(i):
+    if i == 2:
+        return '</s>'
+    return 't%d' % i if i != VOCAB - 1 else '<unk>'
+
+
+@pytest.mark.parametrize(
+    "order,gz", [(1, False), (2, False), (3, False), (4, False), (3, True)]
+)
+def test_ppl(tmp_path, order, gz):
+    arpa_path, dict_path, arpa = write_files(tmp_path, order, gz)
+    module = importlib.import_module('neural_sp.models.lm.ngram')
+    lm = module.NgramLM(arpa_path, dict_path)
+    assert lm.order == order
+    assert lm.vocab == VOCAB
+
+    sents = make_corpus(n_sents=10, seed=2)
+    ys = [[2] + s + [2] for s in sents]
+    ymax = max(len(y) for y in ys)
+    ys_pad = torch.tensor([y + [3] * (ymax - len(y)) for y in ys])
+    _, _, log_probs = lm.predict(ys_pad[:, :-1], None)
+    assert log_probs.size() == (len(ys), ymax - 1, VOCAB)
+
+    loss, loss_ref, n_tokens = 0., 0., 0
+    for b, y in enumerate(ys):
+        history = ['<s>']
+        for t in range(1, len(y)):
+            w = to_token(y[t])
+            loss -= log_probs[b, t - 1, y[t]].item()
+            loss_ref -= reference_logprob(arpa, history, w)
+            history.append(w)
+            n_tokens += 1
+    ppl, ppl_ref = math.exp(loss / n_tokens), math.exp(loss_ref / n_tokens)
+    assert abs(ppl - ppl_ref) / ppl_ref < 1e-4
+
+    # incremental prediction with batched states
+    state = None
+    for t in range(ymax - 1):
+        # candidate scoring
+        candidates = torch.randint(0, VOCAB, (len(ys), 5))
+        _, _, ctx = lm.predict(ys_pad[:, t:t + 1], state, shortlist=True)
+
+        _, state, log_probs_t = lm.predict(ys_pad[:, t:t + 1], state)
+        assert torch.allclose(log_probs_t[:, 0], log_probs[:, t])
+        assert torch.allclose(lm.score_shortlist(ctx[:, -1], candidates),
+                              log_probs_t[:, 0].gather(1, candidates), atol=1e-5)
+
+
+def test_throughput(tmp_path):
+    arpa_path, dict_path, _ = write_files(tmp_path, order=4)
+    module = importlib.import_module('neural_sp.models.lm.ngram')
+    lm = module.NgramLM(arpa_path, dict_path)
+    module_rnnlm = importlib.import_module('neural_sp.models.lm.rnnlm')
+    # a moderately sized neural LM as used for shallow fusion
+    rnnlm = module_rnnlm.RNNLM(make_args(n_units=1024, emb_dim=512, bottleneck_dim=512))
+    rnnlm.eval()
+
+    batch_size, n_steps, n_repeats = 10, 50, 3
+    ys = torch.randint(4, VOCAB, (batch_size, n_steps))
+    speed = {}
+    for name, model in [('ngram', lm), ('rnnlm', rnnlm)]:
+        elapsed_times = []
+        for _ in range(n_repeats):
+            state = None
+            start = time.time()
+            with torch.no_grad():
+                for t in range(n_steps):
+                    _, state, _ = model.predict(ys[:, t:t + 1], state)
+            elapsed_times.append(time.time() - start)
+        # the fastest run is the least affected by other processes
+        speed[name] = batch_size * n_steps / min(elapsed_times)
+    logger.info('tokens/sec: n-gram %.1f, RNNLM %.1f' % (speed['ngram'], speed['rnnlm']))
+    # batched n-gram lookups are much cheaper than a step of a 2-layer LSTM with 1024 units
+    assert speed['ngram'] > speed['rnnlm'] * 2
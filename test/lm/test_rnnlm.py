@@ -7,6 +7,7 @@ import argparse
 import importlib
 import numpy as np
 import pytest
+import torch
 
 
 VOCAB = 100  # large for adaptive softmax
@@ -72,3 +73,83 @@ def test_forward(args):
     # assert loss.size(0) == 1
     assert loss.item() >= 0
     assert isinstance(observation, dict)
+
+
+@pytest.mark.parametrize("n_caches", [1, 5, 100])
+def test_forward_cache(n_caches):
+    args = make_args()
+    device = "cpu"
+
+    module = importlib.import_module('neural_sp.models.lm.rnnlm')
+    lm = module.RNNLM(args)
+    lm = lm.to(device)
+
+    ys = np.random.randint(4, VOCAB, (3, 20)).astype(np.int64)
+
+    # token by token
+    state = None
+    losses = []
+    for t in range(ys.shape[1] - 1):
+        loss, state, _ = lm(ys[:, t:t + 2], state=state, is_eval=True, n_caches=n_caches)
+        losses.append(loss.item())
+    if n_caches < ys.shape[1] - 1:
+        assert len(lm.cache_attn) == n_caches
+        assert lm.cache_attn[-1].shape == (3, n_caches)
+
+    # all at once
+    lm.reset_cache()
+    loss, _, observation = lm(ys, state=None, is_eval=True, n_caches=n_caches)
+    assert abs(loss.item() - np.mean(losses)) < 1e-5
+    assert isinstance(observation, dict)
+
+
+@pytest.mark.parametrize(
+    "args", [
+        ({}),
+        ({'adaptive_softmax': True}),
+        ({'vocab': 5000}),  # approximate partition function
+        ({'vocab': 5000, 'recog_lm_shortlist_partition_size': 4096}),
+    ]
+)
+def test_score_shortlist(args):
+    args = make_args(**args)
+    device = "cpu"
+
+    module = importlib.import_module('neural_sp.models.lm.rnnlm')
+    lm = module.RNNLM(args)
+    lm = lm.to(device)
+    lm.eval()
+    exact = lm.adaptive_softmax is not None or args.vocab <= lm.shortlist_partition_size * 2
+
+    # peaked distribution: scale the output layer and make lower indices more frequent
+    with torch.no_grad():
+        if lm.adaptive_softmax is None:
+            lm.output.weight.mul_(1000)
+            lm.output.bias.copy_(-torch.log1p(torch.arange(args.vocab).float()))
+        else:
+            for p in lm.adaptive_softmax.parameters():
+                p.mul_(1000)
+
+    ys = torch.randint(4, 100, (3, 1))
+    candidates = torch.randint(0, args.vocab, (3, 5))
+    with torch.no_grad():
+        _, state, log_probs = lm.predict(ys, None)
+        _, state_shortlist, feats = lm.predict(ys, None, shortlist=True)
+        log_probs = log_probs[:, -1]
+        assert log_probs.max(-1)[0].exp().min() > 0.05
+        candidates[:, 0] = log_probs.argmax(-1)
+        log_probs_shortlist = lm.score_shortlist(feats[:, -1], candidates)
+    assert torch.equal(state['hxs'], state_shortlist['hxs'])
+    assert log_probs_shortlist.size() == (3, 5)
+    error = log_probs_shortlist - log_probs.gather(1, candidates)
+    if exact:
+        assert error.abs().max() < 1e-5
+    else:
+        # the error comes from the estimate of the partition function shared by candidates
+        assert torch.allclose(error, error[:, :1].expand_as(error), atol=1e-5)
+        # tokens out of the partition have enough mass, so dropping them (or not
+        # rescaling the sampled ones) would exceed the bound
+        n_head = lm.shortlist_partition_size
+        log_mass_tail = torch.logsumexp(log_probs[:, n_head:], dim=-1)
+        assert log_mass_tail.exp().min() > 0.1
+        assert error.abs().max() < 0.02
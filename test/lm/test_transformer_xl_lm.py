@@ -4,9 +4,11 @@
 """Test for Transformer-XL LM."""
 
 import argparse
+import copy
 import importlib
 import numpy as np
 import pytest
+import torch
 
 
 VOCAB = 100  # large for adaptive softmax
@@ -82,3 +84,62 @@ def test_forward(args):
     # assert loss.size(0) == 1
     assert loss.item() >= 0
     assert isinstance(observation, dict)
+
+
+@pytest.mark.parametrize(
+    "args", [
+        ({}),
+        ({'recog_mem_len': 7}),  # wrapped ring buffer
+        # NOTE: outputs of lower layers depend on the segment length with zero_center_offset
+        ({'n_layers': 1, 'zero_center_offset': True}),
+        ({'n_layers': 1, 'recog_mem_len': 7, 'zero_center_offset': True}),
+    ]
+)
+def test_decode_incremental(args):
+    args = make_args(**args)
+    bs, ylen = 3, 6
+
+    module = importlib.import_module('neural_sp.models.lm.transformer_xl')
+    lm = module.TransformerXL(args)
+    lm.eval()
+    # NOTE: attention weights are almost uniform with the default initialization
+    for n, p in lm.named_parameters():
+        if p.dim() > 1 or n in ['u_bias', 'v_bias']:
+            torch.nn.init.normal_(p, std=0.3)
+    with torch.no_grad():
+        # Write hidden states of previous segments into memory
+        mems = None
+        for _ in range(2):
+            ys_prev = torch.randint(4, VOCAB, (bs, 5))
+            mems = lm.decode(ys_prev, mems=mems)[2]
+        assert mems.length == min(10, lm.mem_len)
+
+        ys = torch.randint(4, VOCAB, (bs, ylen))
+        cache = None
+        for t in range(ylen):
+            logits, _, cache = lm.decode(ys[:, :t + 1], mems=mems, cache=cache, incremental=True)
+            assert cache[0].size() == (bs, t + 1, args.transformer_d_model * 2)
+
+            # Full recomputation of the prefix (memory is updated in place)
+            logits_full = lm.decode(ys[:, :t + 1], mems=copy.deepcopy(mems))[0]
+            assert torch.allclose(logits[:, -1], logits_full[:, -1], atol=1e-4)
+
+
+def test_update_memory():
+    args = make_args(recog_mem_len=7)
+    bs = 2
+
+    module = importlib.import_module('neural_sp.models.lm.transformer_xl')
+    lm = module.TransformerXL(args)
+    mems = None
+    hidden_states = []
+    for qlen in [3, 2, 4, 9, 1]:
+        h = [torch.randn(bs, qlen, args.transformer_d_model) for _ in range(args.n_layers)]
+        hidden_states.append(h)
+        buffer = None if mems is None else mems.buffer
+        mems = lm.update_memory(mems, h)
+        if buffer is not None:
+            assert mems.buffer is buffer  # updated in place
+        for lth in range(args.n_layers):
+            mem_ref = torch.cat([hs[lth] for hs in hidden_states], dim=1)[:, -lm.mem_len:]
+            assert torch.equal(mems[lth], mem_ref)
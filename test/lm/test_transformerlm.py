@@ -7,6 +7,7 @@ import argparse
 import importlib
 import numpy as np
 import pytest
+import torch
 
 
 VOCAB = 100  # large for adaptive softmax
@@ -33,6 +34,7 @@ def make_args(**kwargs):
         transformer_param_init='xavier_uniform',
         mem_len=0,
         recog_mem_len=0,
+        recog_lm_kv_cache_len=0,
         adaptive_softmax=False,
         tie_embedding=False,
     )
@@ -79,3 +81,33 @@ def test_forward(args):
     # assert loss.size(0) == 1
     assert loss.item() >= 0
     assert isinstance(observation, dict)
+
+
+@pytest.mark.parametrize(
+    "args", [
+        ({}),
+        ({'transformer_pe_type': 'none'}),
+        ({'transformer_pe_type': '1dconv3L'}),
+        ({'recog_lm_kv_cache_len': 3}),
+    ]
+)
+def test_predict_incremental(args):
+    args = make_args(**args)
+    device = "cpu"
+
+    module = importlib.import_module('neural_sp.models.lm.transformerlm')
+    lm = module.TransformerLM(args)
+    lm = lm.to(device)
+    lm.eval()
+
+    ys = torch.from_numpy(np.random.randint(0, VOCAB, (4, 8)).astype(np.int64))
+    with torch.no_grad():
+        _, _, log_probs_full = lm.predict(ys)
+        cache = None
+        for t in range(ys.size(1)):
+            _, cache, log_probs = lm.predict(ys[:, :t + 1], cache=cache)
+            if args.recog_lm_kv_cache_len > 0:
+                assert cache[0].size(1) <= args.recog_lm_kv_cache_len
+            if args.recog_lm_kv_cache_len == 0 or t < args.recog_lm_kv_cache_len:
+                # identical to the full computation until the oldest step is evicted
+                assert torch.allclose(log_probs[:, -1], log_probs_full[:, t], atol=1e-5)
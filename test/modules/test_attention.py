@@ -67,3 +67,52 @@ def test_forward(args):
         cv, aws, _, _ = out
         assert cv.size() == (batch_size, 1, value.size(2))
         assert aws.size() == (batch_size, 1, 1, klen)
+
+
+@pytest.mark.parametrize("lookahead", [0, 2])
+@pytest.mark.parametrize("triggered_key_projection", [False, True])
+def test_triggered_attention(lookahead, triggered_key_projection):
+    # raw keys are used in the attention space without the key projection
+    args = make_args(atype='triggered_attention', adim=16 if triggered_key_projection else 32,
+                     dropout=0., lookahead=lookahead,
+                     triggered_key_projection=triggered_key_projection)
+
+    batch_size = 4
+    klen = 40
+    klens = [40, 35, 20, 8]
+
+    key = torch.randn(batch_size, klen, args['kdim'])
+    value = torch.randn(batch_size, klen, args['kdim'])
+    src_mask = (torch.arange(klen).unsqueeze(0) < torch.tensor(klens).unsqueeze(1)).unsqueeze(1)
+    trigger_points = torch.IntTensor([[3, 5, 20],
+                                      [10, 12, 12],
+                                      [0, 4, 9],
+                                      [7, 7, 7]])
+
+    module = importlib.import_module('neural_sp.models.modules.attention')
+    attention = module.AttentionMechanism(**args)
+    attention.eval()
+    with torch.no_grad():
+        key_proj = attention.w_key(key) if triggered_key_projection else key
+        # trigger points are reused after the last step
+        for i in range(trigger_points.size(1) + 1):
+            query = torch.randn(batch_size, 1, args['qdim'])
+            cv, aws, _, _ = attention(key, value, query, mask=src_mask, cache=True,
+                                      trigger_points=trigger_points)
+            assert aws.size() == (batch_size, 1, 1, klen)
+
+            # reference: mask the right part from the trigger point per utterance
+            j = min(i, trigger_points.size(1) - 1)
+            tmp = key_proj.unsqueeze(1) + attention.w_query(query).unsqueeze(2)
+            e = attention.v(torch.tanh(tmp)).squeeze(3)
+            for b in range(batch_size):
+                e[b, :, trigger_points[b, j] + lookahead + 1:] = float('-inf')
+            e = e.masked_fill(src_mask == 0, float('-inf'))
+            aws_ref = torch.softmax(e, dim=-1)
+            assert torch.allclose(aws[:, 0], aws_ref, atol=1e-6)
+            assert torch.allclose(cv, torch.bmm(aws_ref, value), atol=1e-5)
+            for b in range(batch_size):
+                assert aws[b, 0, 0, min(klens[b], trigger_points[b, j] + lookahead + 1):].sum() == 0
+        # only the encoder prefix up to the right-most boundary is scored at each step
+        assert attention.windows == [min(klen, trigger_points[:, j].max().item() + lookahead + 1)
+                                     for j in range(trigger_points.size(1))]
@@ -60,26 +60,71 @@ def test_forward_parallel(args):
         ({'threshold': 0.9}),
     ]
 )
-def test_forward_incremental(args):
+def test_forward_parallel_batch(args):
     args = make_args(**args)
 
-    batch_size = 1
+    batch_size = 4
     xmax = 40
     ymax = 5
-    device = "cpu"
 
-    eouts = torch.FloatTensor(batch_size, xmax, args['enc_dim'], device=device)
-    elens = torch.IntTensor([len(x) for x in eouts])
+    eouts = torch.randn(batch_size, xmax, args['enc_dim'])
+    elens = torch.IntTensor([40, 35, 30, 20])
+    ylens = torch.IntTensor([5, 2, 4, 3])
+
+    module = importlib.import_module('neural_sp.models.modules.cif')
+    cif = module.CIF(**args)
+    cv, alpha, aws = cif(eouts, elens, ylens, mode='parallel')
+    assert cv.size() == (batch_size, ymax, args['enc_dim'])
+    for b in range(batch_size):
+        # each token integrates the weights up to the threshold
+        assert torch.allclose(aws[b, :ylens[b]].sum(1), torch.full((ylens[b],), args['threshold']), atol=1e-5)
+        assert (aws[b, ylens[b]:] == 0).all()
+        assert (aws[b, :, elens[b]:] == 0).all()
+        assert torch.allclose(aws[b].sum(0), alpha[b] / alpha[b].sum() * ylens[b] * args['threshold'], atol=1e-5)
+    assert torch.allclose(cv, torch.bmm(aws, eouts), atol=1e-5)
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ({'threshold': 1.0}),
+        ({'threshold': 0.9}),
+    ]
+)
+def test_forward_incremental(args):
+    # no context across chunks in 1dconv
+    args = make_args(window=1, **args)
+
+    batch_size = 4
+    xmax = 40
+    chunk_size = 7
+
+    eouts = torch.randn(batch_size, xmax, args['enc_dim'])
+    elens = torch.IntTensor([40, 35, 30, 20])
 
     module = importlib.import_module('neural_sp.models.modules.cif')
     cif = module.CIF(**args)
-    cif = cif.to(device)
     cif.eval()
 
-    for i in range(ymax):
-        out = cif(eouts, elens, mode='incremental')
-        assert len(out) == 3
-        cv, alpha, aws = out
-        assert cv.size() == (batch_size, 1, args['enc_dim'])
-        assert alpha.size() == (batch_size, xmax)
-        assert aws.size() == (batch_size, 1, xmax)
+    # whole utterances
+    with torch.no_grad():
+        cv_all, alpha, aws_all = cif(eouts, elens, mode='incremental', is_last_chunk=True)
+    n_tokens = cif.n_tokens
+    assert cv_all.size() == (batch_size, n_tokens.max(), args['enc_dim'])
+    assert aws_all.size() == (batch_size, n_tokens.max(), xmax)
+
+    # chunkwise streaming
+    cif.reset()
+    cvs = [[] for _ in range(batch_size)]
+    for t in range(0, xmax, chunk_size):
+        with torch.no_grad():
+            cv, alpha, aws = cif(eouts[:, t:t + chunk_size], torch.clamp(elens - t, 0, chunk_size),
+                                 mode='incremental', is_last_chunk=t + chunk_size >= xmax)
+        assert alpha.size() == (batch_size, min(chunk_size, xmax - t))
+        assert cv.size(1) == cif.n_tokens.max()
+        for b in range(batch_size):
+            cvs[b].append(cv[b, :cif.n_tokens[b]])
+    for b in range(batch_size):
+        cv_b = torch.cat(cvs[b], dim=0)
+        assert cv_b.size(0) == n_tokens[b]
+        assert torch.allclose(cv_b, cv_all[b, :n_tokens[b]], atol=1e-4)
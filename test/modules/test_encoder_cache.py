@@ -0,0 +1,174 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Test for encoder output cache."""
+
+import numpy as np
+import pytest
+import sys
+import torch
+
+from neural_sp.bin.args_asr import parse_args_train
+from neural_sp.models.seq2seq.encoder_cache import EncoderCache
+from neural_sp.models.seq2seq.speech2text import Speech2Text
+
+INPUT_DIM = 8
+VOCAB = 10
+
+
+@pytest.mark.parametrize("fp16", [False, True])
+def test_save_and_load(tmp_path, fp16):
+    cache = EncoderCache(str(tmp_path), fp16=fp16)
+    utt_ids = ['spk1-utt1', 'spk1/utt2']
+    xs = torch.randn(2, 10, 8)
+    xlens = torch.IntTensor([10, 6])
+
+    eouts, elens = cache.load(utt_ids, 'ys', 'eout', torch.device('cpu'))
+    assert eouts is None and elens is None
+    cache.save(utt_ids, 'ys', 'eout', xs, xlens)
+
+    eouts, elens = cache.load(utt_ids, 'ys', 'eout', torch.device('cpu'))
+    assert eouts.size() == (2, 10, 8)
+    assert elens.tolist() == [10, 6]
+    atol = 1e-2 if fp16 else 0
+    assert torch.allclose(eouts[0], xs[0], atol=atol)
+    assert torch.allclose(eouts[1, :6], xs[1, :6], atol=atol)
+    assert (eouts[1, 6:] == 0).all()
+
+    # partial hit falls back to encoding
+    eouts, _ = cache.load(utt_ids + ['spk1-utt3'], 'ys', 'eout', torch.device('cpu'))
+    assert eouts is None
+    assert cache.n_hits == 1
+    assert cache.n_misses == 2
+
+
+def make_model(monkeypatch, bwd_weight=0.):
+    argv = ['--enc_type', 'blstm', '--enc_n_units', '16', '--enc_n_projs', '0', '--enc_n_layers', '2',
+            '--subsample', '1_2', '--subsample_type', 'drop',
+            '--dec_type', 'lstm', '--dec_n_units', '16', '--dec_n_layers', '1', '--emb_dim', '8',
+            '--ctc_weight', '0.3', '--bwd_weight', str(bwd_weight), '--n_stacks', '1', '--n_skips', '1']
+    monkeypatch.setattr(sys, 'argv', ['train.py'] + argv)
+    args = parse_args_train(argv)
+    args.input_dim = INPUT_DIM
+    args.vocab = VOCAB
+    args.vocab_sub1 = 0
+    args.vocab_sub2 = 0
+
+    torch.manual_seed(0)
+    model = Speech2Text(args)
+    with torch.no_grad():
+        # avoid emitting <eos> at the first step
+        model.dec_fwd.output.bias[2] -= 5
+        if bwd_weight > 0:
+            model.dec_bwd.output.bias[2] -= 5
+    model.eval()
+    return model, vars(args).copy()
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        ({'recog_beam_width': 1}),
+        ({'recog_beam_width': 3, 'recog_ctc_weight': 0.5}),
+        ({'recog_beam_width': 1, 'recog_ctc_weight': 1.0}),
+        ({'recog_beam_width': 3, 'recog_ctc_weight': 1.0}),
+    ]
+)
+def test_decode(tmp_path, monkeypatch, params):
+    model, recog_params = make_model(monkeypatch)
+    recog_params.update(params)
+    xs = [np.random.randn(xmax, INPUT_DIM).astype(np.float32) for xmax in [40, 23, 31]]
+    utt_ids = ['utt1', 'utt2', 'utt3']
+    hyps_ref, _ = model.decode(xs, recog_params, None, exclude_eos=True)
+
+    model.encoder_cache = EncoderCache(str(tmp_path))
+    hyps, _ = model.decode(xs, recog_params, None, exclude_eos=True, utt_ids=utt_ids)
+    assert model.encoder_cache.n_hits == 0
+
+    # neither the encoder nor the CTC layer is run when hitting the cache
+    def fail(*args, **kwargs):
+        raise RuntimeError('not cached')
+    monkeypatch.setattr(model.enc, 'forward', fail)
+    monkeypatch.setattr(model.dec_fwd.ctc.output, 'forward', fail)
+    hyps_cache, _ = model.decode(xs, recog_params, None, exclude_eos=True, utt_ids=utt_ids)
+    # CTC posteriors are cached in joint CTC/attention beam search and CTC-only decoding
+    use_ctc = recog_params['recog_ctc_weight'] == 1 or \
+        (recog_params['recog_ctc_weight'] > 0 and recog_params['recog_beam_width'] > 1)
+    assert model.encoder_cache.n_hits == (2 if use_ctc else 1)
+    assert model.encoder_cache.hit_rate == 0.5
+
+    for b in range(len(xs)):
+        assert hyps[b].tolist() == hyps_ref[b].tolist()
+        assert hyps_cache[b].tolist() == hyps_ref[b].tolist()
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        ({'recog_beam_width': 1}),
+        ({'recog_beam_width': 3, 'recog_ctc_weight': 0.5}),
+        ({'recog_beam_width': 3, 'recog_ctc_weight': 0.5, 'recog_fwd_bwd_attention': True}),
+    ]
+)
+def test_decode_blank_skip(tmp_path, monkeypatch, params):
+    fwd_bwd = params.get('recog_fwd_bwd_attention', False)
+    model, recog_params = make_model(monkeypatch, bwd_weight=0.5 if fwd_bwd else 0.)
+    recog_params.update(params)
+    recog_params['recog_ctc_blank_skip_margin'] = 0
+    with torch.no_grad():
+        # blank-dominant CTC posteriors
+        model.dec_fwd.ctc.output.bias[model.dec_fwd.blank] += 4
+    xs = [np.random.randn(xmax, INPUT_DIM).astype(np.float32) for xmax in [40, 23, 31]]
+    utt_ids = ['utt1', 'utt2', 'utt3']
+
+    # record encoder outputs fed to attention decoders
+    decs = [model.dec_fwd, model.dec_bwd] if fwd_bwd else [model.dec_fwd]
+    fn_name = 'greedy' if recog_params['recog_beam_width'] == 1 else 'beam_search'
+    if fwd_bwd:
+        fn_name = 'beam_search_steps'  # both directions are decoded in lockstep
+    inputs = []
+    for dec in decs:
+        def spy(eouts, elens, *args, fn=getattr(dec, fn_name), **kwargs):
+            inputs.append((eouts, elens))
+            return fn(eouts, elens, *args, **kwargs)
+        monkeypatch.setattr(dec, fn_name, spy)
+
+    # no frame is skipped with a threshold larger than one
+    hyps_ref, _ = model.decode(xs, recog_params, None, exclude_eos=True)
+    recog_params['recog_ctc_blank_skip_threshold'] = 1.1
+    hyps_all, _ = model.decode(xs, recog_params, None, exclude_eos=True)
+    for b in range(len(xs)):
+        assert hyps_all[b].tolist() == hyps_ref[b].tolist()
+
+    recog_params['recog_ctc_blank_skip_threshold'] = 0.5
+    with torch.no_grad():
+        eout_dict = model.encode(xs, 'ys')
+        eouts, elens = eout_dict['ys']['xs'], eout_dict['ys']['xlens']
+        eouts_skip, elens_skip, keep = model.dec_fwd.skip_blank_frames(
+            eouts, elens, 0.5, margin=0)
+    assert 0 < elens_skip.sum() < elens.sum()
+
+    inputs.clear()
+    hyps, aws = model.decode(xs, recog_params, None, exclude_eos=True)
+    assert len(inputs) == len(decs)
+    for eouts_dec, elens_dec in inputs:
+        assert torch.equal(elens_dec, elens_skip)
+        assert torch.equal(eouts_dec, eouts_skip)
+    if fwd_bwd:
+        assert aws is None
+    else:
+        # attention weights are mapped back to the original frames
+        for b in range(len(xs)):
+            aw = aws[b] if fn_name == 'greedy' else aws[b][0]
+            assert aw.shape[-1] == eouts.size(1)
+            assert (aw[..., ~keep[b].numpy()] == 0).all()
+            assert np.allclose(aw[..., keep[b].numpy()].sum(-1), 1, atol=1e-5)
+
+    # cached CTC posteriors cover all frames, so they are not used with blank skipping
+    model.encoder_cache = EncoderCache(str(tmp_path))
+    model.decode(xs, recog_params, None, exclude_eos=True, utt_ids=utt_ids)
+    monkeypatch.setattr(model.enc, 'forward', lambda *args, **kwargs: pytest.fail('not cached'))
+    hyps_cache, _ = model.decode(xs, recog_params, None, exclude_eos=True, utt_ids=utt_ids)
+    assert model.encoder_cache.n_hits == 1
+    for b in range(len(xs)):
+        assert hyps_cache[b].tolist() == hyps[b].tolist()
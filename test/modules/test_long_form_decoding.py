@@ -0,0 +1,74 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Test for long-form decoding with CTC-based segmentation."""
+
+import numpy as np
+import pytest
+import sys
+import torch
+
+from neural_sp.bin.args_asr import parse_args_train
+from neural_sp.models.seq2seq.speech2text import Speech2Text
+
+INPUT_DIM = 8
+VOCAB = 10
+
+
+def make_model(monkeypatch):
+    argv = ['--enc_type', 'blstm', '--enc_n_units', '16', '--enc_n_projs', '0', '--enc_n_layers', '2',
+            '--subsample', '1_2', '--subsample_type', 'drop',
+            '--dec_type', 'lstm', '--dec_n_units', '16', '--dec_n_layers', '1', '--emb_dim', '8',
+            '--ctc_weight', '0.3', '--n_stacks', '1', '--n_skips', '1']
+    monkeypatch.setattr(sys, 'argv', ['train.py'] + argv)
+    args = parse_args_train(argv)
+    args.input_dim = INPUT_DIM
+    args.vocab = VOCAB
+    args.vocab_sub1 = 0
+    args.vocab_sub2 = 0
+
+    torch.manual_seed(0)
+    model = Speech2Text(args)
+    with torch.no_grad():
+        # avoid emitting <eos> at the first step
+        model.dec_fwd.output.bias[2] -= 5
+    return model, vars(args).copy()
+
+
+@pytest.mark.parametrize(
+    "recog_ctc_weight",
+    [0.0, 0.5]
+)
+def test_decode_long_form(monkeypatch, recog_ctc_weight):
+    model, params = make_model(monkeypatch)
+    params.update(recog_beam_width=3, recog_ctc_weight=recog_ctc_weight, recog_nbest_export=True,
+                  recog_long_form_block_size=200, recog_long_form_max_segment_frames=120,
+                  recog_ctc_vad_blank_threshold=40, recog_ctc_vad_spike_threshold=0.1)
+    xs = [np.random.randn(xmax, INPUT_DIM).astype(np.float32) for xmax in [1001, 333, 57, 640]]
+
+    # reference: decode segments one by one
+    params['recog_batch_size'] = 1
+    hyps_ref, segments_ref = model.decode_long_form(xs, params, None, exclude_eos=True)
+    assert sum(len(s) for s in segments_ref) > len(xs)
+    for x, segments in zip(xs, segments_ref):
+        assert (segments[:, 1] - segments[:, 0] <= 120).all()
+        assert (segments[:, 0] >= 0).all() and (segments[:, 1] <= len(x)).all()
+        assert (segments[1:, 0] >= segments[:-1, 1]).all()
+
+    # the result does not depend on how segments are batchfied
+    params['recog_batch_size'] = 4
+    hyps, segments = model.decode_long_form(xs, params, None, exclude_eos=True)
+    for b in range(len(xs)):
+        assert np.array_equal(segments[b], segments_ref[b])
+        assert hyps[b].tolist() == hyps_ref[b].tolist()
+    assert sum(len(h) for h in hyps) > 0
+    # N-best lists of segments are not exposed as those of recordings
+    assert model.nbest_components is None
+
+    # state carry-over decodes segments in the chronological order of each recording
+    params.update(recog_batch_size=4, recog_asr_state_carry_over=True)
+    hyps_co, segments_co = model.decode_long_form(xs, params, None, exclude_eos=True,
+                                                  speakers=[str(b) for b in range(len(xs))])
+    for b in range(len(xs)):
+        assert np.array_equal(segments_co[b], segments_ref[b])
+        assert hyps_co[b].dtype == np.int64
@@ -174,3 +174,62 @@ def test_forward_hard(args):
         if args['chunk_size'] > 1:
             assert beta is not None
             assert beta.size() == (batch_size, args['n_heads_mono'] * args['n_heads_chunk'], 1, klen)
+
+
+def test_recursive_parallel_equivalence():
+    batch_size, n_heads, qlen, klen = 3, 4, 6, 50
+
+    module = importlib.import_module('neural_sp.models.modules.mocha')
+    mocha = module.MoChA(**make_args(n_heads_mono=n_heads, atype='scaled_dot', noise_std=0., eps=1e-10))
+    # keep the cumulative product above eps so that `parallel` is exact
+    e_ma = torch.randn(batch_size, n_heads, qlen, klen, dtype=torch.float64) - 3
+    aw_prev = e_ma.new_zeros(batch_size, n_heads, 1, klen)
+    aw_prev[:, :, :, 0] = 1
+
+    alpha_rec, _ = mocha.recursive(e_ma, aw_prev)
+    alpha_par, _ = mocha.parallel(e_ma, aw_prev, None)
+    assert torch.allclose(alpha_rec, alpha_par, atol=1e-6)
+
+    # reference recurrence over key frames for each query
+    p_choose = torch.sigmoid(e_ma)
+    for i in range(qlen):
+        q = e_ma.new_zeros(batch_size, n_heads, klen + 1)
+        for j in range(klen):
+            shifted_1mp = 1 if j == 0 else 1 - p_choose[:, :, i, j - 1]
+            q[:, :, j + 1] = shifted_1mp * q[:, :, j] + aw_prev[:, :, 0, j]
+        aw_prev = p_choose[:, :, i:i + 1] * q[:, :, None, 1:]
+        assert torch.allclose(alpha_rec[:, :, i:i + 1], aw_prev, atol=1e-10)
+
+    # gradients stay finite even for saturated energies
+    e_ma = (torch.randn(batch_size, n_heads, qlen, klen) * 30).requires_grad_()
+    aw_prev = e_ma.new_zeros(batch_size, n_heads, 1, klen)
+    aw_prev[:, :, :, 0] = 1
+    alpha_rec, _ = mocha.recursive(e_ma, aw_prev)
+    alpha_rec.sum().backward()
+    assert torch.isfinite(e_ma.grad).all()
+
+
+@pytest.mark.parametrize("eps_wait", [1, 2, 5])
+def test_head_synchronous_boundary(eps_wait):
+    batch_size, n_heads, klen = 8, 4, 20
+    module = importlib.import_module('neural_sp.models.modules.mocha')
+
+    torch.manual_seed(0)
+    boundary = torch.randint(-1, klen, (batch_size, n_heads))
+    boundary[0] = -1  # no boundary for all heads
+    alpha = (torch.arange(klen).view(1, 1, klen) == boundary.unsqueeze(2)).float().unsqueeze(2)
+    out = module.head_synchronous_boundary(alpha.clone(), eps_wait)
+
+    # reference implementation per utterance and head
+    for b in range(batch_size):
+        ref = alpha[b].clone()
+        if ref.sum() > 0:
+            leftmost = ref[:, -1].nonzero()[:, -1].min().item()
+            rightmost = ref[:, -1].nonzero()[:, -1].max().item()
+            for h in range(n_heads):
+                if ref[h, -1].sum().item() == 0:
+                    ref[h, -1, min(rightmost, leftmost + eps_wait)] = 1
+                elif ref[h, -1].nonzero()[:, -1].min().item() >= leftmost + eps_wait:
+                    ref[h, -1, :] = 0
+                    ref[h, -1, leftmost + eps_wait] = 1
+        assert torch.equal(out[b], ref)
@@ -0,0 +1,198 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Test for the recognition server with dynamic request batching."""
+
+import io
+import json
+import numpy as np
+import pytest
+import sys
+import threading
+import time
+import torch
+import urllib.error
+import urllib.request
+
+from neural_sp.bin.args_asr import parse_args_train
+from neural_sp.bin.server_utils import DynamicBatcher
+from neural_sp.bin.server_utils import RecognitionServer
+from neural_sp.bin.server_utils import ServerMetrics
+from neural_sp.models.seq2seq.speech2text import Speech2Text
+
+INPUT_DIM = 40
+VOCAB = 10
+
+
+def make_model(monkeypatch, mode):
+    argv = ['--enc_type', 'blstm', '--enc_n_units', '16', '--enc_n_projs', '0', '--enc_n_layers', '2',
+            '--subsample', '1_2', '--subsample_type', 'drop',
+            '--dec_type', 'lstm', '--dec_n_units', '16', '--dec_n_layers', '1', '--emb_dim', '8',
+            '--n_stacks', '1', '--n_skips', '1', '--recog_ctc_vad', 'false']
+    if mode == 'streaming':
+        argv += ['--lc_chunk_size_left', '40', '--lc_chunk_size_right', '20', '--ctc_weight', '0.3',
+                 '--attn_type', 'mocha', '--attn_dim', '16', '--mocha_chunk_size', '4', '--mocha_init_r', '0.5',
+                 '--recog_streaming', 'true', '--recog_chunk_sync', 'true', '--recog_beam_width', '2']
+    elif mode == 'joint':
+        # joint CTC/attention beam search
+        argv += ['--ctc_weight', '0.3', '--recog_beam_width', '3', '--recog_ctc_weight', '0.5']
+    else:
+        argv += ['--ctc_weight', '1.0', '--recog_beam_width', '1', '--recog_ctc_weight', '1.0']
+    monkeypatch.setattr(sys, 'argv', ['train.py'] + argv)
+    args = parse_args_train(argv)
+    args.input_dim = INPUT_DIM
+    args.vocab = VOCAB
+    args.vocab_sub1 = 0
+    args.vocab_sub2 = 0
+
+    torch.manual_seed(0)
+    model = Speech2Text(args)
+    if mode in ['streaming', 'joint']:
+        with torch.no_grad():
+            # avoid emitting <eos> at the first step
+            model.dec_fwd.output.bias[2] -= 5
+    return model, vars(args).copy()
+
+
+def idx2token(ids):
+    return ' '.join(map(str, ids))
+
+
+def post(url, x):
+    f = io.BytesIO()
+    np.save(f, x)
+    request = urllib.request.Request(url + '/recognize', data=f.getvalue(), method='POST')
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def get_metrics(url):
+    with urllib.request.urlopen(url + '/metrics') as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def run_clients(url, xs):
+    results = [None] * len(xs)
+
+    def client(b):
+        results[b] = post(url, xs[b])
+
+    threads = [threading.Thread(target=client, args=(b,)) for b in range(len(xs))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+@pytest.mark.parametrize(
+    "max_batch_size,max_latency",
+    [(4, 0.2), (3, 0.01), (1, 0.)]
+)
+def test_dynamic_batcher(max_batch_size, max_latency):
+    batch_sizes = []
+
+    def decode_fn(xs):
+        batch_sizes.append(len(xs))
+        time.sleep(0.01)
+        return [x[:, 0].astype(np.int64) for x in xs]
+
+    metrics = ServerMetrics()
+    batcher = DynamicBatcher(decode_fn, max_batch_size, max_latency, metrics)
+    batcher.start()
+    xs = [np.full((n_frames, 2), b) for b, n_frames in enumerate(range(10, 20))]
+    results = [None] * len(xs)
+
+    def client(b):
+        results[b] = batcher.submit(xs[b])
+
+    threads = [threading.Thread(target=client, args=(b,)) for b in range(len(xs))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    batcher.stop()
+
+    for b, r in enumerate(results):
+        assert r.hyp.tolist() == [b] * len(xs[b])
+        assert 1 <= r.batch_size <= max_batch_size
+        assert r.queue_delay >= 0
+    assert max(batch_sizes) <= max_batch_size
+    assert sum(batch_sizes) == len(xs)
+    if max_batch_size > 1 and max_latency >= 0.2:
+        # concurrent requests are batched
+        assert len(batch_sizes) < len(xs)
+
+    report = metrics.report()
+    assert report['n_requests'] == len(xs)
+    assert report['n_batches'] == len(batch_sizes)
+    assert report['avg_batch_size'] == len(xs) / len(batch_sizes)
+    assert report['rtf'] > 0
+    assert report['throughput'] > 0
+    assert 0 <= report['avg_queue_delay'] <= report['max_queue_delay']
+
+
+def test_dynamic_batcher_error():
+
+    def decode_fn(xs):
+        raise RuntimeError('decoding failed')
+
+    batcher = DynamicBatcher(decode_fn, 2, 0.)
+    batcher.start()
+    with pytest.raises(RuntimeError):
+        batcher.submit(np.zeros((10, 2)))
+    batcher.stop()
+
+
+@pytest.mark.parametrize(
+    "mode",
+    ['ctc', 'joint', 'streaming']
+)
+def test_server(monkeypatch, mode):
+    model, params = make_model(monkeypatch, mode)
+    xs = [np.random.randn(xmax, INPUT_DIM).astype(np.float32) for xmax in [333, 57, 401, 200, 120, 98]]
+
+    # reference: decode one by one
+    hyps_ref = []
+    for x in xs:
+        if mode == 'streaming':
+            model.dec_fwd.score.reset()
+            hyps_ref.append(model.decode_streaming([x], params, idx2token, exclude_eos=True)[0][0])
+        else:
+            hyps_ref.append(model.decode([x], params, None, exclude_eos=True)[0][0])
+
+    server = RecognitionServer(model, params, idx2token, port=0, max_batch_size=4, max_latency=0.2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = 'http://%s:%d' % server.server_address[:2]
+    try:
+        results = run_clients(url, xs)
+        for r, x, hyp_ref in zip(results, xs, hyps_ref):
+            assert r['hyp'] == list(hyp_ref)
+            assert r['text'] == idx2token(hyp_ref)
+            assert r['n_frames'] == len(x)
+            assert 1 <= r['batch_size'] <= 4
+        assert max(r['batch_size'] for r in results) > 1
+        assert sum(len(r['hyp']) for r in results) > 0
+
+        # waveform request
+        wav = np.random.RandomState(0).randint(-1000, 1000, size=16000).astype(np.int16)
+        r = post(url, wav)
+        assert r['n_frames'] == 98
+
+        # invalid requests
+        with pytest.raises(urllib.error.HTTPError) as e:
+            post(url, np.zeros((10, INPUT_DIM + 1)))
+        assert e.value.code == 400
+        with pytest.raises(urllib.error.HTTPError) as e:
+            urllib.request.urlopen(url + '/unknown')
+        assert e.value.code == 404
+
+        metrics = get_metrics(url)
+        assert metrics['n_requests'] == len(xs) + 1
+        assert metrics['n_batches'] < len(xs) + 1
+        assert metrics['rtf'] > 0
+        assert metrics['audio_throughput'] > 0
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,110 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Test for batched streaming inference over multiple sessions."""
+
+import numpy as np
+import pytest
+import sys
+import torch
+
+from neural_sp.bin.args_asr import parse_args_train
+from neural_sp.models.seq2seq.speech2text import Speech2Text
+from neural_sp.models.seq2seq.streaming_engine import StreamingEngine
+
+INPUT_DIM = 8
+VOCAB = 10
+
+
+def make_model(monkeypatch, dec_type, ctc_weight):
+    argv = ['--enc_type', 'blstm', '--enc_n_units', '16', '--enc_n_projs', '0', '--enc_n_layers', '2',
+            '--subsample', '1_2', '--subsample_type', 'drop',
+            '--lc_chunk_size_left', '40', '--lc_chunk_size_right', '20',
+            '--dec_type', dec_type, '--dec_n_units', '16', '--dec_n_layers', '1', '--emb_dim', '8',
+            '--ctc_weight', str(ctc_weight), '--n_stacks', '1', '--n_skips', '1']
+    if dec_type == 'lstm':
+        argv += ['--attn_type', 'mocha', '--attn_dim', '16', '--mocha_chunk_size', '4', '--mocha_init_r', '0.5']
+    monkeypatch.setattr(sys, 'argv', ['train.py'] + argv)
+    args = parse_args_train(argv)
+    args.input_dim = INPUT_DIM
+    args.vocab = VOCAB
+    args.vocab_sub1 = 0
+    args.vocab_sub2 = 0
+
+    torch.manual_seed(0)
+    model = Speech2Text(args)
+    with torch.no_grad():
+        if dec_type == 'lstm' and ctc_weight < 1:
+            # avoid emitting <eos> at the first step
+            model.dec_fwd.output.bias[2] -= 5
+            # segment by CTC-based VAD occasionally
+            model.dec_fwd.ctc.output.bias[0] += 2
+    return model, vars(args).copy()
+
+
+def feed_randomly(engine, xs, seed=0):
+    """Feed input features to sessions by random lengths while decoding."""
+    rng = np.random.RandomState(seed)
+    session_ids = [engine.open() for _ in xs]
+    offsets = [0] * len(xs)
+    while any(offset < len(x) for offset, x in zip(offsets, xs)):
+        for b, x in enumerate(xs):
+            if offsets[b] < len(x):
+                n_frames = rng.randint(1, 50)
+                engine.feed(session_ids[b], x[offsets[b]:offsets[b] + n_frames],
+                            is_final=offsets[b] + n_frames >= len(x))
+                offsets[b] += n_frames
+        engine.step()
+    return [engine.close(session_id) for session_id in session_ids]
+
+
+@pytest.mark.parametrize(
+    "ctc_vad,recog_ctc_weight",
+    [(False, 0.0), (True, 0.0), (True, 0.3)]
+)
+def test_chunk_sync(monkeypatch, ctc_vad, recog_ctc_weight):
+    model, params = make_model(monkeypatch, 'lstm', 0.3)
+    params.update(recog_beam_width=2, recog_chunk_sync=True,
+                  recog_ctc_vad=ctc_vad, recog_ctc_vad_n_accum_frames=0,
+                  recog_ctc_weight=recog_ctc_weight)
+    xs = [np.random.randn(xmax, INPUT_DIM).astype(np.float32) for xmax in [333, 57, 401, 200]]
+
+    hyps_ref = []
+    for x in xs:
+        model.dec_fwd.score.reset()
+        hyps_ref.append(model.decode_streaming([x], params, lambda ids: '')[0][0])
+
+    engine = StreamingEngine(model, params)
+    hyps = engine.decode(xs)
+    assert [h.tolist() for h in hyps] == [list(h) for h in hyps_ref]
+
+    # results do not depend on how input features are fed and batchfied
+    engine = StreamingEngine(model, params, max_batch_size=3)
+    hyps = feed_randomly(engine, xs)
+    assert [h.tolist() for h in hyps] == [list(h) for h in hyps_ref]
+    assert len(engine.sessions) == 0
+
+
+@pytest.mark.parametrize(
+    "dec_type,ctc_weight,recog_ctc_weight",
+    [('lstm_transducer', 0.3, 0.0), ('lstm', 1.0, 1.0)]
+)
+def test_greedy(monkeypatch, dec_type, ctc_weight, recog_ctc_weight):
+    model, params = make_model(monkeypatch, dec_type, ctc_weight)
+    params.update(recog_beam_width=1, recog_ctc_vad=False, recog_ctc_weight=recog_ctc_weight)
+    xs = [np.random.randn(xmax, INPUT_DIM).astype(np.float32) for xmax in [333, 57, 401, 200]]
+
+    model.eval()
+    hyps_ref = []
+    with torch.no_grad():
+        for x in xs:
+            eout_dict = model.encode([x], 'ys')['ys']
+            if dec_type == 'lstm_transducer':
+                hyps_ref.append(model.dec_fwd.greedy(eout_dict['xs'], eout_dict['xlens'], 1.0, None)[0][0])
+            else:
+                hyps_ref.append(model.dec_fwd.ctc.greedy(eout_dict['xs'], eout_dict['xlens'])[0].tolist())
+
+    engine = StreamingEngine(model, params)
+    hyps = feed_randomly(engine, xs)
+    assert [h.tolist() for h in hyps] == hyps_ref
+    assert sum(len(h) for h in hyps) > 0
@@ -0,0 +1,164 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Test for session-based streaming recognition API."""
+
+import numpy as np
+import pytest
+import sys
+import torch
+
+from neural_sp.bin.args_asr import parse_args_train
+from neural_sp.models.seq2seq.speech2text import Speech2Text
+from neural_sp.models.seq2seq.streaming_engine import StreamingEngine
+from neural_sp.models.seq2seq.streaming_recognizer import common_prefix_length
+from neural_sp.models.seq2seq.streaming_recognizer import StreamingRecognizer
+
+INPUT_DIM = 8
+VOCAB = 10
+
+
+def make_model(monkeypatch, dec_type, ctc_weight, input_dim=INPUT_DIM):
+    argv = ['--enc_type', 'blstm', '--enc_n_units', '16', '--enc_n_projs', '0', '--enc_n_layers', '2',
+            '--subsample', '1_2', '--subsample_type', 'drop',
+            '--lc_chunk_size_left', '40', '--lc_chunk_size_right', '20',
+            '--dec_type', dec_type, '--dec_n_units', '16', '--dec_n_layers', '1', '--emb_dim', '8',
+            '--ctc_weight', str(ctc_weight), '--n_stacks', '1', '--n_skips', '1']
+    if dec_type == 'lstm':
+        argv += ['--attn_type', 'mocha', '--attn_dim', '16', '--mocha_chunk_size', '4', '--mocha_init_r', '0.5']
+    monkeypatch.setattr(sys, 'argv', ['train.py'] + argv)
+    args = parse_args_train(argv)
+    args.input_dim = input_dim
+    args.vocab = VOCAB
+    args.vocab_sub1 = 0
+    args.vocab_sub2 = 0
+
+    torch.manual_seed(0)
+    model = Speech2Text(args)
+    with torch.no_grad():
+        if dec_type == 'lstm' and ctc_weight < 1:
+            # avoid emitting <eos> at the first step
+            model.dec_fwd.output.bias[2] -= 5
+            model.dec_fwd.ctc.output.bias[0] += 2
+    return model, vars(args).copy()
+
+
+def idx2token(ids):
+    return ' '.join(map(str, ids))
+
+
+def push_randomly(recognizer, x, seed=0):
+    rng = np.random.RandomState(seed)
+    session_id = recognizer.open()
+    results, offset = [], 0
+    while offset < len(x):
+        n_frames = rng.randint(1, 50)
+        results += recognizer.push_features(session_id, x[offset:offset + n_frames],
+                                            is_final=offset + n_frames >= len(x))
+        offset += n_frames
+    return session_id, results
+
+
+def check_results(results):
+    """Check consistency of partial and final results."""
+    segment = 0
+    hyp_prev, n_stable_prev = [], 0
+    for r in results:
+        assert r['segment'] == segment
+        assert 0 <= r['n_stable'] <= len(r['hyp'])
+        assert r['text'] == idx2token(r['hyp'])
+        hyp = r['hyp'].tolist()
+        # stable tokens are never changed
+        assert hyp[:n_stable_prev] == hyp_prev[:n_stable_prev]
+        if r['is_final']:
+            assert r['n_stable'] == len(hyp)
+            segment += 1
+            hyp_prev, n_stable_prev = [], 0
+        else:
+            hyp_prev, n_stable_prev = hyp, r['n_stable']
+    assert results[-1]['is_final']
+
+
+def test_common_prefix_length():
+    assert common_prefix_length([[1, 2, 3], [1, 2, 4], [1, 2]]) == 2
+    assert common_prefix_length([[1, 2, 3], [2]]) == 0
+    assert common_prefix_length([[1, 2, 3]]) == 3
+    assert common_prefix_length([[], [1]]) == 0
+
+
+@pytest.mark.parametrize(
+    "dec_type,ctc_weight,params",
+    [('lstm', 0.3, {'recog_beam_width': 2, 'recog_chunk_sync': True, 'recog_ctc_vad': True}),
+     ('lstm', 0.3, {'recog_beam_width': 2, 'recog_chunk_sync': True, 'recog_ctc_vad': False}),
+     ('lstm_transducer', 0.3, {'recog_beam_width': 1, 'recog_ctc_vad': False}),
+     ('lstm', 1.0, {'recog_beam_width': 1, 'recog_ctc_vad': False, 'recog_ctc_weight': 1.0})]
+)
+def test_partial_results(monkeypatch, dec_type, ctc_weight, params):
+    model, _params = make_model(monkeypatch, dec_type, ctc_weight)
+    _params.update(recog_ctc_vad_n_accum_frames=0)
+    _params.update(params)
+    xs = [np.random.randn(xmax, INPUT_DIM).astype(np.float32) for xmax in [333, 57, 401]]
+
+    hyps_ref = StreamingEngine(model, _params).decode(xs)
+
+    recognizer = StreamingRecognizer(model, _params, idx2token)
+    for x, hyp_ref in zip(xs, hyps_ref):
+        session_id, results = push_randomly(recognizer, x)
+        check_results(results)
+        # concatenation of final results is the same as the offline streaming decoding
+        hyp = sum([r['hyp'].tolist() for r in results if r['is_final']], [])
+        assert hyp == hyp_ref.tolist()
+
+        stats = recognizer.latency(session_id)
+        assert stats['n_frames'] == len(x)
+        assert stats['n_segments'] == sum(r['is_final'] for r in results)
+        assert stats['finalization_latency'] >= 0
+        if len(hyp) > 0:
+            assert 0 < stats['first_token_frame'] <= len(x)
+            assert stats['first_token_latency'] >= 0
+    assert len(recognizer.sessions) == 0
+    assert len(recognizer.engine.sessions) == 0
+
+
+def test_endpointing(monkeypatch):
+    model, params = make_model(monkeypatch, 'lstm', 1.0)
+    params.update(recog_beam_width=1, recog_ctc_vad=False, recog_ctc_weight=1.0)
+    x = np.random.randn(1000, INPUT_DIM).astype(np.float32)
+
+    recognizer = StreamingRecognizer(model, params, idx2token)
+    _, results = push_randomly(recognizer, x)
+    n_segments = sum(r['is_final'] for r in results)
+
+    # segment at most every 200 frames
+    recognizer = StreamingRecognizer(model, params, idx2token, endpoint_max_segment_frames=200)
+    session_id, results_ep = push_randomly(recognizer, x)
+    check_results(results_ep)
+    assert sum(r['is_final'] for r in results_ep) > n_segments
+    assert recognizer.latency(session_id)['n_segments'] > 1
+
+    # multiple sessions in parallel
+    session_ids = [recognizer.open() for _ in range(3)]
+    results = {session_id: [] for session_id in session_ids}
+    for offset in range(0, len(x), 100):
+        for session_id in session_ids:
+            results[session_id] += recognizer.push_features(session_id, x[offset:offset + 100])
+    for session_id in session_ids:
+        results[session_id] += recognizer.close(session_id)
+        check_results(results[session_id])
+        assert [r['hyp'].tolist() for r in results[session_id] if r['is_final']] == \
+            [r['hyp'].tolist() for r in results_ep if r['is_final']]
+
+
+def test_push_waveform(monkeypatch):
+    model, params = make_model(monkeypatch, 'lstm', 1.0, input_dim=40)
+    params.update(recog_beam_width=1, recog_ctc_vad=False, recog_ctc_weight=1.0)
+    wav = np.random.RandomState(0).randint(-1000, 1000, size=16000 * 3)
+
+    recognizer = StreamingRecognizer(model, params, idx2token, fbank_conf={'n_mels': 40})
+    session_id = recognizer.open()
+    results = []
+    for offset in range(0, len(wav), 1600):
+        results += recognizer.push_waveform(session_id, wav[offset:offset + 1600],
+                                            is_final=offset + 1600 >= len(wav))
+    check_results(results)
+    assert recognizer.latency(session_id)['n_frames'] == 1 + (len(wav) - 400) // 160